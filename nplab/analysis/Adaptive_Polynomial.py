@@ -1,5 +1,5 @@
 """
-Program to iteratively remove a non-trivial background from a spectrum of peaks. Note that this is not a rapid process.
+Program to iteratively remove a non-trivial background from a spectrum of peaks. Many spectra can be processed together with Run_Batch.
 
 Author: Jack Griffiths 2017
 
@@ -16,15 +16,28 @@ the fit. These are used as weights for the next round of fitting. This continues
 import numpy as np
 import scipy.stats as stat
 
+_Design_Cache={}
+
+def Design(Length,Degree):
+	"""
+	Returns the polynomial design matrix for x=range(Length), with its columns (highest power first) scaled to unit length, the column
+	scales, and the reduced QR decomposition of the scaled matrix. These only depend on Length and Degree, so are cached.
+	"""
+	if (Length,Degree) not in _Design_Cache:
+		Matrix=np.vander(np.arange(Length,dtype=float),Degree+1)
+		Scales=np.sqrt(np.sum(np.square(Matrix),axis=0))
+		Scales[Scales==0]=1.
+		Matrix/=Scales
+		Q,R=np.linalg.qr(Matrix)
+		_Design_Cache[(Length,Degree)]=(Matrix,Scales,Q,R)
+	return _Design_Cache[(Length,Degree)]
+
 def Find_Weights(Background,Data):
 	"""
 	Given a background fit (Background) and a spectrum (Data), calculates the probabilities for seeing the number of counts observed or greater
-	at each wavelength assuming they are Poisson distributed with means at the background fit value.
+	at each wavelength assuming they are Poisson distributed with means at the background fit value. Works on arrays of any shape.
 	"""
-	Weights=[]
-	for i in range(len(Background)):
-		Weights.append(1-stat.poisson.cdf(Data[i],Background[i]))
-	return Weights
+	return stat.poisson.sf(Data,Background)
 
 def Iterative_Step(Data,Current_Params,Degree,Return_BG=False):
 	"""
@@ -36,60 +49,99 @@ def Iterative_Step(Data,Current_Params,Degree,Return_BG=False):
 	INPUT coefficents is also returned.
 	"""
 
-	Background=np.polyval(Current_Params,range(len(Data)))
+	Data=np.asarray(Data,dtype=float)
+	Matrix,Scales,Q,R=Design(len(Data),Degree)
+
+	Background=np.dot(Matrix,np.asarray(Current_Params)*Scales)
 	Background*=(Background>0)  #For a Poisson distribution, negative values are meaningless
 
 	Weights=Find_Weights(Background,Data)
-	
-	Poly_Params=np.polyfit(range(len(Data)),Data,Degree,w=Weights)
+
+	Poly_Params=np.linalg.lstsq(Matrix*Weights[:,np.newaxis],Data*Weights,rcond=None)[0]/Scales
 
 	if Return_BG is False:
 		return Poly_Params
 	else:
 		return Poly_Params,Background
 
-def Run(Data,Degree,Threshold=0.0001,Max_Steps=None,Auto_Remove=True):
+def Weighted_Fits(Array,Weights,Q):
 	"""
-	Main function that completes the background subtraction. 
-
-	Data=1D array for spectrum. Degree is the polynomial degree to fit. The initial sum squared difference between the first two backgrounds is 
-	calculated. The function returns when this sum between two successive background fits is less than Threshold*the original difference. If
-	Max_Steps is a number, the function will automatically return after Max_Steps iterations. 
+	For each row of Array (N, pixels), finds the weighted least squares fit in the orthonormal basis Q (the columns of Q) with the
+	corresponding row of Weights. Returns the (N, basis size) coefficients.
+	"""
+	Squared=np.square(Weights)
+	Normal=np.dot(Squared,(Q[:,:,np.newaxis]*Q[:,np.newaxis,:]).reshape(len(Q),-1)).reshape(len(Array),Q.shape[1],Q.shape[1])
+	Target=np.dot(Squared*Array,Q)
+	try:
+		return np.linalg.solve(Normal,Target[:,:,np.newaxis])[:,:,0]
+	except np.linalg.LinAlgError:  #Some rows are singular (e.g. almost all weights are zero), so fall back to lstsq
+		Output=np.empty(Target.shape)
+		for i in range(len(Array)):
+			Output[i]=np.linalg.lstsq(Q*Weights[i][:,np.newaxis],Array[i]*Weights[i],rcond=None)[0]
+		return Output
+
+def Run_Batch(Array,Degree,Threshold=0.0001,Max_Steps=None,Auto_Remove=True):
+	"""
+	Background subtraction for every spectrum in a 2D array (N, pixels), for example a time series. Each spectrum is treated exactly as
+	by Run (see below), and stops iterating when it has converged, but the weights and fits for all unconverged spectra are calculated
+	together at each step.
 
-	If Auto_Remove is True, the background subtracted spectrum is returned. If it is False, the Background is returned.
+	The fits are done in the orthonormal basis of the cached QR decomposition of the design matrix, so the backgrounds never need
+	to be calculated from the (badly conditioned) polynomial coefficents.
 	"""
 
-	Background=None
-	Intial_Difference=None
-	End=False
+	Array=np.atleast_2d(np.asarray(Array,dtype=float))
+	Matrix,Scales,Q,R=Design(Array.shape[1],Degree)
 
-	Params=np.polyfit(range(len(Data)),Data,Degree)
+	Coefficents=np.dot(Array,Q)  #Unweighted fits
+	Background=np.zeros(Array.shape)
+	Intial_Difference=np.zeros(len(Array))
+	Active=np.arange(len(Array))
 
 	Steps=0
 
-	while End is False:
-		Params,New_Background=Iterative_Step(Data,Params,Degree,True)
-		if Background is None:
-			Background=New_Background
+	while len(Active)>0:
+		New_Background=np.dot(Coefficents[Active],Q.T)
+		New_Background*=(New_Background>0)
+
+		Weights=Find_Weights(New_Background,Array[Active])
+		Coefficents[Active]=Weighted_Fits(Array[Active],Weights,Q)
+
+		if Steps==0:
+			Background[Active]=New_Background
 		else:
-			Difference=np.sum(np.square(np.array(New_Background)-np.array(Background)))**0.5
-			if Intial_Difference is None:
-				Intial_Difference=Difference
+			Difference=np.sum(np.square(New_Background-Background[Active]),axis=1)**0.5
+			if Steps==1:
+				Intial_Difference[Active]=Difference
+				End=Difference==0
 			else:
-				if Difference<Threshold*Intial_Difference:
-					End=True
-				else:
-					Background=New_Background
+				End=np.logical_or(Difference<Threshold*Intial_Difference[Active],Difference==0)
+				Background[Active[np.logical_not(End)]]=New_Background[np.logical_not(End)]
+			Active=Active[np.logical_not(End)]
 		if Max_Steps is not None:
 			if Steps>Max_Steps:
-				End=True
+				Active=Active[:0]
 		Steps+=1
 
-	Background=np.polyval(Params,range(len(Data)))
+	Background=np.dot(Coefficents,Q.T)
 	Background*=(Background>0)
 
 	if Auto_Remove is True:
-		return np.array(Data)-np.array(Background)
+		return Array-Background
 	else:
-		return np.array(Background)
+		return Background
+
+def Run(Data,Degree,Threshold=0.0001,Max_Steps=None,Auto_Remove=True):
+	"""
+	Main function that completes the background subtraction. 
+
+	Data=1D array for spectrum. Degree is the polynomial degree to fit. The initial sum squared difference between the first two backgrounds is 
+	calculated. The function returns when this sum between two successive background fits is less than Threshold*the original difference. If
+	Max_Steps is a number, the function will automatically return after Max_Steps iterations. 
+
+	If Auto_Remove is True, the background subtracted spectrum is returned. If it is False, the Background is returned.
+
+	To process many spectra at once, use Run_Batch.
+	"""
 
+	return Run_Batch(np.asarray(Data,dtype=float)[np.newaxis],Degree,Threshold,Max_Steps,Auto_Remove)[0]
@@ -8,6 +8,9 @@ This is a rewrite of the z-scan analysis code, but hopefully cleaner and without
 To use, input the z_scan array into the run function. For each wavelength, the centroid z-postion will be calcualted and the corresponding
 intensity linearly interpolated. The resulting 1D spectrum is returned.
 
+A stack of z-scans (e.g. one per particle) with shape (particles, z positions, wavelengths) can be passed to Run in one go, in which case
+a 2D array of spectra is returned.
+
 Note: The Z scan array should already be background subtracted and referenced.
 """
 
@@ -21,51 +24,35 @@ def Linear_Interpolation(Value1,Value2,Frac):
 
 def Run(Z_Scan,Threshold=0.2, Smoothing_width=1.5):
     """
-    Here, the Z_Scan is assumed to already by background subtracted and referenced.
+    Here, the Z_Scan is assumed to already by background subtracted and referenced. Z_Scan can also be a stack of z-scans, with z along the
+    second to last axis.
     """
 
+    Z_Scan=np.asarray(Z_Scan)
+
     Thresholded=np.nan_to_num(Z_Scan)
 
     Thresholded=Thresholded.astype(np.float64)
-    Thresholded=(Thresholded - Thresholded.min(axis=0))/(Thresholded.max(axis=0)-Thresholded.min(axis=0))
+    Minimum=Thresholded.min(axis=-2)[...,np.newaxis,:]
+    Thresholded=(Thresholded - Minimum)/(Thresholded.max(axis=-2)[...,np.newaxis,:]-Minimum)
     Thresholded-=Threshold
     Thresholded*=(Thresholded>0)       #Normalise and Threshold array
 
-    Ones=np.zeros([Z_Scan.shape[1]])+1
-    Positions=[]
-    while len(Positions)<Z_Scan.shape[0]:
-        Positions.append(Ones*len(Positions))
-    Positions=np.array(Positions).astype(np.float64)
+    Positions=np.arange(Z_Scan.shape[-2],dtype=np.float64)[:,np.newaxis]
 
-    Centroids=np.sum((Thresholded*Positions),axis=0)/np.sum(Thresholded,axis=0) #Find Z centroid position for each wavelength
+    Centroids=np.sum((Thresholded*Positions),axis=-2)/np.sum(Thresholded,axis=-2) #Find Z centroid position for each wavelength
 
     Centroids=np.nan_to_num(Centroids)
 
-    Rotated=np.transpose(Z_Scan)
-
-    Output=[]
-    n=0
-    while n<len(Centroids):
-        Lower=int(Centroids[n])
-        Upper=Lower+1
-
-        Frac=Centroids[n]-Lower
-        if Upper==len(Rotated[n]):
-            Upper-=1
-            Frac=0
-        #if Lower==len(Rotated):
-            #Lower-=1
-
-        #print Lower,Upper
-
-        Output.append(Linear_Interpolation(Rotated[n][Lower],Rotated[n][Upper],Frac))
-
-        n+=1
-
-    return np.array(Output)
-
-
-
+    Lower=Centroids.astype(int)
+    Upper=Lower+1
 
+    Frac=Centroids-Lower
+    End=Upper==Z_Scan.shape[-2]
+    Upper[End]-=1
+    Frac[End]=0
 
+    Lower_Values=np.take_along_axis(Z_Scan,Lower[...,np.newaxis,:],axis=-2)[...,0,:]
+    Upper_Values=np.take_along_axis(Z_Scan,Upper[...,np.newaxis,:],axis=-2)[...,0,:]
 
+    return Linear_Interpolation(Lower_Values,Upper_Values,Frac)
@@ -1,6 +1,6 @@
 import numpy as np 
 import scipy.ndimage.filters as imf
-import scipy.optimize as spo
+from nplab.analysis import Multi_Peak_Fitting
 
 """
 Author: jpg66 October 2018
@@ -25,24 +25,22 @@ def Grad(Array):
 	"""
 	Returns something prop to the grad of 1D array Array. Does central difference method with mirroring.
 	"""
-	A=np.array(Array.tolist()+[Array[-1],Array[-2]])
-	B=np.array([Array[1],Array[0]]+Array.tolist())
+	A=np.concatenate((Array,[Array[-1],Array[-2]]))
+	B=np.concatenate(([Array[1],Array[0]],Array))
 	return (A-B)[1:-1]
 
 def Find_Zeroes(Array):
 	"""
 	Find the zero crossing points in a 1D array Array, using linear interpolation
 	"""
-	Output=[]
-	for i in range(len(Array))[1:]:
-		if Array[i]==0:
-			Output.append(float(i))
-		else:
-			if i!=0:
-				if ((int((Array[i]>0))*2)-1)*((int((Array[i-1]>0))*2)-1)==-1:
-					Frac=Array[i-1]/(Array[i-1]-Array[i])
-					Output.append(i+Frac-1)
-	return Output
+	Array=np.asarray(Array,dtype=float)
+	Current,Previous=Array[1:],Array[:-1]
+	Index=np.arange(1,len(Array),dtype=float)
+	Zero=Current==0
+	Crossing=np.logical_and(np.logical_not(Zero),(Current>0)!=(Previous>0))
+	with np.errstate(divide='ignore',invalid='ignore'):
+		Output=np.where(Zero,Index,Index+(Previous/(Previous-Current))-1)
+	return Output[np.logical_or(Zero,Crossing)].tolist()
 
 def Find_Maxima(Array):
 	"""
@@ -51,12 +49,10 @@ def Find_Maxima(Array):
 	Diff=Grad(Array)
 	Stationary=Find_Zeroes(Diff)
 	Curv=Grad(Diff)
-	Output=[]
-	for i in Stationary:
-		Value=((Curv[int(i)+1]-Curv[int(i)])*i%1)+Curv[int(i)]
-		if Value<0:
-			Output.append(i)
-	return Output
+	Stationary=np.array(Stationary)
+	Lower=Stationary.astype(int)
+	Value=(((Curv[Lower+1]-Curv[Lower])*Stationary)%1)+Curv[Lower]
+	return Stationary[Value<0].tolist()
 
 def L(x,H,C,W):
 	"""
@@ -75,6 +71,28 @@ def Multi_L_Constant(x,*Params):
 		n+=3
 	return Output
 
+def To_Engine_Order(Params):
+	"""
+	Converts parameters in the order Constant, Height1, Centre1, Width1,Height2..... to the order used by Multi_Peak_Fitting
+	(Constant, Centre1, Width1, Height1, Centre2.....), and From_Engine_Order converts them back.
+	"""
+	Params=np.asarray(Params,dtype=float)
+	return np.concatenate(([Params[0]],Params[1:].reshape(-1,3)[:,[1,2,0]].ravel()))
+
+def From_Engine_Order(Params):
+	Params=np.asarray(Params,dtype=float)
+	return np.concatenate(([Params[0]],Params[1:].reshape(-1,3)[:,[2,0,1]].ravel()))
+
+def Fit(Shift,Array,Initial,Bounds):
+	"""
+	Fits Multi_L_Constant to a spectrum with Multi_Peak_Fitting, which uses an analytic Jacobian. Returns [Parameters, Errors], or
+	[None, None] if the fit fails.
+	"""
+	Params=Multi_Peak_Fitting.Fit_Spectrum(Shift,Array,To_Engine_Order(Initial),(To_Engine_Order(Bounds[0]),To_Engine_Order(Bounds[1])))
+	if Params[0] is None:
+		return Params
+	return [From_Engine_Order(Params[0]),From_Engine_Order(Params[1])]
+
 def Attempt_To_Fit(Shift,Array,Peak_Shifts,Peak_Heights,Width,Minimum_Height=0):
 	"""
 	Given a raman Shift and spectrum Array, with guesses for possible Peak_Shifts and Peak_Heights with a single guess for the Width, attempts to fit the peaks.
@@ -110,9 +128,8 @@ def Attempt_To_Fit(Shift,Array,Peak_Shifts,Peak_Heights,Width,Minimum_Height=0):
 				L_Bounds+=[0,np.min(Shift),0]
 				U_Bounds+=[np.inf,np.max(Shift),np.inf]
 				#print Initial
-			try:
-				Params=spo.curve_fit(Multi_L_Constant,Shift,Array,Initial,bounds=(L_Bounds,U_Bounds))
-				Params=[Params[0],np.sqrt(np.diag(Params[1]))]
+			Params=Fit(Shift,Array,Initial,(L_Bounds,U_Bounds))
+			if Params[0] is not None:
 
 				#print Params
 						
@@ -131,8 +148,6 @@ def Attempt_To_Fit(Shift,Array,Peak_Shifts,Peak_Heights,Width,Minimum_Height=0):
 					n+=3
 				if Fail is False:
 					Parameters.append(Params[0])
-			except RuntimeError:
-					Dump=None
 
 		if len(Parameters)>0:
 			Loss=[]
@@ -172,11 +187,8 @@ def Run(Input,Shift,Width=10,Smoothing_Factor=5,Noise_Threshold=2):
 		U_Bounds+=[np.inf,np.inf,np.inf]
 		n+=3	
 
-	try:
-		Params=spo.curve_fit(Multi_L_Constant,Shift,Input,First_Draft,bounds=(L_Bounds,U_Bounds))
-		Params=[Params[0],np.sqrt(np.diag(Params[1]))]
-		Params=[Params[0][1:],Params[1][1:]]
-		return Params
-	except RuntimeError:
+	Params=Fit(Shift,Input,First_Draft,(L_Bounds,U_Bounds))
+	if Params[0] is None:
 		return [None,None]
+	return [Params[0][1:],Params[1][1:]]
 
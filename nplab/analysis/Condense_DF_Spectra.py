@@ -17,6 +17,8 @@ import h5py
 import numpy as np
 from random import randint
 import time
+import itertools
+from multiprocessing import Pool, cpu_count
 from scipy.signal import butter, filtfilt
 
 if __name__ == '__main__':
@@ -201,11 +203,105 @@ def condenseZscan(zScan):
     """
     Here, the zScan is assumed to already be background subtracted and referenced.
     """
-    output = np.array([scan.max() for scan in np.transpose(zScan)])
+    output = np.max(zScan, axis = 0) #Brightest point in the z-scan at each wavelength
 
     return output
 
-def extractAllSpectra(rootDir, returnIndividual = False, dodgyThreshold = 0.4, start = 0, finish = 0):
+def condenseZscans(zScans):
+    """
+    Condenses a (particles, z, wavelengths) stack of z-scans (background subtracted and referenced) into (particles, wavelengths)
+    """
+    return np.max(zScans, axis = 1)
+
+_inputFiles = {}
+
+def _openInput(inputFile):
+    '''Each process keeps its own read-only handle on the input file, as h5py handles can't be shared between processes'''
+
+    if inputFile not in _inputFiles:
+        _inputFiles[inputFile] = h5py.File(inputFile, 'r')
+
+    return _inputFiles[inputFile]
+
+def _closeInputs():
+
+    for inputFile in _inputFiles.keys():
+        _inputFiles.pop(inputFile).close()
+
+def condenseParticles(args):
+    '''Reads, references and condenses the z-scans of a list of particle groups from one scan'''
+    '''Returns (scanName, [(groupName, spectrum, centered), ...]), with spectrum = None if the particle has no z-scan'''
+
+    inputFile, scanPath, scanName, particleGroups, dParticleFormat, bg, ref = args
+    scan = _openInput(inputFile)[scanPath]
+
+    found = [groupName for groupName in particleGroups if dParticleFormat in scan[groupName]]
+    zScans = [scan[groupName][dParticleFormat][()] for groupName in found]
+
+    if len(set(zScan.shape for zScan in zScans)) == 1:
+        zScans = (np.array(zScans) - bg) / ref #Background subtraction and referencing of all z-scans at once
+        spectra = condenseZscans(zScans)
+
+    else:
+        zScans = [(zScan - bg) / ref for zScan in zScans]
+        spectra = [condenseZscan(z) for z in zScans]
+
+    results = {}
+
+    for groupName, z, y in zip(found, zScans, spectra):
+
+        try:
+            centered = checkCentering(z)
+        except:
+            centered = False
+
+        results[groupName] = (groupName, y, centered)
+
+    return scanName, [results.get(groupName, (groupName, None, False)) for groupName in particleGroups]
+
+def recordSkippedParticles(gScan, groupNames):
+    '''Adds particle groups with no z-scan to the scan's 'skippedGroups' dataset, so incremental runs don't look at them again'''
+
+    if 'skippedGroups' not in gScan:
+        gScan.create_dataset('skippedGroups', shape = (0,), maxshape = (None,), dtype = h5py.special_dtype(vlen = str))
+
+    dSkipped = gScan['skippedGroups']
+    nn = len(dSkipped)
+    dSkipped.resize(nn + len(groupNames), axis = 0)
+
+    if len(groupNames) > 0:
+        dSkipped[nn:] = list(groupNames)
+
+def inputFileId(inputFile):
+    '''Identifies a measurement file by its name and creation time, so a summary made from it can be recognised later'''
+
+    created = ''
+
+    with h5py.File(inputFile, 'r') as ipf:
+
+        for group in [ipf] + [ipf[name] for name in ['nplab_log', 'particleScans'] if name in ipf]:
+
+            if 'creation_timestamp' in group.attrs:
+                created = str(group.attrs['creation_timestamp'])
+                break
+
+    return os.path.basename(inputFile), created
+
+def summaryMatchesInput(summaryFile, inputId):
+    '''Checks whether a summary file was made from the measurement file with this inputFileId'''
+
+    with h5py.File(summaryFile, 'r') as opf:
+        return (opf.attrs.get('Input file'), opf.attrs.get('Input file created')) == inputId
+
+def extractAllSpectra(rootDir, returnIndividual = False, dodgyThreshold = 0.4, start = 0, finish = 0, processes = None, chunkSize = 50,
+                      incremental = False, summaryFile = None):
+    '''
+    Condenses the z-scans of every particle in the most recent measurement file in rootDir into a summary file
+    Particles are condensed by a pool of processes (processes = None uses all cores), chunkSize particles at a time
+    The particle groups condensed into each scan are recorded in its 'particleGroups' dataset, and those with no z-scan in
+    'skippedGroups'. If incremental = True, new particles are appended to the existing summary file (summaryFile, or the
+    most recent summary*.h5) instead of starting again, as long as it was made from the same measurement file
+    '''
 
     os.chdir(rootDir)
 
@@ -215,158 +311,243 @@ def extractAllSpectra(rootDir, returnIndividual = False, dodgyThreshold = 0.4, s
         print 'File not found'
 
     print 'About to extract data from %s' % inputFile
-    outputFile = createOutputFile('summary')
 
-    with h5py.File(inputFile, 'a') as ipf:
+    inputId = inputFileId(inputFile)
 
-        try:
-            ipf['nplab_log']
-            fileType = '2018'
+    if incremental == True:
 
-        except:
+        if summaryFile is None:
 
             try:
-                ipf['particleScans']
+                summaryFile = findH5File(rootDir, nameFormat = 'summary')
+            except IndexError:
+                pass
+
+        if summaryFile is None:
+            print 'No summary file found; condensing all particles'
+
+        elif os.path.exists(summaryFile) and not summaryMatchesInput(summaryFile, inputId):
+            print '%s was not made from %s; condensing all particles into a new summary file' % (summaryFile, inputFile)
+            summaryFile = None
+
+    if summaryFile is None:
+        summaryFile = createOutputFile('summary')
+
+    if processes is None:
+        processes = cpu_count()
+
+    pool = Pool(processes) if processes > 1 else None #Created before any files are opened, so no h5py handles are inherited
+
+    try:
+        with h5py.File(inputFile, 'r') as ipf:
+
+            if 'nplab_log' in ipf:
+                fileType = '2018'
+
+            elif 'particleScans' in ipf:
                 fileType = 'pre-2018'
 
-            except Exception as e:
-                print e
+            else:
                 print 'File format not recognised'
                 return
 
-        with h5py.File(outputFile, 'a') as opf:
+            with h5py.File(summaryFile, 'a') as opf:
+                opf.attrs['Input file'], opf.attrs['Input file created'] = inputId
+                gAllOut = opf.require_group('particleScanSummaries')
 
-            gAllOut = opf.create_group('particleScanSummaries')
+                if returnIndividual == True:
+                    gInd = opf.require_group('Individual NPoM Spectra')
 
-            if returnIndividual == True:
-                gInd = opf.create_group('Individual NPoM Spectra')
+                if fileType == 'pre-2018':
+                    ipf = ipf['particleScans']
+                    gScanFormat = 'scan'
+                    gParticleFormat = 'z_scan_'
+                    dParticleFormat = 'z_scan'
 
-            if fileType == 'pre-2018':
-                ipf = ipf['particleScans']
-                gScanFormat = 'scan'
-                gParticleFormat = 'z_scan_'
-                dParticleFormat = 'z_scan'
+                elif fileType == '2018':
+                    gScanFormat = 'ParticleScannerScan_'
+                    gParticleFormat = 'Particle_'
 
-            elif fileType == '2018':
-                gScanFormat = 'ParticleScannerScan_'
-                gParticleFormat = 'Particle_'
+                allScans = sorted([groupName for groupName in ipf.keys() if groupName.startswith(gScanFormat)],
+                                  key = lambda groupName: len(ipf[groupName].keys()))[::-1]
 
-            allScans = sorted([groupName for groupName in ipf.keys() if groupName.startswith(gScanFormat)],
-                              key = lambda groupName: len(ipf[groupName].keys()))[::-1]
+                existingScans = {gAllOut[name].attrs['Input scan'] : gAllOut[name] for name in gAllOut
+                                 if 'Input scan' in gAllOut[name].attrs}
+                scanStates = {}
+                tasks = []
 
-            for n, scanName in enumerate(allScans):
+                for n, scanName in enumerate(allScans):
 
-                if len(ipf[scanName]) < 15:
-                    continue
+                    if len(ipf[scanName]) < 15:
+                        continue
 
-                if fileType == '2018':
-                    dParticleFormat = 'alinger.z_scan_%s' % n
+                    if fileType == '2018':
+                        dParticleFormat = 'alinger.z_scan_%s' % n
 
-                nummers = range(10, 101, 10)
-                scanStart = time.time()
+                    scan = ipf[scanName]
+                    particleGroups = sorted([groupName for groupName in scan.keys() if groupName.startswith(gParticleFormat)],
+                                    key = lambda groupName: int(groupName.split('_')[-1]))
 
-                dodgyParticles = []
-                dodgyCount = 0
+                    print '%s particles found in %s' % (len(particleGroups), scanName)
 
-                gScan = gAllOut.create_group('scan%s' % n)
+                    if finish == 0:
+                        particleGroups = particleGroups[start:]
 
-                if returnIndividual == True:
-                    gIndScan = gInd.create_group('scan%s' % n)
+                    else:
+                        particleGroups = particleGroups[start:finish]
+
+                    if scanName in existingScans:
+                        gScan = existingScans[scanName]
+                        dParticleFormat = gScan.attrs['Z-scan dataset name']
+                        done = set(gScan['particleGroups'][()])
+                        skipped = set(gScan['skippedGroups'][()]) if 'skippedGroups' in gScan else set()
+                        particleGroups = [groupName for groupName in particleGroups
+                                          if groupName not in done and groupName not in skipped]
+                        print '\t%s already condensed, %s without z-scans, %s new' % (len(done), len(skipped), len(particleGroups))
+
+                    else:
+                        gScan = None
+
+                    if len(particleGroups) == 0:
+                        continue
+
+                    firstZScan = [scan[groupName][dParticleFormat] for groupName in particleGroups
+                                  if dParticleFormat in scan[groupName]]
+
+                    if len(firstZScan) == 0:
+                        print 'No z-scans found in %s' % scanName
+
+                        if gScan is not None:
+                            recordSkippedParticles(gScan, particleGroups)
+
+                        continue
+
+                    firstZScan = firstZScan[0]
+
+                    if gScan is None:
+                        gScanName = 'scan%s' % n
+
+                        while gScanName in gAllOut:
+                            gScanName += '_'
+
+                        gScan = gAllOut.create_group(gScanName)
+                        gScan.attrs['Input scan'] = scanName
+                        gScan.attrs['Z-scan dataset name'] = dParticleFormat
+                        nWl = firstZScan.shape[-1]
+                        dScan = gScan.create_dataset('spectra', shape = (0, nWl), maxshape = (None, nWl), dtype = np.float64)
+                        dScan.attrs.update({key : firstZScan.attrs[key] for key in firstZScan.attrs.keys()})
+                        dScan.attrs['Misaligned particle numbers'] = []
+                        gScan.create_dataset('particleGroups', shape = (0,), maxshape = (None,),
+                                             dtype = h5py.special_dtype(vlen = str))
+                        recordSkippedParticles(gScan, [])
+
+                    bg = gScan['spectra'].attrs['background']
+                    ref = gScan['spectra'].attrs['reference']
+
+                    scanStates[scanName] = {'group' : gScan, 'total' : len(particleGroups), 'done' : 0, 'nummers' : range(10, 101, 10),
+                                            'start time' : time.time(), 'dodgy particles' : [], 'dodgy count' : 0}
+
+                    if returnIndividual == True:
+                        scanStates[scanName]['individual'] = gInd.require_group(gScan.name.split('/')[-1])
+
+                    scanPath = ipf[scanName].name
 
-                spectra = []
-                attrs = {}
-                scan = ipf[scanName]
-                particleGroups = sorted([groupName for groupName in scan.keys() if groupName.startswith(gParticleFormat)],
-                                key = lambda groupName: int(groupName.split('_')[-1]))
+                    for i in range(0, len(particleGroups), chunkSize):
+                        tasks.append((inputFile, scanPath, scanName, particleGroups[i:i + chunkSize], dParticleFormat, bg, ref))
 
-                print '%s particles found in %s' % (len(particleGroups), scanName)
                 print '\n0% complete'
 
-                if finish == 0:
-                    particleGroups = particleGroups[start:]
+                if pool is not None:
+                    results = pool.imap(condenseParticles, tasks) #Results arrive in order, so each scan is written in particle order
 
                 else:
-                    particleGroups = particleGroups[start:finish]
+                    results = itertools.imap(condenseParticles, tasks)
 
-                referenced = False
+                for scanName, particles in results:
+                    state = scanStates[scanName]
+                    gScan = state['group']
+                    dScan = gScan['spectra']
+                    dNames = gScan['particleGroups']
+                    x = dScan.attrs['wavelengths']
 
-                for nn, groupName in enumerate(particleGroups):
+                    for groupName, y, centered in particles:
 
-                    if int(100 * nn / len(particleGroups)) in nummers:
-                        currentTime = time.time() - scanStart
-                        mins = int(currentTime / 60)
-                        secs = (np.round((currentTime % 60)*100))/100
-                        print '%s%% (%s particles) complete in %s min %s sec' % (nummers[0], nn, mins, secs)
-                        nummers = nummers[1:]
+                        if y is None:
+                            print 'Z-Stack not found in %s' % (groupName)
 
-                    particleGroup = scan[groupName]
+                    recordSkippedParticles(gScan, [particle[0] for particle in particles if particle[1] is None])
+                    particles = [particle for particle in particles if particle[1] is not None]
 
-                    try:
-                        zScan = particleGroup[dParticleFormat]
+                    nn = len(dScan)
+                    dScan.resize(nn + len(particles), axis = 0)
+                    dNames.resize(nn + len(particles), axis = 0)
 
-                    except:
-                        print 'Z-Stack not found in %s' % (groupName)
-                        continue
+                    if len(particles) > 0:
+                        dScan[nn:] = np.array([particle[1] for particle in particles])
+                        dNames[nn:] = [particle[0] for particle in particles]
 
-                    if referenced == False:
+                    for groupName, y, centered in particles:
 
-                        for key in zScan.attrs.keys():
-                            attrs[key] = zScan.attrs[key]
+                        if centered == False:
+                            state['dodgy particles'].append(nn)
+                            state['dodgy count'] += 1
 
-                        x = zScan.attrs['wavelengths']
-                        bg = zScan.attrs['background']
-                        ref = zScan.attrs['reference']
+                            if 0 < state['dodgy count'] < 50:
+                                print 'Particle %s not centred properly or too close to another' % nn
 
-                        referenced = True
+                            elif state['dodgy count'] == 50:
+                                print '\nMore than 50 dodgy Z scans found. I\'ll stop clogging up your screen. Assume there are more.\n'
 
-                    z = zScan[()] - bg #Background subtraction of entire z-scan
-                    z /= ref #Normalise to reference
-                    try:
-                        centered = checkCentering(z)
-                    except:
-                        centered = False
-                    y = condenseZscan(z)
+                        if returnIndividual == True:
+                            gSpectrum = state['individual'].create_dataset('Spectrum %s' % nn, data = y)
+                            gSpectrum.attrs['wavelengths'] = x
+                            gSpectrum.attrs['Properly centred?'] = centered
 
-                    if centered == False:
-                        dodgyParticles.append(nn)
-                        dodgyCount += 1
+                        nn += 1
 
-                        if 0 < dodgyCount < 50:
-                            print 'Particle %s not centred properly or too close to another' % nn
+                    state['done'] += len(particles)
 
-                        elif dodgyCount == 50:
-                            print '\nMore than 50 dodgy Z scans found. I\'ll stop clogging up your screen. Assume there are more.\n'
+                    if len(state['nummers']) > 0 and int(100 * state['done'] / state['total']) >= state['nummers'][0]:
+                        currentTime = time.time() - state['start time']
+                        mins = int(currentTime / 60)
+                        secs = (np.round((currentTime % 60)*100))/100
+                        print '%s: %s%% (%s particles) complete in %s min %s sec' % (scanName, int(100 * state['done'] / state['total']),
+                                                                                   state['done'], mins, secs)
 
-                    if returnIndividual == True:
-                        gSpectrum = gIndScan.create_dataset('Spectrum %s' % nn, data = y)
-                        gSpectrum.attrs['wavelengths'] = x
-                        gSpectrum.attrs['Properly centred?'] = centered
+                        while len(state['nummers']) > 0 and state['nummers'][0] <= 100 * state['done'] / state['total']:
+                            state['nummers'] = state['nummers'][1:]
 
-                    spectra.append(y)
+                for scanName, state in scanStates.items():
+                    currentTime = time.time() - state['start time']
+                    mins = int(currentTime / 60)
+                    secs = (np.round((currentTime % 60)*100))/100
+                    print '%s: 100%% (%s particles) complete in %s min %s sec' % (scanName, state['done'], mins, secs)
 
-                currentTime = time.time() - scanStart
-                mins = int(currentTime / 60)
-                secs = (np.round((currentTime % 60)*100))/100
-                print '100%% (%s particles) complete in %s min %s sec' % (len(particleGroups), mins, secs)
-                percentDefocused = 100 * len(dodgyParticles) / len(spectra)
+                    dScan = state['group']['spectra']
+                    dodgyParticles = list(dScan.attrs['Misaligned particle numbers']) + state['dodgy particles']
+                    percentDefocused = 100 * len(dodgyParticles) / max(len(dScan), 1)
 
-                if percentDefocused / 100 > dodgyThreshold:
-                    alignment = 'Poor'
-                    print '\n\n***Warning: lots of messy spectra (~%s%%). Data may not be reliable. Check nanoparticle alignment***\n' % percentDefocused
+                    if percentDefocused / 100 > dodgyThreshold:
+                        alignment = 'Poor'
+                        print '\n\n***Warning: lots of messy spectra in %s (~%s%%). Data may not be reliable. Check nanoparticle alignment***\n' % (scanName,
+                                                                                                                                           percentDefocused)
 
-                else:
-                    alignment = 'Good'
+                    else:
+                        alignment = 'Good'
+
+                    dScan.attrs['Collection spot alignment'] = alignment
+                    dScan.attrs['Misaligned particle numbers'] = dodgyParticles
+                    dScan.attrs['%% particles misaligned'] = percentDefocused
+
+    finally:
 
-                spectra = np.array(spectra)
-                dScan = gScan.create_dataset('spectra', data = spectra)
-                dScan.attrs['Collection spot alignment'] = alignment
-                dScan.attrs['Misaligned particle numbers'] = dodgyParticles
-                dScan.attrs['%% particles misaligned'] = percentDefocused
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
-                for key in attrs.keys():
-                    dScan.attrs[key] = attrs[key]
+        _closeInputs()
 
-    return outputFile #String of output file name for easy identification later
+    return summaryFile #String of output file name for easy identification later
 
 if __name__ == '__main__':
 
@@ -11,13 +11,15 @@ import h5py
 import numpy as np
 import os
 import matplotlib.pyplot as plt
-from scipy import sparse
-import scipy.sparse.linalg as splu
 from scipy.signal import butter, filtfilt
 from lmfit.models import GaussianModel
 import time
 from random import randint
 import scipy.optimize as spo
+from nplab.analysis.baseline import baseline_als
+from nplab.analysis.parallel_fitting import fit_spectra
+from nplab.analysis.fit_results import FitResultsTable, isTrue, isFalse
+from nplab.analysis.summary_spectra import SummarySpectra, main_scan_name
 
 if __name__ == '__main__':
     absoluteStartTime = time.time()
@@ -67,9 +69,12 @@ class DF_Spectrum(object):
 
 '''FUNCTIONS'''
 
-def retrieveData(summaryFile, startSpec = 0, finishSpec = 0, attrsOnly = False):
+def retrieveData(summaryFile, startSpec = 0, finishSpec = 0, attrsOnly = False, lazy = False, blockSize = 1000):
 
     '''Retrieves data from summary file'''
+    '''Only spectra startSpec to finishSpec are read. If lazy = True, they are not read until needed: spectra is then a
+       SummarySpectra that reads (and prepares) blockSize spectra at a time and can be passed to fitAllSpectra in place of
+       the prepared array, so files larger than memory can be fitted. Close it when done'''
 
     if attrsOnly == False:
         print '\nRetrieving data...'
@@ -77,48 +82,37 @@ def retrieveData(summaryFile, startSpec = 0, finishSpec = 0, attrsOnly = False):
     else:
         print '\nRetrieving sample preparation info'
 
-    with h5py.File(summaryFile) as f:
+    with h5py.File(summaryFile, 'r') as f:
 
-        allScans = f['particleScanSummaries/']
-        spectraLengths = []
+        scanName = main_scan_name(f)
+        dSpectra = f['particleScanSummaries'][scanName]['spectra']
+        summaryAttrs = {key : dSpectra.attrs[key] for key in dSpectra.attrs.keys()}
+        nTotal = len(dSpectra)
 
-        for scan in allScans:
-
-            if len(allScans[scan]) != 0:
-                spectraLengths.append(len(allScans[scan]['spectra']))
-
-            else:
-                spectraLengths.append(0)
-
-        scanNumber = np.array(spectraLengths).argmax()
-        scan = f['particleScanSummaries/scan%s' % scanNumber]
-        summaryAttrs = {key : scan['spectra'].attrs[key] for key in scan['spectra'].attrs.keys()}
+        if attrsOnly == True:
+            print '\tInfo retrieved from particleScanSummaries/%s' % scanName
+            print '\t\t%s spectra in total' % nTotal
+            return summaryAttrs
 
         if finishSpec == 0:
-            spectra = f['particleScanSummaries/scan%s/spectra' % scanNumber][()][startSpec:]
+            finishSpec = nTotal
 
-        else:
-            spectra = f['particleScanSummaries/scan%s/spectra' % scanNumber][()][startSpec:finishSpec]
+        if lazy == False:
+            spectra = dSpectra[startSpec:finishSpec]
 
-        wavelengths = f['particleScanSummaries/scan%s/spectra' % scanNumber].attrs['wavelengths'][()]
-        background = f['particleScanSummaries/scan%s/spectra' % scanNumber].attrs['background'][()]
-        reference = f['particleScanSummaries/scan%s/spectra' % scanNumber].attrs['reference'][()]
+        wavelengths = dSpectra.attrs['wavelengths'][()]
+        background = dSpectra.attrs['background'][()]
+        reference = dSpectra.attrs['reference'][()]
 
-    if attrsOnly == True:
-        print '\tInfo retrieved from particleScanSummaries/scan%s' % scanNumber
-        print '\t\t%s spectra in total' % max(spectraLengths)
-        return summaryAttrs
+    if lazy == True:
+        spectra = SummarySpectra(summaryFile, start = startSpec, finish = finishSpec, block_size = blockSize,
+                                 scan_name = scanName, prepare = prepareSpectra)
 
-    else:
+    nSpec = finishSpec - startSpec
 
-        if finishSpec == 0:
-            finishSpec = max(spectraLengths)
+    print '\t%s spectra retrieved from particleScanSummaries/%s' % (nSpec, scanName)
 
-        nSpec = finishSpec - startSpec
-
-        print '\t%s spectra retrieved from particleScanSummaries/scan%s' % (nSpec, scanNumber)
-
-        return spectra, wavelengths, background, reference, summaryAttrs
+    return spectra, wavelengths, background, reference, summaryAttrs
 
 def findKey(inputDict, value):
     return next((k for k, v in inputDict.items() if v == value), None)
@@ -188,6 +182,14 @@ def printEnd():
     print '%s%swow' % ('\n' * randint(2, 5), ' ' * randint(5, 55))
     print '\n' * randint(0, 7)
 
+def prepareSpectra(spectra):
+    '''Removes NaN values from each spectrum in place; returns the spectra'''
+
+    for spectrum in spectra:
+        removeNaNs(spectrum)
+
+    return spectra
+
 def prepareData(spectra, wavelengths, reference):
     '''Removes NaN values from and references spectra'''
     #spectra = list of 1D arrays
@@ -202,8 +204,8 @@ def prepareData(spectra, wavelengths, reference):
 
     removeNaNs(wavelengths)
 
-    for spectrum in spectra:
-        removeNaNs(spectrum)
+    if not isinstance(spectra, SummarySpectra): #Lazily read spectra are prepared as they are read
+        prepareSpectra(spectra)
 
     prepEnd = time.time()
     prepTime = prepEnd - prepStart
@@ -272,16 +274,7 @@ def baselineAls(y, lambd, p, iterations = 10):
     '''Calculates baseline for data
     lambd ~ 10^n
     p ~10^(-m)'''
-
-    L = y.size
-    D = sparse.csc_matrix(np.diff(np.eye(L), 2))
-    w = np.ones(L)
-    for i in xrange(iterations):
-        W = sparse.spdiags(w, 0, L, L)
-        Z = W + lambd * D.dot(D.transpose())
-        z = splu.spsolve(Z, w*y)
-        w = p * (y > z) + (1-p) * (y < z)
-    return z
+    return baseline_als(y, lambd, p, iterations)
 
 def butterLowpassFiltFilt(data, cutoff = 1500, fs = 60000, order=5):
     '''Smoothes data without shifting it'''
@@ -1285,6 +1278,27 @@ def reduceNoise(y, factor = 10):
     y = ySmooth + yNoise
     return y
 
+def getFitResults(outputFile, rebuild = False):
+    '''Returns the columnar table of fit results (see nplab.analysis.fit_results)'''
+    '''If the file has no table (e.g. it was fitted before the table was introduced), or rebuild = True, it is built from the
+       attrs of the "Fitted spectra" groups and saved'''
+
+    if rebuild == True and 'Fit results' in outputFile:
+        del outputFile['Fit results']
+
+    if 'Fit results' in outputFile:
+        return FitResultsTable.load(outputFile['Fit results'])
+
+    results = FitResultsTable.from_groups(outputFile['Fitted spectra'])
+
+    try:
+        results.save(outputFile.create_group('Fit results'))
+
+    except (IOError, ValueError) as e:
+        print 'Fit results table could not be saved because %s' % e
+
+    return results
+
 def plotHistogram(outputFile, histName = 'Histogram', startWl = 450, endWl = 987, binNumber = 80, plot = True,
                   minBinFactor = 5, closeFigures = False, irThreshold = 8, which = 'all', plotTitle = ''):
 
@@ -1299,38 +1313,24 @@ def plotHistogram(outputFile, histName = 'Histogram', startWl = 450, endWl = 987
     print '\nCombining spectra and plotting histogram...'
     print '\tFilter: %s' % which
 
-    if which == 'all':
-        spectra = outputFile['Fitted spectra']
-
-    elif which == 'doubles only':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Double Peak?'] == True]
+    results = getFitResults(outputFile)
+    isDouble = results['Double Peak?']
+    isWeird = results['Weird Peak?']
 
-    elif which == 'no doubles':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Double Peak?'] == False]
+    masks = {'all' : np.ones(len(results), dtype = bool),
+             'doubles only' : isTrue(isDouble),
+             'no doubles' : isFalse(isDouble),
+             'weird only' : isTrue(isWeird),
+             'no weird' : isFalse(isWeird),
+             'filtered' : isFalse(isWeird) & isFalse(isDouble) & isTrue(results['NPoM?']),
+             'aligned only' : isTrue(results['Aligned properly?'])}
 
-    elif which == 'weird only':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Weird Peak?'] == True]
-
-    elif which == 'no weird':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Weird Peak?'] == False]
-
-    elif which == 'filtered':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Weird Peak?'] == False
-                   and outputFile['Fitted spectra/%s' % spectrum].attrs['Double Peak?'] == False
-                   and  outputFile['Fitted spectra/%s' % spectrum].attrs['NPoM?'] == True]
-
-    elif which == 'aligned only':
-        spectra = [spectrum for spectrum in outputFile['Fitted spectra']
-                   if outputFile['Fitted spectra/%s' % spectrum].attrs['Aligned properly?'] == True]
-
-    else:
+    if which not in masks:
         print 'Choice of spectra not recognised. Plotting all spectra by default'
-        spectra = outputFile['Fitted spectra']
+        which = 'all'
+
+    mask = masks[which]
+    spectra = results.names(mask)
 
     print '\t\t%s spectra' % len(spectra)
 
@@ -1341,8 +1341,9 @@ def plotHistogram(outputFile, histName = 'Histogram', startWl = 450, endWl = 987
         if type(x) != str:
             break
 
-    #try:
-    spectraNames = [spectrum for spectrum in spectra if spectrum[:8] == 'Spectrum']
+    spectraNames = spectra
+    cmPeakPositions = results['Coupled mode wavelength'][mask]
+    intensityRatios = results['Intensity ratio (from norm)'][mask]
 
     binSize = (endWl - startWl) / binNumber
     bins = np.linspace(startWl, endWl, num = binNumber)
@@ -1352,28 +1353,22 @@ def plotHistogram(outputFile, histName = 'Histogram', startWl = 450, endWl = 987
     yDataRawBinned = [np.zeros(len(x)) for f in frequencies]
     binnedSpectraList = {binStart : [] for binStart in bins}
 
-    for n, spectrum in enumerate(spectraNames):
-
-        #print spectrum
+    for nn, binStart in enumerate(bins):
+        inBin = (binStart <= cmPeakPositions) & (cmPeakPositions < binStart + binSize) & (600 < cmPeakPositions) & (cmPeakPositions < 900)
+        frequencies[nn] = inBin.sum()
 
-        for nn, binStart in enumerate(bins):
+        for i in np.flatnonzero(inBin):
+            spectrum = spectraNames[i]
 
-            #print [attr for attr in spectra[spectrum].attrs]
-            cmPeakPos = outputFile['Fitted spectra'][spectrum].attrs['Coupled mode wavelength']
-            #print cmPeakPos
-            intensityRatio = outputFile['Fitted spectra'][spectrum].attrs['Intensity ratio (from norm)']
-            yData = outputFile['Fitted spectra'][spectrum]['Raw/Raw data (normalised)']
-            yDataRaw = outputFile['Fitted spectra'][spectrum]['Raw/Raw data']
+            if intensityRatios[i] < irThreshold:
+                yData = outputFile['Fitted spectra'][spectrum]['Raw/Raw data (normalised)'][()]
 
-            if cmPeakPos != 'N/A' and binStart <= cmPeakPos < binStart + binSize and 600 < cmPeakPos < 900:
-                frequencies[nn] += 1
-
-                if intensityRatio < irThreshold and truncateSpectrum(x, yData[()]).min() > -irThreshold:
+                if truncateSpectrum(x, yData).min() > -irThreshold:
                     yDataBinned[nn] += yData
-                    yDataRawBinned[nn] += yDataRaw
+                    yDataRawBinned[nn] += outputFile['Fitted spectra'][spectrum]['Raw/Raw data'][()]
                     binPops[nn] += 1
 
-                binnedSpectraList[binStart].append(spectrum)
+            binnedSpectraList[binStart].append(spectrum)
 
     for n, yDataSum in enumerate(yDataBinned):
         yDataBinned[n] /= binPops[n]
@@ -1625,60 +1620,26 @@ def plotIntensityRatios(outputFile, plot = True, xBins = 150, yBins = 120, ringF
     if alignedOnly == True:
         print '\t(Selecting correctly centred NPoMs only)'
 
-    allSpectra = outputFile['Fitted spectra']
-
-    cmPeakPositions = []
-    intensityRatios = []
+    results = getFitResults(outputFile)
+    cmPeakPositions = results['Coupled mode wavelength']
 
-    spectra = sorted([spectrum for spectrum in allSpectra if spectrum[:8] == 'Spectrum'],
-                     key = lambda spectrum: int(spectrum[9:]))
-
-    for spectrum in spectra:
-        #print '\n', spectrum
-        spectrum = allSpectra[spectrum]
-
-        cmPeakPos = spectrum.attrs['Coupled mode wavelength']
-
-        if normalised == True:
-            intensityRatio = spectrum.attrs['Intensity ratio (from norm)']
-            imgSuffix = 'normalised'
-
-        else:
-            intensityRatio = spectrum.attrs['Intensity ratio (raw)']
-            imgSuffix = 'raw'
-
-        if filterWeird == True:
-
-            irImgName = 'Intensity Ratios (filtered, %s).png' % imgSuffix
-
-            if (spectrum.attrs['NPoM?'] == True and spectrum.attrs['Double Peak?'] == False and
-                cmPeakPos != 'N/A' and cmPeakPos < 849 and intensityRatio != 'N/A' and
-                spectrum.attrs['Weird Peak?'] == False) == True:
-
-                cmPeakPositions.append(cmPeakPos)
-                intensityRatios.append(intensityRatio)
-
-        elif filterWeird == False:
-
-            if alignedOnly == True:
-                irImgName = 'Intensity Ratios (centred NPoMs only, %s).png' % imgSuffix
-
-                if (spectrum.attrs['NPoM?'] == True and spectrum.attrs['Double Peak?'] == False and
-                    cmPeakPos != 'N/A' and cmPeakPos < 849 and intensityRatio != 'N/A'
-                    and spectrum.attrs['Aligned properly?']) == True:
+    if normalised == True:
+        intensityRatios = results['Intensity ratio (from norm)']
 
-                    cmPeakPositions.append(cmPeakPos)
-                    intensityRatios.append(intensityRatio)
+    else:
+        intensityRatios = results['Intensity ratio (raw)']
 
-            else:
+    mask = (isTrue(results['NPoM?']) & isFalse(results['Double Peak?']) & (cmPeakPositions < 849) &
+            np.isfinite(intensityRatios))
 
-                irImgName = 'Intensity Ratios (%s).png' % imgSuffix
+    if filterWeird == True:
+        mask &= isFalse(results['Weird Peak?'])
 
-                if (spectrum.attrs['NPoM?'] == True and spectrum.attrs['Double Peak?'] == False and
-                    cmPeakPos != 'N/A' and cmPeakPos < 849 and intensityRatio != 'N/A') == True:
+    elif alignedOnly == True:
+        mask &= isTrue(results['Aligned properly?'])
 
-                    cmPeakPositions.append(cmPeakPos)
-                    intensityRatios.append(intensityRatio)
+    cmPeakPositions = list(cmPeakPositions[mask])
+    intensityRatios = list(intensityRatios[mask])
 
     if normalised == True:
         imgSuffix = 'normalised'
@@ -1924,6 +1885,8 @@ def updateTransAndCoupledMode(outputFile, transGuess = 533, transRange = [500, 5
                     for key in attrs:
                         dSet.attrs[key] = attrs[key]
 
+    getFitResults(outputFile, rebuild = True)
+
     print 'Transverse and coupled mode updated'
 
 def plotInitStack(x, yData, imgName = 'Initial Stack', closeFigures = False):
@@ -2037,6 +2000,8 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
     stackStartTime = time.time()
 
     gSpectra = outputFile['Fitted spectra']
+    results = getFitResults(outputFile)
+    isDouble = isTrue(results['Double Peak?'])
     outputFile.create_group('Statistics/Stacks')
 
     title = plotTitle
@@ -2048,17 +2013,13 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
         imgName = 'Stack (No weird peaks)'
         plotTitle = '%s%s' % (title, imgName)
 
-        spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-                   gSpectra[spectrum].attrs['Weird Peak?'] == False and
-                   gSpectra[spectrum].attrs[cmWlName] != 'N/A']
-        spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[cmWlName])
+        mask = isFalse(results['Weird Peak?']) & np.isfinite(results[cmWlName])
+        spectraSorted = [gSpectra[spectrum] for spectrum in results.names(mask, sortBy = cmWlName)]
         plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
     '''By order of measurement'''
 
-    spectra = [spectrum for spectrum in gSpectra if spectrum[:8] == 'Spectrum']
-    spectraSorted = sorted(spectra, key = lambda spectrum: int(spectrum[9:]))
-    spectraSorted = [gSpectra[spectrum] for spectrum in spectraSorted]
+    spectraSorted = [gSpectra[spectrum] for spectrum in results.names()]
     imgName = 'Stack (all)'
     plotTitle = '%s%s' % (title, imgName)
     plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
@@ -2069,9 +2030,7 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
     imgName = 'Stack (CM wavelength)'
     plotTitle = '%s%s' % (title, imgName)
 
-    spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-               gSpectra[spectrum].attrs[cmWlName] != 'N/A']
-    spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[cmWlName])
+    spectraSorted = [gSpectra[spectrum] for spectrum in results.names(np.isfinite(results[cmWlName]), sortBy = cmWlName)]
 
     plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
@@ -2081,10 +2040,7 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
     imgName = 'Stack (TM wavelength)'
     plotTitle = '%s%s' % (title, imgName)
 
-    spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-               gSpectra[spectrum].attrs[tmWlName] != 'N/A']
-
-    spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[tmWlName])
+    spectraSorted = [gSpectra[spectrum] for spectrum in results.names(np.isfinite(results[tmWlName]), sortBy = tmWlName)]
 
     plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
@@ -2094,21 +2050,15 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
     imgName = 'Stack (intensity ratio)'
     plotTitle = '%s%s' % (title, imgName)
 
-    spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-               gSpectra[spectrum].attrs[irName] != 'N/A']
-    spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[irName])
+    spectraSorted = [gSpectra[spectrum] for spectrum in results.names(np.isfinite(results[irName]), sortBy = irName)]
 
     plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
     '''Doubles in order of measurement'''
 
-    spectra = [spectrum for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-               gSpectra[spectrum].attrs['Double Peak?'] == True]
-
-    if len(spectra) > 0:
+    if isDouble.any():
 
-        spectraSorted = sorted(spectra, key = lambda spectrum: int(spectrum[9:]))
-        spectraSorted = [gSpectra[spectrum] for spectrum in spectraSorted]
+        spectraSorted = [gSpectra[spectrum] for spectrum in results.names(isDouble)]
 
         '''By order of measurement'''
 
@@ -2121,10 +2071,8 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
         cmWlName = 'Coupled mode wavelength'
         imgName = 'Stack (Doubles by CM wavelength)'
         plotTitle = '%s%s' % (title, imgName)
-        spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-                   gSpectra[spectrum].attrs[cmWlName] != 'N/A' and
-                   gSpectra[spectrum].attrs['Double Peak?'] == True]
-        spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[cmWlName])
+        mask = isDouble & np.isfinite(results[cmWlName])
+        spectraSorted = [gSpectra[spectrum] for spectrum in results.names(mask, sortBy = cmWlName)]
 
         plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
@@ -2134,11 +2082,8 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
         imgName = 'Stack (Doubles by TM wavelength)'
         plotTitle = '%s%s' % (title, imgName)
 
-        spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-                   gSpectra[spectrum].attrs[tmWlName] != 'N/A' and
-                   gSpectra[spectrum].attrs['Double Peak?'] == True]
-
-        spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[tmWlName])
+        mask = isDouble & np.isfinite(results[tmWlName])
+        spectraSorted = [gSpectra[spectrum] for spectrum in results.names(mask, sortBy = tmWlName)]
 
         plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
@@ -2148,10 +2093,8 @@ def plotAllStacks(outputFile, plotTitle = '', closeFigures = False, filterWeird
         imgName = 'Stack (Doubles by intensity ratio)'
         plotTitle = '%s%s' % (title, imgName)
 
-        spectra = [gSpectra[spectrum] for spectrum in gSpectra if spectrum[:8] == 'Spectrum' and
-                   gSpectra[spectrum].attrs[irName] != 'N/A' and
-                   gSpectra[spectrum].attrs['Double Peak?'] == True]
-        spectraSorted = sorted(spectra, key = lambda spectrum: spectrum.attrs[irName])
+        mask = isDouble & np.isfinite(results[irName])
+        spectraSorted = [gSpectra[spectrum] for spectrum in results.names(mask, sortBy = irName)]
 
         plotStackedMap(spectraSorted, imgName = imgName, plotTitle = plotTitle, closeFigures = closeFigures)
 
@@ -2214,6 +2157,8 @@ def sortSpectra(outputFile, replace = False, method = 'basic', npomLower = 0.1,
            spectrum.attrs['Double Peak?'] = isDouble
            spectrum.attrs['Weird Peak?'] = isWeird
 
+        getFitResults(outputFile, rebuild = True)
+
     gNPoMs = gAll.create_group('NPoMs')
     gAllNPoMs = gNPoMs.create_group('All NPoMs')
     gDoubles = gNPoMs.create_group('Doubles')
@@ -2550,6 +2495,34 @@ def doubBoolsHists(outputFile, binNumber = 80, plot = True, closeFigures = False
     timeElapsed = doubBoolsEnd - doubBoolsStart
     print '\tDoubles stats done in %s seconds' % timeElapsed
 
+def calcAttrAverages(results, spectrumNames, suffix = '(average)'):
+    '''Averages the peak attrs of the named spectra, using the fit results table'''
+
+    attrNames = ['Weird peak FWHM (raw)', 'Weird peak FWHM (norm)', 'Weird peak wavelength', 'Weird peak intensity (raw)',
+                 'Weird peak intensity (norm)', 'Coupled mode FWHM (raw)', 'Coupled mode FWHM (norm)', 'Coupled mode wavelength',
+                 'Coupled mode intensity (raw)', 'Coupled mode intensity (norm)', 'Transverse mode intensity (raw)',
+                 'Intensity ratio (from norm)', 'Intensity ratio (raw)']
+
+    rows = results.rowIndex(spectrumNames) if len(spectrumNames) > 0 else np.array([], dtype = int)
+    attrAvgs = {}
+
+    for attrName in attrNames:
+        attrList = results[attrName][rows]
+        attrList = attrList[np.isfinite(attrList)]
+
+        if len(attrList) != 0:
+            attrAvg = np.average(attrList)
+
+        elif 'Weird peak intensity' in attrName:
+            attrAvg = 0
+
+        else:
+            attrAvg = 'N/A'
+
+        attrAvgs[attrName + suffix] = attrAvg
+
+    return attrAvgs
+
 def peakAverages(outputFile, singleBin = False, peakPos = 0):
     '''If singleBin = False, function averages peak data from all NPoM spectra'''
     '''If True, specify wavelength and function will average peak data from all spectra contained in that histogram bin'''
@@ -2558,6 +2531,7 @@ def peakAverages(outputFile, singleBin = False, peakPos = 0):
 
     print '\nCollecting peak averages'
 
+    results = getFitResults(outputFile)
     allNpoms = outputFile['All spectra/NPoMs/All NPoMs']
 
     hists = ['all', 'no doubles', 'filtered', 'aligned only']
@@ -2569,59 +2543,11 @@ def peakAverages(outputFile, singleBin = False, peakPos = 0):
         if singleBin == False:
 
             npomList = [yDataBinned[binName] for binName in yDataBinned]
-            yDataBinned = outputFile['Statistics/Histogram/%s/Binned y data' % histName]
-
             npomList.append(allNpoms)
 
             for listName in npomList:
-                weirdFwhmsRaw = []
-                weirdFwhmsNorm = []
-                weirdPositions = []
-                weirdHeightsRaw = []
-                weirdHeightsNorm = []
-                cmFwhmsRaw = []
-                cmFwhmsNorm = []
-                cmPositions = []
-                cmHeightsRaw = []
-                cmHeightsNorm = []
-                tmHeightsRaw = []
-                irsNorm = []
-                irsRaw = []
-                attrAvgs = {}
-
-                for spectraName in listName:
-
-                    if spectraName != 'Sum':
-                        attrNames = ['Weird peak FWHM (raw)', 'Weird peak FWHM (norm)', 'Weird peak wavelength', 'Weird peak intensity (raw)',
-                                     'Weird peak intensity (norm)', 'Coupled mode FWHM (raw)', 'Coupled mode FWHM (norm)', 'Coupled mode wavelength',
-                                     'Coupled mode intensity (raw)', 'Coupled mode intensity (norm)', 'Transverse mode intensity (raw)',
-                                     'Intensity ratio (from norm)', 'Intensity ratio (raw)']
-                        attrLists = [weirdFwhmsRaw, weirdFwhmsNorm, weirdPositions, weirdHeightsRaw, weirdHeightsNorm, cmFwhmsRaw, cmFwhmsNorm,
-                                     cmPositions, cmHeightsRaw, cmHeightsNorm, tmHeightsRaw, irsNorm, irsRaw]
-
-                        for n, attrName in enumerate(attrNames):
-                            attr = allNpoms[spectraName].attrs[attrName]
-
-                            if attr != 'N/A':
-                                attrLists[n].append(attr)
-
-                for n, attrList in enumerate(attrLists):
-                    attrList = np.array(attrList)
-
-                    if len(attrList) != 0:
-                        attrAvg = np.average(attrList)
-
-                    else:
-
-                        if 'Weird peak intensity' in attrNames[n]:
-                            attrAvg = 0
-
-                        else:
-                            attrAvg = 'N/A'
-
-                    attrAvgs[attrNames[n] + '(average)'] = attrAvg
-
-                listName.attrs.update(attrAvgs)
+                spectrumNames = [spectraName for spectraName in listName if spectraName != 'Sum']
+                listName.attrs.update(calcAttrAverages(results, spectrumNames))
 
         elif singleBin == True:
 
@@ -2633,39 +2559,8 @@ def peakAverages(outputFile, singleBin = False, peakPos = 0):
                     npomList = yDataBinned[binName]
                     break
 
-            weirdFwhmsRaw = []
-            weirdFwhmsNorm = []
-            weirdPositions = []
-            weirdHeightsRaw = []
-            weirdHeightsNorm = []
-            cmFwhmsRaw = []
-            cmFwhmsNorm = []
-            cmPositions = []
-            cmHeightsRaw = []
-            cmHeightsNorm = []
-            tmHeightsRaw = []
-            attrAvgs = {}
-
-            for spectraName in npomList:
-                attrNames = ['Weird peak FWHM (raw)', 'Weird peak FWHM (norm)', 'Weird peak wavelength', 'Weird peak intensity (raw)',
-                             'Weird peak intensity (norm)', 'Coupled mode FWHM (raw)', 'Coupled mode FWHM (norm)', 'Coupled mode wavelength',
-                             'Coupled mode intensity (raw)', 'Coupled mode intensity (norm)', 'Transverse mode intensity (raw)',
-                             'Intensity ratio (from norm)', 'Intensity ratio (raw)']
-                attrLists = [weirdFwhmsRaw, weirdFwhmsNorm, weirdPositions, weirdHeightsRaw, weirdHeightsNorm, cmFwhmsRaw, cmFwhmsNorm,
-                             cmPositions, cmHeightsRaw, cmHeightsNorm, tmHeightsRaw, irsNorm, irsRaw]
-
-                for n, attrName in enumerate(attrNames):
-                    print attrName
-                    attr = allNpoms[spectraName].attrs[attrName]
-
-                    if attr != 'N/A':
-                        attrLists[n].append(attr)
-
-            for n, attrList in enumerate(attrLists):
-                attrList = np.array(attrList)
-                attrAvgs[attrNames[n]] = np.average(attrList)
-
-            npomList.attrs.update(attrAvgs)
+            spectrumNames = [spectraName for spectraName in npomList if spectraName != 'Sum']
+            npomList.attrs.update(calcAttrAverages(results, spectrumNames, suffix = ''))
 
     peakAvgEnd = time.time()
     timeElapsed = peakAvgEnd - peakAvgStart
@@ -2888,12 +2783,14 @@ def doStats(outputFile, minBinFactor = 5, sortSpec = True, replaceWhenSorting =
     print '\nStats done'
 
 def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monitorProgress = False, plot = False, irThreshold = 8,
-                  raiseExceptions = False, doublesThreshold = 2, closeFigures = False, fukkit = False, simpleFit = True, stats = True):
+                  raiseExceptions = False, doublesThreshold = 2, closeFigures = False, fukkit = False, simpleFit = True, stats = True,
+                  processes = None, chunkSize = None):
 
     absoluteStartTime = time.time()
 
     '''Fits all spectra and populates h5 file with relevant output data.
-       h5 file must be opened before the function and closed afterwards'''
+       h5 file must be opened before the function and closed afterwards
+       Spectra are fitted by a pool of processes (processes = None uses all cores) and written here in order'''
 
     print '\nBeginning fit procedure...'
 
@@ -2905,11 +2802,24 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
     detectionThreshold = 0
     doublesDist = 0
 
-    fittedSpectra = []
-    failedSpectra = []
+    fittedCount = 0
     failedSpectraIndices = []
+    resultNumbers = [] #Rows of the fit results table
+    resultRecords = []
+
+    if simpleFit == True:
+        fitFunction = analyseNpomPeaks
+        fitKwargs = dict(cutoff = 1500, fs = 60000, doublesThreshold = doublesThreshold, doublesDist = 0,
+                         monitorProgress = False, raiseExceptions = raiseExceptions, transPeakPos = 533, plot = plot)
 
-    nummers = range(5, 101, 5)
+    else:
+        fitFunction = fitNpomSpectrum
+        fitKwargs = dict(detectionThreshold = detectionThreshold, doublesThreshold = doublesThreshold,
+                         doublesDist = doublesDist, monitorProgress = monitorProgress, plot = plot, fukkit = fukkit,
+                         simpleFit = simpleFit, raiseExceptions = raiseExceptions)
+
+    if plot == True or monitorProgress == True:
+        processes = 1 #Plots and printouts from inside the fit only make sense in the main process
 
     totalFitStart = time.time()
     print '\n0% complete'
@@ -2921,60 +2831,26 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
     gCrap = gAll.create_group('Non-NPoMs')
     gSpecOnly = gAll.create_group('Raw')
 
-    for n, y in enumerate(yData[:]):
+    fitResults = fit_spectra(fitFunction, x, yData, start_index = startSpec, processes = processes, chunk_size = chunkSize,
+                             raise_exceptions = raiseExceptions, **fitKwargs)
+
+    for n, fittedSpectrum, fitError in fitResults:
 
-        nn = n
-        n += startSpec
+        y = yData[n - startSpec]
 
         if monitorProgress in [True, 'main']:
             print 'Spectrum %s' % n
 
-        if int(100 * nn / len(yData[:])) in nummers:
-            currentTime = time.time() - totalFitStart
-            mins = int(currentTime / 60)
-            secs = (np.round((currentTime % 60)*100))/100
-            print '%s%% (%s spectra) complete in %s min %s sec' % (nummers[0], nn, mins, secs)
-            nummers = nummers[1:]
-
-        if raiseExceptions == False:
-
-            try:
-
-                if simpleFit == True:
-                    fittedSpectrum = analyseNpomPeaks(x, y, cutoff = 1500, fs = 60000, doublesThreshold = doublesThreshold, doublesDist = 0,
-                                                      monitorProgress = False, raiseExceptions = False, transPeakPos = 533, plot = plot)
-
-                else:
-                    fittedSpectrum = fitNpomSpectrum(x, y, detectionThreshold = detectionThreshold, doublesThreshold = doublesThreshold,
-                                                     doublesDist = doublesDist, monitorProgress = monitorProgress, plot = plot, fukkit = fukkit,
-                                                     simpleFit = simpleFit, raiseExceptions = raiseExceptions)
-                fittedSpectra.append(fittedSpectrum)
-                fitError = 'N/A'
-
-            except Exception as e:
-                #raise e
-                fittedSpectrum = DF_Spectrum(y, 'N/A', False, 'N/A', 'N/A', 'N/A')
-                fittedSpectrum = fittedSpectrum.metadata
-                failedSpectra.append(fittedSpectrum)
-                failedSpectraIndices.append(n)
-                fitError = e
-
-                print 'Spectrum %s failed because: \n\t"%s"' % (n, e)
-
-        elif raiseExceptions == True:
-            #print n
-
-            if simpleFit == True:
+        if fitError is None:
+            fittedCount += 1
+            fitError = 'N/A'
 
-                fittedSpectrum = analyseNpomPeaks(x, y, cutoff = 1500, fs = 60000, doublesThreshold = doublesThreshold, doublesDist = 0,
-                                                  monitorProgress = False, raiseExceptions = raiseExceptions, transPeakPos = 533, plot = plot)
+        else:
+            fittedSpectrum = DF_Spectrum(y, 'N/A', False, 'N/A', 'N/A', 'N/A')
+            fittedSpectrum = fittedSpectrum.metadata
+            failedSpectraIndices.append(n)
 
-            else:
-                fittedSpectrum = fitNpomSpectrum(x, y, detectionThreshold = detectionThreshold, doublesThreshold = doublesThreshold,
-                                                 doublesDist = doublesDist, monitorProgress = monitorProgress, plot = plot, fukkit = fukkit,
-                                                 simpleFit = simpleFit, raiseExceptions = raiseExceptions)
-            fittedSpectra.append(fittedSpectrum)
-            fitError = 'N/A'
+            print 'Spectrum %s failed because: \n\t"%s"' % (n, fitError)
 
         '''Adds data to open HDF5 file'''
 
@@ -3029,6 +2905,9 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
             g.attrs['Intensity ratio (raw)'] = fittedSpectrum['Intensity ratio (raw)']
             g.attrs['Error(s)'] = str(fitError)
 
+            resultNumbers.append(n)
+            resultRecords.append(dict(g.attrs))
+
             gRaw = g.create_group('Raw/')
 
             dRaw = gRaw.create_dataset('Raw data', data = rawData)
@@ -3089,6 +2968,9 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
 
     gFitted.attrs['Failed spectra indices'] = failedSpectraIndices
 
+    resultsTable = FitResultsTable.from_records(resultNumbers, resultRecords)
+    resultsTable.save(outputFile.create_group('Fit results'))
+
     print '100% complete'
     totalFitEnd = time.time()
     timeElapsed = totalFitEnd - totalFitStart
@@ -3096,7 +2978,7 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
     mins = int(timeElapsed / 60)
     secs = int(np.round(timeElapsed % 60))
 
-    print '\n%s spectra fitted in %s min %s sec' % (nn + 1, mins, secs)
+    print '\n%s spectra fitted in %s min %s sec' % (len(yData), mins, secs)
 
     if stats == True:
         doStats(outputFile, closeFigures = closeFigures, doubBools = False, pointyPeaks = False, irThreshold = irThreshold)
@@ -3109,20 +2991,20 @@ def fitAllSpectra(x, yData, outputFile, summaryAttrs = {}, startSpec = 0, monito
 
     printEnd()
 
-    if len(failedSpectra) == 0:
+    if len(failedSpectraIndices) == 0:
         print '\nFinished in %s min %s sec. Smooth sailing.' % (mins, secs)
 
-    elif len(failedSpectra) == 1:
-        print '\nPhew... finished in %s min %s sec with only %s failure' % (mins, secs, len(failedSpectra))
+    elif len(failedSpectraIndices) == 1:
+        print '\nPhew... finished in %s min %s sec with only %s failure' % (mins, secs, len(failedSpectraIndices))
 
-    elif len(failedSpectra) > len(fittedSpectra):
-        print '\nHmmm... finished in %s min %s sec but with %s failures and only %s successful fits' % (mins, secs, len(failedSpectra),
-                                                                                                        len(fittedSpectra))
+    elif len(failedSpectraIndices) > fittedCount:
+        print '\nHmmm... finished in %s min %s sec but with %s failures and only %s successful fits' % (mins, secs, len(failedSpectraIndices),
+                                                                                                        fittedCount)
     elif mins > 30:
         print '\nM8 that took ages. %s min %s sec' % (mins, secs)
 
     else:
-        print '\nPhew... finished in %s min %s sec with only %s failures' % (mins, secs, len(failedSpectra))
+        print '\nPhew... finished in %s min %s sec with only %s failures' % (mins, secs, len(failedSpectraIndices))
 
     print ''
 
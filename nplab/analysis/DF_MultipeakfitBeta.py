@@ -19,6 +19,8 @@ import time
 from random import randint
 import scipy.optimize as spo
 import re
+from nplab.analysis.parallel_fitting import fit_spectra
+from nplab.analysis.summary_spectra import main_scan_name
 
 if __name__ == '__main__':
     absoluteStartTime = time.time()
@@ -167,8 +169,7 @@ def retrieveData(directory, summaryNameFormat = 'summary', first = 0, last = 0,
 
     with h5py.File(summaryFile) as f:
 
-        mainDatasetName = sorted([scan for scan in f['particleScanSummaries/'].keys()],
-                           key = lambda scan: len(f['particleScanSummaries/'][scan]['spectra']))[-1]
+        mainDatasetName = main_scan_name(f)
 
         mainDataset = f['particleScanSummaries/'][mainDatasetName]['spectra']
         summaryAttrs = {key : mainDataset.attrs[key] for key in mainDataset.attrs.keys()}
@@ -181,7 +182,7 @@ def retrieveData(directory, summaryNameFormat = 'summary', first = 0, last = 0,
         if last == 0:
             last = len(mainDataset)
 
-        spectra = mainDataset[()][first:last]
+        spectra = mainDataset[first:last] #Only reads the spectra needed
         wavelengths = summaryAttrs['wavelengths'][()]
         nSpec = len(spectra)
 
@@ -1507,7 +1508,9 @@ def doStats(outputFileName, closeFigures = True, stacks = True, hist = True, all
     if analRep == True:
         analyseRepresentative(outputFileName)
 
-def fitAllSpectra(x, yData, outputFileName, summaryAttrs = False, first = 0, last = 0, stats = True, raiseExceptions = False, closeFigures = True):
+def fitAllSpectra(x, yData, outputFileName, summaryAttrs = False, first = 0, last = 0, stats = True, raiseExceptions = False, closeFigures = True,
+                  processes = None, chunkSize = None):
+    '''Spectra are analysed by a pool of processes (processes = None uses all cores) and written to the output file in order'''
     absoluteStartTime = time.time()
 
     if last == 0:
@@ -1563,20 +1566,15 @@ def fitAllSpectra(x, yData, outputFileName, summaryAttrs = False, first = 0, las
         if len(yData) > 2500:
             print '\tAbout to fit %s spectra. This may take a while...' % len(yData)
 
-        nummers = range(5, 101, 5)
         totalFitStart = time.time()
         print '\n0% complete'
 
-        for n, spectrum in enumerate(yData[first:last]):
-            nn = n # Keeps track of our progress through our list of spectra
-            n += first # For correlation with particle groups in original dataset
+        fitResults = fit_spectra(analyseNpomSpectrum, x, yData[first:last], start_index = first, processes = processes,
+                                 chunk_size = chunkSize, raise_exceptions = raiseExceptions)
 
-            if int(100 * nn / len(yData[:])) in nummers:
-                currentTime = time.time() - totalFitStart
-                mins = int(currentTime / 60)
-                secs = (np.round((currentTime % 60)*100))/100
-                print '%s%% (%s spectra) analysed in %s min %s sec' % (nummers[0], nn, mins, secs)
-                nummers = nummers[1:]
+        for n, specAttrs, error in fitResults:
+            nn = n - first # Keeps track of our progress through our list of spectra
+            spectrum = yData[n] # n is the index for correlation with particle groups in original dataset
 
             spectrumName = 'Spectrum %s' % n
             gAllRaw[spectrumName] = spectrum
@@ -1585,27 +1583,17 @@ def fitAllSpectra(x, yData, outputFileName, summaryAttrs = False, first = 0, las
                 gAllRaw[spectrumName].attrs['wavelengths'] = x
 
             else:
-                gAllRaw[spectrumName].attrs['wavelengths'] = gAllRaw['Spectrum 0'].attrs['wavelengths']
-
-            if raiseExceptions == True:
-                specAttrs = analyseNpomSpectrum(x, spectrum)
-
-            else:
-
-                try:
-                    specAttrs = analyseNpomSpectrum(x, spectrum)#Main spectral analysis function
-
-                except Exception as e:
-
-                    print '%s failed because %s' % (spectrumName, e)
-                    gAllRaw[spectrumName].attrs['Failure reason'] = str(e)
-                    gAllRaw[spectrumName].attrs['wavelengths'] = x
+                gAllRaw[spectrumName].attrs['wavelengths'] = gAllRaw['Spectrum %s' % first].attrs['wavelengths']
 
+            if error is not None:
+                print '%s failed because %s' % (spectrumName, error)
+                gAllRaw[spectrumName].attrs['Failure reason'] = error
+                gAllRaw[spectrumName].attrs['wavelengths'] = x
 
-                    gFailed[spectrumName] = gAllRaw[spectrumName]
-                    gFailed[spectrumName].attrs['Failure reason'] = gAllRaw[spectrumName].attrs['Failure reason']
-                    gFailed[spectrumName].attrs['wavelengths'] = gAllRaw[spectrumName].attrs['wavelengths']
-                    continue
+                gFailed[spectrumName] = gAllRaw[spectrumName]
+                gFailed[spectrumName].attrs['Failure reason'] = gAllRaw[spectrumName].attrs['Failure reason']
+                gFailed[spectrumName].attrs['wavelengths'] = gAllRaw[spectrumName].attrs['wavelengths']
+                continue
 
             del specAttrs['Raw data']
             gAllRaw[spectrumName].attrs.update(specAttrs)
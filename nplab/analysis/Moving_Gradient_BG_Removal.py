@@ -19,48 +19,95 @@ by 100.*((1./6)**Set Length) = Peak_Tolerance. The backround signal gradients ar
 possible peak positions. 
 
 These iterations are stopped when they reach Maximum_Iterations or when the list of possible peak positions converges.
+
+To remove the background from many signals of the same length at once, use Run_Batch(Signals,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5) with a 2D
+array of signals (one per row). Each row gives the same result as Run.
 """
 
+def Window_Medians(Values,Window,Signal_Length,Max_Elements=10**7):
+	"""
+	Values is a 2D array of line gradients (one row per signal), which are NaN for lines that are not allowed. Line i bounds points i to i+Window.
+	Returns the median of the allowed gradients assigned to each point, or NaN where there are none. The lines bounding each point are read
+	through a strided window view, which is sorted (NaNs sort last) in blocks of rows holding up to Max_Elements values.
+	"""
+	Number=len(Values)
+	Padded=np.full((Number,Signal_Length+Window),np.nan)
+	Padded[:,Window:Window+Values.shape[1]]=Values
+	Valid=np.zeros((Number,Signal_Length+Window+1),dtype=int)
+	Valid[:,1:]=np.cumsum(np.logical_not(np.isnan(Padded)),axis=1)
+	Counts=Valid[:,Window+1:]-Valid[:,:Signal_Length]  #Number of allowed lines bounding each point
+
+	Output=np.full((Number,Signal_Length),np.nan)
+	Step=max(1,Max_Elements//(Signal_Length*(Window+1)))
+	for i in range(0,Number,Step):
+		Block=Padded[i:i+Step]
+		Views=np.lib.stride_tricks.as_strided(Block,shape=(len(Block),Signal_Length,Window+1),strides=(Block.strides[0],Block.strides[1],Block.strides[1]))
+		Sorted=np.sort(Views,axis=2)
+		Count=Counts[i:i+Step]
+		Lower=np.take_along_axis(Sorted,np.maximum((Count-1)//2,0)[:,:,np.newaxis],axis=2)[:,:,0]
+		Upper=np.take_along_axis(Sorted,np.maximum(Count//2,0)[:,:,np.newaxis],axis=2)[:,:,0]
+		Output[i:i+Step]=np.where(Count>0,0.5*(Lower+Upper),np.nan)
+	return Output
+
 def Construct_Background(Gradient,Not_Allowed,Window,Signal_Length):
 	"""
 	Function that takes a list of gradients (Gradient), a list indicating whether points represent possible peak postions (Not_Allowed), the window size
-	and the length of the signal and reconstructs the BG signal + a constant.
+	and the length of the signal and reconstructs the BG signal + a constant. Gradient and Not_Allowed can also be 2D arrays, with one row per signal,
+	in which case a 2D array of backgrounds is returned.
 	"""
 
-	#---Estimate gradient at each position----
+	Single=np.ndim(Not_Allowed)==1
+	Gradient=np.atleast_2d(np.asarray(Gradient,dtype=float))
+	Not_Allowed=np.atleast_2d(np.asarray(Not_Allowed,dtype=bool))
 
-	Average=[]
-	while len(Average)<Signal_Length:
-		Average.append([])
+	#---Estimate gradient at each position----
 
-	for i in range(len(Gradient)):
-		if Not_Allowed[i] is False and Not_Allowed[i+Window] is False:
-			n=0
-			while n<=Window:
-				Average[n+i].append(Gradient[i])
-				n+=1
+	Lines=Gradient.shape[1]
+	Allowed=np.logical_not(np.logical_or(Not_Allowed[:,:Lines],Not_Allowed[:,Window:Window+Lines]))
+	Average=Window_Medians(np.where(Allowed,Gradient,np.nan),Window,Signal_Length)
 
 	#--- Ensure every point has a gradient----
 
-	if len(Average[0])==0:
-		Average[0]=[0]
-	for i in range(len(Average)):
-		if len(Average[i])==0:
-			Average[i]=Average[i-1]
+	Missing=np.isnan(Average)
+	Average[:,0][Missing[:,0]]=0
+	Missing[:,0]=False
+	Previous=np.maximum.accumulate(np.where(Missing,0,np.arange(Signal_Length)),axis=1)
+	Average=np.take_along_axis(Average,Previous,axis=1)
 
 	#---Integrate up output------
 
-	Output=[0.]
-	for i in Average:
-		Output.append(Output[-1]+np.median(i))
-
-	return np.array(Output[:-1])
+	Output=np.zeros(Average.shape)
+	Output[:,1:]=np.cumsum(Average,axis=1)[:,:-1]
 
+	if Single is True:
+		return Output[0]
+	return Output
 
-def Run(Signal,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5):
+def Possible_Peak_Regions(Clean,Point_Run):
 	"""
-	Main function, explained at the top of the page.
+	For each row of the 2D array Clean, finds the points that are in runs of at least Point_Run points at or above the noise threshold
+	(the median of the absolute signal). Returns a boolean array.
+	"""
+	Threshold=np.median(np.abs(Clean),axis=1)
+	Over=np.zeros((len(Clean),Clean.shape[1]+2),dtype=int)  #Padded so that runs never continue between rows
+	Over[:,1:-1]=Clean>=Threshold[:,np.newaxis]
+	Change=np.diff(Over.ravel())
+	Starts=np.flatnonzero(Change==1)+1
+	Ends=np.flatnonzero(Change==-1)+1
+	Long=(Ends-Starts)>=Point_Run
+
+	Marks=np.zeros(Over.size+1,dtype=int)
+	np.add.at(Marks,Starts[Long],1)
+	np.add.at(Marks,Ends[Long],-1)
+	return (np.cumsum(Marks)[:-1]>0).reshape(Over.shape)[:,1:-1]
+
+def Run_Batch(Signals,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5):
 	"""
+	Runs the background removal (explained at the top of the page) on every row of the 2D array Signals. Rows stop iterating independently.
+	"""
+
+	Signals=np.atleast_2d(np.asarray(Signals,dtype=float))
+	Signal_Length=Signals.shape[1]
 
 	#---Ensure Window fits contraints---
 
@@ -70,21 +117,13 @@ def Run(Signal,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5):
 
 	#--Calcuate gradients-------
 
-	Gradient=[]
-	n=Window
-	while n<len(Signal):
-		Gradient.append(float(Signal[n]-Signal[n-Window])/Window)
-		n+=1
-	Not_Allowed=[]
-	while len(Not_Allowed)<len(Signal):
-		Not_Allowed.append(False)
+	Gradient=(Signals[:,Window:]-Signals[:,:max(Signal_Length-Window,0)])/Window
+	Not_Allowed=np.zeros(Signals.shape,dtype=bool)
 
 	#----Initial estimate-----
 
-	Background=Construct_Background(Gradient,Not_Allowed,Window,len(Signal))
-
-	Clean=np.array(Signal)-Background
-	Clean=Clean-np.median(Clean)
+	Clean=Signals-Construct_Background(Gradient,Not_Allowed,Window,Signal_Length)
+	Clean-=np.median(Clean,axis=1)[:,np.newaxis]
 
 	#---Calculate number of points over the noise threshold that correspond to a possible peak
 
@@ -94,36 +133,23 @@ def Run(Signal,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5):
 
 	#---Iterate background estimation, ignoring possible peak positions-----
 
-	Iterate=True
+	Active=np.arange(len(Signals))
 	Iterations=0
-	while Iterate is True and Iterations<Maximum_Iterations:
+	while len(Active)>0 and Iterations<Maximum_Iterations:
 		Iterations+=1
-		Possible_Peak_Regions=[]
-		Current_Run=[]
-		Threshold=np.median(np.abs(Clean))
-		for i in range(len(Signal)):
-			if Clean[i]>=Threshold:
-				Current_Run.append(i)
-			else:
-				if len(Current_Run)>=Point_Run:
-					Possible_Peak_Regions+=Current_Run
-				Current_Run=[]
-		if len(Current_Run)>=Point_Run:
-			Possible_Peak_Regions+=Current_Run
-
-		New_Not_Allowed=[]
-		for i in range(len(Signal)):
-			if i in Possible_Peak_Regions:
-				New_Not_Allowed.append(True)
-			else:
-				New_Not_Allowed.append(False)
-
-		if np.array_equal(Not_Allowed,New_Not_Allowed)==False:
-			Not_Allowed=New_Not_Allowed
-			Background=Construct_Background(Gradient,Not_Allowed,Window,len(Signal))
-			Clean=np.array(Signal)-Background
-			Clean=Clean-np.median(Clean)
-		else:
-			Iterate=False
-
-	return Clean
\ No newline at end of file
+		New_Not_Allowed=Possible_Peak_Regions(Clean[Active],Point_Run)
+		Changed=np.any(New_Not_Allowed!=Not_Allowed[Active],axis=1)
+		Active=Active[Changed]
+		if len(Active)>0:
+			Not_Allowed[Active]=New_Not_Allowed[Changed]
+			New_Clean=Signals[Active]-Construct_Background(Gradient[Active],Not_Allowed[Active],Window,Signal_Length)
+			Clean[Active]=New_Clean-np.median(New_Clean,axis=1)[:,np.newaxis]
+
+	return Clean
+
+def Run(Signal,Window=50,Maximum_Iterations=10,Peak_Tolerance=0.5):
+	"""
+	Main function, explained at the top of the page.
+	"""
+
+	return Run_Batch(np.asarray(Signal,dtype=float)[np.newaxis],Window,Maximum_Iterations,Peak_Tolerance)[0]
@@ -0,0 +1,185 @@
+"""
+Multi Peak Fitting Engine
+
+Fits a constant plus a sum of Lorentzian or Gaussian peaks to single spectra or to whole (N, pixels) arrays of spectra, such as a
+spectral time series. This is shared by Peak_Fitting_UI and Auto_Fit_Raman.
+
+Parameters are always ordered [Constant, Peak Centre, Peak Width, Peak Height, Peak Centre,.......]. For a Lorentzian the width is
+the half width at half maximum, for a Gaussian it is the standard deviation.
+
+The fits use analytic Jacobians, so curve_fit does not need to estimate derivatives numerically. For arrays, initial peak heights
+are found for every spectrum at once and each spectrum can start from the fit to the previous one (Warm_Start), which is much
+faster for slowly changing time series. Fit_Array splits an array into chunks of consecutive spectra and fits the chunks in
+parallel.
+"""
+
+import numpy as np
+import multiprocessing as mp
+import scipy.optimize as spo
+
+def Lorentzian(x,Centre,Width,Height):
+	"""
+	Defines a Lorentzian
+	"""
+	return Height/(1+(((x-Centre)/Width)**2))
+
+def Gaussian(x,Centre,Width,Height):
+	"""
+	Defines a Gaussian
+	"""
+	return Height*np.exp(-0.5*(((x-Centre)/Width)**2))
+
+def _Peak_Parameters(x,Params):
+	"""
+	Splits Params into the constant and (1, peaks) arrays of centres, widths and heights, and returns these with u=(x-Centre)/Width
+	as a (len(x), peaks) array
+	"""
+	Params=np.asarray(Params,dtype=float)
+	Centres,Widths,Heights=Params[1:].reshape(-1,3).T
+	u=(np.asarray(x,dtype=float)[:,np.newaxis]-Centres)/Widths
+	return Params[0],Centres,Widths,Heights,u
+
+def Constant_plus_Peaks(x,*Params,**kwargs):
+	"""
+	Defines a constant plus an arbitary sum of peaks. Shape (a keyword argument) is 'Lorentzian' (the default) or 'Gaussian'.
+	"""
+	Shape=kwargs.get('Shape','Lorentzian')
+	Constant,Centres,Widths,Heights,u=_Peak_Parameters(x,Params)
+	if Shape=='Lorentzian':
+		Peaks=Heights/(1+u**2)
+	elif Shape=='Gaussian':
+		Peaks=Heights*np.exp(-0.5*u**2)
+	else:
+		raise ValueError('Unknown peak shape: %s' % Shape)
+	return Constant+np.sum(Peaks,axis=1)
+
+def Constant_plus_Peaks_Jacobian(x,*Params,**kwargs):
+	"""
+	Analytic Jacobian of Constant_plus_Peaks with respect to Params. Returns a (len(x), len(Params)) array.
+	"""
+	Shape=kwargs.get('Shape','Lorentzian')
+	Constant,Centres,Widths,Heights,u=_Peak_Parameters(x,Params)
+	Jacobian=np.empty((len(u),len(Params)))
+	Jacobian[:,0]=1.
+	if Shape=='Lorentzian':
+		Profile=1/(1+u**2)
+		dC=Heights*2*u*(Profile**2)/Widths
+		dW=dC*u
+	elif Shape=='Gaussian':
+		Profile=np.exp(-0.5*u**2)
+		dC=Heights*Profile*u/Widths
+		dW=dC*u
+	else:
+		raise ValueError('Unknown peak shape: %s' % Shape)
+	Jacobian[:,1::3]=dC
+	Jacobian[:,2::3]=dW
+	Jacobian[:,3::3]=Profile
+	return Jacobian
+
+def Fit_Spectrum(x,y,Initial,Bounds=(-np.inf,np.inf),Shape='Lorentzian'):
+	"""
+	Fits one spectrum y. Returns [Parameters, Errors], or [None, None] if the fit fails.
+	"""
+	Function=lambda x,*Params: Constant_plus_Peaks(x,*Params,Shape=Shape)
+	Jacobian=lambda x,*Params: Constant_plus_Peaks_Jacobian(x,*Params,Shape=Shape)
+	try:
+		Output=spo.curve_fit(Function,x,y,Initial,bounds=Bounds,jac=Jacobian)
+		return [Output[0],np.sqrt(np.diag(Output[1]))]
+	except (RuntimeError,ValueError):
+		return [None,None]
+
+def Initial_Heights(Array,x_axis,Centres,Width):
+	"""
+	For each spectrum in Array (N, pixels) and each peak centre, finds the height (max-min) of the spectrum within Width of the centre.
+	Returns an (N, peaks) array. x_axis must be increasing.
+	"""
+	Array=np.atleast_2d(Array)
+	Centres=np.asarray(Centres,dtype=float)
+	Lower=np.searchsorted(x_axis,Centres-(0.5*Width))
+	Upper=np.maximum(np.searchsorted(x_axis,Centres+(0.5*Width)),Lower+1)
+	Heights=np.empty((len(Array),len(Centres)))
+	for i in range(len(Centres)):
+		Section=Array[:,Lower[i]:Upper[i]]
+		Heights[:,i]=np.max(Section,axis=1)-np.min(Section,axis=1)
+	return Heights
+
+def Initial_Parameters(Array,x_axis,Centres,Width):
+	"""
+	Initial guesses for every spectrum in Array: zero constant and the given centres and width, with heights from Initial_Heights.
+	Returns an (N, 1+3*peaks) array.
+	"""
+	Heights=Initial_Heights(Array,x_axis,Centres,Width)
+	Initial=np.zeros((len(Heights),1+3*len(Centres)))
+	Initial[:,1::3]=Centres
+	Initial[:,2::3]=Width
+	Initial[:,3::3]=Heights
+	return Initial
+
+def Peak_Bounds(x_axis,Number_Of_Peaks):
+	"""
+	Default bounds: peak centres within the x range and positive widths and heights.
+	"""
+	Lower=[-np.inf]+[np.min(x_axis),0,0]*Number_Of_Peaks
+	Upper=[np.inf]+[np.max(x_axis),np.inf,np.inf]*Number_Of_Peaks
+	return (Lower,Upper)
+
+def Fit_Batch(Array,x_axis,Initial,Bounds,Shape='Lorentzian',Warm_Start=True):
+	"""
+	Fits each spectrum in Array (N, pixels) in turn. Initial is either one set of initial parameters or one per spectrum. If
+	Warm_Start is True, each spectrum starts from the fit to the previous spectrum (if it succeeded) instead. Returns arrays of
+	Parameters and Errors, each (N, parameters), which are NaN where the fit failed.
+	"""
+	Array=np.atleast_2d(Array)
+	Initial=np.asarray(Initial,dtype=float)
+	if Initial.ndim==1:
+		Initial=np.tile(Initial,(len(Array),1))
+	Lower,Upper=[np.broadcast_to(np.asarray(i,dtype=float),Initial.shape[1:]) for i in Bounds]
+	Parameters=np.full(Initial.shape,np.nan)
+	Errors=np.full(Initial.shape,np.nan)
+	Previous=None
+	for i in range(len(Array)):
+		Warm=Warm_Start is True and Previous is not None
+		if Warm is True:
+			Start=Previous
+		else:
+			Start=Initial[i]
+		Start=np.clip(Start,Lower,Upper)
+		Params,Errs=Fit_Spectrum(x_axis,Array[i],Start,(Lower,Upper),Shape)
+		if Params is None and Warm is True:
+			Params,Errs=Fit_Spectrum(x_axis,Array[i],np.clip(Initial[i],Lower,Upper),(Lower,Upper),Shape) #Warm start failed, so try the normal guess
+		if Params is not None:
+			Parameters[i]=Params
+			Errors[i]=Errs
+		Previous=Params
+	return Parameters,Errors
+
+def _Fit_Batch_Worker(Args):
+	return Fit_Batch(*Args)
+
+def Fit_Array(Array,x_axis,Center_Guesses,Width_Guess,Shape='Lorentzian',Cores=1,Chunk_Size=None,Warm_Start=True,Bounds=None):
+	"""
+	Fits every spectrum in Array (N, pixels) with peaks starting at Center_Guesses, all with width Width_Guess. Consecutive spectra
+	are fitted in chunks (of Chunk_Size, by default enough for a few per core) using Cores processes, with warm starts within each
+	chunk. Returns arrays of Parameters and Errors, each (N, 1+3*peaks), which are NaN where the fit failed.
+	"""
+	Array=np.atleast_2d(Array)
+	x_axis=np.asarray(x_axis,dtype=float)
+	Initial=Initial_Parameters(Array,x_axis,Center_Guesses,Width_Guess)
+	if Bounds is None:
+		Bounds=Peak_Bounds(x_axis,len(Center_Guesses))
+
+	if Chunk_Size is None:
+		Chunk_Size=max(1,int(np.ceil(len(Array)/(4.*Cores))))
+	Chunks=[(Array[i:i+Chunk_Size],x_axis,Initial[i:i+Chunk_Size],Bounds,Shape,Warm_Start) for i in range(0,len(Array),Chunk_Size)]
+
+	if Cores>1 and len(Chunks)>1:
+		Pool=mp.Pool(processes=Cores)
+		try:
+			Results=Pool.map(_Fit_Batch_Worker,Chunks)
+		finally:
+			Pool.close()
+			Pool.join()
+	else:
+		Results=[_Fit_Batch_Worker(i) for i in Chunks]
+
+	return np.concatenate([i[0] for i in Results]),np.concatenate([i[1] for i in Results])
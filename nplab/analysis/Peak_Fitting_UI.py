@@ -25,7 +25,7 @@ matplotlib.use('Qt4Agg')
 import matplotlib.pyplot as pl
 import numpy as np
 import multiprocessing as mp
-import scipy.optimize as spo
+from nplab.analysis import Multi_Peak_Fitting
 
 def Select_Time_Range(Min,Max):
 	"""
@@ -220,78 +220,29 @@ def Lorentzian(x,Centre,Width,Height):
 	"""
 	Defines a Lorentzian
 	"""
-	return Height/(1+(((x-Centre)/Width)**2))
+	return Multi_Peak_Fitting.Lorentzian(x,Centre,Width,Height)
 
 def Constant_plus_Lorentzians(x,*Params):
 	"""
 	Defines a constant plus an arbitary sum of Lorentzians
 	"""
-	Output=Params[0]
-	n=1
-	while n<len(Params):
-		Output+=Lorentzian(x,*Params[n:n+3])
-		n+=3
-	return Output
+	return Multi_Peak_Fitting.Constant_plus_Peaks(x,*Params)
 
-def Fitting_Worker(Function,x,y,Initial,Bounds,Label):
-	"""
-	Worker to complete the fitting. Function is function to fit. x and y is the data. Initial is a guess for the fitting parameters.
-	Bounds are the bounds for the fitting. Label is a number labelling which spectrum is being fit here. Returns [Parameters, Errors] which can 
-	all be None if the fitting fails.
-	"""
-	try:
-		Output=spo.curve_fit(Function,x,y,Initial,bounds=Bounds)
-		Output=[Output[0],np.sqrt(np.diag(Output[1])),Label]
-	except RuntimeError:
-		Output=[]
-		while len(Output)<len(Initial):
-			Output.append(None)
-		Output=[Output,Output,Label]
-	return Output
-
-def Run_Fitting(Array,x_axis,Center_Guesses,Width_Guess,Cores):
+def Run_Fitting(Array,x_axis,Center_Guesses,Width_Guess,Cores,Warm_Start=True):
 	"""
 	Takes an array, the x_axis list, guesses for the peak positions (Center_Guesses) and a peak width (Width_Guess) and completes the fitting using Cores cores.
+	The fitting itself is done by Multi_Peak_Fitting.Fit_Array. If Warm_Start is True, each spectrum starts from the fit to the previous one.
+	Returns [Parameters, Errors] for each spectrum, which are lists of None if the fitting fails.
 	"""
 
-	Bounds_Lower=[-np.inf]
-	Bounds_Upper=[np.inf]
-	for i in range(len(Center_Guesses)):
-		Bounds_Lower+=[x_axis[0],0,0]
-		Bounds_Upper+=[x_axis[-1],np.inf,np.inf]
-
-	Processes=[]
-	Pool=mp.Pool(processes=Cores)
-
-	for i in range(len(Array)):
-
-		Heights=[]
+	Parameters,Errors=Multi_Peak_Fitting.Fit_Array(Array,x_axis,Center_Guesses,Width_Guess,Cores=Cores,Warm_Start=Warm_Start)
 
-		for j in Center_Guesses:
-			Lower_x=j-(0.5*Width_Guess)
-			Upper_x=j+(0.5*Width_Guess)
-			Lower_element=0
-			while x_axis[Lower_element]<Lower_x:
-				Lower_element+=1
-			Upper_element=Lower_element
-			while x_axis[Upper_element]<Upper_x:
-				Upper_element+=1
-			Heights.append(np.max(Array[i][Lower_element:Upper_element])-np.min(Array[i][Lower_element:Upper_element]))
-
-		Initial=[0.]
-		for j in range(len(Center_Guesses)):
-			Initial+=[Center_Guesses[j],Width_Guess,Heights[j]]
-
-		Processes.append(Pool.apply_async(Fitting_Worker,args=(Constant_plus_Lorentzians,x_axis,Array[i],Initial,(Bounds_Lower,Bounds_Upper),i)))
-
-	Results=[p.get() for p in Processes]
-
-	Pool.close()
-
-	Results=Quick_Sort(Results,2)
-
-	for i in range(len(Results)):
-		Results[i]=Results[i][:-1]
+	Results=[]
+	for i in range(len(Parameters)):
+		if np.any(np.isnan(Parameters[i])):
+			Results.append([[None]*len(Parameters[i]),[None]*len(Parameters[i])])
+		else:
+			Results.append([Parameters[i],Errors[i]])
 
 	return Results
 
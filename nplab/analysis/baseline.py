@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Asymmetric least squares (ALS) baseline estimation.
+
+The ALS baseline z of a spectrum y minimises sum(w*(y - z)**2) + lambd*sum(diff(z, 2)**2), with
+the weights w re-estimated on each iteration so that points above the baseline (peaks) count
+for little. The system matrix W + lambd*D'D is symmetric and pentadiagonal, so it is stored
+in banded form and solved with a banded Cholesky decomposition. The penalty band only depends
+on the spectrum length and is cached, and a stack of spectra is solved as one block-diagonal
+banded system, so there is no per-spectrum matrix construction.
+"""
+
+import numpy as np
+from scipy.linalg import solveh_banded
+
+_penalty_cache = {}
+
+def difference_penalty_band(L):
+    '''The upper band (3, L) of D'D, where D is the (L - 2, L) second difference operator, in the
+    form used by scipy.linalg.solveh_banded. The result is cached and must not be modified.'''
+    if L not in _penalty_cache:
+        band = np.zeros((3, L))
+        if L > 2:
+            # each row of D is [1, -2, 1], so the diagonals of D'D are sums of their products
+            band[2] = np.convolve(np.ones(L - 2), [1., 4., 1.])
+            band[1, 1:] = np.convolve(np.ones(L - 2), [-2., -2.])
+            band[0, 2:] = 1.
+        band.flags.writeable = False
+        _penalty_cache[L] = band
+    return _penalty_cache[L]
+
+def baseline_als_batch(spectra, lambd, p, iterations = 10):
+    '''Calculates the ALS baseline of each row of an (N, L) array of spectra
+    lambd ~ 10^n (smoothness)
+    p ~ 10^(-m) (asymmetry)'''
+    spectra = np.atleast_2d(np.asarray(spectra, dtype = np.float64))
+    N, L = spectra.shape
+    y = spectra.ravel()
+    # the spectra are independent, so they can be solved together as a block diagonal system;
+    # the tiled penalty band is already zero where it would couple neighbouring spectra
+    penalty = lambd*np.tile(difference_penalty_band(L), (1, N))
+    w = np.ones(N*L)
+    ab = penalty.copy()
+
+    for i in xrange(iterations):
+        ab[2] = penalty[2] + w
+        z = solveh_banded(ab, w*y, overwrite_ab = False, check_finite = False)
+        w = p * (y > z) + (1-p) * (y < z)
+
+    return z.reshape(N, L)
+
+def baseline_als(y, lambd, p, iterations = 10):
+    '''Calculates the ALS baseline for a 1D spectrum, or for each row of a 2D array
+    lambd ~ 10^n
+    p ~10^(-m)'''
+    y = np.asarray(y, dtype = np.float64)
+    z = baseline_als_batch(y.reshape(-1, y.shape[-1]), lambd, p, iterations)
+    return z.reshape(y.shape)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+A columnar table of per-spectrum fit results.
+
+Fitting scripts such as DF_Multipeakfit store the results for each spectrum as attributes of
+its own group, which makes statistics over a whole file slow to gather. FitResultsTable keeps
+the same values as one aligned column per attribute, indexed by spectrum number, so that
+spectra can be selected and sorted with numpy masks. Numeric and boolean attributes are stored
+as floats, with 'N/A' stored as NaN, and other attributes as strings.
+
+The table is saved in an HDF5 group as one dataset per column plus a 'Spectrum number' dataset.
+It can also be built from the per-spectrum groups of an existing file, and row() returns a
+dictionary in the same form as the group attributes.
+"""
+
+import numpy as np
+import h5py
+
+class FitResultsTable(object):
+    index_name = 'Spectrum number'
+
+    def __init__(self, spectrumNumbers = [], columns = {}):
+        self.spectrumNumbers = np.array(spectrumNumbers, dtype = np.int64)
+        self.columns = dict((name, np.asarray(column)) for name, column in columns.items())
+        self._rows = None
+
+    def __len__(self):
+        return len(self.spectrumNumbers)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        '''Returns a whole column; missing values are NaN in numeric columns, and a column that
+        no spectrum has is all NaN'''
+        if name not in self.columns:
+            return np.full(len(self), np.nan)
+
+        return self.columns[name]
+
+    def keys(self):
+        return self.columns.keys()
+
+    @staticmethod
+    def _column_from_values(values):
+        '''Converts a list of attribute values to a float column if possible, otherwise a string column'''
+        if all(isinstance(value, (bool, int, long, float, np.number, np.bool_)) or value == 'N/A' for value in values):
+            return np.array([np.nan if value == 'N/A' else float(value) for value in values])
+
+        return np.array([str(value) for value in values], dtype = object)
+
+    @classmethod
+    def from_records(cls, spectrumNumbers, records):
+        '''Builds a table from one dictionary of attributes per spectrum. Attributes that are
+        arrays (e.g. spectra) are not tabulated.'''
+        names = []
+
+        for record in records:
+            for name, value in record.items():
+                if name not in names and np.ndim(value) == 0:
+                    names.append(name)
+
+        columns = dict((name, cls._column_from_values([record.get(name, 'N/A') for record in records]))
+                       for name in names)
+        return cls(spectrumNumbers, columns)
+
+    @classmethod
+    def from_groups(cls, group, prefix = 'Spectrum'):
+        '''Builds a table from the attributes of the "Spectrum n" members of an HDF5 group'''
+        names = [name for name in group if name.startswith(prefix)]
+        names.sort(key = lambda name: int(name[len(prefix):]))
+        records = [dict(group[name].attrs) for name in names]
+        return cls.from_records([int(name[len(prefix):]) for name in names], records)
+
+    @classmethod
+    def load(cls, group):
+        '''Loads a table saved with save'''
+        columns = dict((name, group[name][()]) for name in group if name != cls.index_name)
+
+        for name, column in columns.items():
+            if column.dtype.kind in 'OSU':
+                columns[name] = column.astype(object)
+
+        return cls(group[cls.index_name][()], columns)
+
+    def save(self, group):
+        '''Writes the table to an (empty) HDF5 group, one dataset per column'''
+        group.create_dataset(self.index_name, data = self.spectrumNumbers)
+
+        for name, column in self.columns.items():
+            if column.dtype == object:
+                group.create_dataset(name, data = column, dtype = h5py.special_dtype(vlen = str))
+
+            else:
+                group.create_dataset(name, data = column)
+
+    def names(self, mask = None, sortBy = None, prefix = 'Spectrum'):
+        '''Returns the "Spectrum n" group names of the selected rows, in order of spectrum number
+        or sorted by the values in column sortBy'''
+        indices = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+
+        if sortBy is not None:
+            indices = indices[np.argsort(self[sortBy][indices], kind = 'mergesort')]
+
+        return ['%s %s' % (prefix, n) for n in self.spectrumNumbers[indices]]
+
+    def rowIndex(self, spectrumNumbers):
+        '''Converts spectrum numbers (or "Spectrum n" names) to row indices'''
+        if self._rows is None:
+            self._rows = dict((n, i) for i, n in enumerate(self.spectrumNumbers))
+
+        return np.array([self._rows[int(str(n).split(' ')[-1])] for n in np.atleast_1d(spectrumNumbers)], dtype = int)
+
+    def row(self, spectrumNumber):
+        '''Returns the results for one spectrum in the form of the per-spectrum group attributes'''
+        i = self.rowIndex(spectrumNumber)[0]
+        record = {}
+
+        for name, column in self.columns.items():
+            value = column[i]
+            record[name] = 'N/A' if column.dtype != object and np.isnan(value) else value
+
+        return record
+
+def isTrue(column):
+    '''Mask of the rows where a boolean column is True (NaN counts as False)'''
+    return np.asarray(column) == 1
+
+def isFalse(column):
+    '''Mask of the rows where a boolean column is False (NaN counts as False)'''
+    return np.asarray(column) == 0
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a spectrum fitting function over many spectra in a pool of worker processes.
+
+The spectra are split into chunks which are fitted in separate processes, and the results
+are handed back in the original order so that they can be written to a file by a single
+writer in the main process. An exception raised while fitting one spectrum is caught in the
+worker and reported alongside that spectrum's index, rather than stopping the whole run.
+"""
+
+import numpy as np
+import itertools
+import time
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+def _fit_chunk(args):
+    '''Fits one chunk of spectra in a worker; returns a list of (index, result, error) records'''
+    fit_function, x, indices, spectra, kwargs, capture_errors = args
+    records = []
+
+    for n, y in zip(indices, spectra):
+        try:
+            records.append((n, fit_function(x, y, **kwargs), None))
+
+        except Exception as e:
+            if not capture_errors:
+                raise
+            records.append((n, None, str(e)))
+
+    return records
+
+def _imap_bounded(pool, function, iterable, max_pending):
+    '''Like pool.imap, but only takes up to max_pending items from iterable ahead of the results
+    that have been collected, so a lazily read input is never held in memory all at once'''
+    pending = deque()
+
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+class FitProgress(object):
+    '''Prints the progress of a fit every few percent, with an estimate of the time remaining'''
+
+    def __init__(self, total, step = 5):
+        self.total = total
+        self.step = step
+        self.done = 0
+        self.next_percent = step
+        self.start_time = time.time()
+
+    def format_time(self, t):
+        return '%s min %s sec' % (int(t / 60), int(np.round(t % 60)))
+
+    def update(self, n = 1):
+        self.done += n
+        percent = 100 * self.done / self.total if self.total > 0 else 100
+
+        if percent >= self.next_percent and self.done < self.total:
+            elapsed = time.time() - self.start_time
+            remaining = elapsed * (self.total - self.done) / self.done
+            print '%s%% (%s spectra) complete in %s, about %s remaining (%.1f spectra/s)' % (percent, self.done,
+                                                                                          self.format_time(elapsed),
+                                                                                          self.format_time(remaining),
+                                                                                          self.done / elapsed)
+            self.next_percent = (percent // self.step + 1) * self.step
+
+def fit_spectra(fit_function, x, spectra, start_index = 0, processes = None, chunk_size = None,
+                raise_exceptions = False, report_progress = True, **kwargs):
+    '''Applies fit_function(x, y, **kwargs) to each spectrum y and yields (index, result, error)
+    in the order of the spectra, where index counts from start_index. If fitting fails, result
+    is None and error is the exception message; otherwise error is None.
+
+    spectra can be anything with a length that gives arrays when sliced, such as an h5py dataset
+    or a SummarySpectra (see summary_spectra); only a few chunks per process are read ahead.
+
+    fit_function must be defined at module level so that it can be sent to the workers. If
+    processes is 1, or raise_exceptions is True (so that the traceback is usable), the spectra
+    are fitted in this process instead.'''
+    total = len(spectra)
+
+    if processes is None:
+        processes = cpu_count()
+
+    if chunk_size is None:
+        # several chunks per process balances the load, but each chunk has to be pickled
+        chunk_size = int(np.clip(total // (4 * processes), 1, 100))
+
+    chunks = ((fit_function, x, range(start_index + i, start_index + min(i + chunk_size, total)),
+               np.asarray(spectra[i:i + chunk_size]), kwargs, not raise_exceptions)
+              for i in xrange(0, total, chunk_size))
+
+    if processes > 1 and raise_exceptions == False and total > chunk_size:
+        pool = Pool(processes)
+        results = _imap_bounded(pool, _fit_chunk, chunks, 2 * processes) # results are kept in order
+
+    else:
+        pool = None
+        results = itertools.imap(_fit_chunk, chunks)
+
+    progress = FitProgress(total) if report_progress == True else None
+
+    try:
+        for records in results:
+            for record in records:
+                yield record
+
+            if progress is not None:
+                progress.update(len(records))
+
+    finally:
+        if pool is not None: # all results have been received, or the caller stopped early
+            pool.terminate()
+            pool.join()
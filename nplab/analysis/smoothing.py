@@ -1,61 +1,162 @@
-import cvxpy as cvx
 import numpy as np
+import scipy.sparse
+from scipy.linalg import solveh_banded
+try:
+	import cvxpy as cvx
+except ImportError:
+	cvx = None #only needed for solver="cvxpy"
 
+OBJECTIVE_TYPES = ["total_variation", "quadratic"]
 
 #Initialize the CVX problem variables
 #TODO - generalize to N-dimensional signals
 def init_problem(n):
 	x = cvx.Variable(n)
-	D = np.identity(n, int)
-	for i in range(1,n):
-		D[i][i-1] = -1
+	#first differences, with the first row penalising x[0] itself
+	D = scipy.sparse.diags([np.ones(n), -np.ones(n-1)], [0, -1], format="csc")
 	return x, D
 
-def convex_smooth(signal,weight, objective_type="quadratic",normalise = True):
-	'''Smoothing signal based on weight parameter
-		@param signal - your 1D signal
-		@param weight - the strength of your smoothing. 0 for no smoothing 
-		@param objective_type - sets the type of smoothing you want
-			See: wikipedia - Tikhonov_regularization
-			quadratic - what you will most often want
-			total_variation [See: https://en.wikipedia.org/wiki/Total_variation_denoising]
-	'''
+def difference_norm(x, objective_type):
+	'''The penalty term for each row of x: the sum of the squares or absolute values of
+	D*x, where D is the difference matrix made by init_problem'''
+	Dx = np.concatenate((x[..., :1], np.diff(x, axis=-1)), axis=-1)
+	if objective_type == "total_variation":
+		return np.sum(np.abs(Dx), axis=-1)
+	return np.sum(np.square(Dx), axis=-1)
 
-	#you can't add noise to your data
-	signal = np.array(signal,dtype=float)
-	assert(weight >= 0)
-	signal_max = np.max(signal)
-	if normalise==True: signal=signal/signal_max
+def quadratic_smooth(signals, weight):
+	'''Solves (I + weight*D'D)x = signal for each row of signals, which minimises
+	sum_squares(x - signal) + weight*sum_squares(D*x). D'D is tridiagonal, so the rows are
+	solved together as one block diagonal banded system.'''
+	N, n = signals.shape
+	ab = np.empty((2, n))
+	ab[0] = -weight
+	ab[0, 0] = 0 #also separates the blocks of neighbouring signals
+	ab[1] = 1 + 2*weight
+	ab[1, -1] = 1 + weight
+	if N*n == 1: #solveh_banded fails for a single equation
+		return signals/ab[1]
+	x = solveh_banded(np.tile(ab, (1, N)), signals.ravel(), check_finite=False)
+	return x.reshape(N, n)
 
-	#initialize the problem)
-	dims = signal.shape[0]
-	x,D = init_problem(dims)
+def tv_denoise(y, lambd):
+	'''Minimises 0.5*sum_squares(x - y) + lambd*sum(abs(diff(x))) for a 1D signal y, with
+	the direct algorithm of L. Condat, IEEE Signal Processing Letters 20, 1054 (2013)'''
+	N = len(y)
+	x = np.empty(N)
+	if N == 0:
+		return x
+	k = k0 = kplus = kminus = 0
+	umin, umax = lambd, -lambd
+	vmin, vmax = y[0] - lambd, y[0] + lambd
+	while True:
+		while k == N - 1:
+			if umin < 0:
+				x[k0:kminus + 1] = vmin
+				k = k0 = kminus = kminus + 1
+				vmin = y[k]
+				umin = lambd
+				umax = vmin + umin - vmax
+			elif umax > 0:
+				x[k0:kplus + 1] = vmax
+				k = k0 = kplus = kplus + 1
+				vmax = y[k]
+				umax = -lambd
+				umin = vmax + umax - vmin
+			else:
+				x[k0:k + 1] = vmin + umin/(k - k0 + 1)
+				return x
+		umin += y[k + 1] - vmin
+		if umin < -lambd:
+			x[k0:kminus + 1] = vmin
+			k = k0 = kplus = kminus = kminus + 1
+			vmin = y[k]
+			vmax = vmin + 2*lambd
+			umin, umax = lambd, -lambd
+			continue
+		umax += y[k + 1] - vmax
+		if umax > lambd:
+			x[k0:kplus + 1] = vmax
+			k = k0 = kplus = kminus = kplus + 1
+			vmax = y[k]
+			vmin = vmax - 2*lambd
+			umin, umax = lambd, -lambd
+			continue
+		k += 1
+		if umin >= lambd:
+			kminus = k
+			vmin += (umin - lambd)/(kminus - k0 + 1)
+			umin = lambd
+		if umax <= -lambd:
+			kplus = k
+			vmax += (umax + lambd)/(kplus - k0 + 1)
+			umax = -lambd
 
-	####
-	#select the type of smoothing
-	####
+def total_variation_smooth(signals, weight):
+	'''Minimises sum_squares(x - signal) + weight*norm(D*x, 1) for each row of signals.
+	The first row of D penalises |x[0]|, as if the signal started from a fixed 0. Extending
+	the signal antisymmetrically (-signal[::-1], signal) turns this into ordinary TV
+	denoising with lambda = weight/2, whose solution is also antisymmetric.'''
+	return np.array([tv_denoise(np.concatenate((-y[::-1], y)), 0.5*weight)[len(y):] for y in signals])
 
-	#total variational smoothing:
+def cvxpy_smooth(signal, weight, objective_type):
+	'''Solves a single smoothing problem with cvxpy; returns (x, objective value, status)'''
+	if cvx is None:
+		raise ImportError("cvxpy is needed for solver='cvxpy'")
+	x,D = init_problem(signal.shape[0])
 	if objective_type == "total_variation":
 		f2 = cvx.norm(D*x,1)
-
-	#quadratic 
-	elif objective_type == "quadratic":
-		f2 = cvx.sum_squares(D*x)
 	else:
-		raise ValueError("Only allowed values: [ total_variation | quadratic ]")
-	
-	#set up problem
+		f2 = cvx.sum_squares(D*x)
 	f1 = cvx.sum_squares(x-signal)
-	objective = cvx.Minimize(f1 + weight*f2)
-	prob = cvx.Problem(objective)
-	#solve
+	prob = cvx.Problem(cvx.Minimize(f1 + weight*f2))
 	prob.solve()
-	#return answer
-	x_out =  np.asarray(x.value)
-	x_out = x_out.reshape(signal.shape)
-	if normalise==True: x_out=x_out*signal_max
-	return x_out, prob.value, prob.status
+	return np.asarray(x.value).reshape(signal.shape), prob.value, prob.status
+
+def convex_smooth_batch(signals, weight, objective_type="quadratic", normalise=True, solver="direct"):
+	'''Smooths each row of a 2D array of signals, as convex_smooth does for one signal.
+	Returns (smoothed signals, objective values, statuses).'''
+	signals = np.atleast_2d(np.array(signals,dtype=float))
+	assert(weight >= 0)
+	if objective_type not in OBJECTIVE_TYPES:
+		raise ValueError("Only allowed values: [ total_variation | quadratic ]")
+	signal_max = np.max(signals, axis=1)[:, np.newaxis]
+	if normalise==True: signals = signals/signal_max
+
+	if solver == "direct":
+		if objective_type == "quadratic":
+			x_out = quadratic_smooth(signals, weight)
+		else:
+			x_out = total_variation_smooth(signals, weight)
+		values = np.sum(np.square(x_out - signals), axis=1) + weight*difference_norm(x_out, objective_type)
+		statuses = ["optimal"]*len(signals)
+	elif solver == "cvxpy":
+		results = [cvxpy_smooth(signal, weight, objective_type) for signal in signals]
+		x_out = np.array([r[0] for r in results])
+		values = np.array([r[1] for r in results])
+		statuses = [r[2] for r in results]
+	else:
+		raise ValueError("Only allowed solvers: [ direct | cvxpy ]")
+
+	if normalise==True: x_out = x_out*signal_max
+	return x_out, values, statuses
+
+def convex_smooth(signal,weight, objective_type="quadratic",normalise = True, solver="direct"):
+	'''Smoothing signal based on weight parameter
+		@param signal - your 1D signal
+		@param weight - the strength of your smoothing. 0 for no smoothing 
+		@param objective_type - sets the type of smoothing you want
+			See: wikipedia - Tikhonov_regularization
+			quadratic - what you will most often want
+			total_variation [See: https://en.wikipedia.org/wiki/Total_variation_denoising]
+		@param solver - "direct" solves quadratic smoothing as a banded linear system and
+			total_variation with a direct TV denoising algorithm; "cvxpy" sets up and
+			solves the problem with cvxpy instead
+		Use convex_smooth_batch to smooth many signals at once.
+	'''
+	signal = np.array(signal,dtype=float)
+	x_out, values, statuses = convex_smooth_batch(signal.reshape(1, -1), weight, objective_type, normalise, solver)
+	return x_out[0].reshape(signal.shape), values[0], statuses[0]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Block-wise access to the spectra in particle scan summary files.
+
+Summary files (as written by Condense_DF_Spectra) keep the spectra of each scan as one
+(particles, wavelengths) dataset under 'particleScanSummaries/scanN/spectra'. Reading that
+dataset with [()] loads every spectrum at once, which fails for files larger than memory.
+iter_spectra reads only the requested range, one block at a time, and SummarySpectra wraps
+the same reads in a sequence that can be used in place of an array of spectra.
+"""
+
+import numpy as np
+import h5py
+
+def main_scan_name(f):
+    '''The name of the scan in 'particleScanSummaries' with the most spectra'''
+    scans = f['particleScanSummaries']
+    return max(scans.keys(), key = lambda scan: len(scans[scan]['spectra']) if 'spectra' in scans[scan] else 0)
+
+def _spectra_dataset(f, scan_name = None):
+    if scan_name is None:
+        scan_name = main_scan_name(f)
+
+    return f['particleScanSummaries'][scan_name]['spectra']
+
+def iter_spectra(summary_file, start = 0, finish = 0, block_size = 1000, scan_name = None, prepare = None):
+    '''Yields (indices, wavelengths, spectra) for consecutive blocks of up to block_size spectra
+    from a summary file (a filename or an open h5py file), reading only spectra start to finish
+    (finish = 0 means the last spectrum). If given, prepare(spectra) is applied to each block
+    before it is yielded. The scan with the most spectra is used unless scan_name is given.'''
+    own_file = isinstance(summary_file, basestring)
+    f = h5py.File(summary_file, 'r') if own_file else summary_file
+
+    try:
+        dataset = _spectra_dataset(f, scan_name)
+        wavelengths = dataset.attrs['wavelengths'][()]
+        finish = len(dataset) if finish == 0 else min(finish, len(dataset))
+
+        for i in xrange(start, finish, block_size):
+            j = min(i + block_size, finish)
+            spectra = dataset[i:j]
+
+            if prepare is not None:
+                spectra = prepare(spectra)
+
+            yield np.arange(i, j), wavelengths, spectra
+
+    finally:
+        if own_file:
+            f.close()
+
+class SummarySpectra(object):
+    '''A read-only sequence of the spectra in a summary file, which reads them from disk in blocks
+    as they are needed, so that it can be used in place of an array of all the spectra. Integer
+    indexing reads (and keeps) the block containing that spectrum, so reading the spectra in
+    order costs one read per block. Slices are read directly.
+
+    Index 0 is spectrum start of the scan. prepare(spectra), if given, is applied to every block
+    or slice that is read.'''
+
+    def __init__(self, summary_file, start = 0, finish = 0, block_size = 1000, scan_name = None, prepare = None):
+        self._own_file = isinstance(summary_file, basestring)
+        self.file = h5py.File(summary_file, 'r') if self._own_file else summary_file
+        self.dataset = _spectra_dataset(self.file, scan_name)
+        self.start = start
+        self.finish = len(self.dataset) if finish == 0 else min(finish, len(self.dataset))
+        self.block_size = block_size
+        self.prepare = prepare
+        self.wavelengths = self.dataset.attrs['wavelengths'][()]
+        self.attrs = dict(self.dataset.attrs)
+        self._block_start = None
+        self._block = None
+
+    def __len__(self):
+        return max(self.finish - self.start, 0)
+
+    @property
+    def shape(self):
+        return (len(self), self.dataset.shape[1])
+
+    def _read(self, i, j):
+        spectra = self.dataset[self.start + i:self.start + j]
+        return self.prepare(spectra) if self.prepare is not None else spectra
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            i, j, step = index.indices(len(self))
+
+            if step != 1:
+                return self[i:j][::step]
+
+            return self._read(i, max(i, j))
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError('spectrum index out of range')
+
+        if self._block_start is None or not self._block_start <= index < self._block_start + len(self._block):
+            self._block_start = index - index % self.block_size
+            self._block = self._read(self._block_start, min(self._block_start + self.block_size, len(self)))
+
+        return self._block[index - self._block_start]
+
+    def __iter__(self):
+        for i in xrange(0, len(self), self.block_size):
+            for spectrum in self._read(i, min(i + self.block_size, len(self))):
+                yield spectrum
+
+    def close(self):
+        if self._own_file:
+            self.file.close()
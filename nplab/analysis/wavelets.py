@@ -5,7 +5,7 @@ author: im354
 import numpy as np
 import matplotlib.pyplot as plt
 import pywt
-from scipy.optimize import minimize_scalar
+from multiprocessing import Pool, cpu_count
 
 def blocks():
 
@@ -53,6 +53,56 @@ def doppler():
 
 
 
+def soft_threshold(coefs,trsh):
+	'''
+	Soft thresholding of coefficients ('coefs') by 'trsh', which can be an array of one
+	threshold per row (shape (..., 1)) when coefs holds many rows.
+	'''
+	return np.sign(coefs)*np.maximum(np.absolute(coefs)-trsh,0)
+
+def _sorted_magnitudes(coefs,*weights):
+	'''
+	Sorts the magnitudes of each row of coefs (along the last axis), and returns them with
+	prefix sums (starting at 0) of their squares and of each of weights (in the same order),
+	plus, for each sorted magnitude a_k, the number of magnitudes < a_k and <= a_k.
+	'''
+	a = np.absolute(coefs)
+	order = np.argsort(a,axis=-1)
+	a = np.take_along_axis(a,order,axis=-1)
+	def prefix_sum(x):
+		return np.concatenate((np.zeros(x.shape[:-1]+(1,)),np.cumsum(x,axis=-1)),axis=-1)
+	index = np.arange(a.shape[-1])*np.ones(a.shape,dtype=int)
+	first = np.concatenate((np.ones(a.shape[:-1]+(1,),dtype=bool),a[...,1:]!=a[...,:-1]),axis=-1)
+	last = np.concatenate((a[...,1:]!=a[...,:-1],np.ones(a.shape[:-1]+(1,),dtype=bool)),axis=-1)
+	below = np.maximum.accumulate(np.where(first,index,0),axis=-1) #number of magnitudes < a_k
+	upto = np.minimum.accumulate(np.where(last,index+1,a.shape[-1])[...,::-1],axis=-1)[...,::-1] #number <= a_k
+	sums = [prefix_sum(np.take_along_axis(w,order,axis=-1)) for w in weights]
+	return a,prefix_sum(a**2),sums,below,upto
+
+def _best_threshold(candidates,risks,t_max):
+	'''Picks the candidate threshold with the lowest risk in each row, ignoring those above t_max'''
+	risks = np.where(candidates<=t_max,risks,np.inf)
+	best = np.argmin(risks,axis=-1)[...,np.newaxis]
+	return np.take_along_axis(candidates,best,axis=-1)[...,0]
+
+def SUREThreshold(coefs):
+	'''
+	Finds the SURE threshold (see SUREThresh) for each row of coefs (along the last axis).
+
+	Between the coefficient magnitudes, SURE(t) = d - 2*#{|c| <= t} + sum(min(|c|,t)**2) only
+	increases with t, so its minimum over 0 <= t <= t_max is at t = 0 or at one of the
+	magnitudes. All of these are evaluated at once with cumulative sums over the sorted magnitudes.
+	'''
+	coefs = np.asarray(coefs,dtype=float)
+	d = coefs.shape[-1]
+	t_max = np.sqrt(2*np.log(d))
+	a,squares,_,below,upto = _sorted_magnitudes(coefs)
+	risks = d-2*upto+np.take_along_axis(squares,upto,axis=-1)+(a**2)*(d-upto)
+	zeros = np.sum(a==0,axis=-1)[...,np.newaxis] #t = 0
+	candidates = np.concatenate((np.zeros(a.shape[:-1]+(1,)),a),axis=-1)
+	risks = np.concatenate((d-2*zeros,risks),axis=-1)
+	return _best_threshold(candidates,risks,t_max)
+
 def SUREThresh(coefs):
 	'''
 	Single level SURE adaptive thresholding of wavelet coefficients from:
@@ -66,31 +116,15 @@ def SUREThresh(coefs):
 	For more details see paper.
 
 	Args:
-        coefs (float list): Single level wavelet coefficients.
+        coefs (float list): Single level wavelet coefficients, or an array with one set
+        	of coefficients per row (thresholded separately).
 
     Returns:
         float list: Softmax thresholded wavelet coefficients.
 
 	'''
-	d = coefs.shape[0]
-	t_max = np.sqrt(2*np.log(d))
-	t_min = 0
-	def SURE(t):
-		return d-2*np.sum(np.abs(coefs) <= t) + np.sum(np.minimum(coefs,t)**2)
-
-	trsh = minimize_scalar(SURE,bounds=[t_min,t_max]).x
-	def soft_threshold(y):
-
-		a = np.absolute(y) - trsh
-		sgn = np.sign(y)
-		if a <= 0:
-			return 0
-		else:
-			return sgn*a
-	
-	thresholded = np.vectorize(soft_threshold)(coefs)
-	
-	return thresholded
+	coefs = np.asarray(coefs,dtype=float)
+	return soft_threshold(coefs,SUREThreshold(coefs)[...,np.newaxis])
 
 def SUREShrink(data):
 	'''
@@ -104,7 +138,8 @@ def SUREShrink(data):
 	few wavelet transform components allowing softmax thresholding to remove unwanted noise contributions.
 
 	Args:
-        data (float list): .
+        data (float list): A signal, or an (N, L) array of signals (e.g. spectra) which are
+        	denoised separately.
 
     Returns:
         float list: SUREShrink Denoised signal.
@@ -112,63 +147,67 @@ def SUREShrink(data):
 	'''
 	mode = "periodic"
 	wl = "sym8"
-	n = data.shape[0]
-	J = np.ceil(np.log2(n))
 	
-	dwt = pywt.wavedec(data,wavelet=wl,mode=mode)  
+	dwt = pywt.wavedec(data,wavelet=wl,mode=mode,axis=-1)  
 
 	for i in range(len(dwt)):
 		dwt[i] = SUREThresh(dwt[i])
 
-	return pywt.waverec(dwt,wavelet=wl,mode=mode)
+	return pywt.waverec(dwt,wavelet=wl,mode=mode,axis=-1)
 
-def SkellamThresh(wavelet_coefs,scaling_coefs):
-	yi = wavelet_coefs
-	ti = scaling_coefs
-	# print len(yi), len(ti)
-	d = yi.shape[0]
-	t_max = np.sqrt(2*np.log(d))
-	t_min = 0
-
-	def SkellamObjective(t):
-			t1 = np.sum(np.sign(np.abs(yi)-t)*ti)
-			t2 = np.sum(np.minimum(yi**2,np.ones(yi.shape)*t**2))
-			t3 = -t*np.sum(np.abs(yi)==t)
-			# print t1,t2,t3
-			return np.sum([t1,t2,t3])
-
-
-	def SS(t):
-		t1 = np.sum(np.sign(np.abs(yi)-t)*ti)
-		t2 = np.sum(np.minimum(yi**2,np.ones(yi.shape)*t**2))
-		t3 = -t*np.sum(np.abs(yi)==t)
-		# print t1,t2,t3
-		return np.sum([t1,t2,t3])
-
-	trsh = minimize_scalar(SkellamObjective,bounds=[t_min,t_max]).x
-	# print "threshold", trsh
-	def soft_threshold(y):
-
-		a = np.absolute(y) - trsh
-		sgn = np.sign(y)
-		if a <= 0:
-			return 0
-		else:
-			return sgn*a
+def SUREShrink2D(images,wavelet="sym8",mode="periodic",level=None):
+	'''
+	2D version of SUREShrink, for camera frames or the planes of a hyperspectral cube. The
+	approximation and each detail subband at each level get their own SURE threshold.
 
-	# sigma_x = np.std(yi)
-	# def adjusted_threshold(y,t):
-	# 	if np.abs(y) >= (np.sqrt(2)*t)/sigma_x:
-	# 		return -np.sign(y)*(np.sqrt(2)*t)/sigma_x
-	# 	else:
-	# 		return -y
+	Args:
+        images: A 2D image, or a stack of images with the image axes last (N, H, W).
 
-	# thresholded = np.zeros(yi.shape)
-	# for i in range(yi.shape[0]):
-	# 	thresholded[i] = adjusted_threshold(y=yi[i],t=ti[i])
-	# soft threshold:
-	thresholded = np.vectorize(soft_threshold)(yi)
-	return thresholded
+    Returns:
+        SUREShrink denoised image(s).
+	'''
+	images = np.asarray(images,dtype=float)
+	shape = images.shape[:-2]
+	def threshold_subband(c):
+		flat = c.reshape(shape+(-1,))
+		return SUREThresh(flat).reshape(c.shape)
+	dwt = pywt.wavedec2(images,wavelet=wavelet,mode=mode,level=level,axes=(-2,-1))
+	dwt = [threshold_subband(dwt[0])]+[tuple(threshold_subband(c) for c in details) for details in dwt[1:]]
+	return pywt.waverec2(dwt,wavelet=wavelet,mode=mode,axes=(-2,-1))
+
+def SkellamThreshold(wavelet_coefs,scaling_coefs):
+	'''
+	Finds the Skellam threshold (see SkellamThresh) for each row of wavelet_coefs (along the last axis).
+
+	Between the coefficient magnitudes the objective only increases with t, so its minimum over
+	0 <= t <= t_max is at one of the magnitudes (or 0), or just above one. All of these are
+	evaluated at once with cumulative sums over the sorted magnitudes.
+	'''
+	yi = np.asarray(wavelet_coefs,dtype=float)
+	ti = np.asarray(scaling_coefs,dtype=float)*np.ones(yi.shape)
+	d = yi.shape[-1]
+	t_max = np.sqrt(2*np.log(d))
+	a,squares,[scaling],below,upto = _sorted_magnitudes(yi,ti)
+	total = scaling[...,-1:]
+	t2 = np.take_along_axis(squares,upto,axis=-1)+(a**2)*(d-upto)
+	at = (total-np.take_along_axis(scaling,upto,axis=-1)-np.take_along_axis(scaling,below,axis=-1)) + t2 - a*(upto-below)
+	above = (total-2*np.take_along_axis(scaling,upto,axis=-1)) + t2 #just above each magnitude
+	zeros = np.sum(a==0,axis=-1)[...,np.newaxis]
+	at_zero = total-np.take_along_axis(scaling,zeros,axis=-1)
+	above_zero = total-2*np.take_along_axis(scaling,zeros,axis=-1)
+	zero = np.zeros(a.shape[:-1]+(1,))
+	candidates = np.concatenate((zero,np.nextafter(zero,1),a,np.nextafter(a,np.inf)),axis=-1)
+	risks = np.concatenate((at_zero,above_zero,at,above),axis=-1)
+	return _best_threshold(candidates,risks,t_max)
+
+def SkellamThresh(wavelet_coefs,scaling_coefs):
+	'''
+	Soft thresholds wavelet_coefs with the threshold minimising the Skellam risk objective
+	sum(sign(|y|-t)*ti) + sum(min(y**2,t**2)) - t*#{|y| == t}, for 0 <= t <= sqrt(2*log(d)).
+	Works on one set of coefficients, or on one set per row.
+	'''
+	yi = np.asarray(wavelet_coefs,dtype=float)
+	return soft_threshold(yi,SkellamThreshold(yi,scaling_coefs)[...,np.newaxis])
 
 
 def multiscale_function_apply(func,wavelet_name,max_level=None):
@@ -178,14 +217,14 @@ def multiscale_function_apply(func,wavelet_name,max_level=None):
 		wl = pywt.Wavelet(wavelet_name)
 		
 		if max_level is None:
-			level = pywt.dwt_max_level(len(ys),wl)
+			level = pywt.dwt_max_level(np.shape(ys)[-1],wl)
 		else:
 			level = max_level
 
 		coeffs_list = []
 		a = ys
 		for i in range(level):
-			a, d = pywt.dwt(a, wavelet=wl)
+			a, d = pywt.dwt(a, wavelet=wl, axis=-1) #along the last axis, so ys can hold many signals
 			f = func(approx =a, detail=d)
 			coeffs_list.append(f)
 		coeffs_list.append(a)
@@ -198,12 +237,12 @@ def SkellamShrink(data,max_level=-1):
 	'''
 	Based on: Skellam Shrinkage: Wavelet-Based Intensity Estimation for Inhomogeneous Poisson data
 	Related papers: Fast Haar-Wavelet denoising of multidimensional fluorescence microscopy data
+
+	data can be a signal or an (N, L) array of signals, which are denoised separately.
 	'''
 
 	mode = "periodic"
 	wl = "haar"
-	n = data.shape[0]
-	J = np.ceil(np.log2(n))
 	
 	def identify(approx,detail):
 		return detail
@@ -216,10 +255,31 @@ def SkellamShrink(data,max_level=-1):
 	else:
 		f = multiscale_function_apply(func=skellam,wavelet_name=wl,max_level=max_level)
 	dwt = f(data)
-	return pywt.waverec(dwt,wavelet=wl,mode=mode)
-
+	return pywt.waverec(dwt,wavelet=wl,mode=mode,axis=-1)
 
+def _denoise_chunk(args):
+	denoise, chunk, kwargs = args
+	return denoise(chunk, **kwargs)
 
+def denoise_stack(denoise,data,processes=None,chunk_size=None,**kwargs):
+	'''
+	Applies a denoising function (e.g. SUREShrink, SkellamShrink or SUREShrink2D, which all
+	work on stacks) to data in chunks along the first axis, in a pool of processes.
+	This is worthwhile for large stacks or hyperspectral cubes.
+	'''
+	if processes is None:
+		processes = cpu_count()
+	if chunk_size is None:
+		chunk_size = int(np.ceil(len(data)/(4.0*processes)))
+	chunks = [(denoise,data[i:i+chunk_size],kwargs) for i in range(0,len(data),chunk_size)]
+	if processes == 1 or len(chunks) < 2:
+		return np.concatenate([_denoise_chunk(c) for c in chunks])
+	pool = Pool(processes)
+	try:
+		return np.concatenate(pool.map(_denoise_chunk,chunks))
+	finally:
+		pool.close()
+		pool.join()
 
 
 
@@ -82,20 +82,15 @@ def binned_data_len(input_length, bin_width):
 	return int(math.ceil(float(input_length)/float(bin_width)))
 
 def binning(thresholded, index_bin_width):
-	#length of input thresholded array of 0s and 1s
-
-	thresholded_len = len(thresholded)
-
-	# for i in xrange(thresholded_len): #DELETE LOOP
-	# 	assert(thresholded[i] in [0,1]), "Threasholded:" thresholded[i]
-
-	#length of output [int]
-	outp_len = binned_data_len(thresholded_len, index_bin_width)
-	output = np.zeros(outp_len)
-	for i in xrange(outp_len):
-		output[i] = np.sum(np.absolute(thresholded[i*index_bin_width:min(thresholded_len,(i+1)*index_bin_width)]))
-
-	return output
+	#sum the (absolute values of) thresholded array of 0s and 1s in bins of index_bin_width
+	#	the last bin may be shorter, if the length isn't a multiple of the bin width
+	thresholded = np.absolute(np.asarray(thresholded))
+	if len(thresholded) == 0:
+		return np.zeros(0)
+	if len(thresholded) % index_bin_width == 0:
+		#reshaping is faster than reduceat when the bins are all full
+		return thresholded.reshape(-1, index_bin_width).sum(axis=1).astype(float)
+	return np.add.reduceat(thresholded, np.arange(0, len(thresholded), index_bin_width)).astype(float)
 
 def autocorrelation(x,mode="fft"):
 	x=np.asarray(x)
@@ -111,6 +106,149 @@ def autocorrelation(x,mode="fft"):
 		return outp
 
 
+class MultiTauCorrelator(object):
+	"""
+	Streaming multi-tau autocorrelator, for computing g2(tau) live as photon counts arrive.
+
+	Lag times are spaced logarithmically: the first level correlates the counts at lags of
+	1 to channels-1 bins, then each subsequent level sums pairs of bins from the level before
+	(halving the time resolution) and correlates them at lags of channels/2 to channels-1 of
+	its own bins.  Each level only keeps the last `channels` bins, so memory use doesn't grow
+	with the length of the measurement, and each block of counts is processed with a few
+	vectorised dot products per level.
+
+	g2 is normalised symmetrically, i.e. the sum of the products of the counts at each lag
+	divided by the sums of the counts that went into them, which reduces the bias for lags
+	that are not much shorter than the measurement.
+
+	dt - time width of the bins passed to add(), in seconds
+	channels - number of lag channels in each level (even)
+	levels - number of levels; the longest lag is (channels-1)*2**(levels-1) bins
+	"""
+	def __init__(self, dt, channels=16, levels=20):
+		assert channels % 2 == 0, "The number of channels must be even"
+		self.dt = dt
+		self.channels = channels
+		self.levels = levels
+		lags = [np.arange(1, channels)] + [np.arange(channels//2, channels)]*(levels - 1)
+		self._lags = lags
+		self.lag_times = np.concatenate([dt*(2**level)*lag for level, lag in enumerate(lags)])
+		self.reset()
+
+	def reset(self):
+		self._history = [np.zeros(0) for level in range(self.levels)] #the last few bins of each level
+		self._leftover = [None]*self.levels #an unpaired bin, waiting to be summed into the next level
+		self._products = [np.zeros(len(lag)) for lag in self._lags]
+		self._direct = [np.zeros(len(lag)) for lag in self._lags] #sums of the counts at time t
+		self._delayed = [np.zeros(len(lag)) for lag in self._lags] #sums of the counts at time t-tau
+		self._terms = [np.zeros(len(lag)) for lag in self._lags]
+		self.total_bins = 0
+
+	def add(self, counts):
+		"""Add a block of binned counts, updating the correlation."""
+		counts = np.asarray(counts, dtype=float)
+		self.total_bins += len(counts)
+		for level in range(self.levels):
+			if len(counts) == 0:
+				break
+			self._correlate(level, counts)
+			#sum pairs of bins to make the (coarser) counts for the next level
+			if self._leftover[level] is not None:
+				counts = np.concatenate(([self._leftover[level]], counts))
+			self._leftover[level] = counts[-1] if len(counts) % 2 else None
+			pairs = len(counts)//2
+			counts = counts[:2*pairs].reshape(pairs, 2).sum(axis=1)
+
+	def _correlate(self, level, counts):
+		lags = self._lags[level]
+		data = np.concatenate((self._history[level], counts))
+		start = len(self._history[level]) #index of the first new bin in data
+		cumulative = np.concatenate(([0], np.cumsum(data)))
+		for i, lag in enumerate(lags):
+			#products of each new bin with the bin `lag` before it, where there is one
+			first = max(start, lag)
+			if first >= len(data):
+				continue
+			self._products[level][i] += np.dot(data[first:], data[first - lag:len(data) - lag])
+			self._direct[level][i] += cumulative[len(data)] - cumulative[first]
+			self._delayed[level][i] += cumulative[len(data) - lag] - cumulative[first - lag]
+			self._terms[level][i] += len(data) - first
+		self._history[level] = data[-self.channels:]
+
+	@property
+	def g2(self):
+		"""The normalised correlation, g2(tau), at each of lag_times (nan where there's no data yet)"""
+		products = np.concatenate(self._products)
+		direct = np.concatenate(self._direct)
+		delayed = np.concatenate(self._delayed)
+		terms = np.concatenate(self._terms)
+		with np.errstate(divide='ignore', invalid='ignore'):
+			return products*terms/(direct*delayed)
+
+	def correlation(self):
+		"""Return the lag times and g2 at each one"""
+		return self.lag_times, self.g2
+
+
+class StreamingAutocorrelation(object):
+	"""
+	Count photons in buffers of voltages as they arrive from the card, and correlate them
+	with a MultiTauCorrelator, giving a live g2(tau).
+
+	This does the same as signal_diff, thresholding and binning on the whole trace, except
+	that the voltages are normalised using the lowest and highest voltages seen so far, edges
+	between buffers are counted, and bins carry over from one buffer to the next.
+
+	Normalising noise alone would turn it into pulses, so nothing is counted until the
+	voltages seen span at least min_span (buffers before then are discarded).  Alternatively,
+	a fixed threshold voltage can be given, in which case no normalisation is done.
+
+	dt - sampling interval of the voltages, in seconds
+	index_bin_width - number of samples in each bin of counts
+	channels, levels - passed to MultiTauCorrelator
+	min_span - the smallest difference between the highest and lowest voltages, in volts,
+		for the pulses to be counted
+	threshold - if not None, the voltage above which the signal is high
+	"""
+	def __init__(self, dt, index_bin_width, channels=16, levels=20, min_span=0.5, threshold=None):
+		self.dt = dt
+		self.index_bin_width = index_bin_width
+		self.min_span = min_span
+		self.threshold = threshold
+		self.correlator = MultiTauCorrelator(dt*index_bin_width, channels, levels)
+		self.total_counts = 0
+		self._vmin = None
+		self._vmax = None
+		self._last_level = None
+		self._pulses = np.zeros(0, dtype=int) #pulses that don't yet fill a bin
+
+	def add_voltages(self, voltages):
+		voltages = np.asarray(voltages)
+		if self.threshold is not None:
+			levels = (voltages > self.threshold).astype(float)
+		else:
+			self._vmin = np.min(voltages) if self._vmin is None else min(self._vmin, np.min(voltages))
+			self._vmax = np.max(voltages) if self._vmax is None else max(self._vmax, np.max(voltages))
+			if self._vmax - self._vmin < self.min_span:
+				#no pulses yet, only noise: don't count anything
+				return np.zeros(0)
+			levels = np.rint((voltages - self._vmin)/(self._vmax - self._vmin))
+		if self._last_level is not None:
+			levels = np.concatenate(([self._last_level], levels))
+		self._last_level = levels[-1]
+		pulses = np.concatenate((self._pulses, np.absolute(diff(levels)).astype(int)))
+		full = len(pulses) - len(pulses) % self.index_bin_width
+		counts = binning(pulses[:full], self.index_bin_width)
+		self._pulses = pulses[full:]
+		self.total_counts += int(np.sum(counts))
+		self.correlator.add(counts)
+		return counts
+
+	def correlation(self):
+		"""Return the lag times and g2 at each one"""
+		return self.correlator.correlation()
+
+
 if __name__ == "__main__":
 
 	#test count_photons - general pulse
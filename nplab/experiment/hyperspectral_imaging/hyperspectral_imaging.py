@@ -32,6 +32,7 @@ pg.setConfigOption('foreground', 'k')
 
 class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
     view_layer_updated = QtCore.Signal(int)
+    pipeline_saving = True  # spectra are processed and saved while the stage moves on
 
     def __init__(self):
         GridScanQt.__init__(self)
@@ -81,6 +82,11 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             raise ValueError('stage must be a Stage')
         if not isinstance(self.spectrometer, (Spectrometer, Spectrometers)):
             raise ValueError('spectrometer must be a Spectrometer or Spectrometers')
+        if self._overrides_scan_function():
+            if self.adaptive:
+                raise ValueError('adaptive scans need acquire_point and save_point, not scan_function')
+            warnings.warn('overriding scan_function is deprecated, and stops points being saved while '
+                          'the stage moves; override acquire_point and save_point instead', DeprecationWarning)
         # if not self._created:
         #     self.init_figure()
 
@@ -97,14 +103,58 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             spectrometer = self.spectrometer.spectrometers[i]\
                 if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
             self.data.create_dataset('wavelength'+suffix, data=spectrometer.wavelengths)
+            # adaptive scans are sparse, so they store a list of spectra rather than an image
+            shape = (0,) if self.adaptive else self.grid_shape
+            maxshape = (None, spectrometer.wavelengths.size) if self.adaptive else None
             self.data.create_dataset('hs_image'+suffix,
-                                     shape=self.grid_shape + (spectrometer.wavelengths.size,),
+                                     shape=shape + (spectrometer.wavelengths.size,),
+                                     maxshape=maxshape,
                                      dtype=np.float64,
                                      attrs=spectrometer.metadata)
             self.data.create_dataset('raw_data/hs_image'+suffix,
-                                     shape=self.grid_shape + (spectrometer.wavelengths.size,),
+                                     shape=shape + (spectrometer.wavelengths.size,),
+                                     maxshape=maxshape,
                                      dtype=np.float64,
                                      attrs=spectrometer.metadata)
+        if self.adaptive:
+            self.data.create_dataset('point_indices', shape=(0, len(self.grid_shape)),
+                                     maxshape=(None, len(self.grid_shape)), dtype=int)
+        # record the scan parameters and which points are done, so the scan can be resumed
+        scan_state = self.data.create_group('scan_state', auto_increment=False)
+        for key, value in self.get_scan_state().iteritems():
+            scan_state.attrs[key] = value
+        self.data.create_dataset('completed', data=self.completed, auto_increment=False)
+        self.init_spectrometer_functions()
+
+    def reopen_scan(self):
+        print 'Resuming scan in: {}'.format(self.f.file.filename), self.data
+        self.init_spectrometer_functions()
+
+    def resume(self, scan_group=None, *args, **kwargs):
+        """
+        Continues an interrupted scan, by default the most recent one in the current file.
+
+        The scan parameters and completed-point mask are read from the scan group, and
+        acquisition carries on from the first point that was not completed.
+        """
+        if scan_group is None:
+            scan_group = self.f.require_group('hyperspectral_images').numbered_items('scan')[-1]
+        if 'completed' not in scan_group:
+            raise ValueError('{0} has no completed-point mask, so cannot be resumed'.format(scan_group.name))
+        state = dict(scan_group['scan_state'].attrs)
+        for key in ('axes', 'axes_names'):
+            state[key] = np.atleast_1d(state[key]).tolist()
+        self.set_scan_state(state)
+        self.data = scan_group
+        self.completed = scan_group['completed'][...]
+        super(HyperspectralScan, self).resume(*args, **kwargs)
+
+    def checkpoint_point(self, *indices):
+        # the spectra have been written by save_point, so the point can be marked complete
+        self.data['completed'][indices] = True
+        self.data.file.flush()
+
+    def init_spectrometer_functions(self):
         if isinstance(self.spectrometer, Spectrometer):
             self.read_spectra = self.spectrometer.read_spectrum
             self.process_spectra = self.spectrometer.process_spectrum
@@ -113,8 +163,23 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             self.process_spectra = self.spectrometer.process_spectra
         self.init_figure()
 
+    def _write_scan_record(self, name, data, **kwargs):
+        """Writes a per-point record of the scan, after those from before it was resumed."""
+        if name in self.data:
+            if self._first_index > 0:
+                data = np.concatenate((self.data[name][...], data))
+            del self.data[name]
+        self.data.create_dataset(name, data=data, auto_increment=False, **kwargs)
+
     def close_scan(self):
         super(HyperspectralScan, self).close_scan()
+        if self.phase_times is not None:
+            if self.adaptive:
+                self._write_scan_record('point_signals', self.point_signals[:len(self.trajectory)])
+                self._write_scan_record('preview', self.adaptive_preview)
+            else:
+                self._write_scan_record('trajectory', self.trajectory)
+            self._write_scan_record('phase_times', self.phase_times, attrs=dict(phases=self.phase_names))
         self.data.file.flush()
         time.sleep(0.1)
         if self.safe_exit:
@@ -123,12 +188,43 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
             else:
                 self.light_source.power = 0
 
-    def scan_function(self, *indices):
+    def settle(self):
         time.sleep(self.delay)
-        raw_spectra = self.read_spectra()
+
+    def _overrides_scan_function(self):
+        """Whether a subclass still does its work in scan_function, rather than acquire_point and save_point."""
+        return type(self).scan_function.__func__ is not HyperspectralScan.scan_function.__func__
+
+    def scan_function(self, *indices):
+        # the scan calls acquire_point and save_point itself, unless a subclass overrides this
+        self.save_point(self.read_spectra(), *indices)
+
+    def acquire_point(self, *indices):
+        if self._overrides_scan_function():
+            self.scan_function(*indices)  # this saves the point too
+            return None
+        return self.read_spectra()
+
+    def point_signal(self, raw_spectra, *indices):
+        """The mean processed intensity at a point, used to refine adaptive scans."""
         spectra = self.process_spectra(raw_spectra)
-        self.data['raw_data/hs_image'+self._suffix(0)][indices] = raw_spectra
-        self.data['hs_image'+self._suffix(0)][indices] = spectra
+        spectrum = spectra[0] if isinstance(self.spectrometer, Spectrometers) else spectra
+        return float(np.nanmean(spectrum))
+
+    def save_point(self, raw_spectra, *indices):
+        if raw_spectra is None:
+            return  # scan_function has saved it already
+        spectra = self.process_spectra(raw_spectra)
+        if self.adaptive:
+            for name, value in [('point_indices', indices),
+                                ('raw_data/hs_image'+self._suffix(0), raw_spectra),
+                                ('hs_image'+self._suffix(0), spectra)]:
+                dset = self.data[name]
+                dset.resize(dset.shape[0] + 1, axis=0)
+                dset[-1] = value
+        else:
+            self.data['raw_data/hs_image'+self._suffix(0)][indices] = raw_spectra
+            self.data['hs_image'+self._suffix(0)][indices] = spectra
 #        for i, (spectrum, raw_spectrum) in enumerate(zip(spectra, raw_spectra)):
 #            try:
 #                suffix = self._suffix(i)
@@ -146,14 +242,19 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
                 if isinstance(self.spectrometer, Spectrometers) else self.spectrometer
             w = abs(spectrometer.wavelengths - self.view_wavelength).argmin()
             data = self.data['hs_image'+suffix]
-            if self.num_axes == 2:
+            if self.adaptive:
+                latest_view = self.adaptive_preview
+                spectrum = data[-1, :] if data.shape[0] > 0 else np.zeros(data.shape[1])
+            elif self.num_axes == 2:
                 latest_view = data[:, :, w]
                 spectrum = self.data['hs_image'+suffix][indices[-2], indices[-1], :]
             elif self.num_axes == 3:
                 if self.override_view_layer:
                     k = self.view_layer
                 else:
-                    k = self.indices[0]
+                    # the layer of the point being shown - with pipeline_saving, self.indices
+                    # may already have moved on to the next point
+                    k = indices[0]
                     if self.view_layer != k:
                         self.view_layer = k
                 latest_view = data[k, :, :, w]
@@ -269,6 +370,22 @@ class HyperspectralScan(GridScanQt, ScanningExperimentHDF5):
     def estimated_step_time(self, value):
         print value
 
+    def timing_model_name(self):
+        # the timing model depends on both the stage and the spectrometer(s)
+        spectrometers = self.spectrometer.spectrometers \
+            if isinstance(self.spectrometer, Spectrometers) else [self.spectrometer]
+        return '{0}/{1}'.format(super(HyperspectralScan, self).timing_model_name(),
+                                '+'.join(s.__class__.__name__ for s in spectrometers))
+
+    def timing_settings(self):
+        # the settle phase is the delay, and the acquire phase depends on the exposure
+        settings = dict(delay=self.delay)
+        spectrometers = self.spectrometer.spectrometers \
+            if isinstance(self.spectrometer, Spectrometers) else [self.spectrometer]
+        for i, spectrometer in enumerate(spectrometers):
+            settings['integration_time'+self._suffix(i)] = getattr(spectrometer, 'integration_time', None)
+        return settings
+
     def get_qt_ui(self):
         return HyperspectralScanUI(self)
 
@@ -11,6 +11,7 @@ import numpy as np
 import threading
 import time
 import operator
+from multiprocessing.pool import ThreadPool
 from nplab.experiment.scanning_experiment import ScanningExperiment, TimedScan
 from nplab.instrument.stage import Stage
 from functools import partial
@@ -19,11 +20,111 @@ from nplab.ui.ui_tools import UiTools
 from nplab import inherit_docstring
 
 
+def snake_trajectory(shape, order=None):
+    """
+    Returns the grid indices visited by a snaking scan over a grid of the given shape.
+
+    The result is an (N, len(shape)) integer array with one row per point, in the order
+    the points are visited. The outermost axis is stepped once, and each inner axis
+    reverses direction every time an enclosing axis steps, so consecutive points differ
+    along one axis only.
+
+    :param shape: the number of points along each axis
+    :param order: the axes from the outermost loop to the innermost, by default in order
+    :return: an array of indices with shape (N, len(shape))
+    """
+    if order is None:
+        order = range(len(shape))
+    shape = tuple(shape[d] for d in order)
+    steps = np.indices(shape).reshape(len(shape), -1).T
+    trajectory = steps.copy()
+    for d in range(1, len(shape)):
+        # count how many times this axis has been swept already; it starts reversed
+        sweeps = np.ravel_multi_index(steps[:, :d].T, shape[:d])
+        reverse = sweeps % 2 == 0
+        trajectory[reverse, d] = shape[d] - 1 - steps[reverse, d]
+    reordered = np.empty_like(trajectory)
+    reordered[:, list(order)] = trajectory
+    return reordered
+
+
+def snake_sort(points):
+    """
+    Orders a list of 2D grid indices into a snake: rows in increasing order, alternating
+    the direction along each row.
+
+    :param points: a sequence of (row, column) index pairs
+    :return: an (N, 2) integer array of the sorted indices
+    """
+    points = np.array(sorted(points), dtype=int).reshape(-1, 2)
+    if len(points) == 0:
+        return points
+    rows, row_starts = np.unique(points[:, 0], return_index=True)
+    row_ends = np.append(row_starts[1:], len(points))
+    for start, end in zip(row_starts[1::2], row_ends[1::2]):
+        points[start:end] = points[start:end][::-1]
+    return points
+
+
+def resample_sparse(indices, values, shape):
+    """
+    Interpolates values sampled at scattered grid indices onto the full 2D grid.
+
+    Points inside the sampled region are linearly interpolated, and any outside it take
+    the nearest sampled value.
+
+    :param indices: an (N, 2) array of the grid indices that were sampled
+    :param values: the N sampled values
+    :param shape: the shape of the dense grid
+    :return: a dense array of the given shape
+    """
+    from scipy.interpolate import griddata
+    indices = np.asarray(indices, dtype=float)
+    values = np.asarray(values, dtype=float)
+    grid = tuple(np.indices(shape))
+    if len(values) < 3:
+        return np.full(shape, np.nanmean(values) if len(values) else np.nan)
+    try:
+        dense = griddata(indices, values, grid, method='linear')
+    except Exception:  # e.g. all the points are in a line, so there's no triangulation
+        dense = np.full(shape, np.nan)
+    missing = np.isnan(dense)
+    if np.any(missing):
+        dense[missing] = griddata(indices, values, grid, method='nearest')[missing]
+    return dense
+
+
 class GridScan(ScanningExperiment, TimedScan):
     """
     Note that the axes (x,y,z) will relate to the indices (z,y,x) as per array standards.
+
+    By default scan_function is called at each point. Subclasses can instead split the
+    work into acquire_point and save_point and set pipeline_saving to True, in which case
+    each point is saved in a worker thread while the stage moves on to the next one.
+
+    Setting adaptive to True scans a 2D grid sparsely: a coarse grid is acquired first,
+    with a spacing of 2**adaptive_levels steps, then each cell whose corners have a
+    point_signal above adaptive_threshold (or that differ by more than
+    adaptive_gradient_threshold) is split in four and its new corners acquired, until the
+    full resolution is reached. The points acquired are listed in trajectory and their
+    signals in point_signals, and adaptive_preview holds a dense interpolated image.
+
+    Each point is marked in the completed mask once it has been saved, and checkpoint_point
+    is called so subclasses can persist the mask alongside the data. An interrupted
+    (non-adaptive) scan can then be continued with resume, after restoring its parameters
+    with set_scan_state and its completed mask.
+
+    The time taken for each phase is fed into a ScanTimingModel (see TimedScan), which is
+    kept between scans for each stage and timing_settings, and used for the time
+    estimates. If optimise_orientation is True, the model is also used to choose which
+    of the two innermost axes to sweep along; they are only swapped if that is predicted
+    to be quicker by more than orientation_margin (a fraction of the scan time), so that
+    small errors in the model don't change the scan direction.
     """
 
+    phase_names = ('move', 'settle', 'acquire', 'save')
+    pipeline_saving = False
+
     def __init__(self):
         ScanningExperiment.__init__(self)
         TimedScan.__init__(self)
@@ -35,6 +136,20 @@ class GridScan(ScanningExperiment, TimedScan):
         self.step = 0.05 * np.ones(len(self.axes), dtype=np.float64)
         self.init = np.zeros(len(self.axes), dtype=np.float64)
         self.scan_axes = None
+        self.settling_time = 0.
+        self.trajectory = None
+        self.phase_times = None
+        self.adaptive = False
+        self.adaptive_levels = 3
+        self.adaptive_threshold = None
+        self.adaptive_gradient_threshold = None
+        self.point_signals = None
+        self.adaptive_preview = None
+        self.completed = None
+        self._resuming = False
+        self.optimise_orientation = False
+        self.orientation_margin = 0.1
+        self.loop_order = None
         # underscored attributes are made into properties
         self._num_axes = len(self.axes)
         self._unit_conversion = {'nm': 1e-9, 'um': 1e-6, 'mm': 1e-3}
@@ -114,6 +229,45 @@ class GridScan(ScanningExperiment, TimedScan):
                                                    args=(self.axes, self.size, self.step, self.init))
         self.acquisition_thread.start()
 
+    def resume(self, *args, **kwargs):
+        """
+        Continues an interrupted scan from the first point that was not completed, in the
+        same snake order. The scan parameters, loop order and completed mask must match
+        the interrupted scan.
+        Arguments are passed to run.
+        """
+        if self.completed is None:
+            raise ValueError('there is no completed-point mask to resume from')
+        if self.adaptive:
+            raise ValueError('adaptive scans cannot be resumed')
+        self._resuming = True
+        self.run(*args, **kwargs)
+
+    def get_scan_state(self):
+        """Returns a dictionary of the parameters that define the current scan."""
+        state = dict(axes=list(self.axes), axes_names=list(self.axes_names),
+                     size=self.size.copy(), step=self.step.copy(), init=self.init.copy(),
+                     size_unit=self.size_unit, step_unit=self.step_unit, init_unit=self.init_unit)
+        if self.loop_order is not None:
+            state['loop_order'] = list(self.loop_order)
+        return state
+
+    def set_scan_state(self, state):
+        """Restores the scan parameters from a dictionary made by get_scan_state."""
+        self.num_axes = len(state['axes'])
+        self.axes = list(state['axes'])
+        self.axes_names = [str(name) for name in state['axes_names']]
+        # set the units first, without rescaling, so the values are not converted
+        self._size_unit, self._step_unit, self._init_unit = (str(state['size_unit']),
+                                                             str(state['step_unit']),
+                                                             str(state['init_unit']))
+        self.size, self.step, self.init = (np.array(state['size'], dtype=np.float64),
+                                           np.array(state['step'], dtype=np.float64),
+                                           np.array(state['init'], dtype=np.float64))
+        # scans saved before the loop order was recorded are planned afresh when resumed
+        loop_order = state.get('loop_order')
+        self.loop_order = tuple(int(d) for d in np.atleast_1d(loop_order)) if loop_order is not None else None
+
     def init_grid(self, axes, size, step, init):
         """Create a grid on which to scan."""
         scan_axes = []
@@ -128,6 +282,54 @@ class GridScan(ScanningExperiment, TimedScan):
         self.scan_axes = scan_axes
         return scan_axes
 
+    def timing_model_name(self):
+        return '{0}/{1}'.format(self.__class__.__name__, self.stage.__class__.__name__)
+
+    def timing_settings(self):
+        return dict(settling_time=self.settling_time)
+
+    def move_distances(self, trajectory, scan_axes=None):
+        """
+        Returns the distance moved along each axis to reach each point of a trajectory, as
+        an array with the same shape. The first point is counted as no move.
+        """
+        if scan_axes is None:
+            scan_axes = self.scan_axes
+        positions = np.column_stack([scan_axes[d][trajectory[:, d]] for d in range(len(scan_axes))])
+        distances = np.zeros_like(positions)
+        distances[1:] = np.abs(np.diff(positions, axis=0))
+        return distances
+
+    def plan_trajectory(self):
+        """
+        Returns the snake trajectory and loop order for the current grid. If
+        optimise_orientation is set and the timing model has data, the two innermost
+        axes are swapped when that is predicted to be quicker by more than
+        orientation_margin.
+        """
+        self.load_timing_model(len(self.grid_shape))
+        order = tuple(range(len(self.grid_shape)))
+        trajectory = snake_trajectory(self.grid_shape, order)
+        if self.optimise_orientation and len(order) >= 2:
+            swapped_order = order[:-2] + order[:-3:-1]
+            swapped = snake_trajectory(self.grid_shape, swapped_order)
+            estimate = self._model_estimate(self.move_distances(trajectory))
+            swapped_estimate = self._model_estimate(self.move_distances(swapped))
+            if estimate is not None and swapped_estimate < (1 - self.orientation_margin)*estimate:
+                return swapped, swapped_order
+        return trajectory, order
+
+    def planned_move_distances(self):
+        if self.scan_axes is None or self.adaptive:
+            return None
+        trajectory, order = self.plan_trajectory()
+        return self.move_distances(trajectory)
+
+    def remaining_move_distances(self):
+        if self.trajectory is None or self.adaptive or not self.acquiring.is_set():
+            return None
+        return self.move_distances(self.trajectory[self._index - self._first_index:])
+
     def init_current_grid(self):
         """Convenience method that initialises a grid based on current parameters."""
         axes, size, step, init = (self.axes[::-1], self.size[::-1], self.step[::-1], self.init[::-1])
@@ -171,59 +373,112 @@ class GridScan(ScanningExperiment, TimedScan):
     def middle_loop_end(self):
         """This function is called after the scan happens, for each value of the second-outermost variable (usually Y)"""
         pass
+
+    def reopen_scan(self):
+        """
+        This is called instead of open_scan when a scan is resumed, to reopen its data
+        storage without overwriting the points that were already completed.
+        """
+        pass
+
+    def checkpoint_point(self, *indices):
+        """
+        This is called once the data for a point has been saved, after it is marked in
+        the completed mask. Subclasses should persist the mask here, after the data, so that
+        a point is only ever recorded as complete once its data are safely stored.
+        """
+        pass
+
+    def settle(self):
+        """This function is called after moving to each point, before acquiring data."""
+        if self.settling_time > 0:
+            time.sleep(self.settling_time)
+
+    def acquire_point(self, *indices):
+        """
+        Acquires data at the current point and returns it for save_point. The default
+        implementation just calls scan_function.
+        """
+        self.scan_function(*indices)
+
+    def save_point(self, data, *indices):
+        """
+        Processes and saves the data returned by acquire_point. If pipeline_saving is
+        True this runs in a worker thread while the stage moves to the next point, so it
+        must not use the stage or any instrument.
+        """
+        pass
+
+    def point_signal(self, data, *indices):
+        """
+        Returns a single number summarising the data acquired at a point, used to decide
+        where to refine an adaptive scan. The default is the sum of the data.
+        """
+        return float(np.nansum(data))
+
+    def _timed_save_point(self, n, data, indices):
+        t0 = time.time()
+        self.save_point(data, *indices)
+        self.completed[indices] = True
+        self.checkpoint_point(*indices)
+        self.phase_times[n, 3] = time.time() - t0
+        self.timing_model.add_save(self.phase_times[n, 3])
+
     def scan(self, axes, size, step, init):
-        """Scans a grid, applying a function at each position."""
+        """
+        Scans a grid, applying a function at each position.
+
+        The snake trajectory is computed before the scan starts, and only the axes that
+        change between consecutive points are moved. The time spent moving, settling,
+        acquiring and saving at each point is recorded in phase_times, in trajectory order.
+        Afterwards, trajectory and phase_times cover only the points visited in this run.
+        """
         self.abort_requested = False
+        resuming, self._resuming = self._resuming, False
         axes, size, step, init = (axes[::-1], size[::-1], step[::-1], init[::-1])
+        if self.adaptive and len(axes) != 2:
+            raise ValueError('adaptive scans are only supported on 2D grids')
         scan_axes = self.init_grid(axes, size, step, init)
         print scan_axes
-        self.open_scan()
-        # get the indices of points along each of the scan axes for use with snaking over array
-        pnts = [range(axis.size) for axis in scan_axes]
+        if resuming and self.completed.shape != self.grid_shape:
+            raise ValueError('the completed-point mask does not match the scan grid')
+        # plan before opening the scan, so the loop order is stored with the scan state
+        if self.adaptive:
+            self.loop_order = tuple(range(len(axes)))
+        elif resuming and self.loop_order is not None:
+            self.trajectory = snake_trajectory(self.grid_shape, self.loop_order)
+        else:
+            self.trajectory, self.loop_order = self.plan_trajectory()
+        if resuming:
+            self.reopen_scan()
+        else:
+            self.completed = np.zeros(self.grid_shape, dtype=bool)
+            self.open_scan()
 
-        self.indices = [-1,] * len(axes)
-        self._index = 0
+        self.indices = (-1,) * len(axes)
+        self._index = int(self.completed.sum())
+        self._first_index = self._index
+        self.load_timing_model(len(axes))
         self._step_times = np.zeros(self.grid_shape)
         self._step_times.fill(np.nan)
+        self.phase_times = np.zeros((self.total_points, len(self.phase_names)))
+        self.phase_times.fill(np.nan)
         self.status = 'acquiring data'
         self.acquiring.set()
         scan_start_time = time.time()
-        for k in pnts[0]:  # outer most axis
-            self.indices = list(self.indices)
-            self.indices[0] = k # Make sure indices is always up-to-date, for the drift compensation
-            if self.abort_requested:
-                break
-            self.outer_loop_start()
-            self.status = 'Scanning layer {0:d}/{1:d}'.format(k + 1, len(pnts[0]))
-            self.move(scan_axes[0][k], axes[0])
-            pnts[1] = pnts[1][::-1]  # reverse which way is iterated over each time
-            for j in pnts[1]:
-                if self.abort_requested:
-                    break
-                self.move(scan_axes[1][j], axes[1])
-                self.indices = list(self.indices)
-                self.indices[1] = j
-                if len(axes) == 3:  # for 3d grid (volume) scans
-                    self.middle_loop_start()
-                    pnts[2] = pnts[2][::-1]  # reverse which way is iterated over each time
-                    for i in pnts[2]:
-                        if self.abort_requested:
-                            break
-                        self.move(scan_axes[2][i], axes[2])
-                        self.indices[2] = i # These two lines are redundant.  TODO: pick one...
-                        #self.indices = (k, j, i) # keeping it as a list allows index assignment
-                        self.scan_function(k, j, i)
-                        self._step_times[k,j,i] = time.time()
-                        self._index += 1
-                    self.middle_loop_end()
-                elif len(axes) == 2:  # for regular 2d grid scans ignore third axis i
-                    self.indices = (k, j)
-                    self.scan_function(k, j)
-                    self._step_times[k,j] = time.time()
-                    self._index += 1
-            self.outer_loop_end()
+        if self.adaptive:
+            self._adaptive_scan(scan_axes, axes)
+        else:
+            if resuming:
+                self.trajectory = self.trajectory[~self.completed[tuple(self.trajectory.T)]]
+            self._scan_points(self.trajectory, scan_axes, axes)
+            # keep only the points visited, in case the scan was aborted
+            visited = self._index - self._first_index
+            self.trajectory, self.phase_times = self.trajectory[:visited], self.phase_times[:visited]
 
         self.print_scan_time(time.time() - scan_start_time)
+        self.print_phase_times()
+        self.save_timing_model()
         self.acquiring.clear()
         # move back to initial positions
         for i in range(len(axes)):
@@ -233,6 +488,144 @@ class GridScan(ScanningExperiment, TimedScan):
         self.close_scan()
         self.status = 'scan complete'
 
+    def _scan_points(self, points, scan_axes, axes):
+        """
+        Visits each of the given grid indices in turn, acquiring and saving data at each.
+        Points are numbered in phase_times from the start of this run of the scan.
+        """
+        num_axes = len(axes)
+        order = self.loop_order
+        pool = ThreadPool(processes=1) if self.pipeline_saving else None
+        pending_save = None
+        previous = None
+        try:
+            for point in points:
+                if self.abort_requested:
+                    break
+                point = tuple(point)
+                n = self._index - self._first_index
+                distances = np.zeros(num_axes)
+                if previous is None:
+                    changed = list(order)
+                else:
+                    # axes are moved, and loop hooks called, from the outermost loop inwards
+                    changed = [d for d in order if point[d] != previous[d]]
+                    for d in changed:
+                        distances[d] = abs(scan_axes[d][point[d]] - scan_axes[d][previous[d]])
+                    if num_axes == 3 and order.index(changed[0]) < 2:
+                        self.middle_loop_end()
+                    if changed[0] == order[0]:
+                        self.outer_loop_end()
+                new_row = order.index(changed[0]) < 2
+                self.indices = point  # keep indices up-to-date, for the drift compensation
+                if changed[0] == order[0]:
+                    self.outer_loop_start()
+                    self.status = 'Scanning layer {0:d}/{1:d}'.format(point[order[0]] + 1,
+                                                                     self.grid_shape[order[0]])
+                move_time = 0.
+                for d in changed:
+                    if num_axes == 3 and d == order[2] and new_row:
+                        self.middle_loop_start()
+                    t0 = time.time()
+                    self.move(scan_axes[d][point[d]], axes[d])
+                    move_time += time.time() - t0
+                if num_axes == 3 and new_row and order[2] not in changed:
+                    self.middle_loop_start()
+                self.phase_times[n, 0] = move_time
+                t0 = time.time()
+                self.settle()
+                t1 = time.time()
+                data = self.acquire_point(*point)
+                t2 = time.time()
+                self.phase_times[n, 1:3] = (t1 - t0, t2 - t1)
+                self.timing_model.add_point(distances, move_time, t1 - t0, t2 - t1)
+                self._step_times[point] = t2
+                if self.adaptive:
+                    self.point_signals[n] = self.point_signal(data, *point)
+                    self.adaptive_preview[point] = self.point_signals[n]
+                self._index += 1
+                if pool is not None:
+                    if pending_save is not None:
+                        pending_save.get()  # keep at most one point in flight, raising any errors
+                    pending_save = pool.apply_async(self._timed_save_point, (n, data, point))
+                else:
+                    self._timed_save_point(n, data, point)
+                previous = point
+            if previous is not None:
+                if num_axes == 3:
+                    self.middle_loop_end()
+                self.outer_loop_end()
+        finally:
+            if pool is not None:
+                if pending_save is not None:
+                    pending_save.wait()
+                pool.close()
+                pool.join()
+        if pending_save is not None:
+            pending_save.get()
+
+    def _adaptive_scan(self, scan_axes, axes):
+        """Scans a 2D grid coarsely, then refines cells where the signal is interesting."""
+        shape = self.grid_shape
+        spacing = 2**self.adaptive_levels
+        lattice = [np.unique(np.append(np.arange(0, n, spacing), n - 1)) for n in shape]
+        cells = [(y0, y1, x0, x1)
+                 for y0, y1 in zip(lattice[0][:-1], lattice[0][1:]) or [(0, 0)]
+                 for x0, x1 in zip(lattice[1][:-1], lattice[1][1:]) or [(0, 0)]]
+        points = snake_sort([(y, x) for y in lattice[0] for x in lattice[1]])
+        self.point_signals = np.zeros(self.total_points)
+        self.point_signals.fill(np.nan)
+        self.adaptive_preview = np.zeros(shape)
+        self.adaptive_preview.fill(np.nan)
+        signals = np.zeros(shape)
+        signals.fill(np.nan)
+        sampled = []
+        threshold = self.adaptive_threshold
+        for level in range(self.adaptive_levels + 1):
+            if len(points) == 0:
+                break
+            self.status = 'Adaptive scan level {0:d}/{1:d}'.format(level + 1, self.adaptive_levels + 1)
+            start = self._index
+            self._scan_points(points, scan_axes, axes)
+            sampled.extend(tuple(p) for p in points[:self._index - start])
+            self.trajectory = np.array(sampled, dtype=int)
+            signals[tuple(self.trajectory.T)] = self.point_signals[:self._index]
+            self.adaptive_preview = resample_sparse(self.trajectory, self.point_signals[:self._index], shape)
+            if self.abort_requested or level == self.adaptive_levels:
+                break
+            if threshold is None:
+                # default to halfway between the background (median) and the brightest point
+                finite = self.point_signals[np.isfinite(self.point_signals)]
+                threshold = (np.median(finite) + np.max(finite)) / 2. if len(finite) else np.inf
+            new_cells = []
+            new_points = set()
+            for y0, y1, x0, x1 in cells:
+                corners = signals[[y0, y0, y1, y1], [x0, x1, x0, x1]]
+                interesting = np.nanmax(corners) > threshold
+                if self.adaptive_gradient_threshold is not None:
+                    interesting |= np.nanmax(corners) - np.nanmin(corners) > self.adaptive_gradient_threshold
+                if not interesting:
+                    continue
+                ys = sorted(set([y0, (y0 + y1) // 2, y1]))
+                xs = sorted(set([x0, (x0 + x1) // 2, x1]))
+                if len(ys) < 3 and len(xs) < 3:
+                    continue  # already at full resolution
+                new_cells += [(ya, yb, xa, xb) for ya, yb in zip(ys[:-1], ys[1:]) or [(y0, y1)]
+                              for xa, xb in zip(xs[:-1], xs[1:]) or [(x0, x1)]]
+                new_points.update((y, x) for y in ys for x in xs if np.isnan(signals[y, x]))
+            cells = new_cells
+            points = snake_sort(new_points)
+        self.phase_times = self.phase_times[:self._index]
+
+    def print_phase_times(self):
+        """Prints the mean time per point spent in each phase of the scan."""
+        if self.phase_times is None or not np.any(np.isfinite(self.phase_times)):
+            return
+        done = np.isfinite(self.phase_times).all(axis=1)
+        means = self.phase_times[done].mean(axis=0)
+        print 'Time per point:', ', '.join('{0} {1:.1f} ms'.format(name, 1e3*t)
+                                           for name, t in zip(self.phase_names, means))
+
     def vary_axes(self, name, multiplier=2.):
         if 'increase_size' in name:
             self.size *= multiplier
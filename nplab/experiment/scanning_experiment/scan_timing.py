@@ -1,12 +1,123 @@
 __author__ = 'alansanders'
 
 import numpy as np
+import h5py
+import os
+from collections import deque
+from scipy.optimize import nnls
+
+DEFAULT_TIMING_MODEL_FILE = os.path.join(os.path.expanduser("~"), ".nplab", "scan_timing.h5")
+
+
+class ScanTimingModel(object):
+    """
+    A rolling model of how long each phase (move, settle, acquire, save) of a scan point takes.
+
+    The move time is fitted as a constant plus a linear term in the distance moved along each
+    axis, and the other phases are averaged. Only the most recent `window` points are used so
+    the model follows changes in the hardware during a scan.
+    """
+    phase_names = ('move', 'settle', 'acquire', 'save')
+
+    def __init__(self, num_axes, window=200):
+        self.num_axes = num_axes
+        self.window = window
+        self._distances = deque(maxlen=window)
+        self._times = dict((name, deque(maxlen=window)) for name in self.phase_names)
+
+    def add_point(self, distances, move, settle, acquire):
+        """Records the distance moved along each axis and the time taken for a point."""
+        self._distances.append(np.abs(np.asarray(distances, dtype=np.float64)))
+        self._times['move'].append(move)
+        self._times['settle'].append(settle)
+        self._times['acquire'].append(acquire)
+
+    def add_save(self, save):
+        """Records the time taken to save a point."""
+        self._times['save'].append(save)
+
+    @property
+    def trained(self):
+        """Whether any points have been recorded yet."""
+        return len(self._times['acquire']) > 0
+
+    def mean_time(self, phase):
+        """The average time taken for a phase over the window, or 0 if there is no data."""
+        times = np.array(self._times[phase], dtype=np.float64)
+        return times.mean() if times.size > 0 else 0.
+
+    def move_coefficients(self):
+        """
+        Fits the move time as t = c[0] + sum(c[1:] * |distance|) and returns c. Axes that did
+        not move within the window get a coefficient of zero.
+        """
+        n = min(len(self._distances), len(self._times['move']))
+        if n == 0:
+            return np.zeros(self.num_axes + 1)
+        distances = np.array(self._distances)[-n:].reshape(n, self.num_axes)
+        times = np.array(self._times['move'], dtype=np.float64)[-n:]
+        # fit with non-negative coefficients, as moving further never saves time; scaling the
+        # columns keeps the problem well conditioned when distances are in metres
+        design = np.column_stack([np.ones(n), distances])
+        scale = np.sqrt(np.mean(design**2, axis=0))
+        scale[scale == 0] = 1
+        coefficients = nnls(design / scale, times)[0] / scale
+        return coefficients
+
+    def point_times(self, distances, pipelined=False):
+        """
+        Predicts the time taken for each of a sequence of points, given the (N, num_axes)
+        distances moved to reach them. If saving is pipelined it overlaps with the next point,
+        so only the slower of the two counts.
+        """
+        distances = np.abs(np.asarray(distances, dtype=np.float64)).reshape(-1, self.num_axes)
+        c = self.move_coefficients()
+        move = np.clip(c[0] + distances.dot(c[1:]), 0, None)
+        stage_time = move + self.mean_time('settle') + self.mean_time('acquire')
+        if pipelined:
+            return np.maximum(stage_time, self.mean_time('save'))
+        else:
+            return stage_time + self.mean_time('save')
+
+    def estimate(self, distances, pipelined=False):
+        """Predicts the total time for a sequence of points (see point_times)."""
+        return float(np.sum(self.point_times(distances, pipelined)))
+
+    def throughput(self, pipelined=False):
+        """Predicts the number of points per second, based on the recent moves."""
+        if not self.trained:
+            return np.nan
+        mean_time = np.mean(self.point_times(np.array(self._distances), pipelined))
+        return 1./mean_time if mean_time > 0 else np.inf
+
+    def save(self, group):
+        """Stores the model's data in an HDF5 group."""
+        for name in ('distances',) + self.phase_names:
+            if name in group:
+                del group[name]
+        group.create_dataset('distances', data=np.array(self._distances).reshape(-1, self.num_axes))
+        for phase in self.phase_names:
+            group.create_dataset(phase, data=np.array(self._times[phase], dtype=np.float64))
+
+    def load(self, group):
+        """Replaces the model's data with that stored in an HDF5 group by save."""
+        if group['distances'].shape[1:] != (self.num_axes,):
+            return  # the stored model was for a different number of axes
+        self._distances.clear()
+        self._distances.extend(group['distances'][...])
+        for phase in self.phase_names:
+            self._times[phase].clear()
+            self._times[phase].extend(group[phase][...])
 
 
 class TimedScan(object):
+    timing_model_file = DEFAULT_TIMING_MODEL_FILE
+    """The file where timing models are kept between scans (set this on a subclass or instance to use another)."""
+
     def __init__(self):
         self._estimated_step_time = 0
         self.total_points = 0
+        self.timing_model = None
 
     @property
     def estimated_step_time(self):
@@ -16,23 +127,103 @@ class TimedScan(object):
     def estimated_step_time(self, value):
         self._estimated_step_time = value
 
+    def timing_model_name(self):
+        """
+        The name the timing model is stored under. Override this to identify the hardware
+        used (e.g. the stage and spectrometer), as the model is only valid for that hardware.
+        """
+        return self.__class__.__name__
+
+    def timing_settings(self):
+        """
+        The settings that change how long each point takes, such as a settling time or
+        exposure, as a dictionary. Override this to add them: a separate model is kept for
+        each combination, so that a model measured with a short exposure isn't used to
+        predict a long one.
+        """
+        return {}
+
+    def timing_model_key(self):
+        """The name of the stored timing model for this hardware and these settings."""
+        settings = self.timing_settings()
+        if not settings:
+            return self.timing_model_name()
+        return '{0}/{1}'.format(self.timing_model_name(),
+                                ','.join('{0}={1}'.format(key, settings[key]) for key in sorted(settings)))
+
+    def load_timing_model(self, num_axes):
+        """Creates the timing model, starting from the stored one for this hardware if any."""
+        name = self.timing_model_key()
+        if self.timing_model is not None and self.timing_model.num_axes == num_axes \
+                and getattr(self, '_timing_model_name', None) == name:
+            return self.timing_model
+        self.timing_model = ScanTimingModel(num_axes)
+        self._timing_model_name = name
+        try:
+            with h5py.File(self.timing_model_file, 'r') as f:
+                if name in f:
+                    self.timing_model.load(f[name])
+        except IOError:
+            pass  # there's no stored model yet
+        return self.timing_model
+
+    def save_timing_model(self):
+        """Stores the timing model so later scans on the same hardware can use it."""
+        if self.timing_model is None or not self.timing_model.trained:
+            return
+        try:
+            directory = os.path.dirname(self.timing_model_file)
+            if directory != '' and not os.path.exists(directory):
+                os.makedirs(directory)
+            with h5py.File(self.timing_model_file, 'a') as f:
+                self.timing_model.save(f.require_group(self.timing_model_key()))
+        except (IOError, OSError) as e:
+            print 'Could not save the scan timing model:', e
+
+    def planned_move_distances(self):
+        """
+        Returns the distance moved along each axis to reach every point of the planned scan,
+        as an (N, num_axes) array, or None if it is not known. Override in subclasses.
+        """
+        return None
+
+    def remaining_move_distances(self):
+        """As planned_move_distances, but for the points not yet acquired in the current scan."""
+        return None
+
+    def _model_estimate(self, distances):
+        if self.timing_model is None or not self.timing_model.trained or distances is None:
+            return None
+        return self.timing_model.estimate(distances, getattr(self, 'pipeline_saving', False))
+
     def estimate_scan_duration(self):
         """Estimate the duration of a grid scan."""
-        estimated_time = self.total_points * self.estimated_step_time
+        estimated_time = self._model_estimate(self.planned_move_distances())
+        if estimated_time is None:
+            estimated_time = self.total_points * self.estimated_step_time
         return self.format_time(estimated_time)
 
     def get_estimated_time_remaining(self):
         """Estimate the time remaining of the current scan."""
         if not hasattr(self, '_step_times'):
             return np.inf
+        etr = self._model_estimate(self.remaining_move_distances())
+        if etr is not None:
+            return etr
         mask = np.isfinite(self._step_times)
         if not np.any(mask):
             return 0
-        times = self._step_times[mask].flatten()
-        average_step_time = np.mean(np.diff(times))
+        times = np.sort(self._step_times[mask].flatten())
+        average_step_time = np.mean(np.diff(times)) if times.size > 1 else self.estimated_step_time
         etr = (self.total_points - self._index) * average_step_time  # remaining steps = self.total_points - index
         return etr
 
+    def get_throughput(self):
+        """The predicted number of points acquired per second."""
+        if self.timing_model is None:
+            return np.nan
+        return self.timing_model.throughput(getattr(self, 'pipeline_saving', False))
+
     def format_time(self, t):
         """Formats the time in seconds into a string with convenient units."""
         if t < 120:
@@ -48,10 +239,13 @@ class TimedScan(object):
         """Returns a string of convenient units for the estimated time remaining."""
         if self.acquisition_thread.is_alive():
             etr = self.get_estimated_time_remaining()
+            throughput = self.get_throughput()
+            if np.isfinite(throughput):
+                return '{0} ({1:.1f} points/s)'.format(self.format_time(etr), throughput)
             return self.format_time(etr)
         else:
             return 'inactive'
 
     def print_scan_time(self, t):
         """Prints the duration of the scan."""
-        print 'Scan took', self.format_time(t)
\ No newline at end of file
+        print 'Scan took', self.format_time(t)
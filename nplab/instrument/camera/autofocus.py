@@ -0,0 +1,174 @@
+"""
+Autofocus
+=========
+
+Merit functions and search strategies for autofocus.  None of this needs a camera or
+stage, so it can be tested (or reused with other instruments) on its own; the code that
+drives the hardware lives in `CameraWithLocation`.
+
+Scoring a frame is usually slower than it needs to be, because the whole colour frame
+is used.  `focus_region` converts a frame to a small grayscale array first (an ROI around
+a point, optionally binned down to a "thumbnail"), which is all the merit function needs.
+"""
+from __future__ import division
+import numpy as np
+import cv2
+from scipy.signal import argrelextrema
+
+
+def af_merit_squared_laplacian(image):
+    """Return the mean squared Laplacian of an image - a sharpness metric.
+
+    The image will be converted to grayscale if its shape is MxNx3"""
+    if len(image.shape) == 3:
+        image = np.mean(image, axis=2, dtype=image.dtype)
+    assert len(image.shape) == 2, "The image is the wrong shape - must be 2D or 3D"
+    return np.sum(cv2.Laplacian(image, ddepth=cv2.CV_32F) ** 2)
+
+
+def focus_region(image, roi=None, centre=None, binning=1):
+    """Return a grayscale, float32 region of an image for scoring focus.
+
+    Arguments:
+    roi : (height, width), optional
+        Size of the region to use, centred on `centre` (default: the centre of the image).
+        The whole image is used if this is None.
+    binning : int, optional
+        Sum blocks of binning x binning pixels, to make a small "thumbnail" image.
+    """
+    image = np.asarray(image)
+    if roi is not None:
+        if centre is None:
+            centre = np.array(image.shape[:2]) / 2.0
+        top_left = np.round(np.array(centre) - np.array(roi) / 2.0).astype(int)
+        top_left = np.maximum(np.minimum(top_left, np.array(image.shape[:2]) - np.array(roi)), 0)
+        image = image[top_left[0]:top_left[0] + roi[0], top_left[1]:top_left[1] + roi[1], ...]
+    # crop before converting, so we only convert the pixels we need
+    if image.ndim == 3:
+        image = np.mean(image, axis=2, dtype=np.float32)
+    else:
+        image = image.astype(np.float32)
+    if binning > 1:
+        h, w = image.shape[0] // binning, image.shape[1] // binning
+        image = image[:h * binning, :w * binning].reshape(h, binning, w, binning).sum(axis=(1, 3))
+    return image
+
+
+def parabola_peak(z, powers):
+    """Fit a parabola to (z, power) points and return the z of its maximum.
+
+    Returns None if the fit has no maximum (i.e. it curves upwards, or is flat)."""
+    z = np.asarray(z, dtype=np.float)
+    offset, scale = z.mean(), np.ptp(z) # fit in scaled coordinates, so it's well conditioned for tiny steps
+    coefficients = np.polyfit((z - offset) / scale, powers, deg=2)
+    if coefficients[0] >= 0:
+        return None
+    return offset - scale * coefficients[1] / (2 * coefficients[0])
+
+
+def best_focus_position(positions, powers, here, method="centre_of_mass", noise_floor=0.3):
+    """Choose the best focus from positions (an Nx3 array) and the merit function at each.
+
+    `method` may be "centre_of_mass", "parabola" or anything else (which picks the
+    highest score).  If no sensible maximum is found, `here` is returned.
+    """
+    powers = np.asarray(powers, dtype=np.float)
+    positions = np.asarray(positions, dtype=np.float)
+    z = positions[:, 2]
+    if method == "centre_of_mass":
+        threshold = powers.min() + (powers.max() - powers.min()) * noise_floor
+        weights = powers - threshold
+        weights[weights < 0] = 0.  # zero out any negative values
+        indices_of_maxima = argrelextrema(np.pad(weights, (1, 1), 'minimum'), np.greater)[0]-1
+        number_of_maxima = indices_of_maxima.size
+        if (np.sum(weights) == 0):
+            print "Warning, something went wrong and all the autofocus scores were identical! Returning to initial position."
+            new_position = here # Return to initial position if something fails
+        elif (number_of_maxima == 1) and not (indices_of_maxima[0] == 0 or indices_of_maxima[-1] == (weights.size-1)):
+            new_position = np.dot(weights, positions) / np.sum(weights)
+        else:
+            print("Warning, a maximum autofocus score could not be found. Returning to initial position.")
+            new_position = here
+    elif method == "parabola":
+        root = parabola_peak(z, powers)
+        if root is not None and z.min() < root and root < z.max():
+            new_position = [here[0], here[1], root]
+        else:
+            # The new position would have been outside the scan range - clip it to the outer points.
+            new_position = positions[powers.argmax(), :]
+    else:
+        new_position = positions[powers.argmax(), :]
+    return np.array(new_position, dtype=np.float)
+
+
+def _neighbourhood(z, powers):
+    """The best point, and its nearest sampled neighbours either side (sorted by z)."""
+    order = np.argsort(z)
+    z, powers = z[order], powers[order]
+    best = powers.argmax()
+    return z[max(best - 1, 0):best + 2], powers[max(best - 1, 0):best + 2], best == 0, best == len(z) - 1
+
+
+def coarse_to_fine_search(measure, z, refine_factor=3.0, tolerance=None, max_rounds=4):
+    """Find the z with the highest focus score, using a coarse grid then parabolic refinement.
+
+    Arguments:
+    measure : function
+        Takes a list of z positions and returns (z, powers) - the positions actually
+        reached, and the merit function at each.  Positions are passed in batches so that
+        `measure` can overlap moving the stage with scoring images.
+    z : np.array
+        The coarse grid of z positions to measure first (evenly spaced).
+    refine_factor : float, optional
+        Each round, the step shrinks by this factor, and three points are measured around
+        the peak of a parabola through the best point so far and its neighbours.
+    tolerance : float, optional
+        Stop when the step gets smaller than this.
+    max_rounds : int, optional
+        The most rounds of refinement (or of extending the grid, if the best point is at one
+        end of it) to do.
+
+    Returns the best z, and arrays of all the z positions measured and their scores.
+    """
+    z = np.sort(np.asarray(z, dtype=np.float))
+    step = np.median(np.diff(z))
+    zs, powers = [np.asarray(a, dtype=np.float) for a in measure(list(z))]
+    for i in range(max_rounds):
+        z_near, p_near, at_bottom, at_top = _neighbourhood(zs, powers)
+        if at_bottom or at_top:
+            # The peak is outside the grid: measure more of the coarse grid in that direction
+            direction = -1 if at_bottom else 1
+            new_z = z_near[0 if at_bottom else -1] + direction * step * np.arange(1, len(z) // 2 + 1)
+        else:
+            peak = parabola_peak(z_near, p_near)
+            if peak is None:
+                peak = z_near[p_near.argmax()]
+            peak = np.clip(peak, z_near[0], z_near[-1])
+            step /= refine_factor
+            if tolerance is not None and step < tolerance:
+                break
+            new_z = peak + np.array([-1, 0, 1]) * step
+        new_zs, new_powers = measure(list(new_z))
+        zs = np.concatenate((zs, new_zs))
+        powers = np.concatenate((powers, new_powers))
+    z_near, p_near, at_bottom, at_top = _neighbourhood(zs, powers)
+    best = z_near[p_near.argmax()]
+    if not (at_bottom or at_top):
+        peak = parabola_peak(z_near, p_near)
+        if peak is not None and z_near[0] < peak < z_near[-1]:
+            best = peak
+    return best, zs, powers
+
+
+def interpolate_positions(times, position_times, positions):
+    """Estimate where the stage was at each time, by interpolating between position readings.
+
+    Used for the continuous sweep autofocus, where frames are timestamped during a move and
+    the stage position is read (or just known at the start and end) at other times."""
+    order = np.argsort(position_times)
+    position_times = np.asarray(position_times, dtype=np.float)[order]
+    positions = np.asarray(positions, dtype=np.float)[order]
+    if positions.ndim == 1:
+        return np.interp(times, position_times, positions)
+    return np.array([np.interp(times, position_times, positions[:, i])
+                     for i in range(positions.shape[1])]).T
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+Qt user interface for cameras: the controls, parameter table and live preview.
+
+These are kept separate from nplab.instrument.camera so that cameras can be used
+without loading Qt; Camera.get_qt_ui etc. import this module when they're called.
+"""
+
+import nplab.utils.gui #load Qt correctly - do this BEFORE traits
+from nplab.utils.gui import QtCore, QtGui, QtWidgets, uic
+from nplab.ui.ui_tools import UiTools
+import numpy as np
+import os
+import datetime
+from PIL import Image
+import pyqtgraph as pg
+
+from nplab.instrument.camera import Camera
+from nplab.utils.notified_property import DumbNotifiedProperty, register_for_property_changes
+
+
+class CameraUI(QtWidgets.QWidget):
+    """Generic user interface for a camera."""
+    def __init__(self, camera):
+        assert isinstance(camera, Camera), "instrument must be a Camera"
+        #TODO: better checking (e.g. assert camera has color_image, gray_image methods)
+        super(CameraUI, self).__init__()
+        self.camera=camera
+        
+        # Set up the UI        
+        self.setWindowTitle(self.camera.__class__.__name__)
+        layout = QtWidgets.QVBoxLayout()
+        # The image display goes at the top of the window
+        self.preview_widget = self.camera.get_preview_widget()
+        layout.addWidget(self.preview_widget)
+        # The controls go in a layout, inside a group box.
+        self.controls = self.camera.get_control_widget()
+        layout.addWidget(self.controls)
+        #layout.setContentsMargins(5,5,5,5)
+        layout.setSpacing(5)
+        self.setLayout(layout)
+        
+class CameraControlWidget(QtWidgets.QWidget, UiTools):
+    """Controls for a camera (these are the really generic ones)"""
+    def __init__(self, camera, auto_connect=True):
+        assert isinstance(camera, Camera), "instrument must be a Camera"
+        #TODO: better checking (e.g. assert camera has color_image, gray_image methods)
+        super(CameraControlWidget, self).__init__()
+        self.camera=camera
+        self.load_ui_from_file(__file__,"camera_controls_generic.ui")
+        if auto_connect==True:
+            self.auto_connect_by_name(controlled_object=self.camera, verbose=False)
+        
+    def snapshot(self):
+        """Take a new snapshot and display it."""
+        self.camera.raw_image(update_latest_frame=True)
+    
+    def save_to_data_file(self):
+        self.camera.save_raw_image(
+            attrs={'description':self.description_lineedit.text()})
+        
+    def save_jpeg(self):
+        cur_img = self.camera.color_image()
+        fname = QtWidgets.QFileDialog.getSaveFileName(
+                                caption = "Select JPEG filename",
+                                directory = os.path.join(os.getcwd(),datetime.date.today().strftime("%Y-%m-%d.jpg")),
+                                filter = "Images (*.jpg *.jpeg)",
+                            )
+        j = Image.fromarray(cur_img)
+        j.save(fname)
+        
+    def edit_camera_parameters(self):
+        """Pop up a camera parameters dialog box."""
+        self.camera_parameters_widget = self.camera.get_parameters_widget()
+        self.camera_parameters_widget.show()
+        
+    description = DumbNotifiedProperty("Description...")
+        
+    def __del__(self):
+        pass
+
+class CameraParametersTableModel(QtCore.QAbstractTableModel):
+    """Class to manage a Qt table of a camera's parameters.
+    
+    With thanks to http://stackoverflow.com/questions/11736560/edit-table-in-
+    pyqt-using-qabstracttablemodel"""
+    def __init__(self, camera, parent=None):
+        super(CameraParametersTableModel, self).__init__(parent)
+        self.camera = camera
+        self.parameter_names = self.camera.camera_parameter_names()
+        for parameter_name in self.parameter_names[:]:   #Added to prevent properties the camera does not posses from trying to appear in the list of parameters
+            try:
+                getattr(self.camera, parameter_name)
+            except:
+                self.parameter_names.remove(parameter_name)
+        
+        # Here, we register to get a callback if any of the parameters change
+        # so that we stay in sync with the camera.
+        self._callback_functions = dict()       
+        for i, pn in enumerate(self.parameter_names):
+            callback = self.callback_to_update_row(i)
+            register_for_property_changes(self.camera, pn, callback)
+            self._callback_functions[pn] = callback
+    
+    def callback_to_update_row(self, i):
+        """Return a callback function that refreshes the i-th parameter."""
+        def callback(value=None):
+            index = self.createIndex(i, 1)
+            self.dataChanged.emit(index, index)
+        return callback
+    
+    def rowCount(self, parent):
+        return len(self.parameter_names)
+    
+    def columnCount(self, parent):
+        return 2
+    
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        "Return the data for the table - property names left, values right."
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None    
+        parameter_name = self.parameter_names[index.row()]
+        if index.column() == 0:
+            return parameter_name
+        else:
+            return getattr(self.camera, parameter_name)
+    
+    def headerData(self, i, orientation, role=QtCore.Qt.DisplayRole):
+        "Return data for the headers."
+        if role == QtCore.Qt.DisplayRole:
+            if orientation == QtCore.Qt.Horizontal:
+                return ["Parameter Name", "Parameter Value"][i]
+            else:
+                return None
+        return None
+    
+    def setData(self, index, value, role=QtCore.Qt.DisplayRole):
+        """If the value is changed, update the corresponding property."""
+        assert index.column() == 1, "Can only edit second column!"
+        parameter_name = self.parameter_names[index.row()]
+        try:
+            float(value) # make sure the input is valid
+        except:
+            return False
+        setattr(self.camera, parameter_name, float(value))
+        self.dataChanged.emit(index, index) # signal that the data has changed.
+        return True
+        
+    def flags(self, index):
+        "Return flags to tell Qt that only the second column is editable."
+        if index.column() == 1:
+            return (QtCore.Qt.ItemIsEditable | QtCore.Qt.ItemIsEnabled | 
+                    QtCore.Qt.ItemIsSelectable)
+        else:
+            return QtCore.Qt.ItemIsEnabled
+    
+class CameraParametersWidget(QtWidgets.QWidget, UiTools):
+    """An editable table that controls a camera's acquisition parameters."""
+    def __init__(self, camera, *args, **kwargs):
+        super(CameraParametersWidget, self).__init__(*args, **kwargs)
+        self.camera = camera
+        self.table_model = CameraParametersTableModel(camera)
+        self.table_view = QtWidgets.QTableView()
+        self.table_view.setModel(self.table_model)
+        self.table_view.setCornerButtonEnabled(False)
+        self.table_view.resizeColumnsToContents()
+        self.table_view.horizontalHeader().setStretchLastSection(True)
+        
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.table_view)
+        self.setLayout(layout)
+
+class PreviewViewBox(pg.ViewBox):
+    """A pyqtgraph ViewBox for use in the preview widget."""
+    def suggestPadding(self, axis):
+        """Return a value to use for the padding on a given axis.
+        
+        We always return zero so the image, by default, fills the window."""
+        return 0
+        
+class PreviewImageItem(pg.ImageItem):
+    legacy_click_callback = None
+    click_callback_signal = QtCore.Signal(np.ndarray)
+    def mouseClickEvent(self, ev):
+        """Handle a mouse click on the image."""
+        if ev.button() == QtCore.Qt.LeftButton:
+            pos = np.array(ev.pos())
+            if self.legacy_click_callback is not None:
+        #        size = np.array(self.image.shape[:2])
+     #           point = pos/size
+      #          self.legacy_click_callback(point[1], point[0])
+                self.legacy_click_callback(int(pos[1]), int(pos[0]))
+                print pos[1],pos[0]
+                ev.accept()
+            else:
+                pass
+        else:
+            super(PreviewImageItem, self).mouseClickEvent(ev)
+    
+
+class CameraPreviewWidget(pg.GraphicsView):
+    """A Qt Widget to display the live feed from a camera."""
+    update_data_signal = QtCore.Signal(np.ndarray)
+    
+    def __init__(self):
+        super(CameraPreviewWidget, self).__init__()
+        
+        self.image_item = PreviewImageItem()
+        self.view_box = PreviewViewBox(lockAspect=1.0, invertY=True)
+        self.view_box.addItem(self.image_item)
+        self.view_box.setBackgroundColor([128,128,128,255])
+        self.setCentralWidget(self.view_box)
+        self.crosshair = {'h_line': pg.InfiniteLine(pos=0,angle=0),
+                          'v_line': pg.InfiniteLine(pos=0,angle=90),}
+        for item in self.crosshair.values():
+            self.view_box.addItem(item)
+        self._image_shape = ()
+
+        # We want to make sure we always update the data in the GUI thread.
+        # This is done using the signal/slot mechanism
+        self.update_data_signal.connect(self.update_widget, type=QtCore.Qt.QueuedConnection)
+
+    def update_widget(self, newimage):
+        """Set the image, but do so in the Qt main loop to avoid threading nasties."""
+        # I've explicitly dealt with the datatype of the source image, to avoid
+        # a bug in the way pyqtgraph interacts with numpy 1.10.  This means
+        # scaling the display values will fail for integer data.  I've thus
+        # forced floating-point for anything that isn't a u8, and assumed u8
+        # wants to be displayed raw.  You can always use filter_function to
+        # tweak the brightness/contrast.
+        if len(newimage.shape)==2:
+            newimage = newimage.transpose()
+        elif len(newimage.shape)==3:
+            newimage = newimage.transpose((1,0,2))
+        if newimage.dtype =="uint8":
+            self.image_item.setImage(newimage, autoLevels=False)
+        else:
+            self.image_item.setImage(newimage.astype(float))
+        if newimage.shape != self._image_shape:
+            self._image_shape = newimage.shape
+            self.set_crosshair_centre((newimage.shape[1]/2.0, newimage.shape[0]/2.0))
+    def update_image(self, newimage):
+        """Update the image displayed in the preview widget."""
+        # NB compared to previous versions, pyqtgraph flips in y, hence the
+        # funny slice on the next line.
+        self.update_data_signal.emit(newimage)
+        
+    def add_legacy_click_callback(self, function):
+        """Add an old-style (coordinates in fractions-of-an-image) callback."""
+        self.image_item.legacy_click_callback = function
+    
+    def set_crosshair_centre(self, pos):
+        """Move the crosshair to centre on a given pixel coordinate."""
+        self.crosshair['h_line'].setValue(pos[0])
+        self.crosshair['v_line'].setValue(pos[1])
@@ -20,28 +20,20 @@ import nplab.instrument.camera
 from nplab.instrument.stage import Stage
 from nplab.instrument import Instrument
 import numpy as np
-from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel
+from nplab.utils.image_with_location import ImageWithLocation, ensure_3d, ensure_2d, locate_feature_in_image, datum_pixel, FeatureTracker
 from nplab.experiment import Experiment, ExperimentStopped
 from nplab.experiment.gui import ExperimentWithProgressBar, run_function_modally
 from nplab.utils.gui import QtCore, QtGui, QtWidgets
-import cv2
-#import cv2.cv
 from scipy import ndimage
-from scipy.signal import argrelextrema
 from nplab.ui.ui_tools import QuickControlBox, UiTools
 from nplab.utils.notified_property import DumbNotifiedProperty
+from nplab.utils.mosaic import TileStitcher
+from nplab.instrument.camera.autofocus import (af_merit_squared_laplacian, focus_region, best_focus_position,
+                                               coarse_to_fine_search, interpolate_positions)
+from multiprocessing.pool import ThreadPool
+import threading
 import time
 
-# Autofocus merit functions
-def af_merit_squared_laplacian(image):
-    """Return the mean squared Laplacian of an image - a sharpness metric.
-
-    The image will be converted to grayscale if its shape is MxNx3"""
-    if len(image.shape) == 3:
-        image = np.mean(image, axis=2, dtype=image.dtype)
-    assert len(image.shape) == 2, "The image is the wrong shape - must be 2D or 3D"
-    return np.sum(cv2.Laplacian(image, ddepth=cv2.CV_32F) ** 2)
-
 
 class CameraWithLocation(Instrument):
     """
@@ -164,7 +156,8 @@ class CameraWithLocation(Instrument):
         for i in range(self.frames_to_discard):
             self.camera.raw_image(*args, **kwargs)
 
-    def move_to_feature(self, feature, ignore_position=False, ignore_z_pos = False, margin=50, tolerance=0.5, max_iterations = 10):
+    def move_to_feature(self, feature, ignore_position=False, ignore_z_pos = False, margin=50, tolerance=0.5, max_iterations = 10,
+                        method="template", pyramid_levels=2):
         """Bring the feature in the supplied image to the centre of the camera
 
         Strictly, what this aims to do is move the sample such that the datum pixel of the "feature" image is on the
@@ -183,6 +176,13 @@ class CameraWithLocation(Instrument):
             Once the error between our current position and the feature's position is below this threshold, we stop.
         max_iterations : int (optional)
             The maximum number of moves we make to fine-tune the position.
+        method : str (optional)
+            "template" (the default) finds the feature with `locate_feature_in_image` on every iteration.
+            "phase_correlation" uses a `FeatureTracker`, which finds the feature by FFT phase correlation, reuses the
+            feature's transform between iterations and, if pyramid_levels > 0, searches a downsampled image first.
+            It is much faster, particularly for large margins.
+        pyramid_levels : int (optional)
+            The number of times to halve the resolution for the coarse search, if method is "phase_correlation".
         """
         if (feature.datum_pixel[0]<0 or feature.datum_pixel[0]>np.shape(feature)[0] or 
             feature.datum_pixel[1]<0 or feature.datum_pixel[1]>np.shape(feature)[1]):
@@ -198,13 +198,25 @@ class CameraWithLocation(Instrument):
                 print "Warning: no position data in feature image, skipping initial move."
         image = self.color_image()
         assert isinstance(image, ImageWithLocation), "CameraWithLocation should return an ImageWithLocation...?"
+        if method == "phase_correlation":
+            if margin > 0:
+                search_margin = margin
+            else: # use the biggest search area that fits in the image
+                search_margin = np.min(np.array(image.shape[:2]) - np.array(feature.shape[:2]))//2
+            tracker = FeatureTracker(feature, margin=search_margin, pyramid_levels=pyramid_levels)
+        elif method != "template":
+            raise ValueError("method must be 'template' or 'phase_correlation'")
 
         last_move = np.infty
         for i in range(max_iterations):
             try:
                 self.settle()
                 image = self.color_image()
-                pixel_position = locate_feature_in_image(image, feature, margin=margin, restrict=margin>0)
+                if method == "phase_correlation":
+                    # after each move, the feature should be at the datum pixel
+                    pixel_position = tracker.locate(image, predicted_position=image.datum_pixel)
+                else:
+                    pixel_position = locate_feature_in_image(image, feature, margin=margin, restrict=margin>0)
              #   pixel_position = locate_feature_in_image(image, feature,margin=margin)
                 new_position = image.pixel_to_location(pixel_position)
                 self.move(new_position)
@@ -266,32 +278,7 @@ class CameraWithLocation(Instrument):
             update_progress(step_num)
         powers = np.array(powers)
         positions = np.array(positions)
-        z = positions[:, 2]
-        if method == "centre_of_mass":
-            threshold = powers.min() + (powers.max() - powers.min()) * noise_floor
-            weights = powers - threshold
-            weights[weights < 0] = 0.  # zero out any negative values
-            indices_of_maxima = argrelextrema(np.pad(weights, (1, 1), 'minimum'), np.greater)[0]-1
-            number_of_maxima = indices_of_maxima.size
-            if (np.sum(weights) == 0):
-                print "Warning, something went wrong and all the autofocus scores were identical! Returning to initial position."
-                new_position = here # Return to initial position if something fails
-            elif (number_of_maxima == 1) and not (indices_of_maxima[0] == 0 or indices_of_maxima[-1] == (weights.size-1)):
-                new_position = np.dot(weights, positions) / np.sum(weights)
-            else:
-                print("Warning, a maximum autofocus score could not be found. Returning to initial position.")
-                new_position = here
-        elif method == "parabola":
-            coefficients = np.polyfit(z, powers, deg=2)  # fit a parabola
-            root = -coefficients[1] / (2 * coefficients[
-                0])  # p = c[0]z**" + c[1]z + c[2] which has max (or min) at 2c[0]z + c[1]=0 i.e. z=-c[1]/2c[0]
-            if z.min() < root and root < z.max():
-                new_position = [here[0], here[1], root]
-            else:
-                # The new position would have been outside the scan range - clip it to the outer points.
-                new_position = positions[powers.argmax(), :]
-        else:
-            new_position = positions[powers.argmax(), :]
+        new_position = best_focus_position(positions, powers, here, method, noise_floor)
         self.stage.move(new_position)
         self.camera.live_view = camera_live_view
         update_progress(self.af_steps+1)
@@ -308,6 +295,160 @@ class CameraWithLocation(Instrument):
         else:
             return shift, pos, powers
 
+    def _grab_focus_frame(self, settle=True):
+        """Return a fresh raw frame, waiting for the stage to settle first unless specified.
+
+        If live view is running, we take the next frame from the video stream rather than stopping it."""
+        if settle:
+            time.sleep(self.settling_time)
+        discard_frames = self.frames_to_discard if settle else 0
+        if self.camera.live_view:
+            return self.camera.get_next_frame(discard_frames=discard_frames)
+        for i in range(discard_frames):
+            self.camera.raw_image()
+        return self.camera.raw_image()
+
+    def _focus_scorer(self, merit_function, roi, binning):
+        """Return a function that scores the focus of the region of a frame around the datum pixel"""
+        centre = self.datum_pixel
+        def score(image):
+            return merit_function(focus_region(image, roi, centre, binning))
+        return score
+
+    def pipelined_autofocus(self, dz=None, merit_function=af_merit_squared_laplacian, search="coarse_to_fine",
+                            method="centre_of_mass", noise_floor=0.3, roi=None, binning=1,
+                            refine_factor=3.0, tolerance=None, max_rounds=3, update_progress=lambda p:p):
+        """Autofocus, scoring each image in the background while the stage moves to the next position.
+
+        Arguments:
+        dz : np.array (optional, defaults to values specified in af_step_size and af_steps)
+            Z positions, relative to the current position, for the first (coarse) set of measurements.
+        merit_function : function, optional
+            A function that takes a (2D, float32) image and returns a focus score, which we maximise.
+        search : "coarse_to_fine" or "grid"
+            "grid" measures at each point in dz and picks the best using `method`, as `autofocus`
+            does.  "coarse_to_fine" measures the dz grid, then measures three more points around
+            the peak of a parabola through the best point and its neighbours, with a spacing that
+            shrinks by `refine_factor` each round (see `coarse_to_fine_search`).
+        roi : (height, width), optional
+            Only score this many pixels around the datum pixel (default: the whole frame).
+        binning : int, optional
+            Bin the region by this factor before scoring it.
+        update_progress : function, optional
+            This will be called each time we take an image - for use with run_function_modally.
+
+        Live view is left running if it is enabled: fresh frames are taken from the video stream.
+        Returns the shift, and the positions measured and their scores, like `autofocus`.
+        """
+        if dz is None:
+            dz = (np.arange(self.af_steps) - (self.af_steps - 1)/2.0) * self.af_step_size # Default value
+        here = self.stage.position
+        score = self._focus_scorer(merit_function, roi, binning)
+        positions = []
+        powers = []
+        pool = ThreadPool(processes=1)
+
+        def measure(z_values):
+            pending = []
+            for z in z_values:
+                self.stage.move(np.array([0, 0, z]) + here)
+                image = self._grab_focus_frame()
+                positions.append(self.stage.position)
+                # the image is scored in the background, while we move to the next point
+                pending.append(pool.apply_async(score, (image,)))
+                update_progress(len(positions))
+            new_powers = [p.get() for p in pending]
+            powers.extend(new_powers)
+            return [p[2] - here[2] for p in positions[-len(z_values):]], new_powers
+
+        try:
+            if search == "grid":
+                measure(dz)
+                new_position = best_focus_position(positions, powers, here, method, noise_floor)
+            elif search == "coarse_to_fine":
+                best_z, zs, scores = coarse_to_fine_search(measure, dz, refine_factor=refine_factor,
+                                                           tolerance=tolerance, max_rounds=max_rounds)
+                new_position = here + np.array([0, 0, best_z])
+            else:
+                raise ValueError("search must be 'grid' or 'coarse_to_fine', not '{0}'".format(search))
+        finally:
+            pool.close()
+            pool.join()
+        self.stage.move(new_position)
+        return new_position - here, np.array(positions), np.array(powers)
+
+    def sweep_autofocus(self, dz=None, merit_function=af_merit_squared_laplacian, method="centre_of_mass",
+                        noise_floor=0.3, roi=None, binning=1, poll_position=False, update_progress=lambda p:p):
+        """Autofocus by grabbing frames continuously during a single move through focus.
+
+        The stage moves from dz[0] to dz[-1] (relative to the current position) in a background thread, while
+        we take frames as fast as the camera allows and note when each one arrived.  The stage position at the
+        time of each frame is interpolated from the start and end of the move, and also from readings taken
+        between frames if `poll_position` is True (only do this if the stage can report its position while it
+        is moving).  There is no settling time, so this is usually much faster than stopping at each point,
+        but the stage must move slowly enough that the sweep spans many frames.
+
+        Frames are scored in the background (see `pipelined_autofocus` for merit_function, roi and binning),
+        and the best position is chosen using `method`, as in `autofocus`.
+        Returns the shift, the (interpolated) position of each frame, and their scores.
+        """
+        if dz is None:
+            dz = (np.arange(self.af_steps) - (self.af_steps - 1)/2.0) * self.af_step_size # Default value
+        here = self.stage.position
+        score = self._focus_scorer(merit_function, roi, binning)
+        self.stage.move(np.array([0, 0, dz[0]]) + here)
+        self.settle()
+
+        errors = []
+        def sweep():
+            try:
+                self.stage.move(np.array([0, 0, dz[-1]]) + here)
+            except Exception as e:
+                errors.append(e)
+        def moving():
+            if mover.is_alive():
+                return True
+            try:
+                return self.stage.is_moving() # for stages where move() returns straight away
+            except NotImplementedError:
+                return False
+
+        frame_times = []
+        pending = []
+        position_times = [time.time()]
+        stage_positions = [self.stage.position]
+        pool = ThreadPool(processes=1)
+        mover = threading.Thread(target=sweep)
+        try:
+            mover.start()
+            while moving():
+                start = time.time()
+                image = self._grab_focus_frame(settle=False)
+                frame_times.append((start + time.time())/2.0)
+                pending.append(pool.apply_async(score, (image,)))
+                if poll_position:
+                    position_times.append(time.time())
+                    stage_positions.append(self.stage.position)
+                update_progress(len(frame_times))
+            mover.join()
+            position_times.append(time.time())
+            stage_positions.append(self.stage.position)
+            powers = np.array([p.get() for p in pending])
+        finally:
+            pool.close()
+            pool.join()
+        if len(errors) > 0:
+            raise errors[0]
+        if len(frame_times) < 3:
+            print "Warning, only {0} frames were taken during the autofocus sweep - try moving the stage more " \
+                  "slowly.  Returning to initial position.".format(len(frame_times))
+            self.stage.move(here)
+            return np.zeros(len(here)), np.array(stage_positions), powers
+        positions = interpolate_positions(frame_times, position_times, stage_positions)
+        new_position = best_focus_position(positions, powers, here, method, noise_floor)
+        self.stage.move(new_position)
+        return new_position - here, positions, powers
+
     def autofocus_gui(self):
         """Run an autofocus using default parameters, with a GUI progress bar."""
         run_function_modally(self.autofocus, progress_maximum=self.af_steps+1)
@@ -486,8 +627,12 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
         self.overlap_pixels = overlap_pixels
         self.dest = self.cwl.create_data_group("tiled_image_%d")  if data_group is None else data_group
 
-    def run(self, n_tiles=(1,1), autofocus_args=None):
-        """Acquire a grid of images with the specified overlap."""
+    def run(self, n_tiles=(1,1), autofocus_args=None, stitch=True):
+        """Acquire a grid of images with the specified overlap.
+
+        Tiles are saved in the background while the stage moves to the next one.  If stitch is True, they are also
+        registered against their neighbours and blended into a multi-resolution mosaic, in dest["mosaic"] (see
+        `nplab.utils.mosaic`)."""
         self.update_progress(0)
         cwl = self.cwl
         centre_image = cwl.color_image()
@@ -495,12 +640,16 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
         self.log("Starting a {} scan with a step size of {}".format(n_tiles, scan_step))
 
         dest = self.dest
-        x_indices = np.arange(n_tiles[0]) - (n_tiles[0] - 1) / 2.0
-        y_indices = np.arange(n_tiles[1]) - (n_tiles[1] - 1) / 2.0
+        x_indices = list(enumerate(np.arange(n_tiles[0]) - (n_tiles[0] - 1) / 2.0))
+        y_indices = list(enumerate(np.arange(n_tiles[1]) - (n_tiles[1] - 1) / 2.0))
+        nominal_positions = dict(((i, j), np.array([x_index, y_index]) * scan_step)
+                                 for i, x_index in x_indices for j, y_index in y_indices)
+        stitcher = TileStitcher(dest, centre_image.shape, nominal_positions, margin=min(50, self.overlap_pixels//4),
+                                build_mosaic=stitch, dtype=centre_image.dtype)
         images_acquired = 0
         try:
-            for y_index in y_indices:
-                for x_index in x_indices:
+            for j, y_index in y_indices:
+                for i, x_index in x_indices:
                     # Go to the grid point
                     if self.autofocus == True:
                         cwl.autofocus()
@@ -509,8 +658,7 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
                     if autofocus_args is not None:
                         cwl.autofocus(**autofocus_args)
                     cwl.settle()  # wait for the camera to be ready/stage to settle
-                    dest.create_dataset("tile_%d",data=cwl.color_image())
-                    dest.file.flush()
+                    stitcher.add_tile(cwl.color_image(), (i, j)) # saved (and stitched) while we move on
                     images_acquired += 1 # TODO: work out why I can't just use dest.count_numbered_items("tile")
                     self.update_progress(images_acquired)
                 x_indices = x_indices[::-1]  # reverse the X positions, so we do a snake-scan
@@ -518,6 +666,7 @@ class AcquireGridOfImages(ExperimentWithProgressBar):
             self.log("Experiment was aborted.")
         finally:
             self.cwl.move(centre_image.datum_location)  # go back to the start point
+            stitcher.finish()
             if self.completion_function is not None:
                 self.completion_function()
         return dest
@@ -144,9 +144,13 @@ class Adlink9812(Instrument):
 		self.convert_to_volts(dataBuff,voltageOut,sample_count)
 		return np.asarray(voltageOut)
 
-	def asynchronous_double_buffered_analog_input_read(self,sample_freq,sample_count,card_buffer_size = 500000,verbose=False, channel = 0):
+	def asynchronous_double_buffered_analog_input_read(self,sample_freq,sample_count,card_buffer_size = 500000,verbose=False, channel = 0, buffer_callback=None):
 		'''
 		Non-Triggered Double-Buffered Asynchronous  Analog Input Continuous Read
+
+		If buffer_callback is given, each user buffer is converted to volts as soon as it is
+		transferred and passed to buffer_callback, which must return before the next half of
+		the card buffer fills up.
 		Steps: [Adlink PCIS-DASK manual,page 47]
 
 		1. AI_XXXX_Config
@@ -227,6 +231,8 @@ class Adlink9812(Instrument):
 			uBs.append(currentBuffer)
 			if buffTransferErr.value != 0:
 				self.log(message="buffTransferErr:"+str(buffTransferErr.value))
+			if buffer_callback is not None:
+				buffer_callback(self._convert_user_buffer(currentBuffer, user_buffer_size))
 
 		accessCnt = ctypes.c_int32(0)
 		clearErr = ctypes.c_int16(self.dll.AI_AsyncClear(self.card_id, ctypes.byref(accessCnt)))
@@ -237,19 +243,44 @@ class Adlink9812(Instrument):
 		#reinitialize user buffer
 
 		for i in range(nbuff):
-			oB = (c_double*user_buffer_size)()
-			convertErr = ctypes.c_int16(self.dll.AI_ContVScale(
-			c_ushort(self.card_id),				#CardNumber
-			c_ushort(adlink9812_constants.AD_B_1_V),	#AdRange
-			uBs[i], 					#DataBuffer   - array storing raw 16bit A/D values
-			oB, 					#VoltageArray - reference to array storing voltages
-			c_uint32(user_buffer_size) 			#Sample count - number of samples to be converted
-			))
-			oBs.append(oB)
-			if convertErr.value != 0:
-				self.log(message="AI_ContVScale: Non-zero status code:"+str(convertErr.value))
+			oBs.append(self._convert_user_buffer(uBs[i], user_buffer_size))
 		return np.concatenate(oBs)
 
+	def _convert_user_buffer(self, buffer, user_buffer_size):
+		oB = (c_double*user_buffer_size)()
+		convertErr = ctypes.c_int16(self.dll.AI_ContVScale(
+		c_ushort(self.card_id),				#CardNumber
+		c_ushort(adlink9812_constants.AD_B_1_V),	#AdRange
+		buffer, 					#DataBuffer   - array storing raw 16bit A/D values
+		oB, 					#VoltageArray - reference to array storing voltages
+		c_uint32(user_buffer_size) 			#Sample count - number of samples to be converted
+		))
+		if convertErr.value != 0:
+			self.log(message="AI_ContVScale: Non-zero status code:"+str(convertErr.value))
+		return np.ctypeslib.as_array(oB)
+
+	def live_autocorrelation(self, sample_freq, sample_count, time_bin_width, channels=16, levels=20, update_callback=None, card_buffer_size=500000, channel=0, min_span=0.5, threshold=None):
+		'''
+		Acquire photon counts and correlate them as they arrive, with a multi-tau correlator
+
+		update_callback(times, g2) is called after each buffer, e.g. to plot the live g2(tau).
+		min_span and threshold (in volts) set how pulses are detected - see StreamingAutocorrelation.
+		Returns the StreamingAutocorrelation, which holds the correlation and total counts.
+		'''
+		dt = 1.0/sample_freq
+		index_bin_width = dls_signal_postprocessing.binwidth_time_to_index(time_bin_width,dt)
+		stream = dls_signal_postprocessing.StreamingAutocorrelation(dt, index_bin_width, channels, levels, min_span, threshold)
+		def process_buffer(voltages):
+			stream.add_voltages(voltages)
+			if update_callback is not None:
+				update_callback(*stream.correlation())
+		if self.debug:
+			for i in range(int(math.ceil(sample_count/float(card_buffer_size/2)))):
+				process_buffer((2.0*np.random.rand(card_buffer_size/2))-1.0)
+		else:
+			self.asynchronous_double_buffered_analog_input_read(sample_freq, sample_count, card_buffer_size, channel=channel, buffer_callback=process_buffer)
+		return stream
+
 	@staticmethod
 	def get_times(dt,nsamples):
 		return [i*dt for i in range(nsamples)]
@@ -2,24 +2,23 @@ __author__ = 'alansanders'
 
 import numpy as np
 import numpy.ma as ma
-from nplab.utils.gui import QtCore, QtGui, QtWidgets, get_qt_app, uic
 
 from collections import deque
 
-from nplab.ui.ui_tools import UiTools
 from nplab.datafile import DataFile
-from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty, register_for_property_changes
+from nplab.utils.notified_property import NotifiedProperty, DumbNotifiedProperty
+from nplab.utils.lazy_import import lazy_attributes, names_in
 import h5py
 from multiprocessing.pool import ThreadPool
 
 import time
+import threading
 
 import os
 import inspect
 import datetime
 from nplab.instrument import Instrument
 import warnings
-import pyqtgraph as pg
 from weakref import WeakSet
 
 
@@ -33,8 +32,12 @@ class Spectrometer(Instrument):
    
     variable_int_enabled = DumbNotifiedProperty(False)
     filename = DumbNotifiedProperty("spectrum")
+    live_view_max_rate = DumbNotifiedProperty(30.0)
+    """The maximum rate (in spectra per second) at which live view acquires."""
     def __init__(self):
         super(Spectrometer, self).__init__()
+        self._latest_spectrum_update_condition = threading.Condition()
+        self._spectrum_counter = 0
         self._model_name = None
         self._serial_number = None
         self._wavelengths = None
@@ -46,7 +49,7 @@ class Spectrometer(Instrument):
         self.reference_int = None
       #  self.variable_int_enabled = DumbNotifiedProperty(False)
         self.latest_raw_spectrum = None
-        self.latest_spectrum = None
+        self._latest_spectrum = None
         self.averaging_enabled = False
         self.spectra_deque = deque(maxlen = 1)
         self.absorption_enabled = False
@@ -243,6 +246,96 @@ class Spectrometer(Instrument):
         """Acquire a new spectrum and return a tuple of wavelengths, spectrum"""
         return self.wavelengths, self.read_processed_spectrum()
 
+    _latest_spectrum = None
+    @NotifiedProperty
+    def latest_spectrum(self):
+        """The last processed spectrum acquired by the spectrometer.
+
+        Every call to read_processed_spectrum (from live view, the GUI or an
+        experiment) updates this property, so it forms the spectrometer's
+        acquisition stream: anything that only wants to display spectra should
+        watch it rather than taking readings of its own."""
+        return self._latest_spectrum
+    @latest_spectrum.setter
+    def latest_spectrum(self, spectrum):
+        """Set the latest spectrum, and wake anything waiting for a new one."""
+        with self._latest_spectrum_update_condition:
+            self._latest_spectrum = spectrum
+            self._spectrum_counter += 1
+            self._latest_spectrum_update_condition.notify_all()
+
+    @property
+    def spectrum_counter(self):
+        """The number of spectra published to latest_spectrum so far."""
+        return self._spectrum_counter
+
+    def get_next_spectrum(self, timeout=60, discard_spectra=0,
+                          assert_live_view=True):
+        """Wait for the next spectrum to arrive and return it.
+
+        This is the spectrometer equivalent of Camera.get_next_frame: it
+        returns a fresh processed spectrum from the live view stream without
+        competing with it for the device.
+        
+        @param: timeout: Maximum length of time to wait for a new spectrum.
+        @param: discard_spectra: Wait for this many new spectra before
+        returning one.
+        @param: assert_live_view: If True (default) raise an assertion error if
+        live view is not enabled.
+        """
+        if assert_live_view:
+            assert self.live_view, """Can't wait for the next spectrum if live view is not enabled!"""
+        with self._latest_spectrum_update_condition:
+            target_spectrum = self._spectrum_counter + 1 + discard_spectra
+            expiry_time = time.time() + timeout
+            while self._spectrum_counter < target_spectrum and time.time() < expiry_time:
+                self._latest_spectrum_update_condition.wait(expiry_time - time.time())
+            if self._spectrum_counter < target_spectrum:
+                raise IOError("Timed out waiting for a fresh spectrum from the live view stream.")
+            return self._latest_spectrum
+
+    _live_view = False
+    @NotifiedProperty
+    def live_view(self):
+        """Whether the spectrometer is continuously acquiring spectra.
+
+        While live view is running, a background thread calls
+        read_processed_spectrum no more than live_view_max_rate times per
+        second, publishing each spectrum to latest_spectrum."""
+        return self._live_view
+    @live_view.setter
+    def live_view(self, live_view):
+        """Start or stop the live view acquisition thread."""
+        if live_view:
+            if self._live_view:
+                return # do nothing if it's going already.
+            self._live_view_stop_event = threading.Event()
+            self._live_view_thread = threading.Thread(target=self._live_view_function)
+            self._live_view_thread.daemon = True
+            self._live_view = True
+            self._live_view_thread.start()
+        else:
+            if not self._live_view:
+                return # do nothing if it's not running.
+            self._live_view_stop_event.set()
+            if self._live_view_thread is not threading.current_thread():
+                self._live_view_thread.join()
+            self._live_view = False
+
+    def _live_view_function(self):
+        """Acquire spectra until told to stop; only run by the live_view setter."""
+        t0 = time.time()
+        while not self._live_view_stop_event.is_set():
+            try:
+                self.read_processed_spectrum()
+            except Exception as e:
+                self._logger.warn("Live view stopped: error reading spectrum: {0}".format(e))
+                self._live_view = False
+                break
+            period = 1./self.live_view_max_rate if self.live_view_max_rate else 0
+            t0 = max(t0 + period, time.time() - period) # don't try to catch up after a stall
+            self._live_view_stop_event.wait(max(0, t0 - time.time()))
+
     def mask_spectrum(self, spectrum, threshold):
         """Return a masked array of the spectrum, showing only points where the reference
         is bright enough to be useful."""
@@ -257,6 +350,7 @@ class Spectrometer(Instrument):
     _preview_widgets = WeakSet()
     def get_qt_ui(self, control_only=False,display_only = False):
         """Create a Qt interface for the spectrometer"""
+        from nplab.instrument.spectrometer.spectrometer_ui import SpectrometerControlUI, SpectrometerDisplayUI, SpectrometerUI
         if control_only:
             
             newwidget = SpectrometerControlUI(self)
@@ -354,10 +448,35 @@ class Spectrometers(Instrument):
         """Return a list of metadata for each spectrometer."""
         return self._pool.map(lambda s: s.get_metadata(), self.spectrometers)
 
+    def get_latest_spectra(self):
+        """The most recent processed spectrum from each spectrometer."""
+        return [s.latest_spectrum for s in self.spectrometers]
+
+    latest_spectra = property(get_latest_spectra)
+
+    @property
+    def spectrum_counter(self):
+        """The number of rounds of spectra published, i.e. the lowest count of any spectrometer.
+
+        This goes up by one each time every spectrometer has a new spectrum, so (like the count
+        for a single spectrometer) a jump of more than one means spectra have been missed."""
+        return min(s.spectrum_counter for s in self.spectrometers)
+
+    def get_live_view(self):
+        """Whether all the spectrometers are continuously acquiring."""
+        return all(s.live_view for s in self.spectrometers)
+
+    def set_live_view(self, live_view):
+        for s in self.spectrometers:
+            s.live_view = live_view
+
+    live_view = property(get_live_view, set_live_view)
+
     def mask_spectra(self, spectra, threshold):
         return [spectrometer.mask_spectrum(spectrum, threshold) for (spectrometer, spectrum) in zip(self.spectrometers, spectra)]
 
     def get_qt_ui(self):
+        from nplab.instrument.spectrometer.spectrometer_ui import SpectrometersUI
         return SpectrometersUI(self)
 
     def save_spectra(self, spectra=None, attrs={}):
@@ -384,355 +503,6 @@ class Spectrometers(Instrument):
 
 
 
-class SpectrometerControlUI(QtWidgets.QWidget,UiTools):
-    
-    def __init__(self, spectrometer, ui_file =os.path.join(os.path.dirname(__file__),'spectrometer_controls.ui'),  parent=None):
-        assert isinstance(spectrometer, Spectrometer), "instrument must be a Spectrometer"
-        super(SpectrometerControlUI, self).__init__()
-        uic.loadUi(ui_file, self)
-        self.spectrometer = spectrometer
-        
-        self.integration_time.setValidator(QtGui.QDoubleValidator())
-        self.integration_time.textChanged.connect(self.check_state)
-        self.integration_time.textChanged.connect(self.update_param)
-
-        self.read_background_button.clicked.connect(self.button_pressed)
-        self.read_reference_button.clicked.connect(self.button_pressed)
-        self.clear_background_button.clicked.connect(self.button_pressed)
-        self.clear_reference_button.clicked.connect(self.button_pressed)
-        self.load_state_button.clicked.connect(self.button_pressed)
-
-        self.background_subtracted.stateChanged.connect(self.state_changed)
-        self.referenced.stateChanged.connect(self.state_changed)
-        
-        self.Absorption_checkBox.stateChanged.connect(self.state_changed)
-                
-        register_for_property_changes(self.spectrometer,'variable_int_enabled',self.variable_int_state_change)
-#        if self.spectrometer.variable_int_enabled:
-#                self.background_subtracted.blockSignals(True)
-#                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
-#                self.background_subtracted.blockSignals(False)
-        self.Variable_int.stateChanged.connect(self.state_changed)
-        
-#                if self.spectrometer.variable_int_enabled:
-#                self.background_subtracted.blockSignals(True)
-#                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
-#                self.background_subtracted.blockSignals(False)
-        self.average_checkBox.stateChanged.connect(self.state_changed)
-        self.Average_spinBox.valueChanged.connect(self.update_averages)
-        
-        self.referenceID_spinBox.valueChanged.connect(self.update_references)
-
-
-        self.id_string.setText('{0} {1}'.format(self.spectrometer.model_name, self.spectrometer.serial_number))
-        self.id_string.resize(self.id_string.sizeHint())
-
-        self.integration_time.setText(str(spectrometer.integration_time))
-
-    def update_param(self, *args, **kwargs):
-        sender = self.sender()
-        if sender is self.integration_time:
-            try:
-                self.spectrometer.integration_time = float(args[0])
-            except ValueError:
-                pass
-            
-    def update_averages(self,*args,**kwargs):
-        self.spectrometer.spectra_deque = deque(maxlen = args[0])
-
-    def button_pressed(self, *args, **kwargs):
-        sender = self.sender()
-        if sender is self.read_background_button:
-            self.spectrometer.read_background()
-            self.background_subtracted.blockSignals(True)
-            self.background_subtracted.setCheckState(QtCore.Qt.Checked)
-            self.background_subtracted.blockSignals(False)            
-        elif sender is self.clear_background_button:
-            self.spectrometer.clear_background()
-            self.background_subtracted.blockSignals(True)
-            self.background_subtracted.setCheckState(QtCore.Qt.Unchecked)
-            self.background_subtracted.blockSignals(False)
-        elif sender is self.read_reference_button:
-            self.spectrometer.read_reference()
-            self.referenced.blockSignals(True)
-            self.referenced.setCheckState(QtCore.Qt.Checked)
-            self.referenced.blockSignals(False)
-        elif sender is self.clear_reference_button:
-            self.spectrometer.clear_reference()
-            self.referenced.blockSignals(True)
-            self.referenced.setCheckState(QtCore.Qt.Unchecked)
-            self.referenced.blockSignals(False)
-        elif sender is self.load_state_button:
-            if 'background' in self.spectrometer.config_file:
-                self.spectrometer.background = self.spectrometer.config_file['background'][:] #load the background
-                if 'background_constant' in self.spectrometer.config_file:
-                    self.spectrometer.background_constant = self.spectrometer.config_file['background_constant'][:]
-                if 'background_gradient' in self.spectrometer.config_file:
-                    self.spectrometer.background_gradient = self.spectrometer.config_file['background_gradient'][:]
-                if 'background_int' in self.spectrometer.config_file:
-                    self.spectrometer.background_int = self.spectrometer.config_file['background_constant'][...]
-                    
-                self.background_subtracted.blockSignals(True)
-                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
-                self.background_subtracted.blockSignals(False)
-            else:
-                print 'background not found in config file'
-            if 'reference' in self.spectrometer.config_file:
-                self.spectrometer.reference = self.spectrometer.config_file['reference'][:]
-                if 'reference_int' in self.spectrometer.config_file:
-                    self.spectrometer.reference_int = self.spectrometer.config_file['reference_int'][...]
-                self.referenced.blockSignals(True)
-                self.referenced.setCheckState(QtCore.Qt.Checked)
-                self.referenced.blockSignals(False)
-            else:
-                print 'reference not found in config file'
-                
-
-    def state_changed(self, state):
-        sender = self.sender()
-        if sender is self.background_subtracted and state == QtCore.Qt.Checked:
-            self.spectrometer.read_background()
-        elif sender is self.background_subtracted and state == QtCore.Qt.Unchecked:
-            self.spectrometer.clear_background()
-        if sender is self.referenced and state == QtCore.Qt.Checked:
-            self.spectrometer.read_reference()
-        elif sender is self.referenced and state == QtCore.Qt.Unchecked:
-            self.spectrometer.clear_reference()
-            
-        elif sender is self.Variable_int:
-            self.spectrometer.variable_int_enabled = not self.spectrometer.variable_int_enabled
-            
-        elif sender is self.average_checkBox:
-            self.spectrometer.averaging_enabled = not self.spectrometer.averaging_enabled
-            
-        elif sender is self.Absorption_checkBox:
-            self.spectrometer.absorption_enabled = not self.spectrometer.absorption_enabled
-        
-    def variable_int_state_change(self):
-        if self.spectrometer.variable_int_enabled == True:
-            self.Variable_int.setCheckState(QtCore.Qt.Checked)
-        if self.spectrometer.variable_int_enabled == False:
-            self.Variable_int.setCheckState(QtCore.Qt.Unchecked)
-            
-    def update_references(self,*args, **kwargs):
-        self.spectrometer.reference_ID = args[0]
-        try:
-            self.spectrometer.load_reference(self.spectrometer.reference_ID )
-        except KeyError:
-            self.spectrometer.clear_reference()
-            self.referenced.blockSignals(True)
-            self.referenced.setCheckState(QtCore.Qt.Unchecked)
-            self.referenced.blockSignals(False)
-            
-            self.spectrometer.clear_background()
-            self.background_subtracted.blockSignals(True)
-            self.background_subtracted.setCheckState(QtCore.Qt.Unchecked)
-            self.background_subtracted.blockSignals(False)
-
-
-            self.spectrometer._logger.info('No refence/background saved in slot %s to load' %args[0])
-            
-        
-            
-        
-
-
-class DisplayThread(QtCore.QThread):
-    spectrum_ready = QtCore.Signal(np.ndarray)
-    spectra_ready = QtCore.Signal(list)
-
-    def __init__(self, parent):
-        super(DisplayThread, self).__init__()
-        self.parent = parent
-        self.single_shot = False
-        self.refresh_rate = 30.
-
-    def run(self):
-        t0 = time.time()
-        while self.parent.live_button.isChecked() or self.single_shot:
-            read_processed_spectrum = self.parent.spectrometer.read_processed_spectra \
-                if isinstance(self.parent.spectrometer, Spectrometers) \
-                else self.parent.spectrometer.read_processed_spectrum
-            spectrum = read_processed_spectrum()
-            if time.time()-t0 < 1./self.refresh_rate:
-                continue
-            else:
-                t0 = time.time()
-            if type(spectrum) == np.ndarray:
-                self.spectrum_ready.emit(spectrum)
-            elif type(spectrum) == list:
-                self.spectra_ready.emit(spectrum)
-            if self.single_shot:
-                break
-        self.finished.emit()
-
-
-class SpectrometerDisplayUI(QtWidgets.QWidget,UiTools):
-    def __init__(self, spectrometer,ui_file = os.path.join(os.path.dirname(__file__),'spectrometer_view.ui'), parent=None):
-        assert isinstance(spectrometer, Spectrometer) or isinstance(spectrometer, Spectrometers),\
-            "instrument must be a Spectrometer or an instance of Spectrometers"
-        super(SpectrometerDisplayUI, self).__init__()
-        uic.loadUi(ui_file, self)
-        if isinstance(spectrometer, Spectrometers) and spectrometer.num_spectrometers == 1:
-            spectrometer = spectrometer.spectrometers[0]
-        if isinstance(spectrometer,Spectrometer):
-            spectrometer.num_spectrometers = 1
-        self.spectrometer = spectrometer
-        print self.spectrometer
-
-        pg.setConfigOption('background', 'w')
-        pg.setConfigOption('foreground', 'k')
-        self.plotbox = QtWidgets.QGroupBox()
-        self.plotbox.setLayout(QtWidgets.QGridLayout())
-        self.plotlayout = self.plotbox.layout()          
-        self.plots =[]
-
-        for spectrometer_nom in range(self.spectrometer.num_spectrometers):
-            self.plots.append(pg.PlotWidget(labels = {'bottom':'Wavelength (nm)'}))
-            self.plotlayout.addWidget(self.plots[spectrometer_nom])
-
-        self.figure_widget = self.replace_widget(self.display_layout,
-                                                 self.figure_widget, self.plotbox)         
-        self.take_spectrum_button.clicked.connect(self.button_pressed)
-        self.live_button.clicked.connect(self.button_pressed)
-        self.save_button.clicked.connect(self.button_pressed)
-        self.threshold.setValidator(QtGui.QDoubleValidator())
-        self.threshold.textChanged.connect(self.check_state)
-
-
-        self._display_thread = DisplayThread(self)
-        self._display_thread.spectrum_ready.connect(self.update_display)
-        self._display_thread.spectra_ready.connect(self.update_display)
-
-        self.period = 0.2
-        self.filename_lineEdit.textChanged.connect(self.filename_changed_ui)
-        register_for_property_changes(self.spectrometer,'filename',self.filename_changed)
-    def button_pressed(self, *args, **kwargs):
-        sender = self.sender()
-        if sender is self.take_spectrum_button:
-            #if self._display_thread.is_alive():
-            if self._display_thread.isRunning():
-                print 'already acquiring'
-                return
-            #self._display_thread = Thread(target=self.update_spectrum)
-            self._display_thread.single_shot = True
-            self._display_thread.start()
-            #self.update_spectrum()
-        elif sender is self.save_button:
-            save_spectrum = self.spectrometer.save_spectra \
-                if isinstance(self.spectrometer, Spectrometers) \
-                else self.spectrometer.save_spectrum
-            save_spectrum(attrs={'description':str(self.description.text())})
-        elif sender is self.live_button:
-            if self.live_button.isChecked():
-                #if self._display_thread.is_alive():
-                if self._display_thread.isRunning():
-                    print 'already acquiring'
-                    return
-                #self._display_thread = Thread(target=self.continuously_update_spectrum)
-                self._display_thread.single_shot = False
-                self._display_thread.start()
-
-    def update_spectrum(self):
-        read_processed_spectrum = self.spectrometer.read_processed_spectra \
-            if isinstance(self.spectrometer, Spectrometers) \
-            else self.spectrometer.read_processed_spectrum
-        spectrum = read_processed_spectrum()
-        self.update_display(spectrum)
-
-    def continuously_update_spectrum(self):
-        t0 = time.time()
-        while self.live_button.isChecked():
-            if time.time()-t0 < 1./30.:
-                continue
-            else:
-                t0 = time.time()
-            self.update_spectrum()
-
-    def update_display(self, spectrum):
-        #Update the graphs  
-        if self.enable_threshold.checkState() == QtCore.Qt.Checked:
-            threshold = float(self.threshold.text())
-            if isinstance(self.spectrometer, Spectrometers):
-                spectrum = [spectrometer.mask_spectrum(s, threshold) for (spectrometer, s) in zip(self.spectrometer.spectrometers, spectrum)]
-            else:
-                spectrum = self.spectrometer.mask_spectrum(spectrum, threshold)
-                    
-        if not self.plots[0].getPlotItem().listDataItems():
-            self.plotdata = []
-            if isinstance(self.spectrometer, Spectrometers):
-                for spectrometer_nom in range(self.spectrometer.num_spectrometers):
-                    self.plotdata.append(self.plots[spectrometer_nom].plot(x = self.spectrometer.wavelengths[spectrometer_nom],y = spectrum[spectrometer_nom],pen =(spectrometer_nom,len(range(self.spectrometer.num_spectrometers)))))
-                    
-   
-            else:                
-                self.plotdata.append(self.plots[0].plot(x = self.spectrometer.wavelengths,y = spectrum,pen =(0,len(range(self.spectrometer.num_spectrometers)))))
-        else:
-            if isinstance(self.spectrometer, Spectrometers):
-                for spectrometer_nom in range(self.spectrometer.num_spectrometers):
-                    self.plotdata[spectrometer_nom].setData(x = self.spectrometer.wavelengths[spectrometer_nom],y= spectrum[spectrometer_nom])
-            else:
-                self.plotdata[0].setData(x = self.spectrometer.wavelengths,y= spectrum)
-
-    def filename_changed_ui(self):
-        self.spectrometer.filename = self.filename_lineEdit.text()
-    def filename_changed(self):
-        self.filename_lineEdit.setText(self.spectrometer.filename)
-
-class SpectrometerUI(QtWidgets.QWidget):
-    """
-    Joins together the control and display UIs into a single spectrometer UI.
-    """
-
-    def __init__(self, spectrometer):
-        assert isinstance(spectrometer, Spectrometer), "instrument must be a Spectrometer"
-        super(SpectrometerUI, self).__init__()
-        self.spectrometer = spectrometer
-        self._init_ui()
-
-    def _init_ui(self):
-        self.setWindowTitle(self.spectrometer.__class__.__name__)
-        self.controls = self.spectrometer.get_qt_ui(control_only=True)
-        self.display = SpectrometerDisplayUI(self.spectrometer)
-        layout = QtWidgets.QVBoxLayout()
-    #    controls_layout = QtWidgets.QVBoxLayout()
-    #    controls_layout.addWidget(self.controls)
-    #    controls_layout.setContentsMargins(0,0,0,0)
-    #    controls_group = QtWidgets.QGroupBox()
-    #    controls_group.setTitle('Spectrometer')
-    #    controls_group.setLayout(controls_layout)
-        layout.addWidget(self.controls)
-        layout.addWidget(self.display)
-        layout.setContentsMargins(5,5,5,5)
-        layout.setSpacing(5)
-        self.setLayout(layout)
-
-
-class SpectrometersUI(QtWidgets.QWidget):
-    def __init__(self, spectrometers):
-        assert isinstance(spectrometers, Spectrometers), "instrument must be an instance of Spectrometers"
-        super(SpectrometersUI, self).__init__()
-        self.spectrometers = spectrometers
-        self._init_ui()
-
-    def _init_ui(self):
-        self.setWindowTitle('Spectrometers')
-        self.controls_layout = QtWidgets.QHBoxLayout()
-        controls_group = QtWidgets.QGroupBox()
-        controls_group.setTitle('Spectrometers')
-        controls_group.setLayout(self.controls_layout)
-        self.controls = []
-        for spectrometer in self.spectrometers.spectrometers:
-            control = spectrometer.get_qt_ui(control_only=True)
-            self.controls_layout.addWidget(control)
-            self.controls.append(control)
-        self.display = SpectrometerDisplayUI(self.spectrometers)
-        layout = QtWidgets.QVBoxLayout()
-        layout.addWidget(controls_group)
-        layout.addWidget(self.display)
-        self.setLayout(layout)
-
-
 class DummySpectrometer(Spectrometer):
     """A trivial stub spectrometer, for use in development."""
     metadata_property_names = ["integration_time", "wavelengths"]
@@ -760,6 +530,11 @@ class DummySpectrometer(Spectrometer):
                                     enable=bundle_metadata)
 
 
+# The GUI classes need Qt, so they are only imported when they're used
+lazy_attributes(__name__, names_in("nplab.instrument.spectrometer.spectrometer_ui",
+                                   ["SpectrometerControlUI", "DisplayThread", "SpectrometerDisplayUI",
+                                    "SpectrometerUI", "SpectrometersUI"]))
+
 if __name__ == '__main__':
     import sys
     from nplab.utils.gui import get_qt_app
@@ -0,0 +1,398 @@
+"""
+Qt user interface for spectrometers: controls, live display and the combined
+interfaces for one or several spectrometers.
+
+These are kept separate from nplab.instrument.spectrometer so that spectrometers can
+be used without loading Qt; Spectrometer.get_qt_ui imports this module when called.
+"""
+
+import numpy as np
+from nplab.utils.gui import QtCore, QtGui, QtWidgets, uic
+from nplab.ui.ui_tools import UiTools
+from nplab.utils.notified_property import register_for_property_changes
+from collections import deque
+import time
+import os
+import pyqtgraph as pg
+from nplab.instrument.spectrometer import Spectrometer, Spectrometers
+
+
+class SpectrometerControlUI(QtWidgets.QWidget,UiTools):
+    
+    def __init__(self, spectrometer, ui_file =os.path.join(os.path.dirname(__file__),'spectrometer_controls.ui'),  parent=None):
+        assert isinstance(spectrometer, Spectrometer), "instrument must be a Spectrometer"
+        super(SpectrometerControlUI, self).__init__()
+        uic.loadUi(ui_file, self)
+        self.spectrometer = spectrometer
+        
+        self.integration_time.setValidator(QtGui.QDoubleValidator())
+        self.integration_time.textChanged.connect(self.check_state)
+        self.integration_time.textChanged.connect(self.update_param)
+
+        self.read_background_button.clicked.connect(self.button_pressed)
+        self.read_reference_button.clicked.connect(self.button_pressed)
+        self.clear_background_button.clicked.connect(self.button_pressed)
+        self.clear_reference_button.clicked.connect(self.button_pressed)
+        self.load_state_button.clicked.connect(self.button_pressed)
+
+        self.background_subtracted.stateChanged.connect(self.state_changed)
+        self.referenced.stateChanged.connect(self.state_changed)
+        
+        self.Absorption_checkBox.stateChanged.connect(self.state_changed)
+                
+        register_for_property_changes(self.spectrometer,'variable_int_enabled',self.variable_int_state_change)
+#        if self.spectrometer.variable_int_enabled:
+#                self.background_subtracted.blockSignals(True)
+#                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
+#                self.background_subtracted.blockSignals(False)
+        self.Variable_int.stateChanged.connect(self.state_changed)
+        
+#                if self.spectrometer.variable_int_enabled:
+#                self.background_subtracted.blockSignals(True)
+#                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
+#                self.background_subtracted.blockSignals(False)
+        self.average_checkBox.stateChanged.connect(self.state_changed)
+        self.Average_spinBox.valueChanged.connect(self.update_averages)
+        
+        self.referenceID_spinBox.valueChanged.connect(self.update_references)
+
+
+        self.id_string.setText('{0} {1}'.format(self.spectrometer.model_name, self.spectrometer.serial_number))
+        self.id_string.resize(self.id_string.sizeHint())
+
+        self.integration_time.setText(str(spectrometer.integration_time))
+
+    def update_param(self, *args, **kwargs):
+        sender = self.sender()
+        if sender is self.integration_time:
+            try:
+                self.spectrometer.integration_time = float(args[0])
+            except ValueError:
+                pass
+            
+    def update_averages(self,*args,**kwargs):
+        self.spectrometer.spectra_deque = deque(maxlen = args[0])
+
+    def button_pressed(self, *args, **kwargs):
+        sender = self.sender()
+        if sender is self.read_background_button:
+            self.spectrometer.read_background()
+            self.background_subtracted.blockSignals(True)
+            self.background_subtracted.setCheckState(QtCore.Qt.Checked)
+            self.background_subtracted.blockSignals(False)            
+        elif sender is self.clear_background_button:
+            self.spectrometer.clear_background()
+            self.background_subtracted.blockSignals(True)
+            self.background_subtracted.setCheckState(QtCore.Qt.Unchecked)
+            self.background_subtracted.blockSignals(False)
+        elif sender is self.read_reference_button:
+            self.spectrometer.read_reference()
+            self.referenced.blockSignals(True)
+            self.referenced.setCheckState(QtCore.Qt.Checked)
+            self.referenced.blockSignals(False)
+        elif sender is self.clear_reference_button:
+            self.spectrometer.clear_reference()
+            self.referenced.blockSignals(True)
+            self.referenced.setCheckState(QtCore.Qt.Unchecked)
+            self.referenced.blockSignals(False)
+        elif sender is self.load_state_button:
+            if 'background' in self.spectrometer.config_file:
+                self.spectrometer.background = self.spectrometer.config_file['background'][:] #load the background
+                if 'background_constant' in self.spectrometer.config_file:
+                    self.spectrometer.background_constant = self.spectrometer.config_file['background_constant'][:]
+                if 'background_gradient' in self.spectrometer.config_file:
+                    self.spectrometer.background_gradient = self.spectrometer.config_file['background_gradient'][:]
+                if 'background_int' in self.spectrometer.config_file:
+                    self.spectrometer.background_int = self.spectrometer.config_file['background_constant'][...]
+                    
+                self.background_subtracted.blockSignals(True)
+                self.background_subtracted.setCheckState(QtCore.Qt.Checked)
+                self.background_subtracted.blockSignals(False)
+            else:
+                print 'background not found in config file'
+            if 'reference' in self.spectrometer.config_file:
+                self.spectrometer.reference = self.spectrometer.config_file['reference'][:]
+                if 'reference_int' in self.spectrometer.config_file:
+                    self.spectrometer.reference_int = self.spectrometer.config_file['reference_int'][...]
+                self.referenced.blockSignals(True)
+                self.referenced.setCheckState(QtCore.Qt.Checked)
+                self.referenced.blockSignals(False)
+            else:
+                print 'reference not found in config file'
+                
+
+    def state_changed(self, state):
+        sender = self.sender()
+        if sender is self.background_subtracted and state == QtCore.Qt.Checked:
+            self.spectrometer.read_background()
+        elif sender is self.background_subtracted and state == QtCore.Qt.Unchecked:
+            self.spectrometer.clear_background()
+        if sender is self.referenced and state == QtCore.Qt.Checked:
+            self.spectrometer.read_reference()
+        elif sender is self.referenced and state == QtCore.Qt.Unchecked:
+            self.spectrometer.clear_reference()
+            
+        elif sender is self.Variable_int:
+            self.spectrometer.variable_int_enabled = not self.spectrometer.variable_int_enabled
+            
+        elif sender is self.average_checkBox:
+            self.spectrometer.averaging_enabled = not self.spectrometer.averaging_enabled
+            
+        elif sender is self.Absorption_checkBox:
+            self.spectrometer.absorption_enabled = not self.spectrometer.absorption_enabled
+        
+    def variable_int_state_change(self):
+        if self.spectrometer.variable_int_enabled == True:
+            self.Variable_int.setCheckState(QtCore.Qt.Checked)
+        if self.spectrometer.variable_int_enabled == False:
+            self.Variable_int.setCheckState(QtCore.Qt.Unchecked)
+            
+    def update_references(self,*args, **kwargs):
+        self.spectrometer.reference_ID = args[0]
+        try:
+            self.spectrometer.load_reference(self.spectrometer.reference_ID )
+        except KeyError:
+            self.spectrometer.clear_reference()
+            self.referenced.blockSignals(True)
+            self.referenced.setCheckState(QtCore.Qt.Unchecked)
+            self.referenced.blockSignals(False)
+            
+            self.spectrometer.clear_background()
+            self.background_subtracted.blockSignals(True)
+            self.background_subtracted.setCheckState(QtCore.Qt.Unchecked)
+            self.background_subtracted.blockSignals(False)
+
+
+            self.spectrometer._logger.info('No refence/background saved in slot %s to load' %args[0])
+            
+        
+            
+        
+
+
+class DisplayThread(QtCore.QThread):
+    """Hand spectra to the display at no more than refresh_rate per second.
+
+    In live mode, this thread subscribes to the spectrometer's acquisition
+    stream (see Spectrometer.latest_spectrum) rather than acquiring spectra
+    itself: it turns on live view if needed, then at each refresh emits the
+    latest completed spectrum, if there is a new one.  Spectra that were
+    superseded before they could be shown are counted in dropped_count, and
+    those that were emitted in displayed_count.  A single shot acquires
+    exactly one spectrum.
+    """
+    spectrum_ready = QtCore.Signal(np.ndarray)
+    spectra_ready = QtCore.Signal(list)
+
+    def __init__(self, parent):
+        super(DisplayThread, self).__init__()
+        self.parent = parent
+        self.single_shot = False
+        self.refresh_rate = 30.
+        self.displayed_count = 0
+        self.dropped_count = 0
+
+    def emit_spectrum(self, spectrum):
+        if type(spectrum) == list:
+            self.spectra_ready.emit(spectrum)
+        elif spectrum is not None:
+            self.spectrum_ready.emit(spectrum)
+        self.displayed_count += 1
+
+    def run(self):
+        spectrometer = self.parent.spectrometer
+        multiple = isinstance(spectrometer, Spectrometers)
+        self.displayed_count = 0
+        self.dropped_count = 0
+        if self.single_shot:
+            self.emit_spectrum(spectrometer.read_processed_spectra() if multiple
+                               else spectrometer.read_processed_spectrum())
+            self.finished.emit()
+            return
+        started_live_view = not spectrometer.live_view
+        spectrometer.live_view = True
+        last_counter = spectrometer.spectrum_counter
+        next_refresh = time.time()
+        try:
+            while self.parent.live_button.isChecked():
+                next_refresh += 1./self.refresh_rate
+                counter = spectrometer.spectrum_counter
+                if counter != last_counter:
+                    self.dropped_count += counter - last_counter - 1
+                    last_counter = counter
+                    self.emit_spectrum(spectrometer.latest_spectra if multiple
+                                       else spectrometer.latest_spectrum)
+                time.sleep(max(0, next_refresh - time.time()))
+                next_refresh = max(next_refresh, time.time())
+        finally:
+            if started_live_view:
+                spectrometer.live_view = False
+            spectrometer._logger.debug("Live display: {0} spectra displayed, {1} dropped".format(
+                                       self.displayed_count, self.dropped_count))
+        self.finished.emit()
+
+
+class SpectrometerDisplayUI(QtWidgets.QWidget,UiTools):
+    def __init__(self, spectrometer,ui_file = os.path.join(os.path.dirname(__file__),'spectrometer_view.ui'), parent=None):
+        assert isinstance(spectrometer, Spectrometer) or isinstance(spectrometer, Spectrometers),\
+            "instrument must be a Spectrometer or an instance of Spectrometers"
+        super(SpectrometerDisplayUI, self).__init__()
+        uic.loadUi(ui_file, self)
+        if isinstance(spectrometer, Spectrometers) and spectrometer.num_spectrometers == 1:
+            spectrometer = spectrometer.spectrometers[0]
+        if isinstance(spectrometer,Spectrometer):
+            spectrometer.num_spectrometers = 1
+        self.spectrometer = spectrometer
+        print self.spectrometer
+
+        pg.setConfigOption('background', 'w')
+        pg.setConfigOption('foreground', 'k')
+        self.plotbox = QtWidgets.QGroupBox()
+        self.plotbox.setLayout(QtWidgets.QGridLayout())
+        self.plotlayout = self.plotbox.layout()          
+        self.plots =[]
+
+        for spectrometer_nom in range(self.spectrometer.num_spectrometers):
+            self.plots.append(pg.PlotWidget(labels = {'bottom':'Wavelength (nm)'}))
+            self.plotlayout.addWidget(self.plots[spectrometer_nom])
+
+        self.figure_widget = self.replace_widget(self.display_layout,
+                                                 self.figure_widget, self.plotbox)         
+        self.take_spectrum_button.clicked.connect(self.button_pressed)
+        self.live_button.clicked.connect(self.button_pressed)
+        self.save_button.clicked.connect(self.button_pressed)
+        self.threshold.setValidator(QtGui.QDoubleValidator())
+        self.threshold.textChanged.connect(self.check_state)
+
+
+        self._display_thread = DisplayThread(self)
+        self._display_thread.spectrum_ready.connect(self.update_display)
+        self._display_thread.spectra_ready.connect(self.update_display)
+
+        self.period = 0.2
+        self.filename_lineEdit.textChanged.connect(self.filename_changed_ui)
+        register_for_property_changes(self.spectrometer,'filename',self.filename_changed)
+    def button_pressed(self, *args, **kwargs):
+        sender = self.sender()
+        if sender is self.take_spectrum_button:
+            #if self._display_thread.is_alive():
+            if self._display_thread.isRunning():
+                print 'already acquiring'
+                return
+            #self._display_thread = Thread(target=self.update_spectrum)
+            self._display_thread.single_shot = True
+            self._display_thread.start()
+            #self.update_spectrum()
+        elif sender is self.save_button:
+            save_spectrum = self.spectrometer.save_spectra \
+                if isinstance(self.spectrometer, Spectrometers) \
+                else self.spectrometer.save_spectrum
+            save_spectrum(attrs={'description':str(self.description.text())})
+        elif sender is self.live_button:
+            if self.live_button.isChecked():
+                #if self._display_thread.is_alive():
+                if self._display_thread.isRunning():
+                    print 'already acquiring'
+                    return
+                #self._display_thread = Thread(target=self.continuously_update_spectrum)
+                self._display_thread.single_shot = False
+                self._display_thread.start()
+
+    def update_spectrum(self):
+        read_processed_spectrum = self.spectrometer.read_processed_spectra \
+            if isinstance(self.spectrometer, Spectrometers) \
+            else self.spectrometer.read_processed_spectrum
+        spectrum = read_processed_spectrum()
+        self.update_display(spectrum)
+
+    def continuously_update_spectrum(self):
+        t0 = time.time()
+        while self.live_button.isChecked():
+            if time.time()-t0 < 1./30.:
+                continue
+            else:
+                t0 = time.time()
+            self.update_spectrum()
+
+    def update_display(self, spectrum):
+        #Update the graphs  
+        if self.enable_threshold.checkState() == QtCore.Qt.Checked:
+            threshold = float(self.threshold.text())
+            if isinstance(self.spectrometer, Spectrometers):
+                spectrum = [spectrometer.mask_spectrum(s, threshold) for (spectrometer, s) in zip(self.spectrometer.spectrometers, spectrum)]
+            else:
+                spectrum = self.spectrometer.mask_spectrum(spectrum, threshold)
+                    
+        if not self.plots[0].getPlotItem().listDataItems():
+            self.plotdata = []
+            if isinstance(self.spectrometer, Spectrometers):
+                for spectrometer_nom in range(self.spectrometer.num_spectrometers):
+                    self.plotdata.append(self.plots[spectrometer_nom].plot(x = self.spectrometer.wavelengths[spectrometer_nom],y = spectrum[spectrometer_nom],pen =(spectrometer_nom,len(range(self.spectrometer.num_spectrometers)))))
+                    
+   
+            else:                
+                self.plotdata.append(self.plots[0].plot(x = self.spectrometer.wavelengths,y = spectrum,pen =(0,len(range(self.spectrometer.num_spectrometers)))))
+        else:
+            if isinstance(self.spectrometer, Spectrometers):
+                for spectrometer_nom in range(self.spectrometer.num_spectrometers):
+                    self.plotdata[spectrometer_nom].setData(x = self.spectrometer.wavelengths[spectrometer_nom],y= spectrum[spectrometer_nom])
+            else:
+                self.plotdata[0].setData(x = self.spectrometer.wavelengths,y= spectrum)
+
+    def filename_changed_ui(self):
+        self.spectrometer.filename = self.filename_lineEdit.text()
+    def filename_changed(self):
+        self.filename_lineEdit.setText(self.spectrometer.filename)
+
+class SpectrometerUI(QtWidgets.QWidget):
+    """
+    Joins together the control and display UIs into a single spectrometer UI.
+    """
+
+    def __init__(self, spectrometer):
+        assert isinstance(spectrometer, Spectrometer), "instrument must be a Spectrometer"
+        super(SpectrometerUI, self).__init__()
+        self.spectrometer = spectrometer
+        self._init_ui()
+
+    def _init_ui(self):
+        self.setWindowTitle(self.spectrometer.__class__.__name__)
+        self.controls = self.spectrometer.get_qt_ui(control_only=True)
+        self.display = SpectrometerDisplayUI(self.spectrometer)
+        layout = QtWidgets.QVBoxLayout()
+    #    controls_layout = QtWidgets.QVBoxLayout()
+    #    controls_layout.addWidget(self.controls)
+    #    controls_layout.setContentsMargins(0,0,0,0)
+    #    controls_group = QtWidgets.QGroupBox()
+    #    controls_group.setTitle('Spectrometer')
+    #    controls_group.setLayout(controls_layout)
+        layout.addWidget(self.controls)
+        layout.addWidget(self.display)
+        layout.setContentsMargins(5,5,5,5)
+        layout.setSpacing(5)
+        self.setLayout(layout)
+
+
+class SpectrometersUI(QtWidgets.QWidget):
+    def __init__(self, spectrometers):
+        assert isinstance(spectrometers, Spectrometers), "instrument must be an instance of Spectrometers"
+        super(SpectrometersUI, self).__init__()
+        self.spectrometers = spectrometers
+        self._init_ui()
+
+    def _init_ui(self):
+        self.setWindowTitle('Spectrometers')
+        self.controls_layout = QtWidgets.QHBoxLayout()
+        controls_group = QtWidgets.QGroupBox()
+        controls_group.setTitle('Spectrometers')
+        controls_group.setLayout(self.controls_layout)
+        self.controls = []
+        for spectrometer in self.spectrometers.spectrometers:
+            control = spectrometer.get_qt_ui(control_only=True)
+            self.controls_layout.addWidget(control)
+            self.controls.append(control)
+        self.display = SpectrometerDisplayUI(self.spectrometers)
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(controls_group)
+        layout.addWidget(self.display)
+        self.setLayout(layout)
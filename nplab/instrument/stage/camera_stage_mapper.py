@@ -8,6 +8,8 @@ import nplab.instrument.camera
 import nplab.instrument.stage
 from nplab.instrument import Instrument
 import cv2
+from nplab.utils.image_with_location import FeatureTracker, datum_pixel
+from nplab.utils.mosaic import TileStitcher
 from scipy import ndimage
 from traits.api import HasTraits, Button, Float, Int, Property, Range, Array, on_trait_change, Instance
 from traitsui.api import View, VGroup, Item
@@ -103,7 +105,8 @@ class CameraStageMapper(Instrument, HasTraits):
         return -self.stage.position
     
     ################## Closed loop stage control #################
-    def centre_on_feature(self, feature_image, search_size=(50,50), tolerance=0.3, max_iterations=10, **kwargs):
+    def centre_on_feature(self, feature_image, search_size=(50,50), tolerance=0.3, max_iterations=10, method="template",
+                          pyramid_levels=0, **kwargs):
         """Adjust the stage slightly to centre on the given feature.
         
         This should be called immediately after moving the stage to centre on a
@@ -118,9 +121,17 @@ class CameraStageMapper(Instrument, HasTraits):
         pixels.  Should be a tuple of length 2.
         * tolerance: how accurately we're going to centre (in um)
         * max_iterations: maximum number of shifts
+        * method: "template" to use cv2.matchTemplate, or "phase_correlation" to
+        use a FeatureTracker (faster, and the feature's transform is reused
+        between iterations)
+        * pyramid_levels: for phase correlation, the number of times to halve
+        the resolution for an initial coarse search
         """
         shift=[999.,999.]
         n=0
+        if method == "phase_correlation":
+            kwargs['tracker'] = FeatureTracker(feature_image, margin=max(search_size)//2,
+                                               pyramid_levels=pyramid_levels)
         if self.disable_live_view:
             camera_live_view = self.camera.live_view
             self.camera.live_view = False
@@ -139,7 +150,7 @@ class CameraStageMapper(Instrument, HasTraits):
             print "Centered on feature in %d iterations." % n
         if self.disable_live_view:
             self.camera.live_view = camera_live_view #reenable live view if necessary
-    def centre_on_feature_iterate(self, feature_image, search_size=(50,50), image_filter=lambda x: x):
+    def centre_on_feature_iterate(self, feature_image, search_size=(50,50), image_filter=lambda x: x, tracker=None):
         """Measure the displacement of the sample and move to correct it.
         
         Arguments:
@@ -151,10 +162,18 @@ class CameraStageMapper(Instrument, HasTraits):
         image_filter : function (optional)
             If supplied, run this function on the image before cross-correlating
             (you can use this to cross-correlate in grayscale, for example).
+        tracker : FeatureTracker (optional)
+            If supplied, use this to find the feature (by phase correlation)
+            rather than cv2.matchTemplate.
         """
         try:
             self.flush_camera_and_wait()
             current_image = image_filter(self.camera.color_image()) #get the current image
+            if tracker is not None:
+                centre = datum_pixel(current_image)
+                shift = tracker.locate(current_image, predicted_position=centre) - centre
+                self.move_to_camera_pixel(shift + np.array(current_image.shape[0:2])/2.)
+                return self.camera_pixel_displacement_to_sample(shift)
             corr = cv2.matchTemplate(current_image,feature_image,cv2.TM_SQDIFF_NORMED) #correlate them: NB the match position is the MINIMUM
             #restrict to just the search area, and invert so we find the maximum
             corr = -corr[(corr.shape[0]/2. - search_size[0]/2.):(corr.shape[0]/2. + search_size[0]/2.),
@@ -230,7 +249,7 @@ class CameraStageMapper(Instrument, HasTraits):
 
     ######## Image Tiling ############
     def acquire_tiled_image(self, n_images=(3,3), dest=None, overlap=0.33,
-                            autofocus_args={},live_plot=False, downsample=8):
+                            autofocus_args={},live_plot=False, downsample=8, stitch=True):
         """Raster-scan the stage and take images, which we can later tile.
 
         Arguments:
@@ -244,6 +263,10 @@ class CameraStageMapper(Instrument, HasTraits):
         @param: autofocus_args: A dictionary of keyword arguments for the
         autofocus that occurs before each image is taken.  Set to None to
         disable autofocusing.
+        @param: stitch: If True (default), register each tile against its
+        neighbours and blend it into a multi-resolution mosaic in
+        dest["mosaic"] (see nplab.utils.mosaic).  Tiles are saved and stitched
+        in the background while the stage moves to the next one.
         """
         reset_interactive_mode = live_plot and not matplotlib.is_interactive()
         if live_plot:
@@ -256,28 +279,36 @@ class CameraStageMapper(Instrument, HasTraits):
             if dest is None:
                 dest = self.create_data_group("tiled_image_%d") #or should this be in RAM??
             centre_position = self.camera_centre_position()[0:2] #only 2D
-            x_indices = np.arange(n_images[0]) - (n_images[0] - 1)/2.0
-            y_indices = np.arange(n_images[1]) - (n_images[1] - 1)/2.0
-            for y_index in y_indices:
-                for x_index in x_indices:
-                    position = centre_position + self.camera_point_displacement_to_sample(np.array([x_index, y_index]) * (1-overlap))
-                    self.move_to_sample_position(position) #go to the raster point
-                    if autofocus_args is not None:
-                        self.autofocus(**autofocus_args)
-                    self.flush_camera_and_wait() #wait for the camera to be ready/stage to settle
-                    tile = dest.create_dataset("tile_%d", 
-                                               data=self.camera.color_image(),
-                                               attrs=self.camera.metadata)
-                    tile.attrs.create("stage_position",self.stage.position)
-                    tile.attrs.create("camera_centre_position",self.camera_centre_position())
-                    if live_plot:
-                        #Plot the image, in sample coordinates
-                        corner_points = np.array([self.camera_point_to_sample((xcorner,ycorner)) 
-                                                for ycorner in [0,1] for xcorner in [0,1]]) #positions of corners
-                        plot_skewed_image(tile[::downsample, ::downsample, :],
-                                          corner_points, axes=axes)
-                        fig.canvas.draw()
-                x_indices = x_indices[::-1] #reverse the X positions, so we do a snake-scan
+            x_indices = list(enumerate(np.arange(n_images[0]) - (n_images[0] - 1)/2.0))
+            y_indices = list(enumerate(np.arange(n_images[1]) - (n_images[1] - 1)/2.0))
+            tile_shape = self.camera.color_image().shape
+            nominal_positions = dict(((i, j), np.array([x_index, y_index]) * (1-overlap) * np.array(tile_shape[:2]))
+                                     for i, x_index in x_indices for j, y_index in y_indices)
+            stitcher = TileStitcher(dest, tile_shape, nominal_positions,
+                                    margin=min(50, int(overlap*min(tile_shape[:2])/4)), build_mosaic=stitch)
+            try:
+                for j, y_index in y_indices:
+                    for i, x_index in x_indices:
+                        position = centre_position + self.camera_point_displacement_to_sample(np.array([x_index, y_index]) * (1-overlap))
+                        self.move_to_sample_position(position) #go to the raster point
+                        if autofocus_args is not None:
+                            self.autofocus(**autofocus_args)
+                        self.flush_camera_and_wait() #wait for the camera to be ready/stage to settle
+                        image = self.camera.color_image()
+                        attrs = dict(self.camera.metadata)
+                        attrs["stage_position"] = self.stage.position
+                        attrs["camera_centre_position"] = self.camera_centre_position()
+                        stitcher.add_tile(image, (i, j), attrs=attrs) #saved (and stitched) while we move on
+                        if live_plot:
+                            #Plot the image, in sample coordinates
+                            corner_points = np.array([self.camera_point_to_sample((xcorner,ycorner))
+                                                    for ycorner in [0,1] for xcorner in [0,1]]) #positions of corners
+                            plot_skewed_image(image[::downsample, ::downsample, :],
+                                              corner_points, axes=axes)
+                            fig.canvas.draw()
+                    x_indices = x_indices[::-1] #reverse the X positions, so we do a snake-scan
+            finally:
+                stitcher.finish()
             dest.attrs.set("camera_to_sample",self.camera_to_sample)
             dest.attrs.set("camera_centre",self.camera_centre)
             self.move_to_sample_position(centre_position) #go back to the start point
@@ -1,16 +1,9 @@
 from __future__ import division
 import numpy as np
-import requests
-import matplotlib.pyplot as plt
 from scipy.special import riccati_jn,riccati_yn
 from nplab.utils.refractive_index_db import RefractiveIndexInfoDatabase
-from mpl_toolkits.mplot3d import Axes3D
-from matplotlib import cm
+from nplab.modelling.mie_solver import mie_efficiencies, mie_cross_sections
 
-#Initialized after first request
-WAVELENGTHS = None
-REFRACTIVE_INDEX = None
-print "starting"
 '''
 Adapted from: https://github.com/scottprahl/miepython
 
@@ -19,8 +12,19 @@ Adapted from: https://github.com/scottprahl/miepython
 rfdb = RefractiveIndexInfoDatabase()
 water = "main/H2O/Hale.yml"
 gold = "main/Au/Yakubovsky-25nm.yml"
-water_refractive_index = rfdb.refractive_index_generator(label=water)
-gold_refractive_index = rfdb.refractive_index_generator(label=gold)
+
+#Refractive index generators, made when first used (the dataset is downloaded only if it is not cached)
+_generators = dict()
+def refractive_index(label, required_wavelength):
+    if label not in _generators:
+        _generators[label] = rfdb.refractive_index_generator(label=label)
+    return _generators[label](required_wavelength=required_wavelength)
+
+def water_refractive_index(required_wavelength):
+    return refractive_index(water, required_wavelength)
+
+def gold_refractive_index(required_wavelength):
+    return refractive_index(gold, required_wavelength)
 
 
 def Lentz_Dn(z, N):
@@ -198,51 +202,18 @@ def mie_S1_S2(m,x,mus,n_max):
         S2s.append(S2)
     return [S1s,S2s]
 
-def get_refractive_index(target_wavelength, url):
-    #pull in globals
-    global WAVELENGTHS
-    global REFRACTIVE_INDEX
-    if WAVELENGTHS == None or REFRACTIVE_INDEX == None:
-
-        import csv
-        response = requests.get(url)
-        reader = csv.reader(response._content)
-        # for row in reader:
-        #     print row
-        print response._content
-        # content = ((response._content).replace('\r','\n')).replace('\n\n\n',"\n").replace('\t',",").replace("\n\n","\n")
-        print content
-        R = [v.split(",") for v in (content.split("\n"))]
-        R=R[1:]
-
-        wavelengths = []
-        ns = []
-        for row in R:
-            try:
-                w = float(row[0])
-                n = float(row[1])+1j*float(row[2])
-                wavelengths.append(w)
-                ns.append(n)
-            except:
-                pass
-            WAVELENGTHS = wavelengths
-            REFRACTIVE_INDEX = ns
-    print target_wavelength
-    print WAVELENGTHS
-    print REFRACTIVE_INDEX
-    return np.interp(target_wavelength,WAVELENGTHS,REFRACTIVE_INDEX)
+def get_refractive_index(target_wavelength, label):
+    #target_wavelength in nm (a number or an array)
+    return refractive_index(label, np.asarray(target_wavelength)*1e-9)
 
 def get_refractive_index_Au(target_wavelength):
-    url = "https://refractiveindex.info/data_csv.php?datafile=data/main/Au/Johnson.yml"
-    return get_refractive_index(target_wavelength,url=url)
+    return get_refractive_index(target_wavelength,label="main/Au/Johnson.yml")
 
 def get_refractive_index_Ag(target_wavelength):
-    url = "https://refractiveindex.info/data_csv.php?datafile=data/main/Ag/Johnson.yml"
-    return get_refractive_index(target_wavelength,url=url)
+    return get_refractive_index(target_wavelength,label="main/Ag/Johnson.yml")
 
 def get_refractive_index_water(target_wavelength):
-    url = "https://refractiveindex.info/data_csv.php?datafile=data/main/H2O/Hale.yml"
-    return get_refractive_index(target_wavelength,url=url)
+    return get_refractive_index(target_wavelength,label="main/H2O/Hale.yml")
 
 def calculate_scattering_cross_section(m,x,r,n_max):
     k = x/r
@@ -280,36 +251,22 @@ def calculate_extinction_cross_section(m,x,r,n_max):
     
 
 def main3():
+    import matplotlib.pyplot as plt
     n_medium = 1.3325
     theta = np.pi/2.0
    
     rs = np.linspace(1e-9,500e-9,50)
     rs = [20e-9,40e-9,]
     wavelengths = np.linspace(400e-9,1000e-9,600)
+    n_particle = get_refractive_index_Au(wavelengths/1e-9)
     for r in rs:
         print "r",r
-        Xs_sca = []
-        Xs_ext = []
-        for wavelength in wavelengths:
-            n_particle = get_refractive_index_Au(wavelength/1e-9)
-            print "N:",n_particle
-            x,m = make_rescaled_parameters(n_med=n_medium,n_particle=n_particle,r=r,wavelength=wavelength)
-            
-            print "X:{0},M:{1}".format(x,m)
-            n_max = 20
-            scatteringXc = calculate_scattering_cross_section(m,x,r,n_max)
-            extinctionXc = calculate_extinction_cross_section(m,x,r,n_max)
-
-            # [scatteringXc,extinctionXc,_,_] = small_mie(m,x)
-            Xs_sca.append(scatteringXc)
-            Xs_ext.append(extinctionXc)
+        #whole spectrum at once
+        x,m = make_rescaled_parameters(n_med=n_medium,n_particle=n_particle,r=r,wavelength=wavelengths)
+        Xs_ext, Xs_sca, Xs_abs = mie_efficiencies(m,x)
           
         fig, ax1 = plt.subplots(1,figsize=(8,8))
 
-        Xs_sca = np.asarray(Xs_sca)/(np.pi*r**2)
-        Xs_ext = np.asarray(Xs_ext)/(np.pi*r**2)
-        Xs_abs = Xs_ext - Xs_sca
-
         # wavelengths = wavelengths/1e-9
         ax1.plot(wavelengths/1e-9,Xs_sca, label="Scattering efficiency $Q_{sca} = \sigma_{sca}/\pi r^2$")
         ax1.plot(wavelengths/1e-9,Xs_ext, label="Extinction efficiency $Q_{ext} = \sigma_{ext}/\pi r^2$")
@@ -326,6 +283,7 @@ def main3():
         plt.show()
 
 def main2():
+    import matplotlib.pyplot as plt
     wavelength = 633.0e-9
     n_particle = get_refractive_index_Au(wavelength/1e-9)
     n_medium = 1.3325
@@ -376,6 +334,7 @@ def main2():
     plt.show()
     
 def main():
+    import matplotlib.pyplot as plt
     wavelength = 633.0e-9
     n_particle = get_refractive_index_Au(wavelength/1e-9)
     n_medium = 1.3325
@@ -423,19 +382,21 @@ def main():
         plt.savefig("C:\Users\im354\Pictures\Mie\particle_{}.png".format(r/1e-9))
 
 def scattering_cross_section(radius,wavelength):
-
+    #radius and wavelength can be (broadcastable) arrays
     n_particle = gold_refractive_index(required_wavelength=wavelength)
     n_med = water_refractive_index(required_wavelength=wavelength)
     x,m = make_rescaled_parameters(n_med=n_med,n_particle=n_particle,r=radius,wavelength=wavelength)
-    output = calculate_scattering_cross_section(m=np.asarray([m]),x=np.asarray([x]),r=np.asarray([radius]),n_max=40) 
+    _, output, _ = mie_cross_sections(m,x,radius)
     return output
 
 def main4():
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D #registers the 3d projection
+    from matplotlib import cm
     wavelength_range = np.asarray([1e-9*wl for wl in np.linspace(450,1000,550)])
     radius_range = np.asarray([r*1e-9 for r in np.linspace(50,250,200)])
     x,y= np.meshgrid(radius_range,wavelength_range,indexing="xy")
-    f = np.vectorize(scattering_cross_section)
-    z = f(x,y)
+    z = scattering_cross_section(x,y)
     fig = plt.figure()
     ax = fig.gca(projection='3d')
     zmin = np.min(z)
@@ -449,5 +410,29 @@ def main4():
     print "RATIO LOW: ", ratio_low
     print "RATIO High: ", ratio_high
     plt.show()
+def benchmark(n_wavelengths=600, n_radii=50):
+    '''Compares the scalar (per sphere) and vectorised calculations of the extinction and
+    scattering cross sections over a grid of wavelengths and radii of gold-like spheres'''
+    import time
+    wavelengths = np.linspace(400e-9,1000e-9,n_wavelengths)[:,np.newaxis]
+    rs = np.linspace(5e-9,150e-9,n_radii)[np.newaxis,:]
+    n_particle = (0.2+3.0j) + 0.5*np.sin(wavelengths/1e-7) + 0.3j*np.cos(wavelengths/1e-7)
+    x,m = make_rescaled_parameters(n_med=1.33,n_particle=n_particle,r=rs,wavelength=wavelengths)
+    m = m*np.ones(x.shape)
+    r = rs*np.ones(x.shape)
+
+    start = time.time()
+    scalar_sca = np.vectorize(calculate_scattering_cross_section)(m,x,r,0)
+    scalar_ext = np.vectorize(calculate_extinction_cross_section)(m,x,r,0)
+    scalar_time = time.time() - start
+
+    start = time.time()
+    ext, sca, _ = mie_cross_sections(m,x,r)
+    vectorised_time = time.time() - start
+
+    print "{0} spheres".format(x.size)
+    print "scalar: {0:.3f} s, vectorised: {1:.3f} s ({2:.0f}x faster)".format(scalar_time,vectorised_time,scalar_time/vectorised_time)
+    print "max relative difference: sca {0:.2g}, ext {1:.2g}".format(np.max(np.abs(sca/scalar_sca-1)),np.max(np.abs(ext/scalar_ext-1)))
+
 if __name__ == "__main__":
     main4()
\ No newline at end of file
@@ -0,0 +1,104 @@
+from __future__ import division
+import numpy as np
+from scipy.special import jv, yv
+
+'''
+Vectorised Mie scattering for a sphere, for arrays of size parameters and relative
+refractive indices at once (e.g. a whole grid of wavelengths and radii), following
+Bohren & Huffman, "Absorption and scattering of light by small particles".
+
+m and x can be arrays of any (broadcastable) shape, and the results have that shape,
+with an extra last axis for the series orders or the scattering angles. Each element
+sums its series up to its own Wiscombe limit, n_max = round(2 + x + 4x^(1/3)), as
+Mie_ab in nplab.modelling.mie does for a single sphere.
+'''
+
+def wiscombe_n_max(x):
+    '''Number of series terms needed for size parameter(s) x'''
+    return np.round(2 + x + 4*np.asarray(x)**(1/3)).astype(int)
+
+def mie_coefficients(m, x, n_max=None):
+    '''Returns the Mie coefficients (an, bn) for every element of the broadcast arrays m
+    (relative refractive index) and x (size parameter), each with shape m.shape + (n_max,).
+    If n_max is None, the largest Wiscombe limit is used and each element's terms beyond
+    its own limit are zero; otherwise every element gets n_max terms.'''
+    m, x = np.broadcast_arrays(np.asarray(m, dtype=complex), np.asarray(x, dtype=float))
+    shape = x.shape
+    m = m.ravel()[:, np.newaxis]
+    x = x.ravel()[:, np.newaxis]
+    element_n_max = wiscombe_n_max(x)
+    N = int(np.max(element_n_max)) if n_max is None else int(n_max)
+
+    mx = m*x
+    n = np.arange(1, N + 1)
+    nu = n + 0.5
+
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        sx = np.sqrt(0.5*np.pi*x)
+        px = sx*jv(nu, x)
+        p1x = np.concatenate((np.sin(x), px[:, :-1]), axis=1)
+        chx = -sx*yv(nu, x)
+        ch1x = np.concatenate((np.cos(x), chx[:, :-1]), axis=1)
+        gsx = px - 1j*chx
+        gs1x = p1x - 1j*ch1x
+
+        # B&H Equation 4.89, downward recurrence for all elements together
+        nmx = int(np.round(max(N, np.max(np.abs(mx))) + 16))
+        Dn = np.zeros((len(x), nmx), dtype=complex)
+        for i in range(nmx - 1, 1, -1):
+            Dn[:, i - 1] = (i/mx[:, 0]) - (1/(Dn[:, i] + i/mx[:, 0]))
+
+        D = Dn[:, 1:N + 1]
+        da = D/m + n/x
+        db = m*D + n/x
+
+        an = (da*px - p1x)/(da*gsx - gs1x)
+        bn = (db*px - p1x)/(db*gsx - gs1x)
+
+    if n_max is None:
+        # high orders can overflow the Bessel functions of small spheres; they are not used
+        unused = n > element_n_max
+        an[unused] = 0
+        bn[unused] = 0
+
+    return an.reshape(shape + (N,)), bn.reshape(shape + (N,))
+
+def mie_efficiencies(m, x, n_max=None):
+    '''Returns the extinction, scattering and absorption efficiencies (Qext, Qsca, Qabs),
+    i.e. cross sections divided by pi r^2, with the broadcast shape of m and x'''
+    an, bn = mie_coefficients(m, x, n_max)
+    x = np.broadcast_to(np.asarray(x, dtype=float), an.shape[:-1])
+    n = np.arange(1, an.shape[-1] + 1)
+    qsca = (2/x**2)*np.sum((2*n + 1)*(np.abs(an)**2 + np.abs(bn)**2), axis=-1)
+    qext = (2/x**2)*np.sum((2*n + 1)*(an.real + bn.real), axis=-1)
+    return qext, qsca, qext - qsca
+
+def mie_cross_sections(m, x, r, n_max=None):
+    '''Returns the extinction, scattering and absorption cross sections for spheres of radius r'''
+    area = np.pi*np.asarray(r)**2
+    return tuple(area*q for q in mie_efficiencies(m, x, n_max))
+
+def calculate_pi_tau_all(mu, n_max):
+    '''Angle-dependent functions pi_n and tau_n (B&H page 94) for orders 1 to n_max and all
+    cosines mu at once; returns two arrays of shape mu.shape + (n_max,)'''
+    mu = np.asarray(mu, dtype=float)
+    pi_n = np.zeros(mu.shape + (n_max + 1,))
+    tau_n = np.zeros(mu.shape + (n_max + 1,))
+    pi_n[..., 1] = 1.0
+    tau_n[..., 1] = mu
+    for n in range(2, n_max + 1):
+        pi_n[..., n] = ((2.0*n - 1)/(n - 1))*mu*pi_n[..., n - 1] - (n/(n - 1))*pi_n[..., n - 2]
+        tau_n[..., n] = n*mu*pi_n[..., n] - (n + 1)*pi_n[..., n - 1]
+    return pi_n[..., 1:], tau_n[..., 1:]
+
+def mie_amplitudes(m, x, mu, n_max=None):
+    '''Returns the scattering amplitudes (S1, S2) for the broadcast arrays m and x and the
+    1D array of scattering angle cosines mu, with shape m.shape + (len(mu),)'''
+    an, bn = mie_coefficients(m, x, n_max)
+    n = np.arange(1, an.shape[-1] + 1)
+    pi_n, tau_n = calculate_pi_tau_all(np.ravel(mu), an.shape[-1])
+    weight = (2.0*n + 1)/(n**2 + n)
+    a, b = weight*an, weight*bn
+    S1 = np.dot(a, pi_n.T) + np.dot(b, tau_n.T)
+    S2 = np.dot(b, pi_n.T) + np.dot(a, tau_n.T)
+    return S1, S2
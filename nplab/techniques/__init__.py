@@ -1,4 +1,4 @@
 __author__ = 'alansanders'
 
-from .software_lockin import software_lockin
-from .image_moments import find_centroid
\ No newline at end of file
+from .software_lockin import software_lockin, StreamingLockin
+from .image_moments import find_centroid, find_centroids, measure_fwhms
\ No newline at end of file
@@ -19,31 +19,71 @@ def find_centroid(img, x=None, y=None, threshold=None):
 
     :rtype : float, float
     """
-    img = img.copy()  # img is copied since it is later modified
-    # get x and y or create if necessary (pixel coordinates)
+    img = np.asarray(img)
+    if img.ndim != 2:
+        raise ValueError('img must be 2d, use find_centroids for a stack of images')
+    centroid_x, centroid_y = find_centroids(img[np.newaxis], x, y, threshold)
+    return centroid_x[0], centroid_y[0]
+
+
+def _pixel_coordinates(imgs, x, y):
+    """Return x and y for a stack of images imgs[n][y][x], creating them if necessary (pixel coordinates)"""
     if x is None:
-        x = np.arange(img.shape[-1])
-    elif y is None:
-        y = np.arange(img.shape[-2])
-    if img.shape != (y.size, x.size):
+        x = np.arange(imgs.shape[-1])
+    if y is None:
+        y = np.arange(imgs.shape[-2])
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if imgs.shape[-2:] != (y.size, x.size):
         raise ValueError('Shape of img(y,x) does not match (x,y)')
-    # remove background - the maximum value of the outer array elements and threshold to 0
-    bkgd = np.concatenate((img[0, :],  # bottom
-                           img[-1, :],  # top
-                           img[:, 0].flatten(),  # left
-                           img[:, -1].flatten())  # right
-                          ).max()
-    img *= (img - bkgd >= 0)
-    # apply threshold
+    return x, y
+
+
+def moment_weights(imgs, threshold=None):
+    """
+    The weights used for the image moments of a stack of images, as in find_centroid.
+
+    Pixels below the background (the maximum value of the outer pixels of each image)
+    or below the threshold are set to zero; the image itself is not modified.
+
+    :param imgs: 3d numpy array of images, imgs[n][y][x]
+    :param threshold: bottom fraction of the background-subtracted image to remove
+    :return: an array the same shape as imgs
+    """
+    bkgd = np.maximum.reduce([imgs[:, 0, :].max(axis=1), imgs[:, -1, :].max(axis=1),
+                              imgs[:, :, 0].max(axis=1), imgs[:, :, -1].max(axis=1)])
+    weights = np.where(imgs >= bkgd[:, np.newaxis, np.newaxis], imgs, 0)
     if threshold is not None:
-        threshold = threshold*img.max() + (1 - threshold)*img.min()  # n(x-y)+y = nx +y(1-n)
-        img *= (img >= threshold)
-    # calculate moments
-    m10 = np.sum(y.reshape(img.shape[0], 1) * img)
-    m01 = np.sum(x.reshape(1, img.shape[1]) * img)
-    m00 = np.sum(img)
-    centroid_x = m01 / m00
-    centroid_y = m10 / m00
+        # the threshold is relative to the background-removed image, as in find_centroid
+        threshold = threshold*weights.max(axis=(1, 2)) + (1 - threshold)*weights.min(axis=(1, 2))
+        weights = np.where(weights >= threshold[:, np.newaxis, np.newaxis], weights, 0)
+    return weights
+
+
+def find_centroids(imgs, x=None, y=None, threshold=None):
+    """
+    Find the centroids of a stack of images using image moments.
+
+    This gives the same results as calling find_centroid on each image, but works on
+    all the images at once.
+
+    :param imgs: 3d numpy array of images, imgs[n][y][x]
+    :param x: 1d numpy array corresponding to the last axis of the images
+    :param y: 1d numpy array corresponding to the second axis of the images
+    :param threshold: bottom fraction of the background-subtracted image to remove
+                      before calculating image moments
+    :return: Returns arrays of the x and y centroids
+
+    :rtype : numpy.ndarray, numpy.ndarray
+    """
+    imgs = np.asarray(imgs)
+    x, y = _pixel_coordinates(imgs, x, y)
+    weights = moment_weights(imgs, threshold)
+    # project onto each axis first, so the moments are cheap
+    x_projection = weights.sum(axis=1)
+    y_projection = weights.sum(axis=2)
+    m00 = x_projection.sum(axis=1)
+    centroid_x = np.dot(x_projection, x) / m00
+    centroid_y = np.dot(y_projection, y) / m00
     return centroid_x, centroid_y
 
 
@@ -51,6 +91,12 @@ gaussian = lambda x, bkgd, A, x0, sigma: bkgd + A * np.exp(-(x - x0) ** 2 / sigm
 
 
 def measure_fwhm(img, x=None, y=None, return_curve=False):
+    """
+    Measure the FWHM in x and y of an image, from Gaussian fits to its projections.
+
+    The fit parameters returned with return_curve are those of `gaussian`, whose sigma is
+    sqrt(2) times the standard deviation; the FWHMs are the same as from measure_fwhms.
+    """
     if x is None:
         x = np.arange(img.shape[-1])
     if y is None:
@@ -63,14 +109,98 @@ def measure_fwhm(img, x=None, y=None, return_curve=False):
     p0_y = [ydata.min(), ydata.max() - ydata.min(), cy, (y.max() - y.min()) / 2]
     popt_x, pcov_x = curve_fit(gaussian, x, xdata, p0_x)
     popt_y, pcov_y = curve_fit(gaussian, y, ydata, p0_y)
-    fwhm_x = 2 * np.sqrt(2 * np.log(2)) * popt_x[3]
-    fwhm_y = 2 * np.sqrt(2 * np.log(2)) * popt_y[3]
+    # popt[3] is sqrt(2) times the standard deviation, and only its square is fitted
+    fwhm_x = 2 * np.sqrt(np.log(2)) * np.abs(popt_x[3])
+    fwhm_y = 2 * np.sqrt(np.log(2)) * np.abs(popt_y[3])
     if return_curve:
         return fwhm_x, fwhm_y, xdata, ydata, popt_x, popt_y
     else:
         return fwhm_x, fwhm_y
 
 
+
+def fit_gaussian_profiles(x, profiles, fraction=0.2):
+    """
+    Fit Gaussians to a stack of 1d profiles at once, in closed form.
+
+    A parabola is fitted to the logarithm of each background-subtracted profile (the
+    background is its minimum), using only the points above `fraction` of the peak and
+    weighting them by the square of their values, which makes up for the logarithm
+    amplifying the noise in the tails (Guo's method).
+
+    :param x: 1d numpy array of the coordinates of the profiles
+    :param profiles: 2d numpy array of profiles, profiles[n][x]
+    :param fraction: fraction of the peak height above which points are used
+    :return: Returns an array of (bkgd, A, x0, sigma) for each profile, where sigma is
+             the standard deviation, bkgd + A*exp(-(x-x0)**2/(2*sigma**2)).  sigma is
+             nan if a profile has no peak.
+    """
+    x = np.asarray(x, dtype=float)
+    profiles = np.asarray(profiles, dtype=float)
+    bkgd = profiles.min(axis=1)
+    p = profiles - bkgd[:, np.newaxis]
+    peak = p.argmax(axis=1)
+    amplitude = p[np.arange(p.shape[0]), peak]
+    use = p > fraction*amplitude[:, np.newaxis]
+    weights = np.where(use, p, 0)**2
+    log_p = np.log(np.where(use, p, 1))
+    dx = x[np.newaxis, :] - x[peak][:, np.newaxis]  # relative to the peak, to keep the sums well conditioned
+    powers = [np.ones_like(dx)]
+    for k in range(4):
+        powers.append(powers[-1]*dx)
+    sums = [np.sum(weights*powers[k], axis=1) for k in range(5)]
+    matrix = np.array([[sums[i + j] for j in range(3)] for i in range(3)]).transpose(2, 0, 1)
+    rhs = np.array([np.sum(weights*powers[k]*log_p, axis=1) for k in range(3)]).T
+    # pinv rather than solve, so a degenerate profile doesn't stop us fitting the rest
+    c0, c1, c2 = np.einsum('nij,nj->in', np.linalg.pinv(matrix), rhs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c2 = np.where(c2 < 0, c2, np.nan)
+        sigma = np.sqrt(-1/(2*c2))
+        x0 = x[peak] - c1/(2*c2)
+        A = np.exp(c0 - c1**2/(4*c2))
+    return np.array([bkgd, A, x0, sigma]).T
+
+
+def measure_fwhms(imgs, x=None, y=None, refine=False, return_params=False):
+    """
+    Measure the FWHM in x and y of a stack of images, from Gaussian fits to their projections.
+
+    The Gaussians are fitted in closed form (see fit_gaussian_profiles), which is much
+    faster than least-squares fitting; if refine is True, each fit is then refined with
+    curve_fit.  The results agree with measure_fwhm.
+
+    :param imgs: 3d numpy array of images, imgs[n][y][x]
+    :param x: 1d numpy array corresponding to the last axis of the images
+    :param y: 1d numpy array corresponding to the second axis of the images
+    :param refine: if True, refine the fits with curve_fit
+    :param return_params: if True, also return the fit parameters (bkgd, A, x0, sigma)
+                          for each projection
+    :return: Returns arrays of the x and y FWHMs
+    """
+    imgs = np.asarray(imgs)
+    x, y = _pixel_coordinates(imgs, x, y)
+    xdata = imgs.sum(axis=1)
+    ydata = imgs.sum(axis=2)
+    params_x = fit_gaussian_profiles(x, xdata)
+    params_y = fit_gaussian_profiles(y, ydata)
+    if refine:
+        for coords, data, params in ((x, xdata, params_x), (y, ydata, params_y)):
+            for n in range(data.shape[0]):
+                if not np.all(np.isfinite(params[n])):
+                    continue
+                p0 = [params[n, 0], params[n, 1], params[n, 2], np.sqrt(2)*params[n, 3]]
+                try:
+                    popt, pcov = curve_fit(gaussian, coords, data[n], p0)
+                except RuntimeError:  # keep the closed form estimate if the fit fails
+                    continue
+                params[n] = popt[0], popt[1], popt[2], np.abs(popt[3])/np.sqrt(2)
+    fwhm_x = 2*np.sqrt(2*np.log(2))*params_x[:, 3]
+    fwhm_y = 2*np.sqrt(2*np.log(2))*params_y[:, 3]
+    if return_params:
+        return fwhm_x, fwhm_y, params_x, params_y
+    else:
+        return fwhm_x, fwhm_y
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
     x = np.linspace(-1, 2, 200)
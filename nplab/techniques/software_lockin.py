@@ -1,6 +1,8 @@
 __author__ = 'alansanders'
 
 import numpy as np
+from collections import deque
+from scipy.signal import lfilter, lfilter_zi
 
 
 def software_lockin(t, signal, reference, harmonic=1, trigger=None, smoothing=None, basis='cartesian'):
@@ -27,7 +29,7 @@ def software_lockin(t, signal, reference, harmonic=1, trigger=None, smoothing=No
     # a rising edge is used only
     cond1 = reference[:-1] < np.mean(reference)
     cond2 = reference[1:] >= np.mean(reference)
-    zero_crossings = t[cond1 & cond2]  # these are the points in time that are zero
+    zero_crossings = t[:-1][cond1 & cond2]  # these are the points in time that are zero
     # fit a line to the zero crossing
     n = np.arange(zero_crossings.size)  # number of rising triggers
     p = np.polyfit(n, zero_crossings, 1)  # result is p[0]*t + p[1]
@@ -55,6 +57,256 @@ def cart2pol(x, y):
     return np.sqrt(x**2 + y**2), np.angle(x + 1j*y)
 
 
+
+class StreamingLockin(object):
+    """
+    A software lock-in that processes the signal and reference a block at a time, e.g.
+    as they are read from a DAQ, keeping only a bounded amount of history.
+
+    The reference frequency and phase are tracked by fitting a line to the times of the
+    most recent rising crossings of the reference through its running mean, which is
+    updated as each block arrives.  Crossings are found with hysteresis (the reference must
+    fall below the mean by a fraction of its amplitude before the next rising crossing
+    counts), so noise on the reference doesn't give extra crossings.  The lock is only
+    used once three crossings agree on the period, and if the crossings stop fitting (e.g.
+    the reference frequency jumps) it is found again from scratch.  As in software_lockin,
+    the phase is zero at a rising crossing, so a signal A*sin(phase + delta) gives
+    X + iY = A*exp(i*delta).  Each harmonic is demodulated, low-pass filtered with a
+    cascade of single pole (RC) filters, and decimated.  For example, with a NIDAQ set up
+    for continuous acquisition:
+
+        lockin = StreamingLockin(sample_rate, harmonics=[1, 2], time_constant=0.01, decimation=100)
+        while running:
+            t, (signal, reference) = daq.read_multi_ai_cont()
+            lockin.process(signal, reference)
+        r, theta = lockin.r, lockin.theta
+
+    :param sample_rate: the number of samples per second
+    :param harmonics: the harmonic (or list of harmonics) of the reference to demodulate
+    :param time_constant: the time constant of each low-pass filter stage, in seconds.
+                          The running mean and amplitude of the reference use the same
+                          time constant, and crossings are ignored for the first three
+                          time constants while they settle.
+    :param filter_order: the number of filter stages (each one rolls off at 6dB/octave)
+    :param decimation: keep one output point for every `decimation` samples
+    :param crossing_window: the number of reference crossings fitted to find its phase
+    :param history: the maximum number of output points kept
+    :param hysteresis: how far (as a fraction of its amplitude) the reference must fall
+                       below its mean between rising crossings
+    """
+    max_phase_error = 0.25  # crossings further than this fraction of a period from the fit are rejected
+    max_rejected = 3  # if more of the last crossing_window crossings than this are rejected, the lock is found again
+
+    def __init__(self, sample_rate, harmonics=1, time_constant=0.1, filter_order=2, decimation=1,
+                 crossing_window=20, history=100000, hysteresis=0.5):
+        self.sample_rate = float(sample_rate)
+        self.harmonics = np.atleast_1d(harmonics).astype(float)
+        self.time_constant = time_constant
+        self.filter_order = int(filter_order)
+        self.decimation = int(decimation)
+        self.crossing_window = int(crossing_window)
+        self.history = int(history)
+        self.hysteresis = hysteresis
+        # cascaded single pole filters, y[n] = (1-a)x[n] + a*y[n-1]
+        a = np.exp(-1/(self.time_constant*self.sample_rate))
+        self._smoothing = a
+        self._filter_b = np.array([(1 - a)**self.filter_order])
+        self._filter_a = np.poly(a*np.ones(self.filter_order))
+        self.reset()
+
+    def reset(self):
+        """Forget the reference phase, the filter state and the output history."""
+        self._samples = 0  # total number of samples processed
+        self._level_state = None  # filter states for the running mean and mean square deviation of the reference
+        self._power_state = None
+        self._last_sample = None  # the reference minus its running mean, and the margin, for the last sample
+        self._trigger_state = 1  # the last state of the trigger; a crossing needs it to be -1 first
+        self._lower_time = None  # when the reference last rose through -margin
+        self._rejected = deque(maxlen=self.crossing_window)  # whether each recent crossing was rejected
+        self._crossings = deque(maxlen=self.crossing_window)  # (cycle number, sample number) of rising crossings
+        self._filter_state = np.zeros((len(self.harmonics), max(self.filter_order, 1)), dtype=complex)
+        self._t = np.zeros(self.history)
+        self._z = np.zeros((len(self.harmonics), self.history), dtype=complex)
+        self._stored = 0  # number of points in the history (it's a ring buffer)
+        self._next = 0  # where the next point will be stored
+
+    @property
+    def locked(self):
+        """Whether enough consistent reference crossings have been seen to demodulate the signal."""
+        return len(self._crossings) >= 3
+
+    @property
+    def reference_frequency(self):
+        """The current estimate of the reference frequency (Hz), or None."""
+        if not self.locked:
+            return None
+        return self.sample_rate/self._fit_crossings()[0]
+
+    def _running_mean(self, x, state, order=1):
+        """Smooth x with `order` single pole filters, returning the result and the new filter state."""
+        a = self._smoothing
+        b, a = [(1 - a)**order], np.poly(a*np.ones(order))
+        if state is None:
+            state = lfilter_zi(b, a)*np.mean(x)  # start from the mean of the first block
+        return lfilter(b, a, x, zi=state)
+
+    def _find_crossings(self, reference):
+        """Add the rising crossings of the running mean in this block to the list of crossings."""
+        # three stages, so the ripple at the reference frequency doesn't shift the crossings (or the margins)
+        level, self._level_state = self._running_mean(reference, self._level_state, order=3)
+        deviation = reference - level
+        power, self._power_state = self._running_mean(deviation**2, self._power_state, order=3)
+        margin = self.hysteresis*np.sqrt(2*power)  # a fraction of the amplitude, for a sine wave
+        if self._last_sample is not None:
+            # include the last sample of the previous block, so we can interpolate from it
+            deviation = np.concatenate(([self._last_sample[0]], deviation))
+            margin = np.concatenate(([self._last_sample[1]], margin))
+        first = self._samples - (len(deviation) - len(reference))  # the sample number of deviation[0]
+        # a Schmitt trigger: -1 below -margin, +1 above +margin, 0 in between.  A rising crossing
+        # is where the reference goes from -1 to +1, and its time is half way between it rising
+        # through -margin and through +margin, which are biased by noise in opposite directions.
+        trigger = np.where(deviation < -margin, -1, np.where(deviation > margin, 1, 0))
+        changes = np.nonzero(trigger)[0]
+        states = trigger[changes]
+        previous_states = np.concatenate(([self._trigger_state], states[:-1]))
+        previous_changes = np.concatenate(([-1], changes[:-1]))  # -1 means before this block
+        is_rising = (states == 1) & (previous_states == -1)
+        rising, below = changes[is_rising], previous_changes[is_rising]
+        upper_times = first + self._threshold_crossing(deviation, margin, rising - 1)
+        lower_times = np.full(len(rising), np.nan if self._lower_time is None else self._lower_time)
+        in_block = below >= 0
+        lower_times[in_block] = first + self._threshold_crossing(deviation, -margin, below[in_block])
+        times = (lower_times + upper_times)/2
+        if len(changes) > 0:
+            self._trigger_state = states[-1]
+        lows = changes[states == -1]
+        if len(lows) > 0 and lows[-1] + 1 < len(deviation):
+            self._lower_time = first + self._threshold_crossing(deviation, -margin, lows[-1:])[0]
+        elif len(lows) > 0:
+            self._lower_time = None  # the next block will start with this sample, and interpolate from it
+        self._last_sample = (deviation[-1], margin[-1])
+        settled = 3*self.time_constant*self.sample_rate
+        for time in times[np.isfinite(times) & (times >= settled)]:
+            self._add_crossing(time)
+
+    @staticmethod
+    def _threshold_crossing(deviation, threshold, indices):
+        """The (fractional) sample numbers at which the deviation crosses the threshold, after each index."""
+        before, after = deviation[indices], deviation[indices + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return indices + np.nan_to_num((threshold[indices] - before)/(after - before))
+
+    def _add_crossing(self, time):
+        """Number a crossing with the cycle it belongs to, and add it to the list if it fits."""
+        if len(self._crossings) == 0:
+            self._crossings.append((0, time))
+            return
+        last_cycle, last_time = self._crossings[-1]
+        if len(self._crossings) < 3:
+            # not locked yet: assume no crossings were missed, and check the period when there are three
+            self._crossings.append((last_cycle + 1, time))
+            if len(self._crossings) == 3 and self._fit_residual() > self.max_phase_error:
+                self._relock(time)
+            return
+        period, offset = self._fit_crossings()
+        # count any cycles where we missed a crossing, so the fit isn't thrown off
+        cycle = last_cycle + max(int(np.round((time - last_time)/period)), 1)
+        if abs(time - (period*cycle + offset)) > self.max_phase_error*period:
+            # noise, or the reference has changed: if it keeps happening, lock on again
+            self._rejected.append(True)
+            if self._rejected.count(True) > self.max_rejected:
+                self._relock(time)
+            return
+        self._rejected.append(False)
+        self._crossings.append((cycle, time))
+        if self._fit_residual() > self.max_phase_error:
+            self._relock(time)
+
+    def _relock(self, time):
+        """Forget the crossings so far, and start finding the reference again from this one."""
+        self._rejected.clear()
+        self._crossings.clear()
+        self._crossings.append((0, time))
+
+    def _fit_crossings(self):
+        """Fit sample number = period*cycle + offset to the recent crossings, returning (period, offset)."""
+        cycles, times = np.array(self._crossings).T
+        return tuple(np.polyfit(cycles, times, 1))
+
+    def _fit_residual(self):
+        """The largest distance of a crossing from the fit, as a fraction of the period."""
+        cycles, times = np.array(self._crossings).T
+        period, offset = self._fit_crossings()
+        return np.max(np.abs(times - (period*cycles + offset)))/abs(period)
+
+    def process(self, signal, reference):
+        """
+        Demodulate a block of the signal, and add the new output points to the history.
+
+        :param signal: a numpy array of signal values
+        :param reference: a numpy array of reference values, sampled at the same times
+        :return: the times of the new output points (in seconds from the start of the
+                 stream) and their X and Y values, each with one row per harmonic
+        """
+        signal = np.asarray(signal, dtype=float)
+        reference = np.asarray(reference, dtype=float)
+        assert len(signal) == len(reference), 'the signal and reference must be the same length.'
+        n = len(signal)
+        self._find_crossings(reference)
+        sample_numbers = self._samples + np.arange(n)
+        self._samples += n
+        if not self.locked:
+            return np.zeros(0), np.zeros((len(self.harmonics), 0)), np.zeros((len(self.harmonics), 0))
+        period, offset = self._fit_crossings()
+        phase = 2*np.pi*(sample_numbers - offset)/period
+        mixed = 2j*signal*np.exp(-1j*self.harmonics[:, np.newaxis]*phase)
+        filtered, self._filter_state = lfilter(self._filter_b, self._filter_a, mixed, axis=1,
+                                               zi=self._filter_state)
+        keep = np.nonzero((sample_numbers + 1) % self.decimation == 0)[0]
+        t = sample_numbers[keep]/self.sample_rate
+        z = filtered[:, keep]
+        self._store(t, z)
+        return t, z.real, z.imag
+
+    def _store(self, t, z):
+        """Add points to the ring buffer of output points"""
+        if len(t) > self.history:
+            t, z = t[-self.history:], z[:, -self.history:]
+        indices = (self._next + np.arange(len(t))) % self.history
+        self._t[indices] = t
+        self._z[:, indices] = z
+        self._next = (self._next + len(t)) % self.history
+        self._stored = min(self._stored + len(t), self.history)
+
+    def _ordered(self, array):
+        start = (self._next - self._stored) % self.history
+        return np.take(array, (start + np.arange(self._stored)) % self.history, axis=-1)
+
+    @property
+    def t(self):
+        """The times of the stored output points, in seconds from the start of the stream"""
+        return self._ordered(self._t)
+
+    @property
+    def x(self):
+        """The in-phase output, with one row per harmonic"""
+        return self._ordered(self._z).real
+
+    @property
+    def y(self):
+        """The quadrature output, with one row per harmonic"""
+        return self._ordered(self._z).imag
+
+    @property
+    def r(self):
+        """The amplitude of the output, with one row per harmonic"""
+        return np.abs(self._ordered(self._z))
+
+    @property
+    def theta(self):
+        """The phase of the output, with one row per harmonic"""
+        return np.angle(self._ordered(self._z))
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
 
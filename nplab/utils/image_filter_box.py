@@ -9,10 +9,12 @@ Created on Tue Jul 25 10:18:49 2017
 from numpy.lib.stride_tricks import as_strided
 import cv2
 import numpy as np
+import threading
+import time
 from nplab.utils.notified_property import DumbNotifiedProperty, NotifiedProperty, register_for_property_changes
 from nplab.instrument import Instrument
-from nplab.ui.ui_tools import QuickControlBox
 from nplab.utils.image_with_location import ImageWithLocation
+from nplab.utils.lazy_import import lazy_attributes
 
 class Image_Filter_box(Instrument):
     threshold = DumbNotifiedProperty()
@@ -33,11 +35,14 @@ class Image_Filter_box(Instrument):
         self.bilat_size = bilat_size
         self.bilat_height = bilat_height
         self.morph_kernel_size = morph_kernel_size
-        self.filter_options = ['None','STBOC_with_size_filter','strided_rescale','StrBiThresOpen']
+        self.filter_options = ['None','STBOC_with_size_filter','strided_rescale','StrBiThresOpen',
+                               'detect_particles','particle_overlay']
         self.show_particles = False
         self.return_original_with_particles = False
         self.current_filter_index = 0
         self.update_functions = []
+        self.detector = ParticleDetector()
+        self.detection_worker = None
     def current_filter(self,image):
         if self.current_filter_proxy == None:
             return image
@@ -77,6 +82,61 @@ class Image_Filter_box(Instrument):
                                            morph_kernel_size = self.morph_kernel_size)
         except Exception as e:
             self.log('Image processing has failed due to: '+str(e),level = 'WARN')
+    def update_detector(self):
+        """Copy the current settings to the particle detector, and return it."""
+        for name in ['bin_fac','threshold','min_size','max_size','bilat_size','bilat_height','morph_kernel_size']:
+            setattr(self.detector, name, getattr(self, name))
+        return self.detector
+    def detect_particles(self,g):
+        """Camera filter that finds particles at the binned resolution.
+
+        Returns the binned mask of accepted particles (marked with circles if
+        show_particles is set), or the original image with circles drawn round the
+        particles if return_original_with_particles is set.
+        """
+        try:
+            detector = self.update_detector()
+            centers, radii = detector.detect(g)
+            if self.return_original_with_particles:
+                return draw_particles(g, centers, radii)
+            mask = detector.binned_mask(g)
+            if self.show_particles:
+                return draw_particles(mask, centers/detector.bin_fac, radii/detector.bin_fac)
+            return mask
+        except Exception as e:
+            self.log('Image processing has failed due to: '+str(e),level = 'WARN')
+    def start_background_detection(self, callback=None):
+        """Run particle detection on frames in a background thread.
+
+        Frames are passed to the thread with ``detection_worker.submit(frame)`` (the
+        particle_overlay filter does this for every frame it displays), and the
+        results are available from ``detection_worker.latest_result``.
+        """
+        if self.detection_worker is None:
+            self.detection_worker = ParticleDetectionWorker(self.update_detector())
+        if callback is not None:
+            self.detection_worker.callbacks.append(callback)
+        return self.detection_worker
+    def stop_background_detection(self):
+        if self.detection_worker is not None:
+            self.detection_worker.stop()
+            self.detection_worker = None
+    def particle_overlay(self,g):
+        """Camera filter that draws the latest particles found in the background on each frame.
+
+        The frame is passed to the detection thread, so the preview never waits for
+        detection: the circles are from the most recent frame that has been processed.
+        """
+        try:
+            worker = self.start_background_detection()
+            self.update_detector()
+            worker.submit(g)
+            result = worker.latest_result
+            if result is None:
+                return g
+            return draw_particles(g, result['centers'], result['radii'])
+        except Exception as e:
+            self.log('Image processing has failed due to: '+str(e),level = 'WARN')
     def connect_function_to_property_changes(self,function):
     #    print function
         for variable_name in vars(self.__class__):
@@ -87,26 +147,210 @@ class Image_Filter_box(Instrument):
                 register_for_property_changes(self,variable_name,self.update_functions[-1])
         
     def get_qt_ui(self):
+        from nplab.utils.image_filter_box_ui import Camera_filter_Control_ui
         return Camera_filter_Control_ui(self)
-            
-class Camera_filter_Control_ui(QuickControlBox):
-
-    '''Control Widget for the Shamrock spectrometer
-    '''
-    def __init__(self,filter_box):
-        super(Camera_filter_Control_ui,self).__init__(title = 'Camera_filter_Controls')
-        self.filter_box = filter_box
-        self.add_spinbox('threshold',vmin=-255,vmax=255)
-        self.add_spinbox('bin_fac' , vmin=1)
-        self.add_spinbox('bilat_size')
-        self.add_spinbox('bilat_height')
-        self.add_spinbox('min_size')
-        self.add_spinbox('max_size')
-        self.add_spinbox('morph_kernel_size')
-        self.add_checkbox('show_particles')
-        self.add_checkbox('return_original_with_particles')
-        self.add_combobox('current_filter_index',options = self.filter_box.filter_options)
-        self.auto_connect_by_name(controlled_object = self.filter_box)
+
+
+class ParticleDetector(object):
+    """Finds bright particles in camera frames, working at the binned resolution.
+
+    This follows the same steps as `STBOC_with_size_filter` (bin, rescale, bilateral
+    filter, adaptive threshold, bilateral filter, open and close) but the binned image
+    is never scaled back up to full size, the working images are kept between frames
+    of the same size rather than reallocated, and the particles' centres and sizes come
+    from one call to `cv2.connectedComponentsWithStats` rather than a loop over
+    contours.  All sizes (filter sizes, min_size, max_size and the adaptive threshold's
+    neighbourhood, threshold_block_size) are in pixels of the original image and are
+    scaled down for the binned image; filters that shrink to one pixel are skipped.
+    The centres and radii returned are also in pixels of the original image.
+
+    A detector isn't meant to be shared between threads (the working images are
+    reused), but detect() holds a lock so it is safe if that does happen.
+    """
+    def __init__(self, bin_fac=4, threshold=40, min_size=2, max_size=6, bilat_size=3,
+                 bilat_height=40, morph_kernel_size=3, threshold_block_size=101):
+        self.bin_fac = bin_fac
+        self.threshold = threshold
+        self.min_size = min_size
+        self.max_size = max_size
+        self.bilat_size = bilat_size
+        self.bilat_height = bilat_height
+        self.morph_kernel_size = morph_kernel_size
+        self.threshold_block_size = threshold_block_size
+        self._buffers_key = None
+        self._lock = threading.Lock()
+        self.labels = None # connected component labels of the last frame (binned)
+        self.accepted = None # whether each label (after 0, the background) passed the size filter
+
+    def _allocate_buffers(self, shape):
+        """Make the working images for frames of the given shape (if they don't exist)."""
+        key = (tuple(shape[:2]), int(self.bin_fac))
+        if key != self._buffers_key:
+            binned_shape = (shape[0]//int(self.bin_fac), shape[1]//int(self.bin_fac))
+            self._summed = np.empty(binned_shape, dtype=np.float32)
+            self._scaled = np.empty(binned_shape, dtype=np.uint8)
+            self._work = [np.empty(binned_shape, dtype=np.uint8) for i in range(2)]
+            self._labels = np.empty(binned_shape, dtype=np.int32)
+            self._mask = np.empty(binned_shape, dtype=np.uint8)
+            self._buffers_key = key
+
+    def bin_image(self, image):
+        """Sum the colour channels and bin_fac*bin_fac blocks, and rescale to 0-254 (as strided_rescale, without scaling back up)."""
+        b = int(self.bin_fac)
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+        self._allocate_buffers(image.shape)
+        blocks = as_strided(image, shape=self._summed.shape + (b, b, image.shape[2]),
+                            strides=(image.strides[0]*b, image.strides[1]*b) + image.strides)
+        blocks.sum(axis=(2, 3, 4), out=self._summed)
+        low, high = self._summed.min(), self._summed.max()
+        if high > low:
+            np.subtract(self._summed, low, out=self._summed)
+            np.multiply(self._summed, 254.0/(high - low), out=self._summed)
+        else:
+            self._summed.fill(0)
+        np.copyto(self._scaled, self._summed, casting='unsafe')
+        return self._scaled
+
+    def _binned_size(self, size):
+        """Convert a size in original pixels to binned pixels (at least 1)."""
+        return max(1, int(round(float(size)/int(self.bin_fac))))
+
+    def threshold_image(self, image):
+        """Bin the image and return the (binned) thresholded image of candidate particles."""
+        source = self.bin_image(image)
+        a, b = self._work
+        bilat_size = self._binned_size(self.bilat_size)
+        spatial_sigma = 50.0/int(self.bin_fac)
+        if bilat_size > 1:
+            source = cv2.bilateralFilter(source, bilat_size, self.bilat_size, spatial_sigma, dst=a)
+        block_size = max(3, self._binned_size(self.threshold_block_size) | 1) # must be odd
+        source = cv2.adaptiveThreshold(source, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                                       block_size, -1*self.threshold, dst=b)
+        if bilat_size > 1:
+            source = cv2.bilateralFilter(source, bilat_size, self.bilat_height/4, spatial_sigma, dst=a)
+        kernel_size = self._binned_size(self.morph_kernel_size)
+        if kernel_size > 1:
+            kernel = np.ones((kernel_size, kernel_size), np.uint8)
+            other = b if source is a else a
+            cv2.morphologyEx(source, cv2.MORPH_OPEN, kernel, dst=other)
+            source = cv2.morphologyEx(other, cv2.MORPH_CLOSE, kernel, dst=source)
+        return source
+
+    def detect(self, image):
+        """Find particles in an image.
+
+        Returns (centers, radii): an Nx2 array of the particles' centroids as (row, column)
+        and an array of their radii (half the larger side of the bounding box), in pixels
+        of the original image.  Particles with radii outside min_size to max_size are
+        left out.
+        """
+        with self._lock:
+            thresholded = self.threshold_image(image)
+            n, labels, stats, centroids = cv2.connectedComponentsWithStats(thresholded, self._labels,
+                                                                         connectivity=8)
+            b = int(self.bin_fac)
+            stats, centroids = stats[1:], centroids[1:] # label 0 is the background
+            radii = 0.5*b*np.maximum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT])
+            self.accepted = (radii >= self.min_size) & (radii <= self.max_size)
+            self.labels = labels
+            # the centre of binned pixel i is at (i + 0.5)*b - 0.5 in the original image
+            centers = (centroids[self.accepted, ::-1] + 0.5)*b - 0.5
+            return centers, radii[self.accepted]
+
+    def binned_mask(self, image=None):
+        """The binned image of the particles accepted by the last detect() (255 in particles, 0 elsewhere).
+
+        If the image passed to detect() is given, and it has location metadata, the mask is an
+        ImageWithLocation with the metadata adjusted for the binning.
+        """
+        lookup = np.zeros(len(self.accepted) + 1, dtype=np.uint8)
+        lookup[1:][self.accepted] = 255
+        mask = np.take(lookup, self.labels, out=self._mask)
+        if image is not None and hasattr(image, "attrs") and 'pixel_to_sample_matrix' in image.attrs:
+            b = int(self.bin_fac)
+            decimated = image[:mask.shape[0]*b:b, :mask.shape[1]*b:b, ...] # the slicing code updates the metadata
+            return ImageWithLocation(mask.copy(), attrs=decimated.attrs)
+        return mask.copy()
+
+
+class ParticleDetectionWorker(object):
+    """Runs a ParticleDetector on a background thread, always on the newest frame.
+
+    ``submit`` returns immediately; if frames arrive faster than they can be processed
+    the older ones are skipped, so detection never holds up live view.  The result of
+    the most recent detection is in ``latest_result``, a dictionary with the frame
+    number, ``centers`` and ``radii``, and it is passed to each of ``callbacks``.
+    """
+    def __init__(self, detector, callbacks=None):
+        self.detector = detector
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.latest_result = None
+        self._condition = threading.Condition()
+        self._pending_frame = None
+        self._frames_submitted = 0
+        self._frames_processed = 0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, frame):
+        """Queue a frame for detection, replacing any frame that hasn't been started yet."""
+        with self._condition:
+            self._pending_frame = frame
+            self._frames_submitted += 1
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending_frame is None and not self._stopping:
+                    self._condition.wait(1.0)
+                if self._stopping:
+                    return
+                frame, frame_number = self._pending_frame, self._frames_submitted
+                self._pending_frame = None
+            try:
+                centers, radii = self.detector.detect(frame)
+                self.latest_result = {'frame_number': frame_number, 'centers': centers, 'radii': radii}
+                for callback in self.callbacks:
+                    callback(self.latest_result)
+            except Exception as e:
+                print "Particle detection failed: {0}".format(e)
+            with self._condition:
+                self._frames_processed = frame_number
+                self._condition.notify_all()
+
+    def wait_until_idle(self, timeout=None):
+        """Block until every submitted frame has been processed or skipped; returns False on timeout."""
+        expiry_time = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._frames_processed != self._frames_submitted and not self._stopping:
+                remaining = None if expiry_time is None else expiry_time - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self._frames_processed == self._frames_submitted
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+def draw_particles(image, centers, radii, color=(255, 0, 0)):
+    """Return a colour copy of the image with circles (twice the radius) round the particles."""
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis].repeat(3, axis=2)
+    else:
+        image = image.copy()
+    for (row, column), radius in zip(np.round(centers).astype(int), radii):
+        cv2.circle(image, (column, row), int(radius*2), color, 2)
+    return image
 
             
 def strided_rescale(g, bin_fac= 4):
@@ -249,6 +493,9 @@ def build_strided_filter(func):
     def filter_func(image):
         return func(strided_rescale(image))
     return filter_func
+
+# The control box needs Qt, so it is only imported when it's used
+lazy_attributes(__name__, {"Camera_filter_Control_ui": "nplab.utils.image_filter_box_ui"})
 #if __name__ == '__main__':
 #    from nplab.instrument.camera.lumenera import LumeneraCamera
 #    cam = LumeneraCamera(1)
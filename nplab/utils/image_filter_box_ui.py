@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Qt controls for the camera image filter box (nplab.utils.image_filter_box).
+"""
+
+from nplab.ui.ui_tools import QuickControlBox
+
+
+class Camera_filter_Control_ui(QuickControlBox):
+
+    '''Control Widget for the Shamrock spectrometer
+    '''
+    def __init__(self,filter_box):
+        super(Camera_filter_Control_ui,self).__init__(title = 'Camera_filter_Controls')
+        self.filter_box = filter_box
+        self.add_spinbox('threshold',vmin=-255,vmax=255)
+        self.add_spinbox('bin_fac' , vmin=1)
+        self.add_spinbox('bilat_size')
+        self.add_spinbox('bilat_height')
+        self.add_spinbox('min_size')
+        self.add_spinbox('max_size')
+        self.add_spinbox('morph_kernel_size')
+        self.add_checkbox('show_particles')
+        self.add_checkbox('return_original_with_particles')
+        self.add_combobox('current_filter_index',options = self.filter_box.filter_options)
+        self.auto_connect_by_name(controlled_object = self.filter_box)
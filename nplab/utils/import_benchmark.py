@@ -0,0 +1,90 @@
+"""
+Import time benchmark
+=====================
+
+Measures how long it takes to import nplab modules, each in a fresh Python process,
+and checks them against a time budget.  It also checks that modules which should work
+on headless machines (e.g. analysis code or instruments driven from a server) don't
+pull in the GUI toolkits.
+
+Run it with ``python -m nplab.utils.import_benchmark [module ...]``.  On Python 3.7
+and later, ``python -X importtime -c "import nplab.instrument.camera"`` gives a
+breakdown of where the time goes.
+"""
+
+import sys
+import json
+import subprocess
+
+# Import time budgets in seconds (generous, as they include the interpreter's own
+# start up and numpy, and machines vary).
+IMPORT_TIME_BUDGETS = {
+    "nplab": 1.0,
+    "nplab.datafile": 1.0,
+    "nplab.instrument": 1.0,
+    "nplab.instrument.camera": 1.0,
+    "nplab.instrument.spectrometer": 1.0,
+    "nplab.instrument.stage": 1.0,
+    "nplab.analysis": 1.0,
+    "nplab.modelling.mie": 2.0,
+}
+
+# Modules that the budgeted modules must not import
+GUI_MODULES = ["PyQt4", "PyQt5", "PySide", "qtpy", "pyqtgraph", "matplotlib", "traits", "traitsui"]
+
+_MEASURE_IMPORT = """
+import sys, time, json
+start = time.time()
+import {module}
+duration = time.time() - start
+json.dump({{"time": duration, "modules": sorted(sys.modules.keys())}}, sys.stdout)
+"""
+
+
+def measure_import(module, python=sys.executable):
+    """Import a module in a new interpreter, and return the time taken and the modules loaded."""
+    process = subprocess.Popen([python, "-c", _MEASURE_IMPORT.format(module=module)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output, error = process.communicate()
+    if process.returncode != 0:
+        raise ImportError("Could not import {0}:\n{1}".format(module, error.decode()))
+    # modules may print when they're imported, so the result is the last line
+    result = json.loads(output.decode().strip().split("\n")[-1])
+    loaded = set(m.split(".")[0] for m in result["modules"])
+    return result["time"], sorted(loaded.intersection(GUI_MODULES))
+
+
+def run_benchmark(modules=None, budgets=IMPORT_TIME_BUDGETS, repeats=3):
+    """Measure the import time of each module (best of several repeats).
+
+    Returns a list of dictionaries with the module name, time, budget, the GUI
+    modules it imported, and whether it passed.
+    """
+    if modules is None:
+        modules = sorted(budgets.keys())
+    results = []
+    for module in modules:
+        times = []
+        for i in range(repeats):
+            duration, gui_modules = measure_import(module)
+            times.append(duration)
+        budget = budgets.get(module)
+        results.append({"module": module, "time": min(times), "budget": budget,
+                        "gui_modules": gui_modules,
+                        "passed": (budget is None or min(times) <= budget) and len(gui_modules) == 0})
+    return results
+
+
+def print_report(results):
+    print "{0:40s} {1:>9s} {2:>9s}  {3}".format("module", "time (s)", "budget", "GUI modules loaded")
+    for r in results:
+        print "{0:40s} {1:9.3f} {2:>9s}  {3}{4}".format(r["module"], r["time"],
+                                                       "-" if r["budget"] is None else "%.3f" % r["budget"],
+                                                       ", ".join(r["gui_modules"]),
+                                                       "" if r["passed"] else "  <-- FAILED")
+
+
+if __name__ == "__main__":
+    results = run_benchmark(sys.argv[1:] or None)
+    print_report(results)
+    sys.exit(0 if all(r["passed"] for r in results) else 1)
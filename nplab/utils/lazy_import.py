@@ -0,0 +1,63 @@
+"""
+Lazy imports
+============
+
+Support for loading parts of a module only when they are first used.
+
+Instrument modules usually define a GUI next to the instrument class.  Importing
+the GUI needs Qt, pyqtgraph etc., which takes seconds and isn't possible at all on
+headless machines, so the GUI classes live in a separate module.  Calling
+`lazy_attributes` at the end of the instrument module means that old code using e.g.
+``from nplab.instrument.camera import CameraControlWidget`` still works: the GUI
+module is imported the first time one of its names is asked for.
+"""
+
+import sys
+import types
+import importlib
+
+
+class LazyModule(types.ModuleType):
+    """A module whose listed attributes are imported from other modules when first used."""
+    def __init__(self, module, lazy_attributes):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        # Keep the original module alive: its functions still use its globals,
+        # which Python 2 clears when a module object is deleted.
+        self._original_module = module
+        self._lazy_attributes = dict(lazy_attributes)
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup has failed
+        lazy_attributes = self.__dict__.get('_lazy_attributes', {})
+        if name not in lazy_attributes:
+            raise AttributeError("module '{0}' has no attribute '{1}'".format(self.__name__, name))
+        value = getattr(importlib.import_module(lazy_attributes[name]), name)
+        setattr(self, name, value)  # subsequent lookups don't come here
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__.keys()) | set(self._lazy_attributes.keys()))
+
+
+def lazy_attributes(module_name, attributes):
+    """Make names in a module load from other modules the first time they are used.
+
+    This should be the last statement in the module, e.g.
+    ``lazy_attributes(__name__, {'CameraUI': 'nplab.instrument.camera.camera_ui'})``
+    means ``module.CameraUI`` imports ``camera_ui`` and returns its ``CameraUI``.
+    Code inside the module should import from the other module directly (usually
+    inside a function), as the names never appear in the module's own globals.
+    Does nothing if the module is being run as a script.
+    """
+    module = sys.modules[module_name]
+    if module_name == '__main__' or isinstance(module, LazyModule):
+        return module
+    lazy_module = LazyModule(module, attributes)
+    sys.modules[module_name] = lazy_module
+    return lazy_module
+
+
+def names_in(module_name, names):
+    """A dictionary for `lazy_attributes` that loads all the given names from one module."""
+    return dict((name, module_name) for name in names)
@@ -0,0 +1,262 @@
+"""
+Mosaic
+======
+
+Stitching a grid of overlapping image tiles into one large image as they are acquired.
+
+`PyramidMosaic` is a large image stored in an HDF5 group as chunked datasets at several resolutions (each level is
+half the size of the one before), so it can be viewed at any zoom by reading only the chunks that are on screen.
+Tiles are blended in with weights that fall off towards their edges, so the seams don't show.
+
+`TileStitcher` is the engine for tiled acquisition: tiles are handed to it as they are taken, and it saves,
+registers and blends them on a background thread, so the stage can move to the next tile in the meantime.  Each tile
+is registered by phase correlation (using `FeatureTracker`) against the neighbouring tiles that have already been
+placed, and falls back to its nominal (stage) position if the overlap doesn't match up.
+
+Positions are in pixels, with the same axis order as the image arrays.  A tile's position is that of its [0,0]
+pixel, and the nominal positions are relative to any convenient origin, usually the centre tile.
+"""
+from __future__ import division
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from nplab.utils.image_with_location import FeatureTracker, _grayscale, datum_pixel
+
+
+def feather_weights(shape, width):
+    """Weights for blending a tile of the given (2D) shape, rising linearly from its edges to 1 at `width` pixels in."""
+    ramps = []
+    for n in shape[:2]:
+        distance = np.minimum(np.arange(n), np.arange(n)[::-1]) + 1.0
+        ramps.append(np.clip(distance / max(width, 1), 0, 1))
+    return np.outer(ramps[0], ramps[1]).astype(np.float32)
+
+
+def register_tile(tile, neighbour, nominal_offset, margin=20, min_peak_height=10.0):
+    """Find the position of `tile` relative to `neighbour`, by phase correlation of the region where they overlap.
+
+    nominal_offset is the expected position of the tile's [0,0] pixel in the neighbour's pixel coordinates, and it may
+    be wrong by up to `margin` pixels.  Returns the refined offset and the height of the correlation peak (relative to
+    the mean), or None and the peak height if the overlap is too small or the peak too low to trust.
+    """
+    nominal_offset = np.array(nominal_offset, dtype=np.float)
+    tile_shape = np.array(tile.shape[:2])
+    # The part of the neighbour we expect to see in the tile, shrunk by the margin so it's in the tile for any error
+    start = np.maximum(np.round(nominal_offset).astype(int), 0) + margin
+    stop = np.minimum(np.round(nominal_offset).astype(int) + tile_shape, neighbour.shape[:2]) - margin
+    if np.any(stop - start < 8):
+        return None, 0
+    feature = _grayscale(np.asarray(neighbour)[start[0]:stop[0], start[1]:stop[1], ...])
+    tracker = FeatureTracker(feature, margin=margin)
+    try:
+        found = tracker.locate(_grayscale(tile), predicted_position=start - nominal_offset + datum_pixel(feature))
+    except AssertionError: # the search window doesn't fit in the tile
+        return None, 0
+    if tracker.last_peak_height < min_peak_height:
+        return None, tracker.last_peak_height
+    return start + datum_pixel(feature) - found, tracker.last_peak_height
+
+
+class PyramidMosaic(object):
+    """A large image, stored at several resolutions in chunked HDF5 datasets, that tiles can be blended into.
+
+    group : h5py.Group
+        The group to store the mosaic in.  It will contain datasets "level_0" (full resolution), "level_1" (half
+        resolution), etc. and "weight", the total blending weight of the tiles at each full resolution pixel.  If the
+        datasets already exist, the mosaic is opened (and the other arguments are ignored).
+    shape : tuple
+        The shape of the full resolution image, e.g. (height, width, 3) for a colour image.
+    levels : int (optional)
+        The number of resolutions to store.  By default we keep halving until the image fits in one chunk.
+    chunk_size : int (optional)
+        The height and width of the HDF5 chunks.
+    feather : int (optional)
+        The width, in pixels, over which tiles are faded out towards their edges when they're blended.
+    """
+    def __init__(self, group, shape=None, dtype=np.uint8, levels=None, chunk_size=256, feather=32):
+        self.group = group
+        self.feather = feather
+        if "level_0" not in group:
+            assert shape is not None, "The shape of the mosaic must be given when creating it."
+            if levels is None:
+                levels = 1 + int(np.ceil(np.log2(max(max(shape[:2]) / float(chunk_size), 1))))
+            for level in range(levels):
+                level_shape = tuple(-(-np.array(shape[:2]) // 2**level)) + tuple(shape[2:])
+                chunks = tuple(np.minimum(chunk_size, level_shape[:2])) + tuple(shape[2:])
+                group.create_dataset("level_{0}".format(level), shape=level_shape, dtype=dtype, chunks=chunks,
+                                     fillvalue=0)
+            group.create_dataset("weight", shape=tuple(shape[:2]), dtype=np.float32,
+                                 chunks=tuple(np.minimum(chunk_size, shape[:2])), fillvalue=0)
+            group.attrs["levels"] = levels
+        self.levels = int(group.attrs["levels"])
+        self.shape = group["level_0"].shape
+
+    def level(self, n):
+        """The dataset holding the image at 1/2**n resolution"""
+        return self.group["level_{0}".format(n)]
+
+    def read(self, start=(0, 0), stop=None, level=0):
+        """Return the region between `start` and `stop` (in full resolution pixels) at a given resolution level."""
+        if stop is None:
+            stop = self.shape[:2]
+        factor = 2**level
+        start = np.array(start) // factor
+        stop = -(-np.array(stop) // factor)
+        return self.level(level)[start[0]:stop[0], start[1]:stop[1], ...]
+
+    def add_tile(self, tile, position):
+        """Blend a tile into the mosaic, with its [0,0] pixel at `position` (rounded to the nearest pixel)."""
+        tile = np.asarray(tile)
+        position = np.round(np.array(position)).astype(int)
+        start = np.maximum(position, 0)
+        stop = np.minimum(position + tile.shape[:2], self.shape[:2])
+        if np.any(stop <= start):
+            return
+        tile = tile[start[0] - position[0]:stop[0] - position[0], start[1] - position[1]:stop[1] - position[1], ...]
+        weights = feather_weights(tile.shape, self.feather)
+        region = (slice(start[0], stop[0]), slice(start[1], stop[1]))
+        # keep a running weighted mean, so each pixel is blended from all the tiles that cover it
+        old_weights = self.group["weight"][region]
+        total = old_weights + weights
+        image = self.level(0)[region].astype(np.float32)
+        if tile.ndim == 3:
+            blended = (image * old_weights[..., np.newaxis] + tile * weights[..., np.newaxis]) / total[..., np.newaxis]
+        else:
+            blended = (image * old_weights + tile * weights) / total
+        if np.issubdtype(self.level(0).dtype, np.integer):
+            blended = np.round(blended)
+        self.level(0)[region] = blended
+        self.group["weight"][region] = total
+        self._update_pyramid(start, stop)
+
+    def _update_pyramid(self, start, stop):
+        """Recalculate the lower resolution levels in the region that has changed"""
+        for level in range(1, self.levels):
+            # work in pixels of the level above, aligned to 2x2 blocks
+            start = np.array(start) // 2 * 2
+            stop = np.minimum(-(-np.array(stop) // 2) * 2, self.level(level - 1).shape[:2])
+            above = self.level(level - 1)[start[0]:stop[0], start[1]:stop[1], ...].astype(np.float32)
+            if np.any(np.array(above.shape[:2]) % 2):
+                # at the edge of an odd-sized image, repeat the last row/column
+                pad = [(0, n % 2) for n in above.shape[:2]] + [(0, 0)] * (above.ndim - 2)
+                above = np.pad(above, pad, mode="edge")
+            h, w = above.shape[0] // 2, above.shape[1] // 2
+            small = above.reshape((h, 2, w, 2) + above.shape[2:]).mean(axis=(1, 3))
+            if np.issubdtype(self.level(level).dtype, np.integer):
+                small = np.round(small)
+            start, stop = start // 2, start // 2 + np.array([h, w])
+            self.level(level)[start[0]:stop[0], start[1]:stop[1], ...] = small
+
+
+class TileStitcher(object):
+    """Save, register and blend tiles into a `PyramidMosaic` in the background, as they are acquired.
+
+    group : h5py.Group
+        Tiles are saved in this group as "tile_%d", and the mosaic is created in a sub-group called "mosaic".
+    tile_shape : tuple
+        The shape of each tile, e.g. (height, width, 3).
+    nominal_positions : dict
+        The position (of the [0,0] pixel) where we expect each tile to be, in pixels, keyed by its grid index
+        (a tuple, whose last element is the row of the scan).  Tiles with adjacent grid indices are assumed to
+        overlap.
+    margin : int (optional)
+        The largest error in the nominal positions that registration will correct; the mosaic is made this much
+        bigger on each side.
+    register : bool (optional)
+        If False, tiles are placed at their nominal positions.
+    build_mosaic : bool (optional)
+        If False, tiles are only saved (still in the background).
+    min_peak_height : float (optional)
+        The lowest correlation peak (see `register_tile`) that's accepted as a match.
+    Other keyword arguments are passed to `PyramidMosaic`.
+
+    Call `add_tile` for each tile (it returns immediately), then `finish` to wait for them all to be processed.
+    """
+    def __init__(self, group, tile_shape, nominal_positions, margin=50, register=True, build_mosaic=True,
+                 min_peak_height=10.0, dtype=np.uint8, **kwargs):
+        self.group = group
+        self.margin = int(margin)
+        self.register = register and build_mosaic
+        self.build_mosaic = build_mosaic
+        self.min_peak_height = min_peak_height
+        self.tile_shape = tuple(tile_shape)
+        nominal = np.array(list(nominal_positions.values()), dtype=np.float)
+        self.origin = nominal.min(axis=0) - self.margin # nominal position of pixel [0,0] of the mosaic
+        shape = tuple((np.ceil(nominal.max(axis=0) - self.origin) + np.array(tile_shape[:2]) + self.margin)
+                      .astype(int)) + self.tile_shape[2:]
+        self.nominal_positions = dict((tuple(k), np.array(v, dtype=np.float) - self.origin)
+                                      for k, v in nominal_positions.items())
+        if build_mosaic:
+            self.mosaic = PyramidMosaic(group.require_group("mosaic"), shape, dtype=dtype, **kwargs)
+        self.positions = {} # registered positions of each tile in the mosaic, keyed by grid index
+        self.peak_heights = {}
+        self._recent_tiles = {} # tiles that may still be needed as neighbours, keyed by grid index
+        self._pool = ThreadPool(processes=1)
+        self._pending = []
+
+    def add_tile(self, tile, grid_index, attrs=None):
+        """Queue a tile to be saved, registered and blended into the mosaic (in the order tiles are added)."""
+        self._pending.append(self._pool.apply_async(self._process_tile, (tile, tuple(grid_index), attrs)))
+        # raise any errors from tiles that have finished, rather than waiting until the end
+        while len(self._pending) > 0 and self._pending[0].ready():
+            self._pending.pop(0).get()
+
+    def finish(self):
+        """Wait for all the tiles to be processed, and return their positions in the mosaic."""
+        try:
+            for result in self._pending:
+                result.get()
+        finally:
+            self._pending = []
+            self._pool.close()
+            self._pool.join()
+            self._recent_tiles = {}
+        if self.build_mosaic:
+            self.group["mosaic"].attrs["origin"] = self.origin
+        return self.positions
+
+    def _neighbours(self, grid_index):
+        """Grid indices of the tiles next to this one that have already been placed"""
+        neighbours = []
+        for axis in range(len(grid_index)):
+            for step in (-1, 1):
+                index = list(grid_index)
+                index[axis] += step
+                if tuple(index) in self._recent_tiles:
+                    neighbours.append(tuple(index))
+        return neighbours
+
+    def locate_tile(self, tile, grid_index):
+        """Estimate a tile's position in the mosaic, from its neighbours (or its nominal position)."""
+        nominal = self.nominal_positions[grid_index]
+        estimates = []
+        weights = []
+        if self.register:
+            for index in self._neighbours(grid_index):
+                offset, peak_height = register_tile(tile, self._recent_tiles[index],
+                                                    nominal - self.nominal_positions[index],
+                                                    margin=self.margin, min_peak_height=self.min_peak_height)
+                if offset is not None:
+                    estimates.append(self.positions[index] + offset)
+                    weights.append(peak_height)
+        if len(estimates) == 0:
+            return nominal, 0
+        return np.average(estimates, axis=0, weights=weights), max(weights)
+
+    def _process_tile(self, tile, grid_index, attrs):
+        dset = self.group.create_dataset("tile_%d", data=tile, attrs=attrs)
+        if not self.build_mosaic:
+            return
+        position, peak_height = self.locate_tile(tile, grid_index)
+        dset.attrs["grid_index"] = grid_index
+        dset.attrs["mosaic_position"] = position
+        self.positions[grid_index] = position
+        self.peak_heights[grid_index] = peak_height
+        self.mosaic.add_tile(tile, position)
+        self._recent_tiles[grid_index] = np.asarray(tile)
+        self._forget_old_tiles(grid_index)
+
+    def _forget_old_tiles(self, grid_index):
+        """Drop tiles that are more than one row behind this one, as they won't be neighbours of any new tiles"""
+        for index in list(self._recent_tiles.keys()):
+            if abs(index[-1] - grid_index[-1]) > 1:
+                del self._recent_tiles[index]
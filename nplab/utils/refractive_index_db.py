@@ -1,31 +1,42 @@
-import requests
-import yaml
 import os, inspect
 import numpy as np
 
+'''
+Refractive indices from the refractiveindex.info database.
 
+Datasets are downloaded once and kept in a local cache (a compressed numpy .npz file, by
+default in ~/.nplab), so later lookups work offline. The cache can also be filled in advance,
+either by downloading every dataset listed in the bundled library (populate_cache) or from a
+local copy of the database (import_dump).
+'''
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".nplab", "refractive_index_cache.npz")
 
 class RefractiveIndexInfoDatabase(object):
 
-	def __init__(self):
-		#load library:
-		dirpath =  os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
-		library_path = os.path.normpath(dirpath+"/refractive_index_db_lib.yml")
-		#print library_path
-		with open(library_path,"r") as file:
-			library = yaml.load(file.read())
+	def __init__(self, cache_path=DEFAULT_CACHE_PATH, offline=False):
+		'''
+		:param cache_path - file the parsed datasets are cached in (None for no file cache)
+		:param offline - if True, only cached datasets can be used
+		'''
+		self.cache_path = cache_path
+		self.offline = offline
+		self._datasets = None #label: {"wavelength": array (um), "n": array}, loaded from the cache when first needed
+		self._library_labels = None
+
+	@property
+	def library_labels(self):
+		'''All dataset labels listed in the bundled library file (loaded when first used)'''
+		if self._library_labels is None:
+			dirpath =  os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+			library_path = os.path.normpath(dirpath+"/refractive_index_db_lib.yml")
+			import yaml #only needed when reading datasets, and slow to import
+			with open(library_path,"r") as file:
+				library = yaml.safe_load(file.read())
 			#loading library file from online location:
 			# library_url = "https://raw.githubusercontent.com/imanyakin/refractiveindex.info-database/master/database/library.yml"
-			# response = requests.get(library_url)
-			# library = yaml.load(response._content)
-			cls = self.__class__
-			data = cls.get_data(library)
-			data_dict = cls.make_dict(data)
-
-			#self test on start
-			cls.test_converse_reversibility(data)
-			dataset = cls.fetch_dataset_yaml(data[0])
-#			print cls.extract_refractive_indices(dataset)
+			self._library_labels = self.__class__.get_data(library)
+		return self._library_labels
 
 	@classmethod
 	def get_data(cls,it):
@@ -126,11 +137,13 @@ class RefractiveIndexInfoDatabase(object):
 		Gets, via HTTP, the yaml file containg hte dataset from the website
 		Returns a yaml structured list (yaml is superset of JSON)
 		'''
+		import requests, yaml #only needed when downloading
 		query_base_url = "https://refractiveindex.info/database/data/{0}"
 		url = query_base_url.format(label)
 		resp =  requests.get(url)
+		resp.raise_for_status()
 
-		response_yaml = yaml.load(resp._content)
+		response_yaml = yaml.safe_load(resp.content)
 		return response_yaml
 
 	@classmethod
@@ -155,16 +168,108 @@ class RefractiveIndexInfoDatabase(object):
 					print "failed on: ({})".format(d)
 		return {"wavelength":wavelengths, "n": refractive_index}
 
-	@classmethod
-	def refractive_index_generator(cls,label):
+	#------ Local cache ------
+
+	@property
+	def datasets(self):
+		if self._datasets is None:
+			self._datasets = self.load_cache(self.cache_path)
+		return self._datasets
+
+	@staticmethod
+	def load_cache(cache_path):
+		'''Reads all datasets from a cache file written by save_cache'''
+		datasets = dict()
+		if cache_path is not None and os.path.exists(cache_path):
+			with np.load(cache_path) as cache:
+				for key in cache.files:
+					label, name = key.rsplit("::",1)
+					datasets.setdefault(label, dict())[name] = cache[key]
+		return datasets
+
+	def save_cache(self):
+		'''Writes all datasets held in memory to the cache file'''
+		if self.cache_path is None:
+			return
+		directory = os.path.dirname(self.cache_path)
+		if directory != "" and not os.path.exists(directory):
+			os.makedirs(directory)
+		arrays = dict()
+		for label, dataset in self.datasets.items():
+			for name in ["wavelength", "n"]:
+				arrays[label+"::"+name] = np.asarray(dataset[name])
+		temporary_path = self.cache_path+".tmp.npz"
+		np.savez_compressed(temporary_path, **arrays)
+		if os.path.exists(self.cache_path):
+			os.remove(self.cache_path) #os.rename can't replace files on Windows
+		os.rename(temporary_path, self.cache_path)
+
+	def add_dataset(self, label, response_yaml, save=True):
+		'''Parses a dataset yaml (as on refractiveindex.info) and adds it to the cache'''
+		dataset = self.__class__.extract_refractive_indices(response_yaml)
+		self.datasets[label] = {"wavelength": np.asarray(dataset["wavelength"],dtype=float),
+								"n": np.asarray(dataset["n"])}
+		if save:
+			self.save_cache()
+		return self.datasets[label]
+
+	def get_dataset(self, label):
+		'''
+		Returns {"wavelength": array (in um), "n": array} for a dataset, from the cache if
+		possible, otherwise downloaded (and cached)
+		'''
+		if label not in self.datasets:
+			if self.offline:
+				raise KeyError("Dataset {0} is not in the refractive index cache ({1})".format(label,self.cache_path))
+			self.add_dataset(label, self.__class__.fetch_dataset_yaml(label))
+		return self.datasets[label]
+
+	def populate_cache(self, labels=None):
+		'''Downloads datasets (by default every one in the bundled library) into the cache'''
+		if labels is None:
+			labels = self.library_labels
+		failed = []
+		for label in labels:
+			if label not in self.datasets:
+				try:
+					self.add_dataset(label, self.__class__.fetch_dataset_yaml(label), save=False)
+				except Exception as e:
+					failed.append(label)
+					print "failed on: ({0}): {1}".format(label,e)
+		self.save_cache()
+		return failed
+
+	def import_dump(self, database_path, labels=None):
+		'''
+		Fills the cache from a local copy of the refractiveindex.info database, i.e. a folder
+		containing data/<label> yaml files, such as the unzipped database download. By default
+		every dataset in the bundled library that is present is imported.
+		'''
+		if labels is None:
+			labels = self.library_labels
+		import yaml
+		imported = []
+		for label in labels:
+			path = os.path.join(database_path, "data", *label.split("/"))
+			if os.path.exists(path):
+				with open(path, "r") as file:
+					response_yaml = yaml.safe_load(file.read())
+				try:
+					self.add_dataset(label, response_yaml, save=False)
+					imported.append(label)
+				except (KeyError, IndexError, AttributeError):
+					print "failed on: ({})".format(label) #e.g. formula rather than tabulated datasets
+		self.save_cache()
+		return imported
+
+	def refractive_index_generator(self,label):
 		'''
-		Main method for use. Pulls data from website, transforms it into a dataset
-		Returns function that can be queried.
+		Main method for use. Gets the dataset (from the cache, or from the website the first time)
+		Returns function that can be queried with a wavelength or an array of wavelengths.
 		Function will interpolate between data within a certain range of wavelengths and will crash if required wavelength is outside of this range
 		'''
 
-		dataset_yaml = cls.fetch_dataset_yaml(label)
-		dataset = cls.extract_refractive_indices(dataset_yaml)
+		dataset = self.get_dataset(label)
 
 		wavelengths = dataset["wavelength"]
 		min_wl = 1e-6*np.min(wavelengths) 
@@ -176,14 +281,14 @@ class RefractiveIndexInfoDatabase(object):
 
 			assert(scale=="nm") #scale must be in nm - other values may be supported later if required
 			#Performs linear interpolation between values in dataset to generate refractive indices over wavelength range spanned by dataset
-			if required_wavelength < min_wl:
-				raise ValueError("Required wavelength: {0} below minimum in dataset: {1}".format(required_wavelength,min_wl))
+			if np.any(np.asarray(required_wavelength) < min_wl):
+				raise ValueError("Required wavelength: {0} below minimum in dataset: {1}".format(np.min(required_wavelength),min_wl))
 
-			elif required_wavelength > max_wl:
-				raise ValueError("Required wavelength: {0} above maximum in dataset: {1}".format(required_wavelength,max_wl))
+			elif np.any(np.asarray(required_wavelength) > max_wl):
+				raise ValueError("Required wavelength: {0} above maximum in dataset: {1}".format(np.max(required_wavelength),max_wl))
 
 			else:
-				output_n = np.interp(required_wavelength*1e6,xp=dataset["wavelength"],fp=dataset["n"])
+				output_n = np.interp(np.asarray(required_wavelength)*1e6,xp=dataset["wavelength"],fp=dataset["n"])
 				if debug > 0:
 					print "--- DEBUG Interpolation---"
 					print "Wavelen: {0}, Refractive_index: {1}".format(required_wavelength,output_n)
@@ -201,7 +306,6 @@ if __name__ == "__main__":
 	generator = rfdb.refractive_index_generator(label=label)
 
 	wls = np.linspace(500e-9,800e-9,300)
-	for w in wls:
-		print generator(required_wavelength=w,debug = 1)
+	print generator(required_wavelength=wls,debug = 1)
 
 	print "Passed basic test"
\ No newline at end of file
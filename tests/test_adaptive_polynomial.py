@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.analysis import Adaptive_Polynomial
+
+def test_batch_matches_single_spectra():
+    random = np.random.RandomState(0)
+    x = np.arange(300.)
+    background = 100 + 0.2*x - 0.0005*x**2
+    spectra = np.array([random.poisson(background + 200*np.exp(-(x - c)**2/20.)) for c in [100, 150, 200]], dtype = float)
+    batch = Adaptive_Polynomial.Run_Batch(spectra, 3, Auto_Remove = False)
+    single = np.array([Adaptive_Polynomial.Run(y, 3, Auto_Remove = False) for y in spectra])
+    assert np.allclose(batch, single)
+    assert np.all((spectra - batch)[[0, 1, 2], [100, 150, 200]] > 150)
+
+def test_iterative_step_matches_polyfit():
+    random = np.random.RandomState(1)
+    data = random.poisson(50 + 10*np.sin(np.arange(200)/40.)).astype(float)
+    params = np.polyfit(np.arange(200), data, 4)
+    new_params, background = Adaptive_Polynomial.Iterative_Step(data, params, 4, True)
+    weights = Adaptive_Polynomial.Find_Weights(background, data)
+    expected = np.polyfit(np.arange(200), data, 4, w = weights)
+    assert np.allclose(np.polyval(new_params, np.arange(200)), np.polyval(expected, np.arange(200)))
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+pytest.importorskip("cv2")
+from nplab.instrument.camera.autofocus import (focus_region, coarse_to_fine_search, best_focus_position,
+                                               interpolate_positions, af_merit_squared_laplacian)
+
+def test_coarse_to_fine_finds_peak_outside_grid():
+    calls = []
+    def measure(z):
+        calls.append(len(z))
+        z = np.array(z)
+        return z, np.exp(-(z - 2.37)**2/2.0) + 0.1
+    best, zs, powers = coarse_to_fine_search(measure, np.arange(-3, 4) * 0.5, max_rounds=6)
+    assert abs(best - 2.37) < 0.01
+    assert len(zs) == len(powers) == sum(calls)
+    assert sum(calls) < 30
+
+def test_focus_region_and_merit():
+    random = np.random.RandomState(0)
+    image = random.randint(0, 255, size=(60, 80, 3)).astype(np.uint8)
+    region = focus_region(image, roi=(20, 30), centre=(10, 70), binning=2)
+    assert region.shape == (10, 15) and region.dtype == np.float32
+    assert np.isclose(region[0, 0], image[:2, 50:52].mean(axis=2).sum(), rtol=1e-5)
+    blurred = focus_region(image).copy()
+    blurred[1:-1] = (blurred[:-2] + blurred[1:-1] + blurred[2:])/3
+    assert af_merit_squared_laplacian(focus_region(image)) > af_merit_squared_laplacian(blurred)
+
+def test_sweep_positions_and_best_focus():
+    times = np.linspace(0, 1, 11)
+    positions = interpolate_positions(times, [0, 1], [[0, 0, -2], [0, 0, 2]])
+    assert np.allclose(positions[:, 2], np.linspace(-2, 2, 11))
+    powers = np.exp(-(positions[:, 2] - 0.3)**2)
+    new_position = best_focus_position(positions, powers, [0, 0, 0])
+    assert abs(new_position[2] - 0.3) < 0.1
+    assert np.allclose(best_focus_position(positions, np.ones(11), [0, 0, 0]), 0)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.analysis import Moving_Gradient_BG_Removal, Analyse_Z_Scan
+
+def reference_construct_background(gradient, not_allowed, window, length):
+    # the original point by point implementation
+    average = [[] for i in range(length)]
+    for i in range(len(gradient)):
+        if not not_allowed[i] and not not_allowed[i + window]:
+            for n in range(window + 1):
+                average[n + i].append(gradient[i])
+    if len(average[0]) == 0:
+        average[0] = [0]
+    for i in range(len(average)):
+        if len(average[i]) == 0:
+            average[i] = average[i - 1]
+    return np.concatenate(([0.], np.cumsum([np.median(a) for a in average])[:-1]))
+
+def reference_moving_gradient(signal, window = 50, maximum_iterations = 10, peak_tolerance = 0.5):
+    gradient = [float(signal[n] - signal[n - window])/window for n in range(window, len(signal))]
+    not_allowed = [False]*len(signal)
+    clean = signal - reference_construct_background(gradient, not_allowed, window, len(signal))
+    clean -= np.median(clean)
+    point_run = 0
+    while 100.*((1./6)**point_run) > peak_tolerance:
+        point_run += 1
+    for iteration in range(maximum_iterations):
+        regions, run = [], []
+        threshold = np.median(np.abs(clean))
+        for i in range(len(signal)):
+            if clean[i] >= threshold:
+                run.append(i)
+            else:
+                if len(run) >= point_run:
+                    regions += run
+                run = []
+        if len(run) >= point_run:
+            regions += run
+        new_not_allowed = [i in regions for i in range(len(signal))]
+        if new_not_allowed == not_allowed:
+            break
+        not_allowed = new_not_allowed
+        clean = signal - reference_construct_background(gradient, not_allowed, window, len(signal))
+        clean -= np.median(clean)
+    return clean
+
+def reference_z_scan(z_scan, threshold = 0.2):
+    thresholded = np.nan_to_num(z_scan).astype(np.float64)
+    thresholded = (thresholded - thresholded.min(axis = 0))/(thresholded.max(axis = 0) - thresholded.min(axis = 0))
+    thresholded -= threshold
+    thresholded *= (thresholded > 0)
+    positions = np.arange(z_scan.shape[0])[:, np.newaxis]*np.ones(z_scan.shape[1])
+    centroids = np.nan_to_num(np.sum(thresholded*positions, axis = 0)/np.sum(thresholded, axis = 0))
+    output = []
+    for n, centroid in enumerate(centroids):
+        lower = int(centroid)
+        upper, frac = lower + 1, centroid - lower
+        if upper == z_scan.shape[0]:
+            upper, frac = lower, 0
+        output.append(z_scan[lower, n] + (z_scan[upper, n] - z_scan[lower, n])*frac)
+    return np.array(output)
+
+def test_construct_background_matches_reference():
+    random = np.random.RandomState(0)
+    gradient = random.normal(size = 40)
+    for not_allowed in [random.rand(50) > 0.7, np.ones(50, dtype = bool)]:
+        expected = reference_construct_background(gradient, not_allowed, 10, 50)
+        assert np.allclose(Moving_Gradient_BG_Removal.Construct_Background(gradient, not_allowed, 10, 50), expected)
+
+def test_moving_gradient_matches_reference():
+    random = np.random.RandomState(1)
+    x = np.arange(300.)
+    signals = np.array([500 - 0.5*x + 0.001*x**2 + 300*np.exp(-(x - c)**2/20.) + random.normal(0, 3, len(x))
+                        for c in [80, 150, 220]])
+    for window in [2, 30]:
+        expected = np.array([reference_moving_gradient(s, window) for s in signals])
+        assert np.allclose(Moving_Gradient_BG_Removal.Run_Batch(signals, window), expected)
+        assert np.allclose(Moving_Gradient_BG_Removal.Run(signals[0], window), expected[0])
+
+def test_z_scan_matches_reference():
+    random = np.random.RandomState(2)
+    z_scans = random.rand(4, 15, 60)
+    z_scans[0, :, 3] = 1.
+    expected = np.array([reference_z_scan(z) for z in z_scans])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        assert np.allclose(Analyse_Z_Scan.Run(z_scans), expected)
+        assert np.allclose(Analyse_Z_Scan.Run(z_scans[1]), expected[1])
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.analysis.baseline import baseline_als, baseline_als_batch, difference_penalty_band
+
+def dense_baseline_als(y, lambd, p, iterations = 10):
+    L = y.size
+    D = np.diff(np.eye(L), 2)
+    w = np.ones(L)
+    for i in range(iterations):
+        z = np.linalg.solve(np.diag(w) + lambd * D.dot(D.T), w*y)
+        w = p * (y > z) + (1-p) * (y < z)
+    return z
+
+def test_penalty_band():
+    L = 7
+    D = np.diff(np.eye(L), 2)
+    P = D.dot(D.T)
+    band = difference_penalty_band(L)
+    assert np.allclose(band[2], np.diag(P))
+    assert np.allclose(band[1, 1:], np.diag(P, 1))
+    assert np.allclose(band[0, 2:], np.diag(P, 2))
+
+def test_baseline_matches_dense():
+    x = np.linspace(0, 1, 200)
+    spectra = np.array([np.exp(-(x - c)**2/0.002) + x**2 for c in [0.3, 0.5, 0.7]])
+    expected = np.array([dense_baseline_als(y, 1e4, 1e-2) for y in spectra])
+    assert np.allclose(baseline_als_batch(spectra, 1e4, 1e-2), expected)
+    assert np.allclose(baseline_als(spectra[1], 1e4, 1e-2), expected[1])
@@ -0,0 +1,50 @@
+import os
+import h5py
+import numpy as np
+from nplab.analysis import Condense_DF_Spectra as cdf
+
+def write_measurement(path, particles, created, missing=(), mtime=None):
+    random = np.random.RandomState(0)
+    with h5py.File(path, 'a') as f:
+        f.require_group('nplab_log').attrs['creation_timestamp'] = created
+        scan = f.require_group('ParticleScannerScan_0')
+        for i in particles:
+            group = scan.require_group('Particle_%s' % i)
+            if i not in missing:
+                dset = group.create_dataset('alinger.z_scan_0', data=random.rand(20, 600) + i)
+                dset.attrs['background'] = np.zeros(600)
+                dset.attrs['reference'] = np.ones(600)
+                dset.attrs['wavelengths'] = np.linspace(400, 900, 600)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def read_summary(path):
+    with h5py.File(path, 'r') as f:
+        scan = f['particleScanSummaries/scan0']
+        skipped = list(scan['skippedGroups'][()])
+        return list(scan['particleGroups'][()]), scan['spectra'][()], skipped
+
+def test_incremental_condensing(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    measurement = str(tmpdir.join('2019-01-01_measurement.h5'))
+    write_measurement(measurement, range(20), '2019-01-01T10:00:00', missing=[3], mtime=1000)
+    summary = cdf.extractAllSpectra(str(tmpdir), processes=2, chunkSize=6)
+    names, spectra, skipped = read_summary(summary)
+    assert names == ['Particle_%s' % i for i in range(20) if i != 3] and skipped == ['Particle_3']
+    numbers = np.array([int(name.split('_')[-1]) for name in names])
+    assert np.all((spectra >= numbers[:, np.newaxis]) & (spectra <= numbers[:, np.newaxis] + 1))  # each spectrum in its place
+
+    write_measurement(measurement, range(20, 25), '2019-01-01T10:00:00', missing=[22], mtime=2000)
+    assert cdf.extractAllSpectra(str(tmpdir), processes=1, incremental=True) == summary
+    names, spectra, skipped = read_summary(summary)
+    assert names == ['Particle_%s' % i for i in range(25) if i not in (3, 22)]
+    assert skipped == ['Particle_3', 'Particle_22'] and len(spectra) == len(names)
+
+    # a newer measurement that reuses the scan name must not be appended to the old summary
+    other = str(tmpdir.join('2019-01-02_measurement.h5'))
+    write_measurement(other, range(16), '2019-01-02T10:00:00', mtime=3000)
+    os.utime(summary, (2500, 2500))
+    new_summary = cdf.extractAllSpectra(str(tmpdir), processes=1, incremental=True)
+    assert new_summary != summary
+    assert read_summary(new_summary)[0] == ['Particle_%s' % i for i in range(16)]
+    assert len(read_summary(summary)[0]) == 23
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+pytest.importorskip("matplotlib")
+from nplab.experiment.dynamic_light_scattering import dls_signal_postprocessing as dls
+
+def loop_binning(thresholded, width):
+    n = int(np.ceil(len(thresholded)/float(width)))
+    return np.array([np.sum(np.absolute(thresholded[i*width:(i+1)*width])) for i in range(n)])
+
+def symmetric_g2(x, lag):
+    direct, delayed = x[lag:], x[:-lag]
+    return np.dot(direct, delayed)*len(direct)/(direct.sum()*delayed.sum())
+
+def test_binning():
+    pulses = np.random.RandomState(0).randint(-1, 2, size=1003)
+    for width in (1, 7, 17, 1003, 2000):
+        assert np.array_equal(dls.binning(pulses, width), loop_binning(pulses, width))
+
+def test_multi_tau_matches_direct_correlation():
+    random = np.random.RandomState(1)
+    counts = random.poisson(np.repeat(random.exponential(3, size=2500), 4)).astype(float)
+    correlator = dls.MultiTauCorrelator(dt=1e-6, channels=8, levels=4)
+    start = 0
+    while start < len(counts):
+        stop = start + random.randint(1, 700)
+        correlator.add(counts[start:stop])
+        start = stop
+    times, g2 = correlator.correlation()
+    assert np.allclose(times[:7]/1e-6, np.arange(1, 8))
+    assert np.allclose(g2[:7], [symmetric_g2(counts, lag) for lag in range(1, 8)])
+    pairs = counts.reshape(-1, 2).sum(axis=1)
+    assert np.allclose(times[7:11]/1e-6, 2*np.arange(4, 8))
+    assert np.allclose(g2[7:11], [symmetric_g2(pairs, lag) for lag in range(4, 8)])
+    assert g2[0] > 1.2 and abs(g2[-1] - 1) < 0.1
+
+def test_streaming_counts_match_whole_trace():
+    random = np.random.RandomState(2)
+    voltages = (random.rand(20000) < 0.05).astype(float)
+    voltages = np.repeat(voltages, 3) + random.normal(0, 0.05, 60000)
+    whole = dls.binning(np.absolute(dls.signal_diff(voltages)).astype(int), 50)
+    stream = dls.StreamingAutocorrelation(dt=1e-7, index_bin_width=50, channels=8, levels=3)
+    counts = np.concatenate([stream.add_voltages(block) for block in np.array_split(voltages, 7)])
+    assert np.array_equal(counts, whole[:len(counts)]) and len(counts) == len(whole) - 1
+
+def test_streaming_ignores_noise_before_pulses():
+    random = np.random.RandomState(3)
+    stream = dls.StreamingAutocorrelation(dt=1e-7, index_bin_width=50, channels=8, levels=3)
+    assert len(stream.add_voltages(random.normal(0, 0.01, 10000))) == 0
+    pulses = np.repeat((random.rand(2000) < 0.05).astype(float), 3) + random.normal(0, 0.01, 6000)
+    stream.add_voltages(pulses)
+    assert stream.total_counts == np.sum(np.absolute(np.diff(np.rint(pulses))))
+    fixed = dls.StreamingAutocorrelation(dt=1e-7, index_bin_width=50, threshold=0.5)
+    assert np.sum(fixed.add_voltages(random.normal(0, 0.01, 10000))) == 0
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+pytest.importorskip("cv2")
+from scipy import ndimage
+from nplab.utils.image_with_location import ImageWithLocation, FeatureTracker, locate_feature_in_image
+
+random = np.random.RandomState(0)
+SAMPLE = ndimage.gaussian_filter(random.rand(700, 800), 2)
+SAMPLE = 255*(SAMPLE - SAMPLE.min())/(SAMPLE.max() - SAMPLE.min())
+
+def camera_image(shift, shape = (240, 320)):
+    """An image of the sample, moved by `shift` pixels."""
+    image = ndimage.shift(SAMPLE, shift, order = 3)[200:200 + shape[0], 200:200 + shape[1]]
+    image = ImageWithLocation(np.dstack([image]*3).astype(np.uint8))
+    image.pixel_to_sample_matrix = np.identity(4)
+    return image
+
+def test_tracker_finds_shifted_feature():
+    feature = camera_image((0, 0)).feature_at((120, 160), size = (64, 64))
+    for pyramid_levels in [0, 2]:
+        tracker = FeatureTracker(feature, margin = 40, pyramid_levels = pyramid_levels)
+        for shift in random.uniform(-35, 35, (5, 2)):
+            image = camera_image(shift)
+            position = tracker.locate(image, predicted_position = image.datum_pixel)
+            assert np.all(np.abs(position - (np.array([120, 160]) + shift)) < 0.25)
+            assert np.all(np.abs(position - locate_feature_in_image(image, feature, margin = 40, restrict = True)) < 0.3)
+
+def test_tracker_follows_drift():
+    # each step is small, but the total drift is bigger than the search margin
+    feature = camera_image((0, 0)).feature_at((120, 160), size = (64, 64))
+    tracker = FeatureTracker(feature, margin = 10)
+    for step in range(1, 8):
+        shift = np.array([4.3, -3.1])*step
+        position = tracker.locate(camera_image(shift))
+        assert np.all(np.abs(position - (np.array([120, 160]) + shift)) < 0.25)
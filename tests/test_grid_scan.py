@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+import pytest
+pytest.importorskip("qtpy")
+from nplab.experiment.scanning_experiment.grid_scanner import GridScan, snake_trajectory
+
+
+class RecordingGridScan(GridScan):
+    """A grid scan with no hardware, that records what it does at each point."""
+    pipeline_saving = True
+
+    def __init__(self, shape):
+        super(RecordingGridScan, self).__init__()
+        self.num_axes = len(shape)
+        self.size = 0.1*(np.array(shape[::-1]) - 1)
+        self.step = 0.1*np.ones(len(shape))
+        self.acquired = []
+        self.saved = []
+        self.save_threads = set()
+        self.abort_after = None
+
+    def move(self, position, axis):
+        pass
+
+    def acquire_point(self, *indices):
+        self.acquired.append(indices)
+        if self.abort_after is not None and len(self.acquired) >= self.abort_after:
+            self.abort_requested = True
+        return np.ravel_multi_index(indices, self.grid_shape)
+
+    def save_point(self, data, *indices):
+        self.save_threads.add(threading.current_thread().ident)
+        assert data == np.ravel_multi_index(indices, self.grid_shape)
+        self.saved.append(indices)
+
+    def run_scan(self):
+        self.scan(self.axes, self.size, self.step, self.init)
+
+
+def test_snake_trajectory():
+    for shape, order in [((3, 4), None), ((2, 3, 4), None), ((3, 4), (1, 0)), ((2, 3, 2), (0, 2, 1))]:
+        trajectory = snake_trajectory(shape, order)
+        assert trajectory.shape == (np.prod(shape), len(shape))
+        # every point is visited once, one step along one axis at a time
+        assert len(set(map(tuple, trajectory))) == np.prod(shape)
+        assert np.all(np.abs(np.diff(trajectory, axis=0)).sum(axis=1) == 1)
+        # the outermost axis only ever increases
+        outer = (order or range(len(shape)))[0]
+        assert np.all(np.diff(trajectory[:, outer]) >= 0)
+
+
+@pytest.fixture
+def scan(tmpdir):
+    scan = RecordingGridScan((3, 4))
+    scan.timing_model_file = str(tmpdir.join('scan_timing.h5'))
+    return scan
+
+
+def test_pipelined_scan_saves_every_point_in_order(scan):
+    scan.run_scan()
+    assert scan.acquired == scan.saved == [tuple(point) for point in scan.trajectory]
+    assert len(scan.saved) == 12 and scan.completed.all()
+    assert threading.current_thread().ident not in scan.save_threads
+    assert np.all(np.isfinite(scan.phase_times))
+
+
+def test_aborted_scan_resumes_where_it_stopped(scan):
+    scan.abort_after = 5
+    scan.run_scan()
+    assert scan.completed.sum() == 5 and scan.saved == scan.acquired
+    assert len(scan.trajectory) == len(scan.phase_times) == 5
+    first_run = list(scan.saved)
+    scan.abort_after = None
+    scan.resume()
+    scan.acquisition_thread.join()
+    # the timing model has been trained by now, but the loop order must not change
+    assert scan.saved[:5] == first_run
+    assert scan.saved == [tuple(point) for point in snake_trajectory((3, 4), scan.loop_order)]
+    assert len(scan.trajectory) == 7 and scan.completed.all()
+
+
+@pytest.mark.parametrize("cost_ratio, swapped", [(1.05, False), (3, True)])
+def test_orientation_is_only_swapped_for_a_clear_gain(scan, cost_ratio, swapped):
+    scan.init_grid(scan.axes[::-1], scan.size[::-1], scan.step[::-1], scan.init[::-1])
+    model = scan.load_timing_model(2)
+    for i in range(20):
+        # moving along axis 1, the inner axis of the default snake, is slower
+        model.add_point([1e-7, 0], 1e-3 + 1e4*1e-7, 0, 0)
+        model.add_point([0, 1e-7], 1e-3 + cost_ratio*1e4*1e-7, 0, 0)
+    assert scan.plan_trajectory()[1] == (0, 1)  # not optimised by default
+    scan.optimise_orientation = True
+    assert scan.plan_trajectory()[1] == ((1, 0) if swapped else (0, 1))
@@ -0,0 +1,85 @@
+import warnings
+import numpy as np
+import pytest
+pytest.importorskip("qtpy")
+pytest.importorskip("pyqtgraph")
+import nplab.datafile
+from nplab.utils.gui import get_qt_app
+from nplab.instrument.stage import DummyStage
+from nplab.instrument.spectrometer import DummySpectrometer
+from nplab.experiment.hyperspectral_imaging import HyperspectralScan
+
+
+class LegacyScan(HyperspectralScan):
+    """A scan written before acquire_point and save_point existed."""
+    def scan_function(self, *indices):
+        self.visited.append(indices)
+        super(LegacyScan, self).scan_function(*indices)
+
+
+def make_scan(tmpdir, cls=HyperspectralScan):
+    get_qt_app()
+    datafile = nplab.datafile.set_current(str(tmpdir.join('data.h5')))
+    stage = DummyStage()
+    stage.axis_names = ('x', 'y')
+    spectrometer = DummySpectrometer()
+    spectrometer.integration_time = 1
+    scan = cls()
+    scan.timing_model_file = str(tmpdir.join('scan_timing.h5'))
+    scan.num_axes = 2
+    scan.set_stage(stage)
+    scan.set_spectrometers(spectrometer)
+    scan.size, scan.step = np.array([0.3, 0.2]), np.array([0.1, 0.1])
+    return scan, datafile
+
+
+def run_scan(scan, resume=False):
+    if resume:
+        scan.resume()
+    else:
+        scan.run()
+    scan.acquisition_thread.join()
+
+
+def test_overridden_scan_function_is_still_called(tmpdir):
+    scan, datafile = make_scan(tmpdir, LegacyScan)
+    scan.visited = []
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        run_scan(scan)
+    assert any(issubclass(w.category, DeprecationWarning) for w in caught)
+    assert scan.visited == [tuple(point) for point in scan.trajectory]
+    assert len(scan.visited) == 12
+    image = datafile['hyperspectral_images/scan_0/hs_image'][...]
+    assert image.shape == (3, 4, 800) and np.all(image.sum(axis=-1) > 0)
+    assert scan.data['completed'][...].all()
+
+
+class AbortingScan(HyperspectralScan):
+    abort_after = None
+
+    def acquire_point(self, *indices):
+        if self.abort_after is not None and self._index + 1 >= self.abort_after:
+            self.abort_requested = True
+        return super(AbortingScan, self).acquire_point(*indices)
+
+
+def test_aborted_scan_can_be_resumed(tmpdir):
+    scan, datafile = make_scan(tmpdir, AbortingScan)
+    scan.abort_after = 5
+    run_scan(scan)
+    group = datafile['hyperspectral_images/scan_0']
+    assert group['completed'][...].sum() == 5 and len(group['trajectory']) == 5
+    first_run = group['trajectory'][...]
+
+    # resume from the file, as after restarting the program
+    scan, datafile = make_scan(tmpdir, AbortingScan)
+    run_scan(scan, resume=True)
+    group = datafile['hyperspectral_images/scan_0']
+    assert 'trajectory_0' not in group and 'phase_times_0' not in group
+    trajectory, phase_times = group['trajectory'][...], group['phase_times'][...]
+    assert np.array_equal(trajectory[:5], first_run)
+    assert len(set(map(tuple, trajectory))) == len(trajectory) == len(phase_times) == 12
+    assert np.all(np.abs(np.diff(trajectory, axis=0)).sum(axis=1) == 1)  # still one snake
+    assert group['completed'][...].all()
+    assert np.all(group['hs_image'][...].sum(axis=-1) > 0)
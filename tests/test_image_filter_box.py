@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+cv2 = pytest.importorskip("cv2")
+from nplab.utils.image_filter_box import ParticleDetector, ParticleDetectionWorker
+
+def particle_image(random, n_particles = 20, shape = (512, 640), radius = 4):
+    image = random.randint(0, 30, shape + (3,)).astype(np.uint8)
+    centres = []
+    for i in range(n_particles):
+        row, column = random.randint(20, shape[0] - 20), random.randint(20, shape[1] - 20)
+        if all(np.hypot(row - r, column - c) > 30 for r, c in centres):
+            centres.append((row, column))
+            cv2.circle(image, (column, row), radius, (200, 200, 200), -1)
+    return image, np.array(centres)
+
+def test_detector_finds_particles():
+    random = np.random.RandomState(0)
+    image, centres = particle_image(random)
+    cv2.circle(image, (30, 30), 20, (200, 200, 200), -1) # too big to be a particle
+    detector = ParticleDetector(bin_fac = 4)
+    found, radii = detector.detect(image)
+    assert len(found) == len(centres)
+    distances = np.sqrt(((centres[:, np.newaxis, :] - found[np.newaxis, :, :])**2).sum(axis = -1))
+    assert np.all(distances.min(axis = 1) < 2)
+    assert np.all((radii >= 2) & (radii <= 6))
+    mask = detector.binned_mask()
+    assert mask.shape == (128, 160) and mask[30//4, 30//4] == 0
+    # the working images are reused for the next frame
+    summed = detector._summed
+    detector.detect(particle_image(random)[0])
+    assert detector._summed is summed
+
+def test_worker_processes_latest_frame():
+    random = np.random.RandomState(1)
+    results = []
+    worker = ParticleDetectionWorker(ParticleDetector(), callbacks = [results.append])
+    try:
+        for i in range(5):
+            image, centres = particle_image(random)
+            worker.submit(image)
+        assert worker.wait_until_idle(timeout = 10)
+        assert worker.latest_result['frame_number'] == 5
+        assert len(worker.latest_result['centers']) == len(centres)
+        assert 1 <= len(results) <= 5
+    finally:
+        worker.stop()
@@ -0,0 +1,39 @@
+import numpy as np
+from nplab.techniques.image_moments import find_centroid, find_centroids, measure_fwhms, measure_fwhm
+
+def reference_centroid(img, x, y, threshold=None):
+    # the original, one-image-at-a-time implementation of find_centroid
+    img = img.copy()
+    bkgd = np.concatenate((img[0, :], img[-1, :], img[:, 0], img[:, -1])).max()
+    img *= (img - bkgd >= 0)
+    if threshold is not None:
+        threshold = threshold*img.max() + (1 - threshold)*img.min()
+        img *= (img >= threshold)
+    m00 = np.sum(img)
+    return np.sum(x.reshape(1, -1)*img)/m00, np.sum(y.reshape(-1, 1)*img)/m00
+
+def gaussian_stack(n, sigma, noise, seed=0):
+    random = np.random.RandomState(seed)
+    x = np.arange(80.)
+    y = np.arange(60.)
+    centres = random.uniform(20, 40, size=(n, 2))
+    imgs = np.exp(-(x[np.newaxis, np.newaxis, :] - centres[:, 0, np.newaxis, np.newaxis])**2/(2*sigma[0]**2) -
+                  (y[np.newaxis, :, np.newaxis] - centres[:, 1, np.newaxis, np.newaxis])**2/(2*sigma[1]**2))
+    return 100*imgs + 5 + noise*random.normal(size=imgs.shape), x, y
+
+def test_centroids_match_single_images():
+    imgs, x, y = gaussian_stack(10, (4, 6), 1.0)
+    for threshold in (None, 0.3):
+        cx, cy = find_centroids(imgs, x, y, threshold)
+        for n in range(len(imgs)):
+            assert np.allclose((cx[n], cy[n]), reference_centroid(imgs[n], x, y, threshold))
+            assert np.allclose(find_centroid(imgs[n], x, y, threshold), (cx[n], cy[n]))
+
+def test_fwhms():
+    imgs, x, y = gaussian_stack(10, (4, 6), 0.2)
+    expected = 2*np.sqrt(2*np.log(2))*np.array([4, 6])
+    fwhm_x, fwhm_y = measure_fwhms(imgs, x, y)
+    assert np.allclose(fwhm_x, expected[0], rtol=0.02) and np.allclose(fwhm_y, expected[1], rtol=0.02)
+    fwhm_x, fwhm_y, params_x, params_y = measure_fwhms(imgs, x, y, refine=True, return_params=True)
+    assert np.allclose(fwhm_x, expected[0], rtol=0.01) and np.allclose(fwhm_y, expected[1], rtol=0.01)
+    assert np.allclose(measure_fwhm(imgs[0], x, y), (fwhm_x[0], fwhm_y[0]), rtol=1e-3)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import sys
+import types
+from nplab.utils.import_benchmark import run_benchmark, IMPORT_TIME_BUDGETS
+from nplab.utils.lazy_import import lazy_attributes, LazyModule
+
+def test_headless_modules_do_not_import_gui():
+    results = run_benchmark(budgets = dict((m, None) for m in IMPORT_TIME_BUDGETS), repeats = 1)
+    for result in results:
+        assert result["gui_modules"] == [], result["module"]
+
+def test_lazy_attributes():
+    module = types.ModuleType("nplab_lazy_test")
+    exec("def f():\n    return 'f'", module.__dict__)
+    sys.modules["nplab_lazy_test"] = module
+    try:
+        lazy = lazy_attributes("nplab_lazy_test", {"OrderedDict": "collections"})
+        import nplab_lazy_test
+        assert isinstance(nplab_lazy_test, LazyModule) and nplab_lazy_test is lazy
+        assert nplab_lazy_test.f() == 'f'
+        from nplab_lazy_test import OrderedDict
+        from collections import OrderedDict as original
+        assert OrderedDict is original
+        assert "OrderedDict" in dir(nplab_lazy_test)
+        try:
+            nplab_lazy_test.missing
+            assert False, "missing attributes should raise AttributeError"
+        except AttributeError:
+            pass
+    finally:
+        del sys.modules["nplab_lazy_test"]
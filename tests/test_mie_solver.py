@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.modelling.mie_solver import mie_coefficients, mie_efficiencies, mie_cross_sections, mie_amplitudes
+
+# (m, x, Qext, Qsca, S1 at mu = 1, 0.5, -1) from the scalar functions in nplab.modelling.mie
+REFERENCE = [
+    (1.5+0.01j, 0.5, 0.025865180905990142, 0.014559923037315904,
+     [0.0016165738-0.0390536411j, 0.0015922151-0.037949822j, 0.0015218521-0.0347603138j]),
+    (0.3+3j, 2.0, 3.7655589815549493, 3.3985287509198043,
+     [3.7655589815-0.7291429901j, 2.2472888056-0.8998037257j, -1.3840463572-0.7771344925j]),
+    (1.33+0j, 10.0, 2.2065487101846135, 2.2065487101846135,
+     [55.1637177546+23.0418857533j, -6.0423940954-1.2762717816j, 0.9600106991+3.6204785869j]),
+    (0.2+4j, 5.5, 2.86911354118706, 2.762806986579022,
+     [21.6976711552-3.1195726192j, -3.3852422044+1.7661752782j, -3.2941265324+0.271144075j]),
+]
+
+def test_efficiencies_match_scalar_results():
+    m = np.array([r[0] for r in REFERENCE])
+    x = np.array([r[1] for r in REFERENCE])
+    qext, qsca, qabs = mie_efficiencies(m, x)
+    assert np.allclose(qext, [r[2] for r in REFERENCE], rtol = 1e-10)
+    assert np.allclose(qsca, [r[3] for r in REFERENCE], rtol = 1e-10)
+    assert np.allclose(qabs, qext - qsca)
+
+def test_amplitudes_match_scalar_results():
+    for m, x, qext, qsca, S1 in REFERENCE:
+        s1, s2 = mie_amplitudes(m, x, [1.0, 0.5, -1.0])
+        assert np.allclose(s1, S1, rtol = 1e-6, atol = 1e-9)
+        assert np.allclose(s1[0], s2[0]) # forward scattering
+        assert np.isclose(s1[0].real, x**2*qext/4) # optical theorem
+
+def test_grid_broadcasting():
+    wavelengths = np.linspace(400e-9, 900e-9, 7)[:, np.newaxis]
+    radii = np.array([10e-9, 50e-9, 100e-9])[np.newaxis, :]
+    x = 1.33*2*np.pi*radii/wavelengths
+    m = (0.3+3j)/1.33
+    ext, sca, absorption = mie_cross_sections(m, x, radii)
+    assert ext.shape == (7, 3)
+    for i in range(7):
+        for j in range(3):
+            qext, qsca, qabs = mie_efficiencies(m, x[i, j])
+            assert np.isclose(sca[i, j], qsca*np.pi*radii[0, j]**2)
+    an, bn = mie_coefficients(m, x)
+    assert an.shape[:2] == (7, 3) and np.all(np.isfinite(an))
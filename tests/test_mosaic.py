@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+import nplab.datafile as df
+from nplab.utils.mosaic import TileStitcher, PyramidMosaic, feather_weights
+
+@pytest.fixture
+def group():
+    f = df.DataFile("mosaic_test.h5", "w", driver="core", backing_store=False)
+    yield f.create_group("tiled_image")
+    f.close()
+
+def test_tiles_are_registered_and_blended(group):
+    random = np.random.RandomState(0)
+    sample = ndimage.gaussian_filter(random.rand(700, 900), 3)
+    sample = ((sample - sample.min())/(sample.max() - sample.min())*255).astype(np.uint8)
+    step = np.array([200, 260])
+    nominal = dict(((i, j), np.array([j, i])*step) for i in range(3) for j in range(2))
+    true = dict((k, v + random.randint(-10, 11, size=2) + 50) for k, v in nominal.items())
+    stitcher = TileStitcher(group, (260, 340), nominal, margin=25)
+    for j in range(2):
+        for i in range(3)[::(-1)**j]:
+            p = true[(i, j)]
+            stitcher.add_tile(sample[p[0]:p[0] + 260, p[1]:p[1] + 340], (i, j))
+    positions = stitcher.finish()
+    origin = true[(0, 0)] - positions[(0, 0)]
+    for k in positions:
+        assert np.allclose(positions[k] + origin, true[k], atol=0.2)
+    assert len([k for k in group.keys() if k.startswith("tile_")]) == 6
+    mosaic = PyramidMosaic(group["mosaic"])
+    corner = np.round(positions[(0, 0)]).astype(int)
+    stitched = mosaic.read(corner, corner + (400, 600)).astype(float)
+    t = true[(0, 0)]
+    assert np.abs(stitched - sample[t[0]:t[0] + 400, t[1]:t[1] + 600]).mean() < 1
+    # each level is a 2x2 downsampled copy of the one above
+    level_1 = mosaic.read(level=1).astype(float)
+    level_0 = mosaic.read().astype(float)
+    assert np.abs(level_1[5, 7] - level_0[10:12, 14:16].mean()) <= 0.5
+    assert mosaic.level(mosaic.levels - 1).shape[0] <= 256
+
+def test_feather_weights():
+    w = feather_weights((10, 20), 4)
+    assert w.shape == (10, 20) and w.max() == 1 and np.isclose(w[0, 0], 1/16.)
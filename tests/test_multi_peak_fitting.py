@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.analysis import Multi_Peak_Fitting as mpf
+
+def test_jacobian_matches_finite_difference():
+    x = np.linspace(0, 100, 300)
+    params = np.array([1., 30., 5., 10., 60., 8., 4.])
+    for shape in ['Lorentzian', 'Gaussian']:
+        jacobian = mpf.Constant_plus_Peaks_Jacobian(x, *params, Shape = shape)
+        step = 1e-6
+        numeric = np.array([(mpf.Constant_plus_Peaks(x, *(params + step*e), Shape = shape) -
+                             mpf.Constant_plus_Peaks(x, *params, Shape = shape))/step for e in np.eye(len(params))]).T
+        assert np.allclose(jacobian, numeric, atol = 1e-4)
+
+def test_initial_heights():
+    x = np.arange(10.)
+    spectra = np.array([[0, 0, 1, 3, 1, 0, 0, 0, 2, 0], [0, 0, 0, 5, 0, 0, 0, 0, 0, 0]], dtype = float)
+    heights = mpf.Initial_Heights(spectra, x, [3, 8], 2)
+    assert np.allclose(heights, [[2, 2], [5, 0]])
+
+def test_fit_array_recovers_peaks():
+    x = np.linspace(0, 100, 400)
+    centres = np.linspace(40, 45, 20)
+    spectra = np.array([2 + mpf.Lorentzian(x, c, 4, 10) + mpf.Lorentzian(x, 70, 6, 5) for c in centres])
+    for warm_start in [True, False]:
+        parameters, errors = mpf.Fit_Array(spectra, x, [41, 69], 5, Warm_Start = warm_start)
+        assert np.allclose(parameters[:, 0], 2)
+        assert np.allclose(parameters[:, 1], centres)
+        assert np.allclose(parameters[:, 4:7], [70, 6, 5])
+
+def test_fit_batch_retries_failed_warm_start(monkeypatch):
+    x = np.linspace(0, 100, 400)
+    spectra = np.array([2 + mpf.Lorentzian(x, c, 4, 10) for c in [40, 41]])
+    initial = np.array([[1., 40, 5, 8], [1., 41, 5, 8]])
+    fit_spectrum = mpf.Fit_Spectrum
+    starts = []
+    def failing_warm_start(x, y, initial_guess, *args, **kwargs):
+        starts.append(np.array(initial_guess))
+        if len(starts) == 2: # the warm start for the second spectrum
+            return [None, None]
+        return fit_spectrum(x, y, initial_guess, *args, **kwargs)
+    monkeypatch.setattr(mpf, 'Fit_Spectrum', failing_warm_start)
+    parameters, errors = mpf.Fit_Batch(spectra, x, initial, mpf.Peak_Bounds(x, 1))
+    assert len(starts) == 3
+    assert np.allclose(starts[2], initial[1])
+    assert np.allclose(parameters[1], [2, 41, 4, 10])
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+import yaml
+from nplab.utils.refractive_index_db import RefractiveIndexInfoDatabase
+
+GOLD = {"DATA": [{"type": "tabulated nk", "data": "0.3 1.5 1.8\n0.5 0.9 1.9\n0.7 0.2 4.0\n"}]}
+WATER = {"DATA": [{"type": "tabulated n", "data": "0.2 1.39\n0.6 1.333\n1.2 1.32\n"}]}
+
+def test_cached_datasets_work_offline(tmpdir):
+    cache_path = str(tmpdir.join("cache.npz"))
+    rfdb = RefractiveIndexInfoDatabase(cache_path = cache_path)
+    rfdb.add_dataset("main/Au/Test.yml", GOLD)
+    offline = RefractiveIndexInfoDatabase(cache_path = cache_path, offline = True)
+    generator = offline.refractive_index_generator("main/Au/Test.yml")
+    wavelengths = np.array([300e-9, 400e-9, 700e-9])
+    assert np.allclose(generator(wavelengths), [1.5+1.8j, 1.2+1.85j, 0.2+4.0j])
+    assert np.isclose(generator(600e-9), 0.55+2.95j)
+    with pytest.raises(ValueError):
+        generator(np.array([400e-9, 800e-9]))
+    with pytest.raises(KeyError):
+        offline.refractive_index_generator("main/Ag/Test.yml")
+
+def test_import_dump(tmpdir):
+    for label, dataset in [("main/Au/Test.yml", GOLD), ("main/H2O/Test.yml", WATER)]:
+        tmpdir.join("data", *label.split("/")).write(yaml.safe_dump(dataset), ensure = True)
+    cache_path = str(tmpdir.join("cache.npz"))
+    rfdb = RefractiveIndexInfoDatabase(cache_path = cache_path)
+    imported = rfdb.import_dump(str(tmpdir), labels = ["main/Au/Test.yml", "main/H2O/Test.yml", "main/Ag/Test.yml"])
+    assert imported == ["main/Au/Test.yml", "main/H2O/Test.yml"]
+    datasets = RefractiveIndexInfoDatabase.load_cache(cache_path)
+    assert sorted(datasets.keys()) == imported
+    assert np.allclose(datasets["main/H2O/Test.yml"]["n"], [1.39, 1.333, 1.32])
@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+import pytest
+pytest.importorskip("qtpy")
+from nplab.experiment.scanning_experiment.scan_timing import ScanTimingModel, TimedScan
+
+
+def trained_model(coefficients, settle=0.01, acquire=0.1, save=0.05, num_points=150, window=200):
+    random = np.random.RandomState(0)
+    model = ScanTimingModel(len(coefficients) - 1, window=window)
+    for i in range(num_points):
+        distances = random.choice([0, 1e-7, 5e-6], size=len(coefficients) - 1)
+        move = coefficients[0] + np.dot(coefficients[1:], distances)
+        model.add_point(distances, move*random.normal(1, 0.01), settle, acquire)
+        model.add_save(save)
+    return model
+
+
+def test_untrained_model():
+    model = ScanTimingModel(2)
+    assert not model.trained and np.isnan(model.throughput())
+    assert np.all(model.move_coefficients() == 0) and model.estimate(np.ones((10, 2))) == 0
+
+
+def test_move_coefficients_are_recovered():
+    model = trained_model([2e-3, 1e3, 4e3])
+    assert np.allclose(model.move_coefficients(), [2e-3, 1e3, 4e3], rtol=0.05)
+    assert model.trained and np.isclose(model.mean_time('acquire'), 0.1)
+
+
+def test_pipelined_saving_overlaps_with_the_next_point():
+    model = trained_model([2e-3, 1e3], save=0.05)
+    distances = np.zeros((10, 1))
+    stage_time = 2e-3 + 0.01 + 0.1
+    assert np.isclose(model.estimate(distances), 10*(stage_time + 0.05), rtol=0.01)
+    assert np.isclose(model.estimate(distances, pipelined=True), 10*stage_time, rtol=0.01)
+    slow_save = trained_model([2e-3, 1e3], save=0.5)
+    assert np.isclose(slow_save.estimate(distances, pipelined=True), 5.)
+    assert model.throughput(pipelined=True) > model.throughput()
+
+
+def test_only_the_window_is_used():
+    model = trained_model([2e-3, 1e3], acquire=1., window=50)
+    for i in range(50):
+        model.add_point([0], 2e-3, 0.01, 0.2)
+    assert np.isclose(model.mean_time('acquire'), 0.2)
+
+
+def test_save_and_load(tmpdir):
+    model = trained_model([2e-3, 1e3, 4e3])
+    with h5py.File(str(tmpdir.join('timing.h5')), 'a') as f:
+        model.save(f.require_group('model'))
+        model.save(f.require_group('model'))  # saving again replaces the data
+        loaded = ScanTimingModel(2)
+        loaded.load(f['model'])
+        assert np.allclose(loaded.move_coefficients(), model.move_coefficients())
+        distances = np.ones((5, 2))*1e-6
+        assert np.isclose(loaded.estimate(distances), model.estimate(distances))
+        other_axes = ScanTimingModel(3)
+        other_axes.load(f['model'])
+        assert not other_axes.trained
+
+
+class SettingsScan(TimedScan):
+    def __init__(self, exposure):
+        super(SettingsScan, self).__init__()
+        self.exposure = exposure
+
+    def timing_settings(self):
+        return dict(exposure=self.exposure)
+
+
+def test_models_are_kept_for_each_setting(tmpdir):
+    timing_file = str(tmpdir.join('timing.h5'))
+    for exposure in (0.1, 1.):
+        scan = SettingsScan(exposure)
+        scan.timing_model_file = timing_file
+        model = scan.load_timing_model(2)
+        assert not model.trained
+        model.add_point([1e-6, 0], 2e-3, 0, exposure)
+        scan.save_timing_model()
+    scan = SettingsScan(0.1)
+    scan.timing_model_file = timing_file
+    assert scan.timing_model_key() == 'SettingsScan/exposure=0.1'
+    assert np.isclose(scan.load_timing_model(2).mean_time('acquire'), 0.1)
+    scan.exposure = 1.
+    assert np.isclose(scan.load_timing_model(2).mean_time('acquire'), 1.)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from scipy.optimize import minimize
+from nplab.analysis.smoothing import convex_smooth, convex_smooth_batch
+
+def difference_matrix(n):
+    return np.eye(n) - np.eye(n, k = -1)
+
+def reference_total_variation(signal, weight):
+    # solves the dual problem: x = signal - D'u/2 with |u| <= weight
+    D = difference_matrix(len(signal))
+    def dual(u):
+        v = D.T.dot(u)/2.
+        return np.sum(v**2) - 2*signal.dot(v), D.dot(v - signal)
+    u = minimize(dual, np.zeros(len(signal)), jac = True, method = 'L-BFGS-B', bounds = [(-weight, weight)]*len(signal),
+                 options = {'ftol': 1e-15, 'gtol': 1e-12, 'maxiter': 10000}).x
+    return signal - D.T.dot(u)/2.
+
+def test_quadratic_matches_dense_solution():
+    random = np.random.RandomState(0)
+    signals = random.normal(size = (3, 50)) + 5
+    D = difference_matrix(50)
+    x, values, statuses = convex_smooth_batch(signals, 10., 'quadratic', normalise = False)
+    for signal, smoothed in zip(signals, x):
+        assert np.allclose(smoothed, np.linalg.solve(np.eye(50) + 10.*D.T.dot(D), signal))
+    assert statuses == ['optimal']*3
+    assert np.allclose(convex_smooth(signals[1], 10.)[0], convex_smooth_batch(signals, 10.)[0][1])
+
+def test_total_variation_matches_dual_solution():
+    random = np.random.RandomState(1)
+    signal = np.repeat([1., 3., 2., 2.5], 10) + random.normal(0, 0.3, 40)
+    for weight in [0.1, 1., 20.]:
+        x, value, status = convex_smooth(signal, weight, 'total_variation', normalise = False)
+        assert np.allclose(x, reference_total_variation(signal, weight), atol = 1e-5)
+        assert np.isclose(value, np.sum((x - signal)**2) + weight*np.sum(np.abs(difference_matrix(40).dot(x))))
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from nplab.techniques.software_lockin import software_lockin, StreamingLockin
+
+def stream(lockin, signal, reference, random):
+    start = 0
+    while start < len(signal):
+        stop = start + random.randint(50, 2000)  # blocks may be shorter than a period
+        lockin.process(signal[start:stop], reference[start:stop])
+        start = stop
+
+@pytest.mark.parametrize("noise", [0.02, 0.05, 0.1])
+@pytest.mark.parametrize("seed", range(5))
+def test_streaming_lockin_tracks_harmonics(seed, noise):
+    random = np.random.RandomState(seed)
+    sample_rate = 10000.
+    t = np.arange(40000)/sample_rate
+    phase = 2*np.pi*37.3*t + 0.4
+    reference = np.sin(phase) + noise*random.normal(size=t.size)
+    signal = 2*np.sin(phase + 0.7) + 0.5*np.sin(2*phase - 1) + 0.3*random.normal(size=t.size)
+    lockin = StreamingLockin(sample_rate, harmonics=[1, 2], time_constant=0.05, filter_order=3,
+                             decimation=50, history=500)
+    stream(lockin, signal, reference, random)
+    assert np.isclose(lockin.reference_frequency, 37.3, rtol=1e-3)
+    assert lockin.t.size == 500 and np.isclose(lockin.t[-1], t[-1])
+    settled = lockin.t > 1.0
+    assert np.allclose(lockin.r[:, settled].mean(axis=1), [2, 0.5], rtol=0.03)
+    assert np.allclose(lockin.theta[:, settled].mean(axis=1), [0.7, -1], atol=0.04)
+    x, y = software_lockin(t, signal, np.sin(phase))  # it needs a clean reference
+    assert np.isclose(x, lockin.x[0, settled].mean(), atol=0.05)
+    assert np.isclose(y, lockin.y[0, settled].mean(), atol=0.05)
+
+def test_streaming_lockin_relocks_when_the_reference_changes():
+    random = np.random.RandomState(0)
+    sample_rate = 10000.
+    t = np.arange(60000)/sample_rate
+    phase = 2*np.pi*np.cumsum(np.where(t < 3, 37.3, 52.1))/sample_rate
+    reference = np.sin(phase) + 0.05*random.normal(size=t.size)
+    lockin = StreamingLockin(sample_rate, time_constant=0.05, decimation=50)
+    stream(lockin, np.sin(phase + 0.7), reference, random)
+    assert np.isclose(lockin.reference_frequency, 52.1, rtol=1e-3)
+    assert np.allclose(lockin.r[0, -20:], 1, rtol=0.02)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+from nplab.analysis import wavelets
+
+def sure_risk(coefs, t):
+    return len(coefs) - 2*np.sum(np.abs(coefs) <= t) + np.sum(np.minimum(np.abs(coefs), t)**2)
+
+def skellam_risk(y, ti, t):
+    return np.sum(np.sign(np.abs(y) - t)*ti) + np.sum(np.minimum(y**2, t**2)) - t*np.sum(np.abs(y) == t)
+
+def test_thresholds_minimise_risk():
+    random = np.random.RandomState(0)
+    for trial in range(50):
+        d = random.randint(2, 50)
+        coefs = np.round(random.normal(size = d), 2)
+        scaling = random.normal(size = d) + 1
+        t_max = np.sqrt(2*np.log(d))
+        grid = np.concatenate((np.linspace(0, t_max, 501), np.abs(coefs)[np.abs(coefs) <= t_max]))
+        t = wavelets.SUREThreshold(coefs)
+        assert sure_risk(coefs, t) <= min(sure_risk(coefs, g) for g in grid) + 1e-9
+        t = wavelets.SkellamThreshold(coefs, scaling)
+        assert skellam_risk(coefs, scaling, t) <= min(skellam_risk(coefs, scaling, g) for g in grid) + 1e-9
+
+def test_batches_match_single_signals():
+    random = np.random.RandomState(1)
+    signals = random.normal(size = (5, 256)) + 3*np.sin(np.linspace(0, 10, 256))
+    counts = random.poisson(20, size = (5, 256)).astype(float)
+    images = random.normal(size = (4, 32, 32))
+    assert np.allclose(wavelets.SUREShrink(signals), [wavelets.SUREShrink(s) for s in signals])
+    assert np.allclose(wavelets.SkellamShrink(counts), [wavelets.SkellamShrink(c) for c in counts])
+    assert np.allclose(wavelets.SUREShrink2D(images), [wavelets.SUREShrink2D(i) for i in images])
+    assert np.allclose(wavelets.denoise_stack(wavelets.SUREShrink, signals, processes = 1, chunk_size = 2),
+                       wavelets.SUREShrink(signals))